@@ -1,6 +1,9 @@
 from flask import Flask
 from flask_cors import CORS
 
+# Instruments the modules shared with the storage trigger
+from . import core_hooks  # noqa: F401
+
 def create_app():
     app = Flask(__name__)
     CORS(app)  # Enable CORS for all routes
@@ -8,5 +11,17 @@ def create_app():
     # Import and register blueprints
     from .routes import chapters_bp
     app.register_blueprint(chapters_bp)
+
+    # Per-request timing and the Prometheus /api/metrics endpoint
+    from . import metrics
+    metrics.init_app(app)
+
+    # Sampled request traces and opt-in profiles (TRACE_SAMPLE_RATE, TRACE_TOKEN)
+    from . import tracing
+    tracing.init_app(app)
+
+    # Fill a new container's vector index from Firestore in the background
+    from . import routes, vector_index
+    vector_index.start_bootstrap(lambda: routes.firestore.client())
     
     return app 
\ No newline at end of file
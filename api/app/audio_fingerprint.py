@@ -0,0 +1,20 @@
+from typing import Optional
+
+import numpy as np
+
+from tiptok_core import audio_fingerprint
+from tiptok_core.audio_fingerprint import (FFMPEG, AUDIO_DEDUP, SAMPLE_RATE, FINGERPRINT_COLLECTION, FingerprintMatch,
+                                           FingerprintIndex, decode_audio, find_peaks, fingerprint, anchors,
+                                           load_fingerprint, load_candidates)
+
+from .write_behind import get_write_behind
+
+
+def save_fingerprint(db, video_path: str, generation: str, duration: float, hashes: np.ndarray, times: np.ndarray):
+    """Queue a video's fingerprint on the process's writer"""
+    audio_fingerprint.save_fingerprint(db, get_write_behind(db), video_path, generation, duration, hashes, times)
+
+
+def find_duplicate(db, source: str, video_path: str, generation: str) -> Optional[FingerprintMatch]:
+    """The earlier upload this upload's audio was cut from, if any"""
+    return audio_fingerprint.find_duplicate(db, get_write_behind(db), source, video_path, generation)
@@ -0,0 +1,143 @@
+import ast
+from typing import Callable, Dict, List, Tuple
+
+# Rough size of one token in English text, for when there is no tokenizer
+# for the model
+CHARS_PER_TOKEN = 4
+# "Block 12: " prefix and newline per block
+BLOCK_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def block_tokens(blocks: List[Dict], count: Callable[[str], int] = estimate_tokens) -> List[int]:
+    return [count(block.get('text', '')) + BLOCK_OVERHEAD_TOKENS for block in blocks]
+
+
+def plan_windows(blocks: List[Dict], max_tokens: int, overlap_tokens: int,
+                 count: Callable[[str], int] = estimate_tokens) -> List[Tuple[int, int]]:
+    """Split blocks into [start, end) windows of at most max_tokens each,
+    as counted by count.
+
+    Consecutive windows share roughly overlap_tokens worth of blocks so a
+    topic change near a window edge is seen with context on both sides.
+    """
+    sizes = block_tokens(blocks, count)
+    windows = []
+    start = 0
+    while start < len(blocks):
+        end, used = start, 0
+        while end < len(blocks) and (end == start or used + sizes[end] <= max_tokens):
+            used += sizes[end]
+            end += 1
+        windows.append((start, end))
+        if end == len(blocks):
+            break
+        # Step back into the window for the overlap, but always make progress
+        next_start, overlap = end, 0
+        while next_start - 1 > start + 1 and overlap + sizes[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap += sizes[next_start]
+        start = next_start
+    return windows
+
+
+def parse_groups(text: str, count: int) -> List[int]:
+    """Chapter start indices from a GPT reply listing groups of block numbers.
+
+    Only where each group starts is trusted, so gaps, overlaps and
+    out-of-order numbers in the reply still give a valid partition.
+    """
+    groups = ast.literal_eval(text.strip())
+    if not isinstance(groups, (list, tuple)):
+        raise ValueError("Expected a list of lists")
+    starts = set()
+    for group in groups:
+        if isinstance(group, int):
+            group = [group]
+        numbers = [number for number in group if isinstance(number, int) and 0 <= number < count]
+        if numbers:
+            starts.add(min(numbers))
+    starts.add(0)
+    return sorted(starts)
+
+
+def groups_from_starts(starts: List[int], count: int) -> List[List[int]]:
+    bounds = sorted(set(starts) | {0}) + [count]
+    return [list(range(bounds[i], bounds[i + 1])) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def reconcile_windows(windows: List[Tuple[int, int]], window_starts: List[List[int]]) -> List[int]:
+    """Merge per-window chapter starts (absolute indices) into one list.
+
+    In each overlap the earlier window is trusted up to a cut point and the
+    later one after it. The cut is a boundary both windows agree on if
+    there is one, otherwise the middle of the overlap, so neither window's
+    view of its ragged edge is used.
+    """
+    starts = set(window_starts[0]) if window_starts else set()
+    for i in range(1, len(windows)):
+        overlap_start, overlap_end = windows[i][0], windows[i - 1][1]
+        previous, current = set(starts), set(window_starts[i])
+        agreed = sorted(
+            boundary for boundary in previous & current
+            if overlap_start <= boundary < overlap_end
+        )
+        if agreed:
+            cut = agreed[len(agreed) // 2]
+        else:
+            cut = (overlap_start + overlap_end) // 2
+        starts = {boundary for boundary in previous if boundary < cut}
+        starts |= {boundary for boundary in current if boundary >= cut}
+    return sorted(starts)
+
+
+def duration_groups(blocks: List[Dict], target_seconds: float) -> List[List[int]]:
+    """Group consecutive blocks into chapters of about target_seconds each.
+
+    The local fallback when GPT grouping fails or runs out of time: no
+    topic awareness, but every block still lands in a chapter.
+    """
+    groups: List[List[int]] = []
+    current: List[int] = []
+    for i, block in enumerate(blocks):
+        current.append(i)
+        if float(block['end']) - float(blocks[current[0]]['start']) >= target_seconds:
+            groups.append(current)
+            current = []
+    if current:
+        if groups and float(blocks[current[-1]]['end']) - float(blocks[current[0]]['start']) < target_seconds / 3:
+            # Fold a short tail into the previous chapter
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    return groups
+
+
+def clip_ranges(chapters: List[Dict], start: float, end: float) -> List[Dict]:
+    """Chapters overlapping [start, end), cut to it and with times counted
+    from start, e.g. to carry chapters over to a trimmed copy of a video"""
+    start, end = float(start), float(end)
+    clipped = []
+    for chapter in chapters:
+        if float(chapter['end']) > start and float(chapter['start']) < end:
+            clipped.append({**chapter,
+                            'start': max(float(chapter['start']), start) - start,
+                            'end': min(float(chapter['end']), end) - start})
+    return clipped
+
+
+def range_groups(blocks: List[Dict], starts: List[float]) -> List[List[int]]:
+    """Group blocks under the last of the sorted range starts at or before
+    each block's start; blocks before the first range go to the first"""
+    groups: List[List[int]] = [[] for _ in starts]
+    if not starts:
+        return groups
+    current = 0
+    for i, block in enumerate(blocks):
+        while current + 1 < len(starts) and float(block['start']) >= starts[current + 1]:
+            current += 1
+        groups[current].append(i)
+    return groups
@@ -0,0 +1,188 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+
+import numpy as np
+
+from .deadlines import call_timeout, carry_deadline
+from .metrics import timed
+from .transcription_backends import local_copy
+from .vector_index import INDEX_DIR
+
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE', 'ffprobe')
+CLIP_WORKERS = int(os.environ.get('CLIP_WORKERS', '4'))
+PROBE_TIMEOUT = 120.0
+CUT_TIMEOUT = 120.0
+
+CLIP_PREFIX = 'clips/'
+KEYFRAME_PREFIX = 'keyframes/'
+KEYFRAME_SUFFIX = '.kf'
+KEYFRAME_CACHE_DIR = os.path.join(INDEX_DIR, 'keyframes')
+# Clips shorter than this after snapping are merged into the one before
+MIN_CLIP_SECONDS = 0.5
+
+
+class KeyframeIndex:
+    """Presentation times of a video's keyframes, and its duration.
+
+    Stream copy can only start a clip on a keyframe, so chapter starts are
+    snapped to the keyframe at or before them.
+    """
+
+    def __init__(self, times: np.ndarray, duration: float):
+        self.times = times
+        self.duration = duration
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def snap(self, t: float) -> float:
+        """The last keyframe at or before t, or the first one"""
+        if not len(self.times):
+            return 0.0
+        i = int(np.searchsorted(self.times, t, side='right')) - 1
+        return float(self.times[max(i, 0)])
+
+    def to_bytes(self) -> bytes:
+        # Duration first, then the times, as little-endian doubles
+        return np.concatenate([[self.duration], self.times]).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'KeyframeIndex':
+        values = np.frombuffer(data, dtype='<f8')
+        return cls(values[1:], float(values[0]) if len(values) else 0.0)
+
+
+@timed('probe_keyframes')
+def probe_keyframes(source: str) -> KeyframeIndex:
+    """Read keyframe times from the video's packet flags; nothing is decoded"""
+    result = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'packet=pts_time,flags:format=duration', '-of', 'json', source],
+                            capture_output=True, timeout=call_timeout(PROBE_TIMEOUT))
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe could not read {source[:100]}: {result.stderr.decode(errors='replace')[-300:]}")
+    data = json.loads(result.stdout)
+    times = [float(packet['pts_time']) for packet in data.get('packets', [])
+             if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')]
+    duration = float(data.get('format', {}).get('duration') or (max(times) if times else 0.0))
+    return KeyframeIndex(np.unique(np.array(times, dtype=np.float64)), duration)
+
+
+def keyframe_path(video_path: str) -> str:
+    """Storage path of a video's keyframe index: the video's path under keyframes/"""
+    return KEYFRAME_PREFIX + video_path.split('/', 1)[-1] + KEYFRAME_SUFFIX
+
+
+def _cache_path(video_path: str, generation: str) -> str:
+    name = video_path.split('/', 1)[-1].replace('/', '_')
+    return os.path.join(KEYFRAME_CACHE_DIR, f"{name}.{generation}{KEYFRAME_SUFFIX}")
+
+
+def load_keyframes(bucket, video_path: str, generation: str, source: str) -> KeyframeIndex:
+    """The keyframe index of this generation of a video, probed once and
+    kept next to the video and in the local index directory"""
+    local = _cache_path(video_path, generation)
+    if os.path.exists(local):
+        with open(local, 'rb') as f:
+            return KeyframeIndex.from_bytes(f.read())
+
+    blob = bucket.get_blob(keyframe_path(video_path))
+    if blob is not None and (blob.metadata or {}).get('videoGeneration') == generation:
+        index = KeyframeIndex.from_bytes(blob.download_as_bytes())
+    else:
+        index = probe_keyframes(source)
+        try:
+            blob = bucket.blob(keyframe_path(video_path))
+            blob.metadata = {'videoGeneration': generation}
+            blob.upload_from_string(index.to_bytes(), content_type='application/octet-stream')
+        except Exception as e:
+            print(f"Error uploading keyframe index for {video_path}: {str(e)}")
+
+    os.makedirs(KEYFRAME_CACHE_DIR, exist_ok=True)
+    partial = f"{local}.{threading.get_ident()}.partial"
+    with open(partial, 'wb') as f:
+        f.write(index.to_bytes())
+    os.replace(partial, local)
+    return index
+
+
+def plan_clips(chapters: List[Dict[str, Any]], keyframes: KeyframeIndex) -> List[Dict[str, Any]]:
+    """Clip ranges for chapters: each starts on the keyframe at or before
+    its chapter and runs to where the next clip starts, so the clips tile
+    the video with no gaps or overlaps"""
+    starts = [keyframes.snap(float(chapter['start'])) for chapter in chapters]
+    last_end = float(chapters[-1]['end']) if chapters else 0.0
+    if keyframes.duration:
+        last_end = min(max(last_end, starts[-1] if starts else 0.0), keyframes.duration)
+    clips: List[Dict[str, Any]] = []
+    for i, chapter in enumerate(chapters):
+        end = starts[i + 1] if i + 1 < len(chapters) else last_end
+        if clips and end - starts[i] < MIN_CLIP_SECONDS:
+            # Snapped onto the same keyframe as the chapter before
+            clips[-1]['end'] = end
+            continue
+        clips.append({
+            'chapter': i,
+            'start': starts[i],
+            'end': end,
+            'chapterStart': float(chapter['start']),
+            'chapterEnd': float(chapter['end']),
+            'summary': chapter.get('summary'),
+        })
+    return [clip for clip in clips if clip['end'] - clip['start'] >= MIN_CLIP_SECONDS]
+
+
+def cut_clip(source: str, start: float, end: float, path: str):
+    """Copy [start, end) of a video into its own MP4 without re-encoding"""
+    result = subprocess.run([FFMPEG, '-nostdin', '-v', 'error', '-y',
+                             '-ss', f'{start:.3f}', '-i', source, '-t', f'{end - start:.3f}',
+                             '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+                             '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', path],
+                            capture_output=True, timeout=call_timeout(CUT_TIMEOUT))
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not cut {start:.1f}-{end:.1f}s: {result.stderr.decode(errors='replace')[-300:]}")
+
+
+def clip_prefix(video_path: str) -> str:
+    """Storage prefix of a video's chapter clips: its path under clips/, without the extension"""
+    return CLIP_PREFIX + os.path.splitext(video_path.split('/', 1)[-1])[0] + '/'
+
+
+@timed('export_chapter_clips')
+def export_chapter_clips(bucket, video_path: str, generation: str, chapters: List[Dict[str, Any]],
+                         source: str) -> List[Dict[str, Any]]:
+    """Cut every chapter of a video into its own clip and upload them.
+
+    The video is downloaded once and the clips are cut from it side by side
+    with stream copy, so an export costs about one read of the file rather
+    than a transcode per chapter.
+    """
+    prefix = clip_prefix(video_path)
+    with local_copy(source) as path, tempfile.TemporaryDirectory(prefix='tiptok-clips-') as workdir:
+        clips = plan_clips(chapters, load_keyframes(bucket, video_path, generation, path))
+
+        def export(clip: Dict[str, Any]) -> Dict[str, Any]:
+            name = f"chapter_{clip['chapter']:03d}.mp4"
+            local = os.path.join(workdir, name)
+            cut_clip(path, clip['start'], clip['end'], local)
+            blob = bucket.blob(prefix + name)
+            blob.metadata = {'videoGeneration': generation}
+            blob.upload_from_filename(local, content_type='video/mp4')
+            os.remove(local)
+            return {**clip, 'path': prefix + name}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(CLIP_WORKERS, len(clips))),
+                                thread_name_prefix='clip-export') as executor:
+            exported = list(executor.map(carry_deadline(export), clips))
+
+    # Clips left over from an earlier upload with more chapters
+    keep = {clip['path'] for clip in exported}
+    for blob in bucket.list_blobs(prefix=prefix):
+        if blob.name not in keep:
+            blob.delete()
+    return exported
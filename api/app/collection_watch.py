@@ -0,0 +1,48 @@
+import threading
+from typing import Dict, Any, Callable, Optional
+
+# How long the first snapshot of a collection may take before the index
+# that needs it gives up
+LOAD_TIMEOUT = 120.0
+
+
+def follow_collection(db, collection: str, load: Callable[[Dict[str, Dict[str, Any]]], None],
+                      apply: Callable[[str, Optional[Dict[str, Any]]], None], timeout: float = LOAD_TIMEOUT):
+    """Build an in-memory index from a Firestore collection and keep it in
+    step with the collection.
+
+    Every API worker, and every backfill, holds its own copy of the search
+    indexes. Writes go to Firestore, so following the collection's snapshot
+    listener is what brings each copy up to date, whichever process made
+    the write. load() gets {doc_id: data} from the first snapshot; apply()
+    gets each later change, with None for a deleted document.
+
+    Returns the listener, whose unsubscribe() stops following.
+    """
+    loaded = threading.Event()
+    errors = []
+
+    def on_snapshot(docs, changes, read_time):
+        if not loaded.is_set():
+            try:
+                load({doc.id: doc.to_dict() or {} for doc in docs})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                loaded.set()
+            return
+        for change in changes:
+            try:
+                removed = change.type.name == 'REMOVED'
+                apply(change.document.id, None if removed else change.document.to_dict() or {})
+            except Exception as e:
+                print(f"Error applying change to {collection}/{change.document.id}: {str(e)}")
+
+    watch = db.collection(collection).on_snapshot(on_snapshot)
+    if not loaded.wait(timeout):
+        watch.unsubscribe()
+        raise TimeoutError(f"No snapshot of {collection} within {timeout:.0f}s")
+    if errors:
+        watch.unsubscribe()
+        raise errors[0]
+    return watch
@@ -0,0 +1,16 @@
+"""The API's metrics, tracing and request deadlines, plugged into the
+shared tiptok_core modules. Imported by the app package, so every entry
+point (the server, backfills, benchmarks) runs them instrumented."""
+from tiptok_core import hooks
+
+from .deadlines import call_timeout, check_deadline, remaining
+from .metrics import registry, record_transcription, stage
+from .tracing import span
+
+
+def count(metric: str, amount: float = 1, **labels):
+    registry.get(metric).inc(amount, **labels)
+
+
+hooks.install(stage=stage, span=span, count=count, call_timeout=call_timeout, remaining=remaining,
+              check_deadline=check_deadline, record_transcription=record_transcription)
@@ -0,0 +1,182 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Deque, Optional, Tuple
+
+from flask import request
+
+from .metrics import hedged_requests, deadlines_exceeded
+
+# Longest a summary or chapters request may take, kept under gunicorn's
+# 300s worker timeout so a stalled provider cannot get the worker killed
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', '240'))
+# A call slower than this percentile of its recent latencies gets a hedge
+HEDGE_PERCENTILE = 0.95
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 64
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's deadline passed before the work finished"""
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None without one"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline(stage: str = 'request'):
+    left = remaining()
+    if left is not None and left <= 0:
+        deadlines_exceeded.inc(stage=stage)
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+def call_timeout(default: float) -> float:
+    """Timeout for one outbound call: the default, cut short by the deadline"""
+    left = remaining()
+    if left is None:
+        return default
+    return max(0.0, min(default, left))
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Set a deadline `seconds` from now for the enclosed work. A deadline
+    already in force is only ever tightened."""
+    deadline = _deadline.get()
+    if seconds is not None:
+        ours = time.monotonic() + seconds
+        deadline = ours if deadline is None else min(deadline, ours)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def detached_deadline(seconds: Optional[float]):
+    """Set a deadline `seconds` from now for the enclosed work, or none,
+    replacing the deadline in force. For work shared with callers other
+    than the one that started it."""
+    token = _deadline.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def carry_deadline(fn: Callable) -> Callable:
+    """Wrap fn to run under the caller's deadline and trace, e.g. in an
+    executor thread"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def request_timeout(data: Optional[Dict[str, Any]]) -> float:
+    """Deadline for this request: 'timeout' seconds from the body or query
+    string, capped at REQUEST_TIMEOUT"""
+    timeout = (data or {}).get('timeout', request.args.get('timeout'))
+    try:
+        return min(float(timeout), REQUEST_TIMEOUT) if timeout is not None else REQUEST_TIMEOUT
+    except (TypeError, ValueError):
+        return REQUEST_TIMEOUT
+
+
+class LatencyTracker:
+    """Recent latencies of one kind of call and the hedge threshold they imply"""
+
+    def __init__(self, default_threshold: float, window: int = HEDGE_WINDOW):
+        self.default_threshold = default_threshold
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def threshold(self, percentile: float = HEDGE_PERCENTILE) -> float:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return self.default_threshold
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+
+_trackers: Dict[Tuple[str, str], LatencyTracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(provider: str, operation: str, default_threshold: float) -> LatencyTracker:
+    key = (provider, operation)
+    if key not in _trackers:
+        with _trackers_lock:
+            if key not in _trackers:
+                _trackers[key] = LatencyTracker(default_threshold)
+    return _trackers[key]
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+
+
+def hedged(primary: Callable[[], Any], secondary: Optional[Callable[[], Any]],
+           tracker: LatencyTracker, provider: str) -> Any:
+    """Run primary; if it is still going once it passes the tracker's
+    latency threshold, also start secondary, and return whichever succeeds
+    first. Both run under the caller's deadline, and waiting for them stops
+    when it passes. The losing call is left to finish in the background.
+    """
+    check_deadline(provider)
+    started = time.monotonic()
+    first = _hedge_pool.submit(carry_deadline(primary))
+
+    def observe(future):
+        if future.exception() is None:
+            tracker.observe(time.monotonic() - started)
+    first.add_done_callback(observe)
+
+    hedge_at = started + tracker.threshold()
+    pending = {first}
+    hedge = None
+    error: Optional[BaseException] = None
+    while pending:
+        timeouts = [remaining()]
+        if hedge is None and secondary is not None:
+            timeouts.append(hedge_at - time.monotonic())
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        done, pending = wait(pending, timeout=max(0.0, min(timeouts)) if timeouts else None,
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if hedge is not None:
+                    hedged_requests.inc(provider=provider, outcome='hedge_won' if future is hedge else 'primary_won')
+                return future.result()
+            error = future.exception()
+        if error is not None and hedge is None:
+            # The primary failed outright; hedging is for slow calls, not errors
+            raise error
+        if not done:
+            left = remaining()
+            if left is not None and left <= 0:
+                deadlines_exceeded.inc(stage=provider)
+                raise DeadlineExceeded(f"Deadline exceeded waiting for {provider}")
+            if hedge is None and secondary is not None and time.monotonic() >= hedge_at:
+                hedged_requests.inc(provider=provider, outcome='sent')
+                hedge = _hedge_pool.submit(carry_deadline(secondary))
+                pending.add(hedge)
+    raise error
@@ -0,0 +1,40 @@
+import re
+from collections import Counter
+from typing import List
+
+from .search_index import tokenize
+
+SUMMARY_CHARS = 240
+# Common words that make poor keywords
+STOPWORDS = frozenset('''
+    about above after again against also because been before being below between both could does doing down
+    during each from further have having here into itself just more most once only other over same should
+    some such than that their theirs them then there these they this those through under until very were what
+    when where which while will with would your yours going really thing things actually right okay gonna
+'''.split())
+
+
+def extractive_summary(text: str, max_chars: int = SUMMARY_CHARS) -> str:
+    """The leading sentences of a text that fit in max_chars, for when the
+    summary model fails or runs out of time"""
+    summary = ''
+    for sentence in re.split(r'(?<=[.?!])\s+', text.strip()):
+        if summary and len(summary) + len(sentence) + 1 > max_chars:
+            break
+        summary = f"{summary} {sentence}".strip()
+    if len(summary) > max_chars:
+        summary = summary[:max_chars].rsplit(' ', 1)[0] + '...'
+    return summary
+
+
+def frequent_keywords(text: str, count: int = 6) -> List[str]:
+    """The most frequent longer words of a text, standing in for extracted keywords"""
+    words = [word for word in tokenize(text) if len(word) > 3 and word not in STOPWORDS and not word.isdigit()]
+    return [word for word, _ in Counter(words).most_common(count)]
+
+
+def keyword_title(keywords: List[str]) -> str:
+    """A plain title from the top keywords"""
+    if not keywords:
+        return 'Untitled Video'
+    return ' '.join(word.replace('_', ' ').title() for word in keywords[:3])
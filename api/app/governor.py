@@ -0,0 +1,10 @@
+"""Provider governors, shared with the storage trigger through tiptok_core.
+
+The default, sqlite, shares a budget between the processes on one host.
+Set GOVERNOR_BACKEND=firestore to share one budget per provider with the
+trigger, which always uses the Firestore backend, at the cost of a
+transaction on one contended document per call.
+"""
+from tiptok_core.governor import (PROVIDER_LIMITS, GOVERNOR_BACKEND, RETRYABLE_STATUSES, RateLimitBackend,
+                                  MemoryBackend, SQLiteBackend, FirestoreBackend, BACKENDS, Governor, status_of,
+                                  is_retryable, backoff_delay, next_limit, get_governor, use_backend)
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from multiprocessing.managers import BaseManager
+from typing import Dict, Any, Optional
+from urllib.parse import urlencode
+
+import aiohttp
+
+from .governor import get_governor
+from .metrics import record_transcription
+from .transcript_archive import TranscriptArchive
+from .transcription_backends import SentenceAccumulator
+
+DEFAULT_API_URL = 'https://api.deepgram.com/v1'
+# Deepgram closes a stream that gets no audio for 10 seconds; uploads stall longer than that
+KEEPALIVE_INTERVAL = 5.0
+SEND_TIMEOUT = 30.0
+FINISH_TIMEOUT = 30.0
+# Sessions nobody has sent audio to for this long are dropped
+SESSION_IDLE_TIMEOUT = 600.0
+# Set by gunicorn.conf.py for its workers: the socket of the live host, the
+# one process holding every live session, and the key to connect to it
+LIVE_HOST_ADDRESS = 'LIVE_HOST_ADDRESS'
+LIVE_HOST_AUTHKEY = 'LIVE_HOST_AUTHKEY'
+
+# Request options accepted from clients and the Deepgram parameters they map to.
+# Containerized audio (webm, ogg, mp3...) needs none; raw audio needs encoding and sampleRate.
+AUDIO_OPTIONS = {
+    'encoding': 'encoding',
+    'sampleRate': 'sample_rate',
+    'channels': 'channels',
+    'language': 'language',
+}
+
+
+class LiveSessionError(RuntimeError):
+    """The streaming connection for a session failed or is already closed"""
+
+
+def live_url(options: Dict[str, Any]) -> str:
+    """Deepgram streaming endpoint with query parameters, honouring
+    DEEPGRAM_LIVE_URL or, failing that, DEEPGRAM_API_URL (e.g. a local fake)"""
+    base = os.getenv('DEEPGRAM_LIVE_URL') or re.sub(r'^http', 'ws', os.getenv('DEEPGRAM_API_URL') or DEFAULT_API_URL)
+    params = {'punctuate': 'true', 'tier': 'enhanced'}
+    for option, param in AUDIO_OPTIONS.items():
+        if options.get(option) not in (None, ''):
+            params[param] = str(options[option])
+    return f"{base.rstrip('/')}/listen?{urlencode(params)}"
+
+
+class LiveSession:
+    """One streaming connection to Deepgram for the audio of one upload.
+
+    Runs on the transcriber's event loop; final results are folded into the
+    accumulator as they arrive, so the transcript is complete moments after
+    the last chunk is sent.
+    """
+
+    def __init__(self, session_id: str, video_path: str, options: Dict[str, Any]):
+        self.id = session_id
+        self.video_path = video_path
+        self.options = options
+        self.accumulator = SentenceAccumulator()
+        self.bytes_sent = 0
+        self.created = time.monotonic()
+        self.last_active = self.created
+        self.error: Optional[str] = None
+        self.archive: Optional[TranscriptArchive] = None
+        self._socket: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._receiver: Optional[asyncio.Task] = None
+        self._keepalive: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def closed(self) -> bool:
+        return self._socket is None or self._socket.closed
+
+    async def connect(self, http: aiohttp.ClientSession):
+        headers = {'Authorization': f"Token {os.getenv('DEEPGRAM_API_KEY')}"}
+        self._socket = await get_governor('deepgram').acall(http.ws_connect, live_url(self.options), headers=headers)
+        self._receiver = asyncio.create_task(self._receive())
+        self._keepalive = asyncio.create_task(self._keep_alive())
+
+    async def _receive(self):
+        try:
+            async for message in self._socket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                data = json.loads(message.data)
+                if data.get('type') == 'Results' and data.get('is_final'):
+                    alternatives = data.get('channel', {}).get('alternatives') or [{}]
+                    self.accumulator.add(alternatives[0].get('words', []), bool(data.get('speech_final')))
+                elif data.get('type') == 'Metadata':
+                    record_transcription('deepgram', data.get('duration', self.accumulator.duration))
+                elif data.get('type') == 'Error' or 'err_code' in data:
+                    self.error = data.get('description') or data.get('err_msg') or 'Deepgram stream error'
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            if not self._closing and self.error is None:
+                self.error = 'Deepgram closed the stream'
+            await self._socket.close()
+
+    async def _keep_alive(self):
+        while not self.closed:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if not self._closing and not self.closed and time.monotonic() - self.last_active >= KEEPALIVE_INTERVAL:
+                await self._socket.send_str(json.dumps({'type': 'KeepAlive'}))
+
+    async def send(self, chunk: bytes):
+        if self._closing or self.closed:
+            raise LiveSessionError(self.error or 'Live session is already finished')
+        await self._socket.send_bytes(chunk)
+        self.bytes_sent += len(chunk)
+        self.last_active = time.monotonic()
+
+    async def finish(self) -> TranscriptArchive:
+        """Close the stream, wait for the remaining results and return the transcript"""
+        if self.archive is not None:
+            return self.archive
+        if not self._closing:
+            self._closing = True
+            if not self.closed:
+                await self._socket.send_str(json.dumps({'type': 'CloseStream'}))
+        await self._receiver
+        self._keepalive.cancel()
+        if self.error is not None:
+            raise LiveSessionError(self.error)
+        self.archive = TranscriptArchive.from_transcript(self.accumulator.transcript('deepgram'))
+        return self.archive
+
+    async def abort(self):
+        self._closing = True
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+        if self._socket is not None:
+            await self._socket.close()
+
+
+class LiveTranscriber:
+    """Live transcription sessions for uploads in progress.
+
+    Sessions run on one event loop in a background thread so the Flask
+    workers only block for as long as it takes to hand a chunk to the
+    socket. They live in this process's memory; with several workers, the
+    live host process holds them and workers reach them through a proxy.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._sessions: Dict[str, LiveSession] = {}
+        self._lock = threading.Lock()
+        self._http: Optional[aiohttp.ClientSession] = None
+        threading.Thread(target=self.loop.run_forever, daemon=True, name='live-transcription').start()
+
+    def _run(self, coroutine, timeout: float):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def _get(self, session_id: str) -> LiveSession:
+        with self._lock:
+            return self._sessions[session_id]
+
+    def _expire_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [session for session in self._sessions.values() if now - session.last_active > SESSION_IDLE_TIMEOUT]
+            for session in idle:
+                del self._sessions[session.id]
+        for session in idle:
+            asyncio.run_coroutine_threadsafe(session.abort(), self.loop)
+
+    async def _open(self, session: LiveSession):
+        if self._http is None:
+            self._http = aiohttp.ClientSession()
+        await session.connect(self._http)
+
+    def start(self, video_path: str, options: Optional[Dict[str, Any]] = None) -> str:
+        """Open a streaming connection for an upload and return its session id"""
+        self._expire_idle()
+        session = LiveSession(uuid.uuid4().hex, video_path, options or {})
+        self._run(self._open(session), SEND_TIMEOUT)
+        with self._lock:
+            self._sessions[session.id] = session
+        return session.id
+
+    def send(self, session_id: str, chunk: bytes) -> int:
+        """Forward the next chunk of audio; returns the sentences transcribed so far.
+        Chunks must be sent in order, one at a time."""
+        session = self._get(session_id)
+        self._run(session.send(chunk), SEND_TIMEOUT)
+        return session.accumulator.sentence_count()
+
+    def finish(self, session_id: str, timeout: float = FINISH_TIMEOUT) -> TranscriptArchive:
+        """Wait for the transcript of everything sent. The session stays open
+        until discarded, so finishing again returns the same transcript."""
+        return self._run(self._get(session_id).finish(), timeout)
+
+    def discard(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            asyncio.run_coroutine_threadsafe(session.abort(), self.loop)
+
+    def status(self, session_id: str) -> Dict[str, Any]:
+        session = self._get(session_id)
+        return {
+            'sessionId': session.id,
+            'videoPath': session.video_path,
+            'bytesReceived': session.bytes_sent,
+            'sentences': session.accumulator.sentence_count(),
+            'transcribedSeconds': session.accumulator.duration,
+            'finished': session.archive is not None,
+            'error': session.error,
+        }
+
+    def video_path(self, session_id: str) -> str:
+        return self._get(session_id).video_path
+
+
+_local: Optional[LiveTranscriber] = None
+_transcriber: Optional[Any] = None
+_transcriber_lock = threading.Lock()
+
+
+def local_transcriber() -> LiveTranscriber:
+    """Return this process's own live transcriber"""
+    global _local
+    if _local is None:
+        with _transcriber_lock:
+            if _local is None:
+                _local = LiveTranscriber()
+    return _local
+
+
+class LiveHost(BaseManager):
+    """Serves the live host's transcriber to the server's workers, which
+    call its methods over a Unix socket"""
+
+
+LiveHost.register('transcriber', callable=local_transcriber)
+
+
+def _init_live_host():
+    # Firebase, which the Deepgram governor may keep its budget in, set up
+    # as the workers set it up
+    from . import routes  # noqa: F401
+
+
+def start_live_host(address: str, authkey: bytes) -> LiveHost:
+    """Start the live host process, listening on the Unix socket `address`"""
+    host = LiveHost(address=address, authkey=authkey)
+    host.start(_init_live_host)
+    return host
+
+
+def get_live_transcriber():
+    """Return the transcriber holding this server's live sessions: a proxy
+    to the live host's when LIVE_HOST_ADDRESS is set, so every worker sees
+    every session, or else this process's own"""
+    global _transcriber
+    if _transcriber is None:
+        address = os.environ.get(LIVE_HOST_ADDRESS)
+        if not address:
+            return local_transcriber()
+        with _transcriber_lock:
+            if _transcriber is None:
+                host = LiveHost(address=address, authkey=bytes.fromhex(os.environ[LIVE_HOST_AUTHKEY]))
+                host.connect()
+                _transcriber = host.transcriber()
+    return _transcriber
@@ -0,0 +1,409 @@
+import asyncio
+import atexit
+import bisect
+import functools
+import hmac
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple
+
+from flask import Flask, Response, g, request
+
+from .tracing import span
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+# USD per 1K tokens (prompt, completion). Unknown models are counted in
+# tokens but not costed.
+LLM_PRICES: Dict[str, Tuple[float, float]] = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4o': (0.005, 0.015),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+    'text-embedding-3-small': (0.00002, 0.0),
+}
+# USD per minute of audio
+TRANSCRIPTION_PRICES: Dict[str, float] = {
+    'deepgram': 0.0145,
+}
+
+# Each gunicorn worker has its own registry. With METRICS_DIR set (gunicorn.conf.py
+# sets it), every worker writes its values there as {pid}.json and
+# /api/metrics sums the files of every worker, like prometheus_client's
+# multiprocess mode; the others' values are at most METRICS_FLUSH_INTERVAL old.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 5.0
+# /api/metrics is only served to requests with 'Authorization: Bearer
+# <METRICS_TOKEN>'; unset, it is not served at all
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in items
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> List[Tuple[Tuple, Any]]:
+        """(label key, value) pairs, copied"""
+        raise NotImplementedError
+
+    def combine(self, snapshots: List[List[Tuple[Tuple, Any]]]) -> List[Tuple[Tuple, Any]]:
+        """Sum the snapshots of several processes"""
+        raise NotImplementedError
+
+    def render(self, values: Optional[List[Tuple[Tuple, Any]]] = None) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        """Sum over every label set"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def snapshot(self) -> List[Tuple[Tuple, Any]]:
+        with self._lock:
+            return list(self._values.items())
+
+    def combine(self, snapshots: List[List[Tuple[Tuple, Any]]]) -> List[Tuple[Tuple, Any]]:
+        totals: Dict[Tuple, float] = {}
+        for values in snapshots:
+            for key, value in values:
+                totals[key] = totals.get(key, 0.0) + value
+        return list(totals.items())
+
+    def render(self, values: Optional[List[Tuple[Tuple, Any]]] = None) -> List[str]:
+        values = self.snapshot() if values is None else values
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> List[Tuple[Tuple, Any]]:
+        with self._lock:
+            return [(key, list(counts)) for key, counts in self._values.items()]
+
+    def combine(self, snapshots: List[List[Tuple[Tuple, Any]]]) -> List[Tuple[Tuple, Any]]:
+        totals: Dict[Tuple, List[float]] = {}
+        for values in snapshots:
+            for key, counts in values:
+                if key not in totals:
+                    totals[key] = list(counts)
+                else:
+                    totals[key] = [a + b for a, b in zip(totals[key], counts)]
+        return list(totals.items())
+
+    def render(self, values: Optional[List[Tuple[Tuple, Any]]] = None) -> List[str]:
+        values = self.snapshot() if values is None else values
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {cumulative}')
+            cumulative += counts[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{_format_labels(key, ("le", "+Inf"))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def get(self, name: str) -> Metric:
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        raise KeyError(f"No metric named {name}")
+
+    def snapshot(self) -> Dict[str, List]:
+        """Every metric's values, as JSON-friendly lists"""
+        return {
+            metric.name: [[list(map(list, key)), value] for key, value in metric.snapshot()]
+            for metric in self._metrics
+        }
+
+    def render(self, snapshots: Optional[List[Dict[str, List]]] = None) -> str:
+        """The exposition text of this process's values, or of the sum of
+        several processes' snapshots"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            if snapshots is None:
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render(metric.combine([
+                    [(tuple(map(tuple, key)), value) for key, value in snapshot.get(metric.name, [])]
+                    for snapshot in snapshots
+                ])))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_duration = registry.register(Histogram(
+    'tiptok_stage_duration_seconds', 'Time spent in each processing stage'))
+stage_errors = registry.register(Counter(
+    'tiptok_stage_errors_total', 'Processing stage calls that raised'))
+stage_in_flight = registry.register(Gauge(
+    'tiptok_stage_in_flight', 'Processing stage calls currently running'))
+llm_requests = registry.register(Counter(
+    'tiptok_llm_requests_total', 'LLM API requests by model'))
+llm_tokens = registry.register(Counter(
+    'tiptok_llm_tokens_total', 'LLM tokens by model and direction (prompt or completion)'))
+llm_cost = registry.register(Counter(
+    'tiptok_llm_cost_usd_total', 'Estimated LLM spend by model'))
+llm_prompt_tokens = registry.register(Histogram(
+    'tiptok_llm_prompt_tokens', 'Prompt tokens per LLM request by call and model', TOKEN_BUCKETS))
+llm_completion_tokens = registry.register(Histogram(
+    'tiptok_llm_completion_tokens', 'Completion tokens per LLM request by call and model', TOKEN_BUCKETS))
+prompt_tokens_saved = registry.register(Counter(
+    'tiptok_prompt_tokens_saved_total', 'Prompt tokens removed by compaction before sending, by call'))
+audio_seconds = registry.register(Counter(
+    'tiptok_transcribed_audio_seconds_total', 'Seconds of audio sent for transcription by provider'))
+transcription_cost = registry.register(Counter(
+    'tiptok_transcription_cost_usd_total', 'Estimated transcription spend by provider'))
+summary_cache_lookups = registry.register(Counter(
+    'tiptok_summary_cache_lookups_total', 'Chapter summary cache lookups by result (hit or miss)'))
+firestore_writes = registry.register(Counter(
+    'tiptok_firestore_writes_total', 'Write-behind Firestore writes by outcome (queued, coalesced, committed, retried, failed)'))
+hedged_requests = registry.register(Counter(
+    'tiptok_hedged_requests_total', 'Hedged provider calls by outcome (sent, primary_won, hedge_won)'))
+deadlines_exceeded = registry.register(Counter(
+    'tiptok_deadlines_exceeded_total', 'Work abandoned because the request deadline passed, by stage'))
+degraded_results = registry.register(Counter(
+    'tiptok_degraded_results_total', 'Results served from a local fallback after a stage failed, by stage'))
+fingerprint_lookups = registry.register(Counter(
+    'tiptok_fingerprint_lookups_total', 'Audio fingerprint lookups by outcome (exact, clip, miss)'))
+http_duration = registry.register(Histogram(
+    'tiptok_http_request_duration_seconds', 'API request latency by endpoint'))
+http_requests = registry.register(Counter(
+    'tiptok_http_requests_total', 'API requests by endpoint and status'))
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block of work as a named stage, and trace it as a span when
+    the request is traced"""
+    stage_in_flight.inc(stage=name)
+    started = time.perf_counter()
+    try:
+        with span(name):
+            yield
+    except BaseException:
+        stage_errors.inc(stage=name)
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - started, stage=name)
+        stage_in_flight.dec(stage=name)
+
+
+def timed(name: str):
+    """Decorator form of stage() for plain and async functions"""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(model: str, usage: Any, call: Optional[str] = None):
+    """Count tokens and estimated cost from an OpenAI usage object. With a
+    call name, the request's prompt and completion sizes are also observed
+    per call, so latency and cost can be read against prompt size."""
+    llm_requests.inc(model=model)
+    if usage is None:
+        return
+    prompt = getattr(usage, 'prompt_tokens', 0) or 0
+    completion = getattr(usage, 'completion_tokens', 0) or 0
+    llm_tokens.inc(prompt, model=model, direction='prompt')
+    llm_tokens.inc(completion, model=model, direction='completion')
+    if call is not None:
+        llm_prompt_tokens.observe(prompt, call=call, model=model)
+        llm_completion_tokens.observe(completion, call=call, model=model)
+    if model in LLM_PRICES:
+        prompt_price, completion_price = LLM_PRICES[model]
+        llm_cost.inc((prompt * prompt_price + completion * completion_price) / 1000, model=model)
+
+
+def record_transcription(provider: str, duration: float):
+    """Count audio seconds and estimated cost for a transcription"""
+    audio_seconds.inc(duration, provider=provider)
+    if provider in TRANSCRIPTION_PRICES:
+        transcription_cost.inc(duration / 60 * TRANSCRIPTION_PRICES[provider], provider=provider)
+
+
+def record_summary_cache(hit: bool):
+    summary_cache_lookups.inc(result='hit' if hit else 'miss')
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def _write_json(path: str, data):
+    """Replace path whole, so a reader never sees half a snapshot"""
+    partial = f'{path}.partial'
+    with open(partial, 'w') as f:
+        json.dump(data, f)
+    os.replace(partial, path)
+
+
+def write_snapshot():
+    """Write this process's values to METRICS_DIR"""
+    _write_json(_snapshot_path(os.getpid()), registry.snapshot())
+
+
+def read_snapshots() -> List[Dict[str, List]]:
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error reading metrics of {name}: {str(e)}")
+    return snapshots
+
+
+def mark_process_dead(pid: int):
+    """Drop an exited worker's gauges, which were only true while it ran;
+    its counters and histograms keep counting towards the totals. Called by
+    gunicorn's child_exit hook."""
+    path = _snapshot_path(pid)
+    if not METRICS_DIR or not os.path.exists(path):
+        return
+    with open(path) as f:
+        snapshot = json.load(f)
+    for metric in registry._metrics:
+        if metric.kind == 'gauge':
+            snapshot.pop(metric.name, None)
+    _write_json(path, snapshot)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"Error writing metrics: {str(e)}")
+
+
+def render_metrics() -> str:
+    """This process's metrics, or every worker's summed with METRICS_DIR"""
+    if not METRICS_DIR:
+        return registry.render()
+    write_snapshot()
+    return registry.render(read_snapshots())
+
+
+def _authorized() -> bool:
+    expected = f'Bearer {METRICS_TOKEN}'
+    return bool(METRICS_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', ''), expected)
+
+
+def init_app(app: Flask):
+    """Time every request and serve the registry at /api/metrics"""
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=_flush_forever, name='metrics-flush', daemon=True).start()
+        atexit.register(write_snapshot)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unknown'
+            http_duration.observe(time.perf_counter() - started, endpoint=endpoint)
+            http_requests.inc(endpoint=endpoint, status=str(response.status_code))
+        return response
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics():
+        if not _authorized():
+            return Response('Not found\n', status=404, mimetype='text/plain')
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
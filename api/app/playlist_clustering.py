@@ -0,0 +1,338 @@
+import hashlib
+import math
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from .related_videos import keyword_terms
+from .search_index import tokenize
+
+# Summary words help separate videos with sparse keywords but are noisier
+# than the GPT keywords, so they are down-weighted.
+SUMMARY_WEIGHT = 0.3
+MIN_DOCUMENT_FREQUENCY = 2
+MAX_FEATURES = 20000
+TARGET_PLAYLIST_SIZE = 8
+CENTROID_TERMS = 64
+# A cluster keeps its previous title when at least this share of its
+# videos are unchanged (Jaccard similarity of the memberships).
+RETITLE_THRESHOLD = 0.8
+
+
+def video_signature(video: Dict[str, Any]) -> str:
+    """Hash of the fields clustering looks at, to spot changed videos"""
+    content = '\n'.join(sorted(video.get('keywords', []))) + '\n' + video.get('summary', '')
+    return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
+
+def video_terms(video: Dict[str, Any]) -> Dict[str, float]:
+    """Raw term weights for a video from its keywords and summary"""
+    terms = keyword_terms(video.get('keywords', []))
+    for token in tokenize(video.get('summary', '')):
+        terms[token] = terms.get(token, 0.0) + SUMMARY_WEIGHT
+    return terms
+
+
+class Vectorizer:
+    """TF-IDF vocabulary fitted once and reused so incremental runs stay comparable"""
+
+    def __init__(self, vocabulary: Dict[str, int], idf: np.ndarray):
+        self.vocabulary = vocabulary
+        self.idf = idf
+
+    @classmethod
+    def fit(cls, term_dicts: List[Dict[str, float]]) -> 'Vectorizer':
+        df: Dict[str, int] = defaultdict(int)
+        for terms in term_dicts:
+            for term in terms:
+                df[term] += 1
+        kept = [term for term, count in df.items() if count >= MIN_DOCUMENT_FREQUENCY]
+        kept.sort(key=lambda term: (-df[term], term))
+        kept = kept[:MAX_FEATURES]
+        n = len(term_dicts)
+        idf = np.array([math.log(1 + n / (1 + df[term])) for term in kept], dtype=np.float32)
+        return cls({term: i for i, term in enumerate(kept)}, idf)
+
+    def transform(self, term_dicts: List[Dict[str, float]]) -> sparse.csr_matrix:
+        """L2-normalized TF-IDF rows"""
+        rows, cols, values = [], [], []
+        for row, terms in enumerate(term_dicts):
+            for term, tf in terms.items():
+                col = self.vocabulary.get(term)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    values.append(tf * self.idf[col])
+        matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(term_dicts), len(self.vocabulary)),
+                                   dtype=np.float32)
+        norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+        norms[norms == 0] = 1.0
+        return (sparse.diags(1.0 / norms) @ matrix).tocsr()
+
+
+def normalize_centroids(centroids: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return centroids / norms
+
+
+def assign(matrix: sparse.csr_matrix, centroids: np.ndarray, chunk: int = 4096) -> Tuple[np.ndarray, np.ndarray]:
+    """Nearest centroid (by cosine) and its similarity for every row"""
+    labels = np.empty(matrix.shape[0], dtype=np.int64)
+    scores = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], chunk):
+        similarity = np.asarray(matrix[start:start + chunk] @ centroids.T)
+        labels[start:start + chunk] = similarity.argmax(axis=1)
+        scores[start:start + chunk] = similarity.max(axis=1)
+    return labels, scores
+
+
+def minibatch_kmeans(matrix: sparse.csr_matrix, n_clusters: int, init: Optional[np.ndarray] = None,
+                     batch_size: int = 1024, iterations: int = 50, seed: int = 0) -> np.ndarray:
+    """Spherical mini-batch k-means (Sculley, 2010) on sparse rows.
+
+    Starting from init (previous centroids) makes re-clustering after a
+    catalog change converge in a handful of batches.
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    n_clusters = min(n_clusters, n)
+    batch_size = min(n, max(batch_size, 4 * n_clusters))
+
+    if init is not None and init.shape == (n_clusters, matrix.shape[1]):
+        centroids = init.astype(np.float32).copy()
+    else:
+        centroids = matrix[rng.choice(n, n_clusters, replace=False)].toarray()
+
+    counts = np.zeros(n_clusters, dtype=np.float32)
+    for _ in range(iterations):
+        batch = matrix[rng.choice(n, batch_size, replace=False)] if batch_size < n else matrix
+        labels, _ = assign(batch, centroids)
+        # Per-cluster sums of the batch rows in one sparse product
+        membership = sparse.csr_matrix(
+            (np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+            shape=(n_clusters, len(labels)),
+        )
+        sums = np.asarray((membership @ batch).todense())
+        batch_counts = np.bincount(labels, minlength=n_clusters).astype(np.float32)
+        counts += batch_counts
+        touched = batch_counts > 0
+        rate = (batch_counts[touched] / counts[touched])[:, None]
+        means = sums[touched] / batch_counts[touched][:, None]
+        centroids[touched] = (1 - rate) * centroids[touched] + rate * means
+        centroids = normalize_centroids(centroids)
+    return centroids
+
+
+def order_cluster(matrix: sparse.csr_matrix, rows: List[int], centroid: np.ndarray) -> List[int]:
+    """Order a cluster as a playlist.
+
+    Starts with the video closest to the centroid (the broadest take on the
+    topic) and then repeatedly moves to the most similar remaining video, so
+    consecutive videos flow into each other.
+    """
+    if len(rows) <= 2:
+        return sorted(rows, key=lambda row: -float((matrix[row] @ centroid)[0]))
+    members = matrix[rows]
+    similarity = (members @ members.T).toarray()
+    np.fill_diagonal(similarity, -np.inf)
+
+    current = int(np.argmax(members @ centroid))
+    order = [current]
+    for _ in range(len(rows) - 1):
+        similarity[:, current] = -np.inf
+        current = int(np.argmax(similarity[current]))
+        order.append(current)
+    return [rows[i] for i in order]
+
+
+def cluster_videos(videos: List[Dict[str, Any]], previous: Optional[Dict[str, Any]] = None,
+                   target_size: int = TARGET_PLAYLIST_SIZE, min_size: int = 2) -> Dict[str, Any]:
+    """Cluster videos into ordered playlists.
+
+    Clustering is two-level: a coarse k-means splits the catalog into about
+    sqrt(k) topics, then each topic is split into playlist-sized clusters.
+    Each level only compares rows against a few dozen centroids, which keeps
+    tens of thousands of videos within a couple of minutes.
+
+    Args:
+        videos: dicts with 'id', 'keywords' and 'summary'
+        previous: the model returned by an earlier run; its vocabulary and
+            centroids seed this one, so only topics whose size changed enough
+            to need a different number of playlists are re-seeded
+        target_size: rough number of videos per playlist
+        min_size: clusters smaller than this are not proposed
+
+    Returns:
+        Dict with 'playlists' (list of {cluster, videoIds}) and 'model'
+        (vocabulary, idf, coarse and fine centroids to pass back as previous)
+    """
+    if not videos:
+        return {'playlists': [], 'model': previous}
+
+    term_dicts = [video_terms(video) for video in videos]
+    n_clusters = max(1, round(len(videos) / target_size))
+    n_topics = max(1, int(round(math.sqrt(n_clusters))))
+
+    if previous is not None:
+        # Keep the vocabulary and topics fixed so videos only move when their
+        # content did; a full run refits both
+        vectorizer = Vectorizer(previous['vocabulary'], previous['idf'])
+        matrix = vectorizer.transform(term_dicts)
+        coarse = previous['coarse']
+    else:
+        vectorizer = Vectorizer.fit(term_dicts)
+        matrix = vectorizer.transform(term_dicts)
+        coarse = minibatch_kmeans(matrix, n_topics)
+    topics, _ = assign(matrix, coarse)
+
+    signatures = [video_signature(video) for video in videos]
+    previous_members: Dict[int, int] = defaultdict(int)
+    if previous is not None:
+        for cluster, _ in previous['assignments'].values():
+            previous_members[int(previous['parents'][cluster])] += 1
+
+    fine_rows = []
+    parents = []
+    assignments = {}
+    playlists = []
+    for topic in range(len(coarse)):
+        rows = np.flatnonzero(topics == topic)
+        if not len(rows):
+            continue
+        submatrix = matrix[rows]
+        k = max(1, round(len(rows) / target_size))
+
+        labels = None
+        init = None
+        if previous is not None:
+            topic_clusters = np.flatnonzero(previous['parents'] == topic)
+            previous_fine = previous['fine'][topic_clusters]
+            if unchanged_topic(videos, signatures, rows, topic, previous, previous_members[topic]):
+                # Same videos with the same content: keep last run's playlists
+                local = {int(cluster): i for i, cluster in enumerate(topic_clusters)}
+                labels = np.array([local[previous['assignments'][videos[row]['id']][0]] for row in rows])
+                centroids = previous_fine.toarray()
+            elif previous_fine.shape[0] == k:
+                init = previous_fine.toarray()
+        if labels is None:
+            centroids = minibatch_kmeans(submatrix, k, init=init, iterations=10 if init is not None else 50)
+            labels, _ = assign(submatrix, centroids)
+
+        for label in range(len(centroids)):
+            members = np.flatnonzero(labels == label)
+            cluster = len(parents)
+            fine_rows.append(sparse.csr_matrix(centroids[label]))
+            parents.append(topic)
+            for row in members:
+                assignments[videos[rows[row]]['id']] = (cluster, signatures[rows[row]])
+            if len(members) < min_size:
+                continue
+            ordered = order_cluster(submatrix, [int(row) for row in members], centroids[label])
+            playlists.append({
+                'cluster': cluster,
+                'videoIds': [videos[rows[row]]['id'] for row in ordered],
+            })
+
+    return {
+        'playlists': playlists,
+        'model': {
+            'vocabulary': vectorizer.vocabulary,
+            'idf': vectorizer.idf,
+            'coarse': coarse,
+            'fine': sparsify(sparse.vstack(fine_rows).tocsr()),
+            'parents': np.array(parents, dtype=np.int64),
+            'assignments': assignments,
+        },
+    }
+
+
+def unchanged_topic(videos: List[Dict[str, Any]], signatures: List[str], rows: np.ndarray, topic: int,
+                    previous: Dict[str, Any], previous_count: int) -> bool:
+    """True when a topic holds exactly the videos it held last run, unedited"""
+    if previous_count != len(rows):
+        return False
+    for row in rows:
+        assignment = previous['assignments'].get(videos[row]['id'])
+        if assignment is None or assignment[1] != signatures[row]:
+            return False
+        if previous['parents'][assignment[0]] != topic:
+            return False
+    return True
+
+
+def sparsify(centroids: sparse.csr_matrix, keep: int = CENTROID_TERMS) -> sparse.csr_matrix:
+    """Keep only the heaviest terms of each centroid so the saved model stays small"""
+    centroids = centroids.tolil()
+    for row in range(centroids.shape[0]):
+        values = np.array(centroids.data[row])
+        if len(values) > keep:
+            top = np.sort(np.argpartition(-values, keep)[:keep])
+            centroids.rows[row] = [centroids.rows[row][i] for i in top]
+            centroids.data[row] = [centroids.data[row][i] for i in top]
+    return centroids.tocsr()
+
+
+def save_model(path: str, model: Dict[str, Any]):
+    """Write a clustering model to a .npz file"""
+    terms = sorted(model['vocabulary'], key=model['vocabulary'].get)
+    fine = model['fine']
+    np.savez_compressed(
+        path,
+        terms=np.array(terms, dtype=object),
+        idf=model['idf'],
+        coarse=model['coarse'],
+        fine_data=fine.data, fine_indices=fine.indices, fine_indptr=fine.indptr,
+        fine_shape=np.array(fine.shape),
+        parents=model['parents'],
+        assigned_ids=np.array(list(model['assignments']), dtype=object),
+        assigned_clusters=np.array([cluster for cluster, _ in model['assignments'].values()], dtype=np.int64),
+        assigned_signatures=np.array([signature for _, signature in model['assignments'].values()], dtype=object),
+    )
+
+
+def load_model(path: str) -> Dict[str, Any]:
+    """Read a clustering model written by save_model"""
+    with np.load(path, allow_pickle=True) as data:
+        return {
+            'vocabulary': {term: i for i, term in enumerate(data['terms'])},
+            'idf': data['idf'],
+            'coarse': data['coarse'],
+            'fine': sparse.csr_matrix((data['fine_data'], data['fine_indices'], data['fine_indptr']),
+                                      shape=tuple(data['fine_shape'])),
+            'parents': data['parents'],
+            'assignments': {
+                video_id: (int(cluster), signature)
+                for video_id, cluster, signature in zip(
+                    data['assigned_ids'], data['assigned_clusters'], data['assigned_signatures'])
+            },
+        }
+
+
+def reuse_titles(playlists: List[Dict[str, Any]], previous_playlists: List[Dict[str, Any]]) -> int:
+    """Copy titles from previous playlists whose membership barely changed.
+
+    Returns:
+        Number of playlists that kept a previous title
+    """
+    playlist_of = {}
+    for i, old in enumerate(previous_playlists):
+        for video_id in old['videoIds']:
+            playlist_of[video_id] = i
+
+    reused = 0
+    for playlist in playlists:
+        members = set(playlist['videoIds'])
+        candidates = {playlist_of[video_id] for video_id in members if video_id in playlist_of}
+        for i in candidates:
+            old = previous_playlists[i]
+            if 'title' not in old:
+                continue
+            old_members = set(old['videoIds'])
+            if len(members & old_members) / len(members | old_members) >= RETITLE_THRESHOLD:
+                playlist['title'] = old['title']
+                reused += 1
+                break
+    return reused
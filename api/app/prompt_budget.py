@@ -0,0 +1,197 @@
+import re
+import threading
+from typing import Dict, Any, List, Optional, Set
+
+from .chapter_grouping import estimate_tokens, BLOCK_OVERHEAD_TOKENS
+from .metrics import prompt_tokens_saved
+
+# Tokens of embedded transcript each call may send, by the stage name of
+# the function making it. Instructions come on top.
+PROMPT_BUDGETS: Dict[str, int] = {
+    'group_window_with_gpt': 5000,
+    'merge_chapters_with_gpt': 3000,
+    'summarize_chapter_with_gpt': 8000,
+    'extract_keywords_with_gpt': 1000,
+    'generate_playlist_title': 1000,
+}
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-3.5-turbo': 16385,
+}
+# Left free in the context window for the completion
+COMPLETION_RESERVE_TOKENS = 1000
+# Framing the chat format adds around each message, and around the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+ELISION = '…'
+
+# Hesitations and verbal tics that carry nothing for grouping or summaries.
+# "you know" and "I mean" only go when set off by a comma.
+FILLER = re.compile(r"\b(?:u+h+|u+m+|e+r+m+|h+m+|mm+)\b[,.]?\s*|\b(?:you know|I mean),\s*", re.IGNORECASE)
+# Stutters: the cut-off start of the next word ("th- that", "w-w-we") or a
+# one-letter word said twice ("I I"). Repeated whole words are left alone,
+# since "had had" and "that that" are usually meant.
+FRAGMENT_STUTTER = re.compile(r"\b([a-z]{1,3})-\s+(?=\1)|\b([a-z])-(?=\2)", re.IGNORECASE)
+LETTER_STUTTER = re.compile(r"\b([a-z])(?:\s+\1\b(?!-))+", re.IGNORECASE)
+SPACES = re.compile(r"\s{2,}")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+NORMALIZE = re.compile(r"[^\w]+")
+
+
+class PromptBudgetExceeded(RuntimeError):
+    """A prompt does not fit the model's context even after compaction"""
+
+
+_encoders: Dict[str, Any] = {}
+_encoders_lock = threading.Lock()
+
+
+def _encoder(model: str):
+    """The model's tiktoken encoding, or None to estimate from characters
+    when tiktoken is not installed or has no encoding for the model"""
+    if model not in _encoders:
+        with _encoders_lock:
+            if model not in _encoders:
+                try:
+                    import tiktoken
+                    try:
+                        _encoders[model] = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        _encoders[model] = tiktoken.get_encoding('cl100k_base')
+                except Exception as e:
+                    print(f"Counting {model} tokens by estimate: {str(e)}")
+                    _encoders[model] = None
+    return _encoders[model]
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoder = _encoder(model)
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    """Prompt tokens of a chat request, as the API will bill them"""
+    return sum(count_tokens(message.get('content', ''), model) + MESSAGE_OVERHEAD_TOKENS
+               for message in messages) + REPLY_OVERHEAD_TOKENS
+
+
+def check_prompt(messages: List[Dict[str, str]], model: str) -> int:
+    """Count a request's prompt tokens, raising if it leaves the model too
+    little room to answer"""
+    tokens = count_message_tokens(messages, model)
+    limit = MODEL_CONTEXT_TOKENS.get(model)
+    if limit is not None and tokens > limit - COMPLETION_RESERVE_TOKENS:
+        raise PromptBudgetExceeded(f"{tokens} prompt tokens leave no room to answer in {model}'s {limit}")
+    return tokens
+
+
+def truncate_tokens(text: str, limit: int, model: str) -> str:
+    """The first `limit` tokens of text"""
+    encoder = _encoder(model)
+    if encoder is None:
+        chars = max(limit - 1, 0) * 4
+        return text if len(text) <= chars else text[:chars].rstrip() + ELISION
+    tokens = encoder.encode(text, disallowed_special=())
+    if len(tokens) <= limit:
+        return text
+    return encoder.decode(tokens[:max(limit - 1, 0)]).rstrip() + ELISION
+
+
+def remove_filler(text: str) -> str:
+    text = FRAGMENT_STUTTER.sub('', text)
+    text = LETTER_STUTTER.sub(r'\1', text)
+    text = FILLER.sub('', text)
+    return SPACES.sub(' ', text).strip()
+
+
+def drop_repeats(text: str, seen: Set[str]) -> str:
+    """Text without the sentences already in `seen`, which it adds to"""
+    kept = []
+    for sentence in SENTENCE_BREAK.split(text):
+        key = NORMALIZE.sub(' ', sentence).strip().lower()
+        if not key:
+            continue
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(sentence)
+    return ' '.join(kept)
+
+
+def compact_text(text: str, budget: int, model: str, call: str) -> str:
+    """Transcript text for a prompt: filler and repeated sentences removed
+    and, if it is still over budget, sentences dropped evenly across it so
+    the whole span of the text stays represented"""
+    before = count_tokens(text, model)
+    if before <= budget // 2:
+        # Well inside the budget; not worth a pass
+        return text
+    text = drop_repeats(remove_filler(text), set())
+    sentences = SENTENCE_BREAK.split(text)
+    sizes = [count_tokens(sentence, model) + 1 for sentence in sentences]
+    total = sum(sizes)
+    if total > budget:
+        # Keep each sentence once it has earned its size at the kept ratio,
+        # marking the gaps. The opening sentence starts with its credit.
+        ratio = budget / total
+        kept: List[str] = []
+        credit, gap = sizes[0] * (1 - ratio), False
+        for sentence, size in zip(sentences, sizes):
+            credit += size * ratio
+            if credit >= size:
+                credit -= size
+                if gap and kept:
+                    kept.append(ELISION)
+                kept.append(sentence)
+                gap = False
+            else:
+                gap = True
+        text = truncate_tokens(' '.join(kept), budget, model)
+    after = count_tokens(text, model)
+    if after < before:
+        prompt_tokens_saved.inc(before - after, call=call)
+    return text
+
+
+def compact_blocks(texts: List[str], budget: int, model: str, call: str) -> List[str]:
+    """Block texts for a prompt that numbers them. Every block is kept, so
+    the indices the model answers with still point at the right blocks:
+    filler and sentences repeated from earlier blocks are removed, and if
+    that is not enough the longest blocks are cut to a common length."""
+    budget = max(budget - BLOCK_OVERHEAD_TOKENS * len(texts), len(texts))
+    before = sum(count_tokens(text, model) for text in texts)
+    if before <= budget // 2:
+        return texts
+    seen: Set[str] = set()
+    texts = [drop_repeats(remove_filler(text), seen) or ELISION for text in texts]
+    sizes = [count_tokens(text, model) for text in texts]
+    if sum(sizes) > budget:
+        # Largest per-block cap that fits: blocks under it are kept whole
+        low, high = 1, max(sizes)
+        while low < high:
+            cap = (low + high + 1) // 2
+            if sum(min(size, cap) for size in sizes) <= budget:
+                low = cap
+            else:
+                high = cap - 1
+        texts = [truncate_tokens(text, low, model) if size > low else text for text, size in zip(texts, sizes)]
+        sizes = [count_tokens(text, model) for text in texts]
+    after = sum(sizes)
+    if after < before:
+        prompt_tokens_saved.inc(before - after, call=call)
+    return texts
+
+
+def prompt_budget(call: str, model: str) -> int:
+    """Transcript tokens a call may embed: its budget, within the model's context"""
+    budget = PROMPT_BUDGETS.get(call, 4000)
+    limit: Optional[int] = MODEL_CONTEXT_TOKENS.get(model)
+    if limit is not None:
+        # Instructions take well under a thousand tokens in every prompt
+        budget = min(budget, limit - COMPLETION_RESERVE_TOKENS - 1000)
+    return budget
@@ -0,0 +1,267 @@
+import math
+import threading
+import warnings
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from .collection_watch import follow_collection
+from .search_index import expand_keyword
+
+NEIGHBOURS = 10
+# Compound parts ("learning" from "machine_learning") link videos more
+# loosely than a shared keyword, so they carry less weight.
+PART_WEIGHT = 0.5
+# IDF only drifts a little per update, so rebuild the whole table after
+# this many incremental updates rather than on every write.
+REBUILD_AFTER_UPDATES = 500
+
+
+def keyword_terms(keywords: List[str]) -> Dict[str, float]:
+    """Raw term weights for a video's keywords, including compound parts"""
+    terms: Dict[str, float] = {}
+    for keyword in keywords or []:
+        expanded = expand_keyword(keyword)
+        if not expanded:
+            continue
+        terms[expanded[0]] = terms.get(expanded[0], 0.0) + 1.0
+        for part in expanded[1:]:
+            terms[part] = max(terms.get(part, 0.0), PART_WEIGHT)
+    return terms
+
+
+class RelatedVideos:
+    """TF-IDF keyword vectors per video with a precomputed top-k neighbour table.
+
+    Vectors are rows of a sparse CSR matrix, so both the full rebuild and the
+    incremental patch after one video changes are sparse matrix products
+    rather than Python loops over the catalog.
+    """
+
+    def __init__(self, k: int = NEIGHBOURS):
+        self.k = k
+        self._lock = threading.RLock()
+        self._terms: Dict[str, Dict[str, float]] = {}
+        self._df: Dict[str, int] = defaultdict(int)
+        self._idf: Dict[str, float] = {}
+        self._vocabulary: Dict[str, int] = {}
+        self._row_of: Dict[str, int] = {}
+        self._video_at: List[Optional[str]] = []
+        self._matrix = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._neighbours: Dict[str, List[Tuple[str, float]]] = {}
+        self._updates_since_rebuild = 0
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def neighbours(self, video_id: str) -> List[Tuple[str, float]]:
+        """Precomputed related videos, best first"""
+        return self._neighbours.get(video_id, [])
+
+    def _idf_of(self, term: str) -> float:
+        if term in self._idf:
+            return self._idf[term]
+        return math.log(1 + len(self._terms) / (1 + self._df.get(term, 0)))
+
+    def _row_vector(self, terms: Dict[str, float]) -> sparse.csr_matrix:
+        """Normalized TF-IDF row for a set of raw term weights"""
+        for term in terms:
+            if term not in self._vocabulary:
+                self._vocabulary[term] = len(self._vocabulary)
+        cols = [self._vocabulary[term] for term in terms]
+        values = np.array([tf * self._idf_of(term) for term, tf in terms.items()], dtype=np.float32)
+        norm = np.linalg.norm(values)
+        if norm:
+            values /= norm
+        return sparse.csr_matrix((values, ([0] * len(cols), cols)), shape=(1, len(self._vocabulary)))
+
+    def _top(self, scores: np.ndarray, exclude: int) -> List[Tuple[str, float]]:
+        scores[exclude] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > self.k:
+            candidates = candidates[np.argpartition(-scores[candidates], self.k)[:self.k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self._video_at[row], float(scores[row])) for row in candidates]
+
+    def _similarities(self, vector: sparse.csr_matrix) -> np.ndarray:
+        return (self._matrix @ vector.T).toarray().ravel()
+
+    def _rank_row(self, row: int) -> List[Tuple[str, float]]:
+        return self._top(self._similarities(self._matrix[row]), row)
+
+    def rebuild(self):
+        """Recompute IDF and every neighbour list with one sparse matrix product"""
+        with self._lock:
+            self._updates_since_rebuild = 0
+            video_ids = list(self._terms)
+            n = len(video_ids)
+            self._idf = {term: math.log(1 + n / (1 + df)) for term, df in self._df.items()}
+            self._vocabulary = {term: i for i, term in enumerate(self._df)}
+            self._row_of = {video_id: row for row, video_id in enumerate(video_ids)}
+            self._video_at = list(video_ids)
+
+            rows, cols, values = [], [], []
+            for row, video_id in enumerate(video_ids):
+                for term, tf in self._terms[video_id].items():
+                    rows.append(row)
+                    cols.append(self._vocabulary[term])
+                    values.append(tf * self._idf[term])
+            matrix = sparse.csr_matrix((values, (rows, cols)), shape=(n, len(self._vocabulary)), dtype=np.float32)
+            norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+            norms[norms == 0] = 1.0
+            self._matrix = (sparse.diags(1.0 / norms) @ matrix).tocsr()
+
+            similarity = (self._matrix @ self._matrix.T).tocsr()
+            similarity.setdiag(0)
+            similarity.eliminate_zeros()
+
+            neighbours = {}
+            for row, video_id in enumerate(video_ids):
+                start, end = similarity.indptr[row], similarity.indptr[row + 1]
+                scores = similarity.data[start:end]
+                others = similarity.indices[start:end]
+                if len(scores) > self.k:
+                    best = np.argpartition(-scores, self.k)[:self.k]
+                    scores, others = scores[best], others[best]
+                order = np.argsort(-scores)
+                neighbours[video_id] = [(video_ids[others[i]], float(scores[i])) for i in order]
+            self._neighbours = neighbours
+
+    def update(self, video_id: str, keywords: List[str]):
+        """Apply a change to one video's keywords.
+
+        Only videos sharing a term with the old or new keywords can be
+        affected, so the neighbour table is patched for those instead of
+        being rebuilt.
+        """
+        with self._lock:
+            old_terms = self._terms.get(video_id, {})
+            new_terms = keyword_terms(keywords)
+            if new_terms == old_terms:
+                return
+
+            for term in old_terms:
+                self._df[term] -= 1
+                if not self._df[term]:
+                    del self._df[term]
+            for term in new_terms:
+                self._df[term] += 1
+            if new_terms:
+                self._terms[video_id] = new_terms
+            else:
+                self._terms.pop(video_id, None)
+
+            self._updates_since_rebuild += 1
+            if self._updates_since_rebuild >= REBUILD_AFTER_UPDATES:
+                self.rebuild()
+                return
+
+            row = self._row_of.get(video_id)
+            if row is None:
+                row = len(self._video_at)
+                self._row_of[video_id] = row
+                self._video_at.append(video_id)
+
+            # Videos that shared a term with the old vector are the only ones
+            # whose lists can currently contain this video
+            if row < self._matrix.shape[0]:
+                old_scores = self._similarities(self._matrix[row])
+                old_scores[row] = 0.0
+            else:
+                old_scores = np.zeros(0, dtype=np.float32)
+
+            vector = self._row_vector(new_terms) if new_terms else None
+            rows = max(row + 1, self._matrix.shape[0])
+            self._matrix.resize((rows, len(self._vocabulary)))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
+                if vector is not None:
+                    self._matrix[row] = vector
+                else:
+                    self._matrix[row] = sparse.csr_matrix((1, len(self._vocabulary)), dtype=np.float32)
+            self._matrix.eliminate_zeros()
+
+            if vector is None:
+                self._neighbours.pop(video_id, None)
+                del self._row_of[video_id]
+                self._video_at[row] = None
+                new_scores = np.zeros(rows, dtype=np.float32)
+            else:
+                new_scores = self._similarities(vector)
+                self._neighbours[video_id] = self._top(new_scores.copy(), row)
+            new_scores[row] = 0.0
+
+            for other_row in np.flatnonzero(old_scores > 0):
+                other = self._video_at[other_row]
+                previous = self._neighbours.get(other, [])
+                current = [(vid, score) for vid, score in previous if vid != video_id]
+                if len(current) == len(previous):
+                    continue
+                if len(previous) >= self.k:
+                    # This video may have lost score in a full list; the
+                    # replacement could be any video sharing a term
+                    self._neighbours[other] = self._rank_row(other_row)
+                else:
+                    self._neighbours[other] = current
+
+            for other_row in np.flatnonzero(new_scores > 0):
+                other = self._video_at[other_row]
+                current = [(vid, score) for vid, score in self._neighbours.get(other, []) if vid != video_id]
+                score = float(new_scores[other_row])
+                if len(current) < self.k or score > current[-1][1]:
+                    current.append((video_id, score))
+                    current.sort(key=lambda item: -item[1])
+                    self._neighbours[other] = current[:self.k]
+
+    def load(self, videos: Dict[str, List[str]]):
+        """Replace the catalog with {video_id: keywords} and rebuild"""
+        with self._lock:
+            self._terms = {}
+            self._df = defaultdict(int)
+            for video_id, keywords in videos.items():
+                terms = keyword_terms(keywords)
+                if not terms:
+                    continue
+                self._terms[video_id] = terms
+                for term in terms:
+                    self._df[term] += 1
+            self.rebuild()
+
+
+_related: Optional[RelatedVideos] = None
+_related_lock = threading.Lock()
+
+
+def get_related_videos(db) -> RelatedVideos:
+    """Return the process-wide related-videos table, building it on first use.
+
+    The table then follows the videos collection, so keywords written by
+    other workers or by a backfill reach this worker's copy too.
+    """
+    global _related
+    if _related is None:
+        with _related_lock:
+            if _related is None:
+                related = RelatedVideos()
+
+                def load(docs: Dict[str, Dict[str, Any]]):
+                    related.load({video_id: data.get('keywords', []) for video_id, data in docs.items()})
+                    print(f"Built related-videos table for {len(related)} videos")
+
+                def apply(video_id: str, data: Optional[Dict[str, Any]]):
+                    # A no-op unless the keywords changed
+                    related.update(video_id, (data or {}).get('keywords', []))
+
+                follow_collection(db, 'videos', load, apply)
+                _related = related
+    return _related
+
+
+def update_related_videos(video_id: str, keywords: List[str]):
+    """Patch this worker's neighbour table after a video's keywords change;
+    the others follow the videos collection. video_id is the id of the
+    video's videos document, the key the follower uses."""
+    if _related is not None:
+        _related.update(video_id, keywords)
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+from flask import Response, jsonify, request
+
+from .tracing import traced
+
+# Clients may keep results but must revalidate with If-None-Match before
+# reusing them, since regenerating a video changes them
+CACHE_CONTROL = 'private, no-cache'
+PROCESSING_COLLECTION = 'videoprocessing'
+CLIPS_COLLECTION = 'videoclips'
+# The longest a Cloud Functions storage trigger can run; a 'processing' status older than this
+# belongs to a run that died
+TRIGGER_TIMEOUT = 540.0
+TRIGGER_POLL_INTERVAL = 1.0
+# summarySource of chapters the trigger summarized with each paragraph's
+# opening sentence, and of chapters the API summarized with a model
+TRIGGER_SUMMARY_SOURCE = 'trigger'
+MODEL_SUMMARY_SOURCE = 'model'
+# Bucket for objects derived from uploads (transcripts, tracks, clips), kept
+# apart from the uploads so writing them does not fire the storage
+# triggers. Unset, e.g. in the emulator, it is the default bucket.
+DERIVED_BUCKET = os.environ.get('DERIVED_BUCKET') or None
+
+
+def processing_id(video_path: str) -> str:
+    """Document id the storage trigger uses in videoprocessing: the file name without extension"""
+    return video_path.split('/')[-1].split('.')[0]
+
+
+@traced('get_video_generation')
+def get_video_generation(bucket, video_path: str) -> Optional[str]:
+    """Generation of the stored video, or None if there is no such blob.
+
+    Storage assigns a new generation whenever the object is overwritten,
+    so results recorded against it go stale with the upload they came from.
+    """
+    blob = bucket.get_blob(video_path)
+    if blob is None:
+        return None
+    return str(blob.generation)
+
+
+def wants_refresh(data: Optional[Dict[str, Any]]) -> bool:
+    """True if the request asks to recompute even when a stored result is current"""
+    force = (data or {}).get('force', request.args.get('force'))
+    if isinstance(force, str):
+        return force.lower() in ('1', 'true', 'yes')
+    return bool(force)
+
+
+@traced('video_doc_id')
+def video_doc_id(db, video_path: str) -> Optional[str]:
+    """Id of a video's document in videos, which the search indexes key it by.
+
+    The client creates videos documents with auto ids and records the
+    upload's path in storagePath. Videos uploaded before that were stored
+    under their document id, so the file name is tried last.
+
+    Returns:
+        None if the video has no document
+    """
+    for doc in db.collection('videos').where('storagePath', '==', video_path).stream():
+        return doc.id
+    video_id = video_path.split('/')[-1]
+    return video_id if db.collection('videos').document(video_id).get().exists else None
+
+
+@traced('load_summary')
+def load_summary(db, video_id: str, generation: str) -> Optional[Dict[str, Any]]:
+    """The summary previously written to videos/{id} for this generation of the video"""
+    doc = db.collection('videos').document(video_id).get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    if data.get('summaryGeneration') != generation or not data.get('summary'):
+        return None
+    return {
+        'summary': data['summary'],
+        'keywords': data.get('keywords', []),
+        'suggested_title': data.get('suggestedTitle', 'Untitled Video'),
+    }
+
+
+@traced('load_chapters')
+def load_chapters(db, video_path: str, generation: str) -> Optional[Dict[str, Any]]:
+    """Chapters stored in videoprocessing/{id} for this generation, whether
+    the API or the storage trigger produced them. The trigger's placeholder
+    summaries do not count; the API summarizes over them."""
+    doc = db.collection(PROCESSING_COLLECTION).document(processing_id(video_path)).get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    if data.get('status') != 'completed' or str(data.get('generation')) != generation:
+        return None
+    if not data.get('chapters') or data.get('summarySource') == TRIGGER_SUMMARY_SOURCE:
+        return None
+    return {
+        'video_id': video_path,
+        'chapters': [{
+            'start': chapter['start'],
+            'end': chapter['end'],
+            'summary': chapter.get('summary'),
+        } for chapter in data['chapters']],
+        'suggested_title': data.get('suggestedTitle', 'Untitled Video'),
+    }
+
+
+@traced('load_trigger_chapters')
+def load_trigger_chapters(db, video_path: str, generation: str) -> Optional[List[Dict[str, Any]]]:
+    """Chapters the storage trigger stored in videoprocessing/{id} for this
+    generation, with its placeholder summaries, for the API to summarize"""
+    doc = db.collection(PROCESSING_COLLECTION).document(processing_id(video_path)).get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    if data.get('status') != 'completed' or str(data.get('generation')) != generation:
+        return None
+    if data.get('summarySource') != TRIGGER_SUMMARY_SOURCE:
+        return None
+    return data.get('chapters') or None
+
+
+@traced('load_clips')
+def load_clips(db, video_path: str, generation: str) -> Optional[Dict[str, Any]]:
+    """Chapter clips stored in videoclips/{id} for this generation of the video"""
+    doc = db.collection(CLIPS_COLLECTION).document(processing_id(video_path)).get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    if str(data.get('generation')) != generation or not data.get('clips'):
+        return None
+    return {
+        'video_id': video_path,
+        'clips': data['clips'],
+    }
+
+
+@traced('wait_for_trigger')
+def wait_for_trigger(db, video_path: str, generation: str,
+                     timeout: float = TRIGGER_TIMEOUT) -> Optional[Dict[str, Any]]:
+    """If the storage trigger is processing this generation right now, wait
+    for it rather than transcribing the video twice. Returns its chapters if
+    they can be served as they are; placeholder chapters are left to
+    load_trigger_chapters."""
+    ref = db.collection(PROCESSING_COLLECTION).document(processing_id(video_path))
+    deadline = time.monotonic() + timeout
+    while True:
+        doc = ref.get()
+        data = (doc.to_dict() or {}) if doc.exists else {}
+        if data.get('status') != 'processing' or str(data.get('generation')) != generation:
+            break
+        created = data.get('created_at')
+        if isinstance(created, datetime):
+            age = (datetime.now(timezone.utc) - created).total_seconds()
+            if age > TRIGGER_TIMEOUT:
+                return None
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(TRIGGER_POLL_INTERVAL)
+    return load_chapters(db, video_path, generation)
+
+
+def result_etag(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+
+def conditional_response(payload: Dict[str, Any], status: int = 200) -> Response:
+    """JSON response with an ETag, or an empty 304 if the client already has it"""
+    etag = result_etag(payload)
+    if status == 200 and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -1,28 +1,113 @@
 from flask import Blueprint, request, jsonify
-from firebase_admin import initialize_app, credentials, get_app, storage
+from firebase_admin import initialize_app, credentials, get_app, storage, firestore
 from openai import OpenAI
-from deepgram import Deepgram
 import os
-import asyncio
-from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import timedelta
-from google.cloud import firestore
+from .search_index import get_search_index, update_search_index
+from .transcript_index import build_sentence_entries, get_transcript_index, save_transcript_index
+from .vector_index import get_vector_index, index_video_summary, index_video_chapters
+from .related_videos import get_related_videos, update_related_videos, NEIGHBOURS
+from .governor import get_governor
+from .metrics import timed, record_llm_usage, record_summary_cache, degraded_results
+from .tracing import span
+from .chapter_grouping import (plan_windows, parse_groups, groups_from_starts, reconcile_windows, duration_groups,
+                               clip_ranges, range_groups)
+from .audio_fingerprint import AUDIO_DEDUP, FingerprintMatch, find_duplicate
+from .clip_export import export_chapter_clips
+from .webvtt import publish_tracks_later
+from .prompt_budget import check_prompt, compact_blocks, compact_text, prompt_budget, count_tokens
+from .fallbacks import extractive_summary, frequent_keywords, keyword_title
+from .deadlines import (deadline_scope, request_timeout, carry_deadline, call_timeout, hedged,
+                        get_latency_tracker, DeadlineExceeded)
+from .summary_cache import get_summary_cache, summary_key
+from .write_behind import get_write_behind
+from .result_store import (get_video_generation, wants_refresh, load_summary, load_chapters, wait_for_trigger,
+                           conditional_response, processing_id, load_clips, video_doc_id, load_trigger_chapters, PROCESSING_COLLECTION,
+                           CLIPS_COLLECTION, TRIGGER_TIMEOUT, MODEL_SUMMARY_SOURCE, DERIVED_BUCKET)
+from .single_flight import SingleFlight, get_lock_backend
+from .transcript_archive import TranscriptArchive, load_transcript, save_transcript
+from .transcription_backends import transcribe
+from .live_transcription import get_live_transcriber, LiveSessionError, AUDIO_OPTIONS
 
 chapters_bp = Blueprint('chapters', __name__, url_prefix='/api')
 
-# Initialize Firebase Admin
+# Initialize Firebase Admin, reusing the app if the host process already set one up
 try:
-    cred = credentials.Certificate('firebase-credentials.json')
+    app = get_app()
+except ValueError:
+    cred = credentials.Certificate(os.environ.get('FIREBASE_CREDENTIALS', 'firebase-credentials.json'))
     initialize_app(cred, {
         'storageBucket': 'trainup-51d3c.firebasestorage.app'
     })
-except ValueError:
-    # If the app is already initialized, get the existing app
-    app = get_app()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+# Initialize OpenAI client. Retries are the governor's, so the client's own are off
+client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=0)
+
+# Identical in-flight video jobs share one computation. With a cross-process
+# lock, queued writes are flushed before the lock is released so the next
+# process finds the stored result.
+flights = SingleFlight(get_lock_backend(),
+                       before_release=lambda: get_write_behind(firestore.client()).flush(timeout=30))
+
+# Long transcripts are grouped in overlapping windows. GPT-4's 8K context
+# has to hold the instructions, the window and a reply listing every block.
+GROUPING_WINDOW_TOKENS = 3000
+GROUPING_OVERLAP_TOKENS = 400
+GROUPING_WORKERS = 8
+# Second pass over windowed drafts that merges neighbours split mid-topic
+CHAPTER_MERGE_PASS = os.environ.get('CHAPTER_MERGE_PASS', '1') != '0'
+MERGE_PREVIEW_CHARS = 400
+CHAPTER_SUMMARY_MODEL = "gpt-3.5-turbo"  # Using 3.5 for summaries to save cost
+SUMMARY_WORKERS = 8
+# Chapter length when GPT grouping fails and blocks are grouped by duration
+FALLBACK_CHAPTER_SECONDS = 30.0
+
+# A completion still running past its model's recent p95 latency is raced by
+# a second request to the hedge model (the same model just duplicates it)
+HEDGE_MODELS = {"gpt-4": "gpt-3.5-turbo", "gpt-3.5-turbo": "gpt-3.5-turbo"}
+# Hedge thresholds until enough latencies have been observed
+HEDGE_AFTER_SECONDS = {"gpt-4": 20.0, "gpt-3.5-turbo": 8.0}
+OPENAI_TIMEOUT = 120.0
+
+# Chapters for uploads transcribed live are generated in the background as
+# soon as the upload completes
+live_chapter_jobs = ThreadPoolExecutor(max_workers=4, thread_name_prefix='live-chapters')
+
+def chat_completion(call: str, **kwargs):
+    """Run a chat completion through the OpenAI governor and record its token usage
+    
+    Each attempt times out by the request's deadline. A call slower than
+    usual for its model is hedged to HEDGE_MODELS and the first answer wins.
+    The prompt is counted before sending and refused if it leaves the model
+    no room to answer; tokens in and out are recorded under the call's name.
+    """
+    def complete(model: str):
+        def run():
+            response = get_governor('openai').call(
+                lambda: client.chat.completions.create(**{**kwargs, 'model': model},
+                                                       timeout=call_timeout(OPENAI_TIMEOUT)))
+            record_llm_usage(model, getattr(response, 'usage', None), call=call)
+            return response
+        return run
+
+    model = kwargs['model']
+    prompt_tokens = check_prompt(kwargs['messages'], model)
+    hedge_model = HEDGE_MODELS.get(model)
+    tracker = get_latency_tracker('openai', model, HEDGE_AFTER_SECONDS.get(model, OPENAI_TIMEOUT / 4))
+    with span('chat_completion', call=call, model=model, prompt_tokens=prompt_tokens) as completion:
+        response = hedged(complete(model), complete(hedge_model) if hedge_model else None, tracker, 'openai')
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            completion.set(completion_tokens=getattr(usage, 'completion_tokens', None))
+        return response
+
+def derived_bucket():
+    """Bucket for transcripts, tracks and clips, apart from the uploads"""
+    return storage.bucket(DERIVED_BUCKET)
 
+@timed('get_video_url')
 def get_video_url(video_path: str) -> str:
     """Generate a signed URL for accessing the video"""
     bucket = storage.bucket()
@@ -33,40 +118,17 @@ def get_video_url(video_path: str) -> str:
         method="GET"
     )
 
-async def transcribe_with_deepgram(url: str, options: Dict[str, bool]) -> Optional[Dict[str, Any]]:
-    """Transcribe video using Deepgram with specified options
+@timed('group_window_with_gpt')
+def group_window_with_gpt(blocks: List[Dict]) -> List[int]:
+    """Use GPT to group one window of blocks into chapters
     
     Returns:
-        The first alternative from the first channel, or None if no voice content
+        The index (within the window) of the first block of each chapter
     """
-    dg_client = Deepgram(os.getenv('DEEPGRAM_API_KEY'))
-    
-    source = {'url': url}
-    dg_options = {
-        'punctuate': True,
-        'paragraphs': True,
-        'utterances': True,
-        'tier': 'enhanced'
-    }
-    
-    if options.get('summarize'):
-        dg_options['summarize'] = True
-    if options.get('detectTopics'):
-        dg_options['detect_topics'] = True
-    if options.get('sentiment'):
-        dg_options['detect_sentiment'] = True
-    
-    response = await dg_client.transcription.prerecorded(source, dg_options)
-    
-    # Extract just the transcript data we need
-    try:
-        return response['results']['channels'][0]['alternatives'][0]
-    except (KeyError, IndexError):
-        return None
-
-def group_blocks_with_gpt(blocks: List[Dict]) -> List[List[int]]:
-    """Use GPT to group blocks into logical chapters based on topics"""
-    blocks_text = "\n".join(f"Block {i}: {block.get('text', '')}" for i, block in enumerate(blocks))
+    # Compaction keeps every block, so the numbers GPT answers with still index blocks
+    texts = compact_blocks([block.get('text', '') for block in blocks],
+                           prompt_budget('group_window_with_gpt', "gpt-4"), "gpt-4", 'group_window_with_gpt')
+    blocks_text = "\n".join(f"Block {i}: {text}" for i, text in enumerate(texts))
     
     # Create the prompt with better guidance
     prompt = f"""You are analyzing a training video transcript that may contain:
@@ -96,7 +158,8 @@ Only return the list, no other text.
 keep in mind that we want these to be easily consumable for training videos that are not much longer than a minute
 """
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'group_window_with_gpt',
         model="gpt-4",
         messages=[
             {"role": "system", "content": "You are a helpful assistant that understands how training videos are structured, with introductions, main topics, and conclusions."},
@@ -106,13 +169,100 @@ keep in mind that we want these to be easily consumable for training videos that
     )
     
     try:
-        return eval(response.choices[0].message.content.strip())
+        with span('parse_groups'):
+            return parse_groups(response.choices[0].message.content, len(blocks))
     except Exception as e:
         raise ValueError("Failed to parse GPT response for block grouping")
 
+def grouping_windows(blocks: List[Dict]) -> List[Tuple[int, int]]:
+    """Overlapping windows of blocks, sized with GPT-4's tokenizer"""
+    return plan_windows(blocks, GROUPING_WINDOW_TOKENS, GROUPING_OVERLAP_TOKENS,
+                        count=lambda text: count_tokens(text, "gpt-4"))
+
+def group_windows(blocks: List[Dict], group_window, windows: Optional[List[Tuple[int, int]]] = None) -> List[int]:
+    """Run group_window over overlapping windows of blocks (planned here
+    unless given) in parallel and reconcile the chapter starts they return"""
+    if windows is None:
+        windows = grouping_windows(blocks)
+    if len(windows) == 1:
+        return group_window(blocks)
+
+    def group(window):
+        start, end = window
+        return [start + index for index in group_window(blocks[start:end])]
+
+    with ThreadPoolExecutor(max_workers=GROUPING_WORKERS) as executor:
+        window_starts = list(executor.map(carry_deadline(group), windows))
+    return reconcile_windows(windows, window_starts)
+
+@timed('merge_chapters_with_gpt')
+def merge_chapters_with_gpt(previews: List[Dict]) -> List[int]:
+    """Use GPT to merge neighbouring draft chapters that continue one topic
+    
+    Returns:
+        The index of the first draft of each merged chapter
+    """
+    texts = compact_blocks([preview.get('text', '') for preview in previews],
+                           prompt_budget('merge_chapters_with_gpt', "gpt-4"), "gpt-4", 'merge_chapters_with_gpt')
+    drafts_text = "\n".join(f"Chapter {i}: {text}" for i, text in enumerate(texts))
+
+    prompt = f"""These are consecutive draft chapters of a training video. The transcript was split into pieces to draft them, so some neighbouring drafts may continue the same topic.
+
+{drafts_text}
+
+Merge neighbouring drafts that cover the same topic or step so each chapter works as a self-contained refresher. Keep distinct topics, the introduction and the conclusion separate.
+Return a list of lists, where each inner list contains consecutive chapter numbers that form one chapter.
+Example: [[0], [1,2], [3], [4,5,6]]
+Only return the list, no other text."""
+
+    response = chat_completion(
+        'merge_chapters_with_gpt',
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant that understands how training videos are structured, with introductions, main topics, and conclusions."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0
+    )
+
+    try:
+        with span('parse_groups'):
+            return parse_groups(response.choices[0].message.content, len(previews))
+    except Exception as e:
+        raise ValueError("Failed to parse GPT response for chapter merging")
+
+@timed('group_blocks_with_gpt')
+def group_blocks_with_gpt(blocks: List[Dict], merge: bool = CHAPTER_MERGE_PASS) -> List[List[int]]:
+    """Use GPT to group blocks into logical chapters based on topics
+    
+    Transcripts that fit one prompt are grouped in a single call. Longer ones
+    are grouped window by window in parallel, so latency stays close to that
+    of one window however long the video is, and then the drafts get a
+    merge pass (windowed the same way) to rejoin topics split at a window edge.
+    """
+    windows = grouping_windows(blocks)
+    starts = group_windows(blocks, group_window_with_gpt, windows)
+    groups = groups_from_starts(starts, len(blocks))
+    if not merge or len(windows) == 1:
+        return groups
+
+    previews = [
+        {'text': ' '.join(blocks[i].get('text', '') for i in group)[:MERGE_PREVIEW_CHARS]}
+        for group in groups
+    ]
+    try:
+        merged_starts = group_windows(previews, merge_chapters_with_gpt)
+    except Exception as e:
+        print(f"Chapter merge pass failed, keeping drafts: {str(e)}")
+        return groups
+    return groups_from_starts([groups[i][0] for i in merged_starts], len(blocks))
+
+@timed('summarize_chapter_with_gpt')
 def summarize_chapter_with_gpt(blocks: List[Dict]) -> str:
     """Use GPT to generate a concise summary of a chapter"""
-    chapter_text = " ".join(block.get('text', '') for block in blocks)
+    chapter_text = compact_text(" ".join(block.get('text', '') for block in blocks),
+                                prompt_budget('summarize_chapter_with_gpt', CHAPTER_SUMMARY_MODEL),
+                                CHAPTER_SUMMARY_MODEL, 'summarize_chapter_with_gpt')
     
     prompt = f"""Summarize this section of a video transcript in one or two sentences:
 
@@ -120,8 +270,9 @@ def summarize_chapter_with_gpt(blocks: List[Dict]) -> str:
 
 Return only the summary, no other text."""
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",  # Using 3.5 for summaries to save cost
+    response = chat_completion(
+        'summarize_chapter_with_gpt',
+        model=CHAPTER_SUMMARY_MODEL,
         messages=[
             {"role": "system", "content": "You are a helpful assistant that creates concise summaries."},
             {"role": "user", "content": prompt}
@@ -131,6 +282,33 @@ Return only the summary, no other text."""
     
     return response.choices[0].message.content.strip()
 
+def summarize_chapters(chapters: List[List[Dict]]) -> List[Optional[str]]:
+    """Summarize each chapter's blocks concurrently
+    
+    Summaries are cached by a hash of the chapter text, so regrouping a video
+    only pays for chapters whose content changed. A chapter whose summary
+    fails gets None rather than failing the rest.
+    """
+    cache = get_summary_cache(firestore.client())
+
+    def summarize(blocks: List[Dict]) -> Optional[str]:
+        key = summary_key(' '.join(block.get('text', '') for block in blocks), CHAPTER_SUMMARY_MODEL)
+        summary = cache.get(key)
+        if summary is not None:
+            record_summary_cache(hit=True)
+            return summary
+        record_summary_cache(hit=False)
+        try:
+            summary = summarize_chapter_with_gpt(blocks)
+        except Exception as e:
+            print(f"Error summarizing chapter: {str(e)}")
+            return None
+        cache.put(key, summary, CHAPTER_SUMMARY_MODEL)
+        return summary
+
+    with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+        return list(executor.map(carry_deadline(summarize), chapters))
+
 def create_chapter_from_blocks(blocks: List[Dict]) -> Dict:
     """Create a chapter object from a list of blocks"""
     texts = [block.get('text', '') for block in blocks]
@@ -141,57 +319,165 @@ def create_chapter_from_blocks(blocks: List[Dict]) -> Dict:
         'text': ' '.join(texts),
     }
 
-def generate_semantic_chapters(video_url: str) -> Dict[str, Any]:
-    """Generate semantically coherent chapters from a video using AI transcription and analysis.
+def find_source_upload(video_path: str, generation: str) -> Optional[FingerprintMatch]:
+    """Earlier upload this upload's audio is a copy or trimmed part of, if any"""
+    if not AUDIO_DEDUP:
+        return None
+    try:
+        return find_duplicate(firestore.client(), get_video_url(video_path), video_path, generation)
+    except Exception as e:
+        print(f"Error fingerprinting {video_path}: {str(e)}")
+        return None
+
+def get_transcript(video_path: str, generation: str) -> Optional[TranscriptArchive]:
+    """Transcript of this upload of a video, from its archive when there is
+    one, otherwise cut from the transcript of an earlier upload of the same
+    audio or from the transcription backend, and archived for next time
+    
+    Returns:
+        None if no voice content was found
+    """
+    bucket = derived_bucket()
+    try:
+        archive = load_transcript(bucket, video_path, generation)
+    except Exception as e:
+        print(f"Error loading transcript archive: {str(e)}")
+        archive = None
+    if archive is not None:
+        return archive
+
+    match = find_source_upload(video_path, generation)
+    if match is not None:
+        try:
+            source = load_transcript(bucket, match.video_path, match.generation)
+        except Exception as e:
+            print(f"Error loading transcript archive of {match.video_path}: {str(e)}")
+            source = None
+        if source is not None:
+            archive = source.clip(match.offset, match.offset + match.duration)
+
+    if archive is None:
+        transcript = transcribe(get_video_url(video_path))
+        if transcript is None:
+            return None
+        archive = TranscriptArchive.from_transcript(transcript)
+
+    try:
+        save_transcript(bucket, video_path, generation, archive)
+    except Exception as e:
+        print(f"Error saving transcript archive: {str(e)}")
+    return archive
+
+def reuse_chapters(match: FingerprintMatch, transcript: Optional[TranscriptArchive]) -> Optional[Dict[str, Any]]:
+    """The stored chapters of the upload this one was cut from, moved onto
+    this upload's timeline, in the shape generate_semantic_chapters returns"""
+    if transcript is None:
+        return None
+    try:
+        stored = load_chapters(firestore.client(), match.video_path, match.generation)
+    except Exception as e:
+        print(f"Error reading chapters of {match.video_path}: {str(e)}")
+        return None
+    if not stored:
+        return None
+
+    ranges = clip_ranges(stored['chapters'], match.offset, match.offset + match.duration)
+    blocks = transcript.sentences()
+    chapters, block_groups = [], []
+    for chapter, group in zip(ranges, range_groups(blocks, [chapter['start'] for chapter in ranges])):
+        if group:
+            entry = create_chapter_from_blocks([blocks[i] for i in group])
+            entry['summary'] = chapter.get('summary')
+            chapters.append(entry)
+            block_groups.append(group)
+    if not chapters:
+        return None
+    return {
+        'chapters': chapters,
+        'suggested_title': stored['suggested_title'],
+        'sentences': build_sentence_entries(blocks, block_groups),
+        'degraded': False
+    }
+
+def generate_semantic_chapters(transcript: Optional[TranscriptArchive]) -> Dict[str, Any]:
+    """Generate semantically coherent chapters from a video transcript using AI analysis.
     
     Args:
-        video_url: The signed URL to access the video
+        transcript: The video's transcript, from get_transcript
         
     Returns:
-        Dict containing list of chapters and suggested title. Returns empty chapters list if:
+        Dict containing list of chapters, suggested title and the timed transcript
+        sentences tagged with their chapter. Stages that fail or run out of
+        the request's time fall back to local stand-ins (chapters by duration,
+        leading sentences as summaries, a title from frequent words) and
+        'degraded' is set. Returns empty chapters list if:
         - No audio/voice content detected
         - No paragraphs/sentences found in transcript
-        - Unable to generate meaningful chapters
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        transcript = loop.run_until_complete(transcribe_with_deepgram(video_url, {}))
-    finally:
-        loop.close()
-
-    if not transcript:
-        return {'chapters': [], 'suggested_title': 'Untitled Video'}
+    if transcript is None:
+        return {'chapters': [], 'suggested_title': 'Untitled Video', 'sentences': [], 'degraded': False}
     
-    blocks = []
-    if 'paragraphs' in transcript:
-        for para in transcript['paragraphs'].get('paragraphs', []):
-            if 'sentences' in para:
-                blocks.extend(para['sentences'])
+    blocks = transcript.sentences()
     
     if not blocks:
-        return {'chapters': [], 'suggested_title': 'Untitled Video'}
-        
+        return {'chapters': [], 'suggested_title': 'Untitled Video', 'sentences': [], 'degraded': False}
+
+    degraded = False
     try:
         block_groups = group_blocks_with_gpt(blocks)
-        chapters = [
-            create_chapter_from_blocks([blocks[i] for i in group])
-            for group in block_groups
-        ]
-        
-        # Generate title based on all chapter content
-        all_text = ' '.join(chapter['text'] for chapter in chapters)
+    except Exception as e:
+        print(f"Chapter grouping failed, grouping by duration: {str(e)}")
+        block_groups = duration_groups(blocks, FALLBACK_CHAPTER_SECONDS)
+        degraded = True
+    return summarize_groups(blocks, block_groups, degraded)
+
+def summarize_trigger_chapters(stored: List[Dict[str, Any]],
+                               transcript: Optional[TranscriptArchive]) -> Optional[Dict[str, Any]]:
+    """The chapters the storage trigger stored, summarized with a model from
+    its archived transcript, in the shape generate_semantic_chapters returns.
+    Its chapter bounds are kept rather than grouping the transcript again."""
+    if transcript is None:
+        return None
+    blocks = transcript.sentences()
+    block_groups = [group for group in range_groups(blocks, [float(chapter['start']) for chapter in stored]) if group]
+    if not block_groups:
+        return None
+    return summarize_groups(blocks, block_groups)
+
+def summarize_groups(blocks: List[Dict], block_groups: List[List[int]], degraded: bool = False) -> Dict[str, Any]:
+    """Chapters of these groups of blocks with model summaries and a title,
+    falling back to local stand-ins (and setting 'degraded') where a model fails"""
+    chapter_blocks = [[blocks[i] for i in group] for group in block_groups]
+    chapters = [create_chapter_from_blocks(group) for group in chapter_blocks]
+    for chapter, summary in zip(chapters, summarize_chapters(chapter_blocks)):
+        if summary is None:
+            summary = extractive_summary(chapter['text'])
+            degraded = True
+        chapter['summary'] = summary
+    
+    # Generate title based on all chapter content
+    all_text = ' '.join(chapter['text'] for chapter in chapters)
+    try:
         suggested_title = generate_playlist_title(all_text)
-        
-        return {
-            'chapters': chapters,
-            'suggested_title': suggested_title
-        }
-    except Exception:
-        return {'chapters': [], 'suggested_title': 'Untitled Video'}
+    except Exception as e:
+        print(f"Title generation failed: {str(e)}")
+        suggested_title = keyword_title(frequent_keywords(all_text))
+        degraded = True
+
+    if degraded:
+        degraded_results.inc(stage='chapters')
+    return {
+        'chapters': chapters,
+        'suggested_title': suggested_title,
+        'sentences': build_sentence_entries(blocks, block_groups),
+        'degraded': degraded
+    }
 
+@timed('extract_keywords_with_gpt')
 def extract_keywords_with_gpt(summary: str) -> List[str]:
     """Use GPT-3.5 to extract 4-6 keywords from a summary"""
+    summary = compact_text(summary, prompt_budget('extract_keywords_with_gpt', "gpt-3.5-turbo"),
+                           "gpt-3.5-turbo", 'extract_keywords_with_gpt')
     prompt = f"""Analyze this video summary and extract 4-6 key terms that would be useful for:
 1. Search/discovery
 2. Content categorization
@@ -211,7 +497,8 @@ python data_structures exception_handling object_oriented_programming
 
 Your response should only contain the keywords, nothing else."""
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'extract_keywords_with_gpt',
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "You are a technical content analyzer that extracts precise, meaningful keywords for educational videos."},
@@ -224,8 +511,11 @@ Your response should only contain the keywords, nothing else."""
     keywords = [word.strip().lower() for word in response.choices[0].message.content.strip().split()]
     return keywords[:6]  # Ensure we don't get more than 6 keywords
 
+@timed('generate_playlist_title')
 def generate_playlist_title(summary: str) -> str:
     """Use GPT-3.5 to generate a short, catchy playlist title based on video content"""
+    summary = compact_text(summary, prompt_budget('generate_playlist_title', "gpt-3.5-turbo"),
+                           "gpt-3.5-turbo", 'generate_playlist_title')
     prompt = f"""Generate a short, catchy playlist title (2-5 words) based on this video summary:
 
 {summary}
@@ -239,7 +529,8 @@ Rules:
 
 Return only the title, nothing else."""
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'generate_playlist_title',
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "You are a creative assistant that generates concise, engaging titles for educational content."},
@@ -250,86 +541,139 @@ Return only the title, nothing else."""
     
     return response.choices[0].message.content.strip()
 
-@chapters_bp.route('/get_summary', methods=['POST'])
-def get_summary():
-    """Get just the summary for a video
-    Request body:
-    {
-        "videoPath": "videos/user_id/video_id.mp4"
-    }
-    """
-    data = request.get_json()
-    
-    if not data or 'videoPath' not in data:
-        return jsonify({'error': 'Missing videoPath in request body'}), 400
+def summarize_video(video_path: str, video_id: Optional[str], generation: str, force: bool) -> Dict[str, Any]:
+    """Summary, keywords and title for a video, from the stored result when
+    current. video_id is the id of its videos document, None if it has none."""
+    if not force and video_id is not None:
+        try:
+            stored = load_summary(firestore.client(), video_id, generation)
+        except Exception as e:
+            print(f"Error reading stored summary: {str(e)}")
+            stored = None
+        if stored:
+            try:
+                # The index on this host may not have seen it yet
+                index_video_summary(video_id, video_path, stored['summary'], stored['suggested_title'], missing=True)
+            except Exception as e:
+                print(f"Error updating vector index: {str(e)}")
+            return stored
 
-    video_path = data['videoPath']
-    if not video_path.startswith('videos/'):
-        return jsonify({'error': 'Invalid video path format'}), 400
-        
-    try:
-        url = get_video_url(video_path)
-    except ValueError as e:
-        return jsonify({'error': "howdy" + str(e)}), 404
-    
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        response = loop.run_until_complete(transcribe_with_deepgram(url, {}))
-    finally:
-        loop.close()
+    # A full re-upload of earlier audio takes that upload's summary; a
+    # trimmed part of one is summarized from its own transcript
+    match = find_source_upload(video_path, generation)
+    if match is not None and match.exact:
+        try:
+            db = firestore.client()
+            source_id = video_doc_id(db, match.video_path)
+            reused = load_summary(db, source_id, match.generation) if source_id else None
+        except Exception as e:
+            print(f"Error reading summary of {match.video_path}: {str(e)}")
+            reused = None
+        if reused:
+            store_summary(video_path, video_id, generation, reused)
+            return reused
+
+    archive = get_transcript(video_path, generation)
  
-    if not response:
-        return jsonify({
+    if archive is None:
+        return {
             'summary': 'No voice content detected in this video',
             'keywords': [],
             'suggested_title': 'Untitled Video'
-        }), 200
+        }
 
-    transcript = response.get('transcript')
+    transcript = archive.transcript
     if not transcript:
-        return jsonify({
+        return {
             'summary': 'No transcription available for this video',
             'keywords': [],
             'suggested_title': 'Untitled Video'
-        }), 200
+        }
 
-    summary = summarize_chapter_with_gpt([{'text': transcript}])
-    keywords = extract_keywords_with_gpt(summary)
-    suggested_title = generate_playlist_title(summary)
+    degraded = False
+    try:
+        summary = summarize_chapter_with_gpt([{'text': transcript}])
+    except Exception as e:
+        print(f"Summary generation failed: {str(e)}")
+        summary = extractive_summary(transcript)
+        degraded = True
+    try:
+        keywords = extract_keywords_with_gpt(summary)
+    except Exception as e:
+        print(f"Keyword extraction failed: {str(e)}")
+        keywords = frequent_keywords(transcript)
+        degraded = True
+    try:
+        suggested_title = generate_playlist_title(summary)
+    except Exception as e:
+        print(f"Title generation failed: {str(e)}")
+        suggested_title = keyword_title(keywords)
+        degraded = True
+
+    if degraded:
+        # Not stored, so the next request tries the models again
+        degraded_results.inc(stage='summary')
+        return {
+            'summary': summary,
+            'keywords': keywords,
+            'suggested_title': suggested_title,
+            'degraded': True
+        }
     
+    result = {
+        'summary': summary,
+        'keywords': keywords,
+        'suggested_title': suggested_title
+    }
+    store_summary(video_path, video_id, generation, result)
+    return result
+
+def store_summary(video_path: str, video_id: Optional[str], generation: str, result: Dict[str, Any]):
+    """Record a video's summary in its videos document and the search indexes"""
+    if video_id is None:
+        print(f"Not storing summary of {video_path}, which has no videos document")
+        return
+    summary, keywords, suggested_title = result['summary'], result['keywords'], result['suggested_title']
     # Update Firestore document with the new summary data
     try:
-        # Extract video ID from path (e.g., "videos/B26t813uX7r2cihYDdEk" -> "B26t813uX7r2cihYDdEk")
-        video_id = video_path.split('/')[-1]
-        db = firestore.client()
-        doc_ref = db.collection('videos').document(video_id)
-        
-        # Update the document with new summary data
-        doc_ref.update({
+        # Queue the update; the write-behind writer commits it off the request path
+        get_write_behind(firestore.client()).update('videos', video_id, {
             'summary': summary,
             'keywords': keywords,
             'suggestedTitle': suggested_title,
+            'summaryGeneration': generation,
             'lastProcessed': firestore.SERVER_TIMESTAMP
         })
-        print(f"Updated Firestore document {video_id} with new summary data")
+        print(f"Queued Firestore update of {video_id} with new summary data")
     except Exception as e:
         print(f"Error updating Firestore: {str(e)}")
         # Continue anyway - we still want to return the summary to the client
-    
-    return jsonify({
-        'summary': summary,
-        'keywords': keywords,
-        'suggested_title': suggested_title
-    }), 200
 
-@chapters_bp.route('/generate_chapters', methods=['POST'])
-def generate_chapters():
-    """Generate chapters for a video
+    try:
+        update_search_index(video_id, keywords, suggested_title, summary)
+        update_related_videos(video_id, keywords)
+    except Exception as e:
+        print(f"Error updating search indexes: {str(e)}")
+
+    try:
+        index_video_summary(video_id, video_path, summary, suggested_title)
+    except Exception as e:
+        print(f"Error updating vector index: {str(e)}")
+
+@chapters_bp.route('/get_summary', methods=['POST'])
+def get_summary():
+    """Get just the summary for a video
     Request body:
     {
-        "videoPath": "videos/user_id/video_id.mp4"
+        "videoPath": "videos/user_id/video_id.mp4",
+        "force": false,  // optional, recompute even if a stored summary is current
+        "timeout": 60    // optional, seconds to spend at most (default and cap REQUEST_TIMEOUT)
     }
+    
+    The summary stored for the current upload of the video is returned
+    without reprocessing, and identical requests arriving while one is
+    being computed share its result. Responses carry an ETag; send it back
+    in If-None-Match to get a 304 when nothing changed.
     """
     data = request.get_json()
     
@@ -339,15 +683,86 @@ def generate_chapters():
     video_path = data['videoPath']
     if not video_path.startswith('videos/'):
         return jsonify({'error': 'Invalid video path format'}), 400
-        
-    # First check if video exists and get URL
+
+    generation = get_video_generation(storage.bucket(), video_path)
+    if generation is None:
+        return jsonify({'error': 'Video not found'}), 404
     try:
-        url = get_video_url(video_path)
+        video_id = video_doc_id(firestore.client(), video_path)
+    except Exception as e:
+        print(f"Error looking up video document: {str(e)}")
+        video_id = None
+
+    force = wants_refresh(data)
+    try:
+        with deadline_scope(request_timeout(data)):
+            result = flights.do(('summary', video_path, generation, force),
+                                summarize_video, video_path, video_id, generation, force)
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
     except ValueError as e:
-        return jsonify({'error': str(e)}), 404
-        
-    # Generate semantic chapters from the video
-    result = generate_semantic_chapters(url)
+        return jsonify({'error': "howdy" + str(e)}), 404
+
+    return conditional_response(result)
+
+def chapter_video(video_path: str, generation: str, force: bool, await_trigger: bool = True) -> Dict[str, Any]:
+    """Chapters for a video, from the stored result when current"""
+    trigger_chapters = None
+    if not force:
+        try:
+            db = firestore.client()
+            stored = load_chapters(db, video_path, generation)
+            if not stored and await_trigger:
+                stored = wait_for_trigger(db, video_path, generation, timeout=call_timeout(TRIGGER_TIMEOUT))
+            if not stored:
+                trigger_chapters = load_trigger_chapters(db, video_path, generation)
+        except Exception as e:
+            print(f"Error reading stored chapters: {str(e)}")
+            stored = None
+        if stored:
+            try:
+                # The index on this host may not have seen them yet
+                video_id = video_doc_id(firestore.client(), video_path)
+                if video_id is not None:
+                    index_video_chapters(video_id, video_path, stored['chapters'], missing=True)
+            except Exception as e:
+                print(f"Error updating vector index: {str(e)}")
+            return stored
+
+    # The trigger's chapters only need model summaries, from the transcript
+    # it archived. A re-upload of earlier audio takes that upload's
+    # chapters; anything else gets semantic chapters generated from its
+    # transcript.
+    transcript = get_transcript(video_path, generation)
+    result = None
+    if trigger_chapters:
+        result = summarize_trigger_chapters(trigger_chapters, transcript)
+    if result is None:
+        match = find_source_upload(video_path, generation)
+        if match is not None:
+            result = reuse_chapters(match, transcript)
+    if result is None:
+        result = generate_semantic_chapters(transcript)
+
+    try:
+        video_id = video_doc_id(firestore.client(), video_path)
+    except Exception as e:
+        print(f"Error looking up video document: {str(e)}")
+        video_id = None
+
+    # Keep the timed sentences so transcript search can answer without Deepgram
+    if result['sentences'] and video_id is not None:
+        try:
+            save_transcript_index(firestore.client(), video_id, video_path,
+                                  result['sentences'], result['chapters'])
+        except Exception as e:
+            print(f"Error saving transcript index: {str(e)}")
+
+    if result['chapters'] and not result['degraded'] and video_id is not None:
+        try:
+            index_video_chapters(video_id, video_path, result['chapters'])
+        except Exception as e:
+            print(f"Error updating vector index: {str(e)}")
 
     # Return only the essential data
     response = {
@@ -355,10 +770,384 @@ def generate_chapters():
         'chapters': [{
             'start': chapter['start'],
             'end': chapter['end'],
+            'summary': chapter.get('summary'),
         } for chapter in result['chapters']],
         'suggested_title': result['suggested_title']
     }
+
+    if result['degraded']:
+        # Fallback chapters are served but not stored, so the next request
+        # tries the models again
+        response['degraded'] = True
+    elif result['chapters']:
+        try:
+            get_write_behind(firestore.client()).set(PROCESSING_COLLECTION, processing_id(video_path), {
+                'status': 'completed',
+                'path': video_path,
+                'generation': generation,
+                'chapters': response['chapters'],
+                'suggestedTitle': result['suggested_title'],
+                'summarySource': MODEL_SUMMARY_SOURCE,
+                'completed_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+        except Exception as e:
+            print(f"Error storing chapters: {str(e)}")
+        # Players read chapters and captions from static WebVTT files
+        publish_tracks_later(derived_bucket(), firestore.client(), get_write_behind(firestore.client()),
+                             video_path, generation, response['chapters'], result['sentences'])
     
-    return jsonify(response), 200
+    return response
+
+@chapters_bp.route('/generate_chapters', methods=['POST'])
+def generate_chapters():
+    """Generate chapters for a video
+    Request body:
+    {
+        "videoPath": "videos/user_id/video_id.mp4",
+        "force": false,  // optional, regenerate even if stored chapters are current
+        "timeout": 60    // optional, seconds to spend at most (default and cap REQUEST_TIMEOUT)
+    }
+    
+    Chapters already stored in videoprocessing for the current upload, by
+    this endpoint or the storage trigger, are returned without reprocessing;
+    if the trigger is still working on the upload, its result is awaited.
+    Identical requests arriving while one is being computed share its
+    result. Responses carry an ETag for If-None-Match revalidation.
+    """
+    data = request.get_json()
+    
+    if not data or 'videoPath' not in data:
+        return jsonify({'error': 'Missing videoPath in request body'}), 400
+
+    video_path = data['videoPath']
+    if not video_path.startswith('videos/'):
+        return jsonify({'error': 'Invalid video path format'}), 400
         
+    # First check if video exists
+    generation = get_video_generation(storage.bucket(), video_path)
+    if generation is None:
+        return jsonify({'error': 'Video not found'}), 404
+
+    force = wants_refresh(data)
+    try:
+        with deadline_scope(request_timeout(data)):
+            result = flights.do(('chapters', video_path, generation, force),
+                                chapter_video, video_path, generation, force)
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+    return conditional_response(result)
+        
+
+def export_clips(video_path: str, generation: str, force: bool) -> Dict[str, Any]:
+    """Chapter clips for a video, from the stored export when current"""
+    if not force:
+        try:
+            stored = load_clips(firestore.client(), video_path, generation)
+        except Exception as e:
+            print(f"Error reading stored clips: {str(e)}")
+            stored = None
+        if stored:
+            return stored
+
+    chapters = flights.do(('chapters', video_path, generation, False),
+                          chapter_video, video_path, generation, False)
+    clips = export_chapter_clips(derived_bucket(), video_path, generation, chapters['chapters'],
+                                 get_video_url(video_path))
+    response = {
+        'video_id': video_path,
+        'clips': clips
+    }
+
+    if chapters.get('degraded'):
+        # Cut from fallback chapters; the next request cuts them again
+        response['degraded'] = True
+    elif clips:
+        try:
+            get_write_behind(firestore.client()).set(CLIPS_COLLECTION, processing_id(video_path), {
+                'path': video_path,
+                'generation': generation,
+                'clips': clips,
+                'completed_at': firestore.SERVER_TIMESTAMP
+            })
+        except Exception as e:
+            print(f"Error storing clips: {str(e)}")
+    return response
+
+@chapters_bp.route('/export_clips', methods=['POST'])
+def export_chapter_clips_endpoint():
+    """Cut a video into one clip per chapter
+    Request body:
+    {
+        "videoPath": "videos/user_id/video_id.mp4",
+        "force": false,  // optional, cut again even if stored clips are current
+        "timeout": 60    // optional, seconds to spend at most (default and cap REQUEST_TIMEOUT)
+    }
+    
+    Clips are cut without re-encoding, so each starts on the keyframe at or
+    before its chapter and runs to the start of the next clip; 'start' and
+    'end' give the clip's range, 'chapterStart' and 'chapterEnd' the
+    chapter's. Each clip's 'path' is its Storage path under clips/.
+    Chapters are generated first if the video has none yet.
+    """
+    data = request.get_json()
+
+    if not data or 'videoPath' not in data:
+        return jsonify({'error': 'Missing videoPath in request body'}), 400
+
+    video_path = data['videoPath']
+    if not video_path.startswith('videos/'):
+        return jsonify({'error': 'Invalid video path format'}), 400
+
+    generation = get_video_generation(storage.bucket(), video_path)
+    if generation is None:
+        return jsonify({'error': 'Video not found'}), 404
+
+    force = wants_refresh(data)
+    try:
+        with deadline_scope(request_timeout(data)):
+            result = flights.do(('clips', video_path, generation, force),
+                                export_clips, video_path, generation, force)
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+    return conditional_response(result)
+
+def prepare_live_chapters(video_path: str, generation: str):
+    """Generate and store chapters for an upload whose transcript was streamed
+    
+    Runs under the same single-flight key as /generate_chapters, so a client
+    asking for chapters meanwhile waits for this job instead of repeating it.
+    The storage trigger is not awaited since the transcript is already here.
+    """
+    try:
+        flights.do(('chapters', video_path, generation, False),
+                   chapter_video, video_path, generation, False, False)
+        get_write_behind(firestore.client()).flush(timeout=30)
+    except Exception as e:
+        print(f"Error generating chapters for live upload {video_path}: {str(e)}")
+
+@chapters_bp.route('/live/start', methods=['POST'])
+def start_live_transcription():
+    """Start transcribing a video's audio while the video is still uploading
+    Request body:
+    {
+        "videoPath": "videos/user_id/video_id.mp4",
+        "encoding": "linear16",  // optional, only for raw (headerless) audio
+        "sampleRate": 16000,     // optional, only for raw audio
+        "channels": 1,           // optional
+        "language": "en"         // optional
+    }
+    
+    Send the audio in order to /live/{sessionId}/audio as it is recorded or
+    read, then call /live/{sessionId}/finish once the upload has completed.
+    Sessions are held by the live host gunicorn starts alongside its
+    workers, so the audio and finish calls may reach any worker.
+    """
+    data = request.get_json()
+    
+    if not data or 'videoPath' not in data:
+        return jsonify({'error': 'Missing videoPath in request body'}), 400
+
+    video_path = data['videoPath']
+    if not video_path.startswith('videos/'):
+        return jsonify({'error': 'Invalid video path format'}), 400
+
+    options = {option: data[option] for option in AUDIO_OPTIONS if option in data}
+    try:
+        session_id = get_live_transcriber().start(video_path, options)
+    except Exception as e:
+        print(f"Error starting live transcription: {str(e)}")
+        return jsonify({'error': 'Could not open a transcription stream'}), 502
+
+    return jsonify({'sessionId': session_id, 'videoPath': video_path}), 201
+
+@chapters_bp.route('/live/<session_id>/audio', methods=['POST'])
+def send_live_audio(session_id: str):
+    """Forward the next chunk of a session's audio
+    Request body: the raw audio bytes, in order, one request at a time
+    """
+    chunk = request.get_data()
+    if not chunk:
+        return jsonify({'error': 'Empty audio chunk'}), 400
+
+    try:
+        sentences = get_live_transcriber().send(session_id, chunk)
+    except KeyError:
+        return jsonify({'error': 'Unknown live session'}), 404
+    except LiveSessionError as e:
+        return jsonify({'error': str(e)}), 409
+
+    return jsonify({'sessionId': session_id, 'sentences': sentences}), 202
+
+@chapters_bp.route('/live/<session_id>', methods=['GET'])
+def live_transcription_status(session_id: str):
+    """Progress of a live session: audio received and sentences transcribed so far"""
+    try:
+        return jsonify(get_live_transcriber().status(session_id)), 200
+    except KeyError:
+        return jsonify({'error': 'Unknown live session'}), 404
+
+@chapters_bp.route('/live/<session_id>/finish', methods=['POST'])
+def finish_live_transcription(session_id: str):
+    """Finish a live session once its video has been uploaded
+    
+    Waits for the last results, archives the transcript against the stored
+    video and starts generating chapters in the background, so
+    /generate_chapters answers without calling Deepgram. Returns 409 while
+    the video is not in storage yet; finishing can be retried.
+    """
+    transcriber = get_live_transcriber()
+    try:
+        video_path = transcriber.video_path(session_id)
+    except KeyError:
+        return jsonify({'error': 'Unknown live session'}), 404
+
+    generation = get_video_generation(storage.bucket(), video_path)
+    if generation is None:
+        return jsonify({'error': 'Video upload has not completed'}), 409
+
+    try:
+        archive = transcriber.finish(session_id)
+    except LiveSessionError as e:
+        transcriber.discard(session_id)
+        return jsonify({'error': str(e)}), 502
+    except TimeoutError:
+        return jsonify({'error': 'Timed out waiting for the transcript'}), 504
+
+    save_transcript(derived_bucket(), video_path, generation, archive)
+    transcriber.discard(session_id)
+    live_chapter_jobs.submit(prepare_live_chapters, video_path, generation)
+
+    return jsonify({
+        'videoPath': video_path,
+        'generation': generation,
+        'sentences': len(archive),
+        'duration': archive.duration
+    }), 202
+
+@chapters_bp.route('/search', methods=['GET'])
+def search_videos():
+    """Search videos by keyword, title and summary
+    Query parameters:
+        q: search query, e.g. "machine learning"
+        limit: maximum number of results (default 20)
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q query parameter'}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    index = get_search_index(firestore.client())
+    return jsonify({
+        'query': query,
+        'results': index.search(query, limit=limit)
+    }), 200
+
+@chapters_bp.route('/search/complete', methods=['GET'])
+def complete_search():
+    """Suggest search terms for a prefix
+    Query parameters:
+        prefix: partial search term, e.g. "mach"
+        limit: maximum number of suggestions (default 10)
+    """
+    prefix = request.args.get('prefix', '').strip()
+    if not prefix:
+        return jsonify({'error': 'Missing prefix query parameter'}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    index = get_search_index(firestore.client())
+    return jsonify({
+        'prefix': prefix,
+        'suggestions': [
+            {'term': term, 'videoCount': count}
+            for term, count in index.complete(prefix, limit=limit)
+        ]
+    }), 200
+
+@chapters_bp.route('/search_transcripts', methods=['GET'])
+def search_transcripts():
+    """Search every indexed transcript for the moments matching a query
+    Query parameters:
+        q: search query, e.g. "gradient descent"
+        limit: maximum number of hits (default 20)
+        perVideo: maximum number of hits from one video (default 3)
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q query parameter'}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+        per_video = max(int(request.args.get('perVideo', 3)), 1)
+    except ValueError:
+        return jsonify({'error': 'limit and perVideo must be integers'}), 400
+
+    index = get_transcript_index(firestore.client())
+    return jsonify({
+        'query': query,
+        'hits': index.search(query, limit=limit, per_video=per_video)
+    }), 200
+
+@chapters_bp.route('/semantic_search', methods=['GET'])
+def semantic_search():
+    """Find videos and chapters whose meaning is closest to a query
+    Query parameters:
+        q: search query, e.g. "neural nets"
+        k: number of results (default 10)
+        kind: optional "video" or "chapter" to restrict the results
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q query parameter'}), 400
+
+    kind = request.args.get('kind')
+    if kind not in (None, 'video', 'chapter'):
+        return jsonify({'error': 'kind must be "video" or "chapter"'}), 400
 
+    try:
+        k = max(1, min(int(request.args.get('k', 10)), 100))
+    except ValueError:
+        return jsonify({'error': 'k must be an integer'}), 400
+
+    return jsonify({
+        'query': query,
+        'results': get_vector_index().search(query, k=k, kind=kind)
+    }), 200
+
+@chapters_bp.route('/related_videos', methods=['GET'])
+def related_videos():
+    """Get videos related to a video through shared keywords
+    Query parameters:
+        videoId: Firestore id of the video
+        limit: maximum number of related videos (default 10)
+    """
+    video_id = request.args.get('videoId', '').strip()
+    if not video_id:
+        return jsonify({'error': 'Missing videoId query parameter'}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), NEIGHBOURS))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    neighbours = get_related_videos(firestore.client()).neighbours(video_id)
+    return jsonify({
+        'videoId': video_id,
+        'related': [
+            {'videoId': other, 'score': score}
+            for other, score in neighbours[:limit]
+        ]
+    }), 200
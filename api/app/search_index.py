@@ -0,0 +1,353 @@
+import bisect
+import math
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from .collection_watch import follow_collection
+
+# Field weights for the BM25F-style score. Keywords are what GPT picked as
+# the searchable terms for a video so they dominate, then the title, then
+# the free-form summary.
+FIELD_WEIGHTS = {
+    'keywords': 3.0,
+    'suggestedTitle': 2.0,
+    'summary': 1.0,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Score multipliers mirroring VideoSearchService.calculateRelevanceScore on
+# the client: exact keyword matches count fully, partial ones count half.
+EXACT_MATCH_WEIGHT = 1.0
+PARTIAL_MATCH_WEIGHT = 0.5
+
+# Substring matches are resolved through a trigram index over the vocabulary
+# so that "learn" can still find "machine_learning" without scanning it.
+NGRAM_SIZE = 3
+
+
+def normalize_search_term(term: str) -> str:
+    """Lowercase, strip special characters and join words with underscores"""
+    term = re.sub(r'[^\w\s]', '', term.lower().strip())
+    return re.sub(r'\s+', '_', term)
+
+
+def normalize_keyword(keyword: str) -> str:
+    """Lowercase and strip special characters, keeping underscores"""
+    return re.sub(r'[^\w\s_]', '', keyword.lower().strip())
+
+
+def tokenize(text: str) -> List[str]:
+    """Split free text into normalized single-word tokens"""
+    return [token for token in re.findall(r'\w+', text.lower()) if token]
+
+
+def expand_keyword(keyword: str) -> List[str]:
+    """Return the index terms for a compound keyword.
+
+    "machine_learning" is indexed as itself, as its parts ("machine",
+    "learning") and with the underscores removed ("machinelearning") so the
+    same matches the Flutter client makes are available from the index.
+    """
+    normalized = normalize_keyword(keyword).replace(' ', '_')
+    if not normalized:
+        return []
+
+    terms = [normalized]
+    parts = [part for part in normalized.split('_') if part]
+    if len(parts) > 1:
+        terms.extend(parts)
+        terms.append(''.join(parts))
+    return terms
+
+
+def document_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """The indexed fields of a videos document, as InvertedIndex stores them"""
+    return {
+        'keywords': data.get('keywords') or [],
+        'suggestedTitle': data.get('suggestedTitle') or '',
+        'summary': data.get('summary') or '',
+    }
+
+
+class InvertedIndex:
+    """In-memory inverted index over video keywords, titles and summaries"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # term -> {video_id: {field: term frequency}}
+        self._postings: Dict[str, Dict[str, Dict[str, int]]] = defaultdict(dict)
+        # video_id -> {field: length in terms}
+        self._lengths: Dict[str, Dict[str, int]] = {}
+        # video_id -> terms the video contributed, for cheap removal
+        self._doc_terms: Dict[str, Set[str]] = {}
+        # video_id -> stored fields returned with results
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._field_totals: Dict[str, int] = defaultdict(int)
+        self._vocabulary: List[str] = []
+        self._ngrams: Dict[str, Set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self._docs
+
+    @staticmethod
+    def _field_terms(field: str, value: Any) -> List[str]:
+        if field == 'keywords':
+            terms = []
+            for keyword in value or []:
+                terms.extend(expand_keyword(keyword))
+            return terms
+        return tokenize(value or '')
+
+    def _add_term(self, term: str):
+        index = bisect.bisect_left(self._vocabulary, term)
+        if index < len(self._vocabulary) and self._vocabulary[index] == term:
+            return
+        self._vocabulary.insert(index, term)
+        for gram in self._term_ngrams(term):
+            self._ngrams[gram].add(term)
+
+    def _drop_term(self, term: str):
+        index = bisect.bisect_left(self._vocabulary, term)
+        if index < len(self._vocabulary) and self._vocabulary[index] == term:
+            del self._vocabulary[index]
+        for gram in self._term_ngrams(term):
+            self._ngrams[gram].discard(term)
+            if not self._ngrams[gram]:
+                del self._ngrams[gram]
+
+    @staticmethod
+    def _term_ngrams(term: str) -> Set[str]:
+        if len(term) < NGRAM_SIZE:
+            return set()
+        return {term[i:i + NGRAM_SIZE] for i in range(len(term) - NGRAM_SIZE + 1)}
+
+    def upsert(self, video_id: str, keywords: Optional[List[str]] = None,
+               suggested_title: str = '', summary: str = ''):
+        """Add or replace a video's entry in the index"""
+        fields = {
+            'keywords': keywords or [],
+            'suggestedTitle': suggested_title or '',
+            'summary': summary or '',
+        }
+        with self._lock:
+            self._remove_locked(video_id)
+
+            lengths = {}
+            terms = set()
+            for field, value in fields.items():
+                field_terms = self._field_terms(field, value)
+                lengths[field] = len(field_terms)
+                self._field_totals[field] += len(field_terms)
+                for term in field_terms:
+                    counts = self._postings[term].setdefault(video_id, {})
+                    counts[field] = counts.get(field, 0) + 1
+                    if term not in terms:
+                        terms.add(term)
+                        self._add_term(term)
+
+            self._lengths[video_id] = lengths
+            self._doc_terms[video_id] = terms
+            self._docs[video_id] = fields
+
+    def document(self, video_id: str) -> Optional[Dict[str, Any]]:
+        """The fields indexed for a video, if it is in the index"""
+        return self._docs.get(video_id)
+
+    def remove(self, video_id: str):
+        """Remove a video from the index if present"""
+        with self._lock:
+            self._remove_locked(video_id)
+
+    def _remove_locked(self, video_id: str):
+        if video_id not in self._docs:
+            return
+        for term in self._doc_terms.pop(video_id):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(video_id, None)
+            if not postings:
+                del self._postings[term]
+                self._drop_term(term)
+        for field, length in self._lengths.pop(video_id).items():
+            self._field_totals[field] -= length
+        del self._docs[video_id]
+
+    def _prefix_terms(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + '\uffff')
+        return self._vocabulary[start:end]
+
+    def _substring_terms(self, needle: str) -> Set[str]:
+        grams = self._term_ngrams(needle)
+        if not grams:
+            # Too short for the trigram index, fall back to prefix matching
+            return set(self._prefix_terms(needle))
+        candidates = None
+        for gram in grams:
+            terms = self._ngrams.get(gram, set())
+            candidates = set(terms) if candidates is None else candidates & terms
+            if not candidates:
+                return set()
+        return {term for term in candidates if needle in term}
+
+    def _match_terms(self, search_term: str) -> Dict[str, float]:
+        """Resolve one query term to index terms with their match weights.
+
+        Mirrors VideoSearchService.isKeywordMatch: exact matches on an index
+        term (with or without underscores, or a compound part) are full
+        strength, substring matches are partial.
+        """
+        normalized = normalize_search_term(search_term)
+        if not normalized:
+            return {}
+        collapsed = normalized.replace('_', '')
+
+        matches = {}
+        for candidate in {normalized, collapsed}:
+            if candidate in self._postings:
+                matches[candidate] = EXACT_MATCH_WEIGHT
+        for needle in {normalized, collapsed}:
+            for term in self._substring_terms(needle):
+                matches.setdefault(term, PARTIAL_MATCH_WEIGHT)
+        return matches
+
+    def _bm25(self, postings: Dict[str, Dict[str, int]], video_id: str) -> float:
+        doc_count = len(self._docs)
+        df = len(postings)
+        idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+
+        weighted_tf = 0.0
+        lengths = self._lengths[video_id]
+        for field, tf in postings[video_id].items():
+            average = self._field_totals[field] / doc_count if doc_count else 0
+            norm = 1 - BM25_B + BM25_B * (lengths[field] / average if average else 0)
+            weighted_tf += FIELD_WEIGHTS[field] * tf / norm
+        return idf * weighted_tf * (BM25_K1 + 1) / (weighted_tf + BM25_K1)
+
+    def search(self, query: str, limit: int = 20, minimum_score: float = 0.0) -> List[Dict[str, Any]]:
+        """Rank videos for a free-text query.
+
+        Returns:
+            List of {videoId, score, matchedKeywords, suggestedTitle, summary}
+            ordered by descending score
+        """
+        search_terms = [term for term in query.split() if term]
+        if not search_terms:
+            return []
+
+        with self._lock:
+            scores: Dict[str, float] = defaultdict(float)
+            matched_terms: Dict[str, Set[str]] = defaultdict(set)
+            matched_keywords: Dict[str, Set[str]] = defaultdict(set)
+
+            for search_term in search_terms:
+                best: Dict[str, float] = {}
+                for term, weight in self._match_terms(search_term).items():
+                    postings = self._postings[term]
+                    for video_id in postings:
+                        score = weight * self._bm25(postings, video_id)
+                        if score > best.get(video_id, 0.0):
+                            best[video_id] = score
+                        if 'keywords' in postings[video_id]:
+                            matched_keywords[video_id].update(
+                                keyword for keyword in self._docs[video_id]['keywords']
+                                if term in expand_keyword(keyword)
+                            )
+                for video_id, score in best.items():
+                    scores[video_id] += score
+                    matched_terms[video_id].add(search_term)
+
+            results = []
+            for video_id, score in scores.items():
+                # Bonus for matching several query terms, as on the client
+                if len(matched_terms[video_id]) > 1:
+                    score *= 1.0 + (len(matched_terms[video_id]) / len(search_terms)) * 0.5
+                if score < minimum_score:
+                    continue
+                doc = self._docs[video_id]
+                results.append({
+                    'videoId': video_id,
+                    'score': score,
+                    'matchedKeywords': sorted(matched_keywords[video_id]),
+                    'suggestedTitle': doc['suggestedTitle'],
+                    'summary': doc['summary'],
+                })
+
+        results.sort(key=lambda result: (-result['score'], result['videoId']))
+        return results[:limit]
+
+    def complete(self, prefix: str, limit: int = 10) -> List[Tuple[str, int]]:
+        """Suggest index terms starting with prefix, most common first"""
+        normalized = normalize_search_term(prefix)
+        if not normalized:
+            return []
+        with self._lock:
+            terms = [(term, len(self._postings[term])) for term in self._prefix_terms(normalized)]
+        terms.sort(key=lambda item: (-item[1], item[0]))
+        return terms[:limit]
+
+
+_index: Optional[InvertedIndex] = None
+_index_lock = threading.Lock()
+
+
+def index_document(index: InvertedIndex, video_id: str, data: Optional[Dict[str, Any]]):
+    """Apply a videos document to the index: upsert it if it has searchable
+    fields, drop it otherwise"""
+    data = data or {}
+    if not (data.get('keywords') or data.get('summary') or data.get('suggestedTitle')):
+        index.remove(video_id)
+        return
+    index.upsert(
+        video_id,
+        keywords=data.get('keywords'),
+        suggested_title=data.get('suggestedTitle', ''),
+        summary=data.get('summary', ''),
+    )
+
+
+def get_search_index(db) -> InvertedIndex:
+    """Return the process-wide search index, building it on first use.
+
+    The index then follows the videos collection, so summaries written by
+    other workers or by a backfill reach this worker's copy too.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = InvertedIndex()
+
+                def load(docs: Dict[str, Dict[str, Any]]):
+                    for video_id, data in docs.items():
+                        index_document(index, video_id, data)
+                    print(f"Built search index with {len(index)} videos")
+
+                def apply(video_id: str, data: Optional[Dict[str, Any]]):
+                    if data is not None and index.document(video_id) == document_fields(data):
+                        # A change to fields the index does not hold
+                        return
+                    index_document(index, video_id, data)
+
+                follow_collection(db, 'videos', load, apply)
+                _index = index
+    return _index
+
+
+def update_search_index(video_id: str, keywords: List[str], suggested_title: str, summary: str):
+    """Apply a freshly written summary to this worker's index straight away.
+
+    The other workers pick it up from the videos collection once the write
+    lands. Nothing to do until the index has been built: the first build
+    reads the document back from Firestore anyway.
+    """
+    if _index is not None:
+        _index.upsert(video_id, keywords=keywords, suggested_title=suggested_title, summary=summary)
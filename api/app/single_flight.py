@@ -0,0 +1,223 @@
+import contextvars
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Optional
+
+from .deadlines import REQUEST_TIMEOUT, DeadlineExceeded, check_deadline, detached_deadline, remaining
+
+# Empty for in-process coalescing only; 'sqlite' or 'firestore' to also
+# hold a lock other processes respect while a job runs
+SINGLE_FLIGHT_LOCK = os.environ.get('SINGLE_FLIGHT_LOCK', '')
+SINGLE_FLIGHT_DB = os.environ.get('SINGLE_FLIGHT_DB', os.path.join(os.environ.get('INDEX_DIR', 'index_data'), 'singleflight.db'))
+
+# Longer than any single video job; a lock whose holder died is taken over after this
+LOCK_TTL = 600.0
+LOCK_POLL_INTERVAL = 0.25
+
+
+class LockBackend:
+    """Named leases shared between processes"""
+
+    def try_lock(self, name: str, ttl: float) -> Optional[str]:
+        """Take the lock if it is free or expired; returns a token or None"""
+        raise NotImplementedError
+
+    def unlock(self, name: str, token: str):
+        """Release the lock if the token still holds it"""
+        raise NotImplementedError
+
+    @contextmanager
+    def hold(self, name: str, ttl: float = LOCK_TTL):
+        """Block until the lock is taken or the deadline passes, and release it afterwards"""
+        while True:
+            token = self.try_lock(name, ttl)
+            if token is not None:
+                break
+            check_deadline('lock')
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self.unlock(name, token)
+
+
+class SQLiteLockBackend(LockBackend):
+    """Locks shared by every process on the host through one SQLite file"""
+
+    def __init__(self, path: str = SINGLE_FLIGHT_DB):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def try_lock(self, name: str, ttl: float) -> Optional[str]:
+        conn = self._connect()
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM locks WHERE name = ? AND expires <= ?', (name, now))
+            cursor = conn.execute('INSERT OR IGNORE INTO locks VALUES (?, ?, ?)', (name, token, now + ttl))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return token if cursor.rowcount == 1 else None
+
+    def unlock(self, name: str, token: str):
+        self._connect().execute('DELETE FROM locks WHERE name = ? AND token = ?', (name, token))
+
+
+class FirestoreLockBackend(LockBackend):
+    """Locks shared across hosts through one Firestore document per name"""
+
+    def __init__(self, db=None, collection: str = 'locks'):
+        if db is None:
+            from firebase_admin import firestore
+            db = firestore.client()
+        self.db = db
+        self.collection = collection
+
+    def _ref(self, name: str):
+        # Lock names contain slashes, which document ids cannot
+        return self.db.collection(self.collection).document(hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def try_lock(self, name: str, ttl: float) -> Optional[str]:
+        from google.cloud import firestore as gcf
+
+        @gcf.transactional
+        def acquire(transaction):
+            now = time.time()
+            ref = self._ref(name)
+            snapshot = ref.get(transaction=transaction)
+            if snapshot.exists and (snapshot.to_dict() or {}).get('expires', 0) > now:
+                return None
+            token = uuid.uuid4().hex
+            transaction.set(ref, {'name': name, 'token': token, 'expires': now + ttl})
+            return token
+
+        return acquire(self.db.transaction())
+
+    def unlock(self, name: str, token: str):
+        from google.cloud import firestore as gcf
+
+        @gcf.transactional
+        def release(transaction):
+            ref = self._ref(name)
+            snapshot = ref.get(transaction=transaction)
+            if snapshot.exists and (snapshot.to_dict() or {}).get('token') == token:
+                transaction.delete(ref)
+
+        release(self.db.transaction())
+
+
+LOCK_BACKENDS: Dict[str, Callable[[], LockBackend]] = {
+    'sqlite': SQLiteLockBackend,
+    'firestore': FirestoreLockBackend,
+}
+
+
+class _Call:
+    def __init__(self, deadline: Optional[float]):
+        # Monotonic time the computation must finish by, or None
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Runs at most one computation per key at a time.
+
+    Callers arriving while a key's computation is in flight wait for it and
+    share its result (or its exception) instead of starting their own.
+    With a lock backend the computation also holds a cross-process lock on
+    the key, so a worker in another process waits rather than duplicating
+    the job; fn should then check for a stored result first, which the
+    waiting process will find once the lock is released.
+
+    The computation runs in its own thread under a deadline of its own,
+    work_timeout or the first caller's, whichever is longer, so a caller
+    with a short timeout only gives up waiting for itself. A caller whose
+    deadline is later than the computation's, and that sees it run out of
+    time, starts it again rather than failing early.
+    """
+
+    def __init__(self, lock_backend: Optional[LockBackend] = None,
+                 before_release: Optional[Callable[[], Any]] = None, work_timeout: float = REQUEST_TIMEOUT):
+        self.lock_backend = lock_backend
+        # Run by the leader before giving up the cross-process lock, e.g.
+        # to flush queued writes so the next holder can read them
+        self.before_release = before_release
+        self.work_timeout = work_timeout
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, _Call] = {}
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: Any, fn: Callable, *args, **kwargs) -> Any:
+        while True:
+            left = remaining()
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    seconds = None if left is None else max(left, self.work_timeout)
+                    call = self._calls[key] = _Call(None if seconds is None else time.monotonic() + seconds)
+                    # The computation keeps the caller's trace, but not its deadline
+                    context = contextvars.copy_context()
+                    threading.Thread(target=context.run, args=(self._run, key, call, seconds, fn, args, kwargs),
+                                     daemon=True, name='single-flight').start()
+
+            if not call.done.wait(timeout=None if left is None else max(0.0, left)):
+                raise DeadlineExceeded(f"Deadline exceeded waiting for {key}")
+            if call.error is None:
+                return call.result
+            ours = remaining()
+            outlived = call.deadline is not None and (ours is None or time.monotonic() + ours > call.deadline)
+            if not (isinstance(call.error, DeadlineExceeded) and outlived):
+                raise call.error
+
+    def _run(self, key: Any, call: _Call, seconds: Optional[float], fn: Callable, args, kwargs):
+        try:
+            with detached_deadline(seconds):
+                if self.lock_backend is None:
+                    call.result = fn(*args, **kwargs)
+                else:
+                    name = ':'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+                    with self.lock_backend.hold(name):
+                        call.result = fn(*args, **kwargs)
+                        if self.before_release is not None:
+                            self.before_release()
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def get_lock_backend(name: str = SINGLE_FLIGHT_LOCK) -> Optional[LockBackend]:
+    """The configured cross-process lock backend, or None for in-process only"""
+    if not name:
+        return None
+    if name not in LOCK_BACKENDS:
+        raise ValueError(f"Unknown single-flight lock backend: {name}")
+    return LOCK_BACKENDS[name]()
@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from .write_behind import get_write_behind
+
+CACHE_COLLECTION = 'chaptersummaries'
+MEMORY_ENTRIES = 10000
+# Part of every key, so changing the summary prompt or model never serves
+# summaries written for the old one
+PROMPT_VERSION = 2
+
+
+def summary_key(text: str, model: str) -> str:
+    """Content hash of a chapter's text for the given model and prompt version"""
+    normalized = ' '.join(text.split())
+    return hashlib.sha256(f"{PROMPT_VERSION}\0{model}\0{normalized}".encode('utf-8')).hexdigest()
+
+
+class SummaryCache:
+    """Chapter summaries keyed by content hash.
+
+    A bounded in-memory LRU sits in front of a Firestore collection, so
+    every worker shares summaries and a restart does not pay for them again.
+    Firestore errors only cost a cache miss.
+    """
+
+    def __init__(self, db=None, max_entries: int = MEMORY_ENTRIES):
+        self.db = db
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, str]' = OrderedDict()
+
+    def _remember(self, key: str, summary: str):
+        with self._lock:
+            self._entries[key] = summary
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.db is None:
+            return None
+        try:
+            doc = self.db.collection(CACHE_COLLECTION).document(key).get()
+        except Exception as e:
+            print(f"Error reading summary cache: {str(e)}")
+            return None
+        if not doc.exists:
+            return None
+        summary = (doc.to_dict() or {}).get('summary')
+        if summary is not None:
+            self._remember(key, summary)
+        return summary
+
+    def put(self, key: str, summary: str, model: str):
+        self._remember(key, summary)
+        if self.db is None:
+            return
+        get_write_behind(self.db).set(CACHE_COLLECTION, key, {
+            'summary': summary,
+            'model': model,
+            'promptVersion': PROMPT_VERSION,
+        })
+
+
+_cache: Optional[SummaryCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_summary_cache(db) -> SummaryCache:
+    """Return the process-wide chapter summary cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SummaryCache(db)
+    return _cache
@@ -0,0 +1,253 @@
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from typing import Dict, Any, List, Optional
+
+from flask import Flask, g, request
+
+# Fraction of requests traced, and of those also profiled. Both default to
+# off, leaving one context variable lookup per span as the only cost.
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+# Requests sending this token in TRACE_HEADER or PROFILE_HEADER are traced
+# or profiled regardless of the sample rates; without a token the headers
+# are ignored
+TRACE_TOKEN = os.environ.get('TRACE_TOKEN', '')
+TRACE_HEADER = 'X-Tiptok-Trace'
+PROFILE_HEADER = 'X-Tiptok-Profile'
+# Chrome trace event format, readable by Perfetto and chrome://tracing
+TRACE_FILE = os.environ.get('TRACE_FILE', os.path.join(os.environ.get('INDEX_DIR', 'index_data'), 'traces.json'))
+# Collapsed stacks, one file per profiled request, readable by speedscope
+# and flamegraph.pl
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.environ.get('INDEX_DIR', 'index_data'), 'profiles'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+
+_trace: contextvars.ContextVar[Optional['Trace']] = contextvars.ContextVar('trace', default=None)
+_file_lock = threading.Lock()
+
+
+class Trace:
+    """Spans recorded for one request, across every thread its work ran on"""
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.events: List[Dict[str, Any]] = []
+        # Thread id -> spans open on it, so the profiler knows whose stacks to sample
+        self.active: Dict[int, int] = {}
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._wall = time.time()
+        self._started = time.perf_counter()
+
+    def timestamp(self, counter: float) -> float:
+        """Microseconds since the epoch of a perf_counter() reading"""
+        return (self._wall + counter - self._started) * 1e6
+
+    def enter(self) -> int:
+        thread = threading.current_thread()
+        with self._lock:
+            self.active[thread.ident] = self.active.get(thread.ident, 0) + 1
+            self._threads.setdefault(thread.ident, thread.name)
+        return thread.ident
+
+    def exit(self, tid: int, name: str, started: float, args: Dict[str, Any]):
+        ended = time.perf_counter()
+        event = {
+            'name': name, 'cat': 'tiptok', 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+            'ts': round(self.timestamp(started), 1), 'dur': round((ended - started) * 1e6, 1),
+            'args': {'trace_id': self.trace_id, **args},
+        }
+        with self._lock:
+            self.events.append(event)
+            self.active[tid] -= 1
+            if not self.active[tid]:
+                del self.active[tid]
+
+    def thread_name(self, tid: int) -> str:
+        return self._threads.get(tid, str(tid))
+
+    def export(self, path: str = TRACE_FILE):
+        """Append this trace's events to the trace file"""
+        with self._lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                      for tid, name in self._threads.items()] + self.events
+        # The JSON array is left open so traces can be appended; the
+        # trace viewers accept a missing closing bracket
+        data = ''.join(json.dumps(event) + ',\n' for event in events)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with _file_lock:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+                data = '[\n' + data
+            except FileExistsError:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, data.encode())
+            finally:
+                os.close(fd)
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'args', 'tid', 'started')
+
+    def __init__(self, trace: Trace, name: str, args: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        """Add arguments known only once the span's work has run"""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.tid = self.trace.enter()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.trace.exit(self.tid, self.name, self.started, self.args)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def span(name: str, **args):
+    """Record the enclosed block as a span of the current trace, if the
+    request is being traced"""
+    trace = _trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, args)
+
+
+def traced(name: str):
+    """Decorator form of span()"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """Samples the stacks of the threads working on a trace every
+    PROFILE_INTERVAL seconds, and writes them as collapsed stacks"""
+
+    def __init__(self, trace: Trace, interval: float = PROFILE_INTERVAL):
+        self.trace = trace
+        self.interval = interval
+        self.samples: Tally = Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.trace._lock:
+                tids = list(self.trace.active)
+            frames = sys._current_frames()
+            for tid in tids:
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[(self.trace.thread_name(tid),) + tuple(reversed(stack))] += 1
+
+    def stop(self) -> Optional[str]:
+        """Stop sampling and write the profile; returns its path"""
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{self.trace.trace_id}.folded")
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(';'.join(part.replace(';', ':') for part in stack) + f' {count}\n')
+        return path
+
+
+def _requested(header: str) -> bool:
+    return bool(TRACE_TOKEN) and request.headers.get(header) == TRACE_TOKEN
+
+
+def init_app(app: Flask):
+    """Trace sampled requests from start to teardown, and profile the
+    ones that ask for it"""
+    if not TRACE_SAMPLE_RATE and not PROFILE_SAMPLE_RATE and not TRACE_TOKEN:
+        return
+
+    @app.before_request
+    def start_trace():
+        sampled = random.random() < TRACE_SAMPLE_RATE or _requested(TRACE_HEADER)
+        profiled = (sampled and random.random() < PROFILE_SAMPLE_RATE) or _requested(PROFILE_HEADER)
+        if not sampled and not profiled:
+            return
+        trace = Trace(request.endpoint or 'unknown')
+        g.trace_token = _trace.set(trace)
+        g.trace_span = span(trace.name, method=request.method, path=request.path).__enter__()
+        if profiled:
+            g.profiler = Profiler(trace)
+            g.profiler.start()
+
+    @app.after_request
+    def trace_headers(response):
+        trace = _trace.get()
+        if trace is not None:
+            response.headers['X-Trace-Id'] = trace.trace_id
+            if 'trace_span' in g:
+                g.trace_span.args['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_trace(error):
+        token = g.pop('trace_token', None)
+        if token is None:
+            return
+        trace = _trace.get()
+        g.pop('trace_span').__exit__(type(error) if error else None, error, None)
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            path = profiler.stop()
+            if path:
+                print(f"Profile of {trace.name} ({trace.trace_id}) written to {path}")
+        _trace.reset(token)
+        try:
+            trace.export()
+        except Exception as e:
+            print(f"Error writing trace {trace.trace_id}: {str(e)}")
@@ -0,0 +1,50 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from tiptok_core.transcript_archive import (MAGIC, VERSION, HEADER, SUFFIX, ARCHIVE_PREFIX, CONTENT_TYPE,
+                                            TranscriptArchive, archive_path, upload_transcript)
+
+from .vector_index import INDEX_DIR
+
+ARCHIVE_CACHE_DIR = os.path.join(INDEX_DIR, 'transcripts')
+
+
+def _cache_path(video_path: str, generation: str) -> str:
+    name = video_path.split('/', 1)[-1].replace('/', '_')
+    return os.path.join(ARCHIVE_CACHE_DIR, f"{name}.{generation}{SUFFIX}")
+
+
+def load_transcript(bucket, video_path: str, generation: str) -> Optional[TranscriptArchive]:
+    """The archived transcript of this generation of a video, or None.
+
+    Archives are downloaded once into the local index directory and
+    memory-mapped from there afterwards.
+    """
+    local = _cache_path(video_path, generation)
+    if not os.path.exists(local):
+        blob = bucket.get_blob(archive_path(video_path))
+        if blob is None or (blob.metadata or {}).get('videoGeneration') != generation:
+            return None
+        os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+        partial = f"{local}.{threading.get_ident()}.partial"
+        blob.download_to_filename(partial)
+        os.replace(partial, local)
+    return TranscriptArchive.open(local)
+
+
+_uploads = ThreadPoolExecutor(max_workers=2, thread_name_prefix='transcript-upload')
+
+
+def save_transcript(bucket, video_path: str, generation: str, archive: TranscriptArchive):
+    """Cache an archive locally and upload it next to the video in the background"""
+    archive.write(_cache_path(video_path, generation))
+
+    def upload():
+        try:
+            upload_transcript(bucket, video_path, generation, archive)
+        except Exception as e:
+            print(f"Error uploading transcript archive for {video_path}: {str(e)}")
+
+    _uploads.submit(upload)
@@ -0,0 +1,231 @@
+import math
+import threading
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from .collection_watch import follow_collection
+from .search_index import tokenize, BM25_K1, BM25_B
+from .write_behind import get_write_behind
+
+# Sentences are short, so hits in the sentence before or after count a
+# little towards a sentence's score. That favours the place where a concept
+# is actually being explained over a passing mention.
+CONTEXT_WEIGHT = 0.3
+SNIPPET_LENGTH = 200
+
+INDEX_COLLECTION = 'transcriptindex'
+
+
+def build_sentence_entries(blocks: List[Dict], block_groups: List[List[int]]) -> List[Dict[str, Any]]:
+    """Flatten transcript blocks into sentence entries tagged with their chapter"""
+    chapter_of = {}
+    for chapter, group in enumerate(block_groups):
+        for i in group:
+            chapter_of[i] = chapter
+
+    return [
+        {
+            'start': float(block.get('start', 0)),
+            'end': float(block.get('end', 0)),
+            'text': block.get('text', ''),
+            'chapter': chapter_of.get(i),
+        }
+        for i, block in enumerate(blocks)
+    ]
+
+
+def make_snippet(text: str, terms: List[str]) -> str:
+    """Trim a sentence to SNIPPET_LENGTH characters around the first matched term"""
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if term in lowered]
+    first = min(positions) if positions else 0
+    start = max(0, min(first - SNIPPET_LENGTH // 4, len(text) - SNIPPET_LENGTH))
+    snippet = text[start:start + SNIPPET_LENGTH].strip()
+    if start > 0:
+        snippet = '…' + snippet
+    if start + SNIPPET_LENGTH < len(text):
+        snippet = snippet + '…'
+    return snippet
+
+
+class SentenceIndex:
+    """Inverted index over transcript sentences for every video"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # term -> {(video_id, sentence index): term frequency}
+        self._postings: Dict[str, Dict[Tuple[str, int], int]] = defaultdict(dict)
+        # video_id -> {videoPath, sentences, chapters, lengths}
+        self._videos: Dict[str, Dict[str, Any]] = {}
+        self._sentence_count = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._videos)
+
+    def upsert(self, video_id: str, video_path: str, sentences: List[Dict[str, Any]],
+               chapters: List[Dict[str, Any]]):
+        """Replace everything indexed for a video"""
+        with self._lock:
+            self._remove_locked(video_id)
+
+            lengths = []
+            for i, sentence in enumerate(sentences):
+                terms = tokenize(sentence.get('text', ''))
+                lengths.append(len(terms))
+                for term in terms:
+                    key = (video_id, i)
+                    self._postings[term][key] = self._postings[term].get(key, 0) + 1
+
+            self._videos[video_id] = {
+                'videoPath': video_path,
+                'sentences': sentences,
+                'chapters': chapters,
+                'lengths': lengths,
+            }
+            self._sentence_count += len(sentences)
+            self._total_length += sum(lengths)
+
+    def holds(self, video_id: str, sentences: List[Dict[str, Any]], chapters: List[Dict[str, Any]]) -> bool:
+        """Whether the index already has exactly these sentences and chapters for a video"""
+        video = self._videos.get(video_id)
+        return video is not None and video['sentences'] == sentences and video['chapters'] == chapters
+
+    def remove(self, video_id: str):
+        """Drop a video's sentences from the index if present"""
+        with self._lock:
+            self._remove_locked(video_id)
+
+    def _remove_locked(self, video_id: str):
+        video = self._videos.pop(video_id, None)
+        if video is None:
+            return
+        for i, sentence in enumerate(video['sentences']):
+            for term in set(tokenize(sentence.get('text', ''))):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                postings.pop((video_id, i), None)
+                if not postings:
+                    del self._postings[term]
+        self._sentence_count -= len(video['sentences'])
+        self._total_length -= sum(video['lengths'])
+
+    def _term_scores(self, term: str) -> Dict[Tuple[str, int], float]:
+        postings = self._postings.get(term)
+        if not postings:
+            return {}
+        df = len(postings)
+        idf = math.log(1 + (self._sentence_count - df + 0.5) / (df + 0.5))
+        average = self._total_length / self._sentence_count if self._sentence_count else 0
+
+        scores = {}
+        for (video_id, i), tf in postings.items():
+            length = self._videos[video_id]['lengths'][i]
+            norm = 1 - BM25_B + BM25_B * (length / average if average else 0)
+            scores[(video_id, i)] = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+        return scores
+
+    def search(self, query: str, limit: int = 20, per_video: int = 3) -> List[Dict[str, Any]]:
+        """Find the sentences that best match a query across all videos.
+
+        Returns:
+            List of {videoId, videoPath, chapter, chapterStart, chapterEnd,
+            start, end, snippet, score} ordered by descending score, with at
+            most per_video hits from any one video
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            scores: Dict[Tuple[str, int], float] = defaultdict(float)
+            for term in terms:
+                for (video_id, i), score in self._term_scores(term).items():
+                    scores[(video_id, i)] += score
+                    sentence_count = len(self._videos[video_id]['sentences'])
+                    for neighbour in (i - 1, i + 1):
+                        if 0 <= neighbour < sentence_count:
+                            scores[(video_id, neighbour)] += CONTEXT_WEIGHT * score
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+            results = []
+            hits_per_video: Dict[str, int] = defaultdict(int)
+            for (video_id, i), score in ranked:
+                if hits_per_video[video_id] >= per_video:
+                    continue
+                video = self._videos[video_id]
+                sentence = video['sentences'][i]
+                if not any(term in tokenize(sentence['text']) for term in terms):
+                    # Only scored through its neighbours
+                    continue
+                hits_per_video[video_id] += 1
+
+                chapter = sentence.get('chapter')
+                chapter_range = video['chapters'][chapter] if chapter is not None else {}
+                results.append({
+                    'videoId': video_id,
+                    'videoPath': video['videoPath'],
+                    'chapter': chapter,
+                    'chapterStart': chapter_range.get('start'),
+                    'chapterEnd': chapter_range.get('end'),
+                    'start': sentence['start'],
+                    'end': sentence['end'],
+                    'snippet': make_snippet(sentence['text'], terms),
+                    'score': score,
+                })
+                if len(results) >= limit:
+                    break
+
+        return results
+
+
+_index: Optional[SentenceIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_transcript_index(db) -> SentenceIndex:
+    """Return the process-wide transcript index, building it on first use.
+
+    The index then follows the transcript index collection, so transcripts
+    saved by other workers or by a backfill reach this worker's copy too.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = SentenceIndex()
+
+                def load(docs: Dict[str, Dict[str, Any]]):
+                    for video_id, data in docs.items():
+                        index.upsert(video_id, data.get('videoPath', ''), data.get('sentences', []),
+                                     data.get('chapters', []))
+                    print(f"Built transcript index with {len(index)} videos")
+
+                def apply(video_id: str, data: Optional[Dict[str, Any]]):
+                    if data is None:
+                        index.remove(video_id)
+                    elif not index.holds(video_id, data.get('sentences', []), data.get('chapters', [])):
+                        index.upsert(video_id, data.get('videoPath', ''), data.get('sentences', []),
+                                     data.get('chapters', []))
+
+                follow_collection(db, INDEX_COLLECTION, load, apply)
+                _index = index
+    return _index
+
+
+def save_transcript_index(db, video_id: str, video_path: str, sentences: List[Dict[str, Any]],
+                          chapters: List[Dict[str, Any]]):
+    """Queue a video's sentence index for writing and apply it to this
+    worker's index straight away; the others follow the collection"""
+    chapter_ranges = [{'start': chapter['start'], 'end': chapter['end']} for chapter in chapters]
+    get_write_behind(db).set(INDEX_COLLECTION, video_id, {
+        'videoPath': video_path,
+        'sentences': sentences,
+        'chapters': chapter_ranges,
+    })
+    if _index is not None:
+        _index.upsert(video_id, video_path, sentences, chapter_ranges)
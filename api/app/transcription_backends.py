@@ -0,0 +1,29 @@
+import os
+from typing import Optional
+
+from tiptok_core.transcription_backends import (TRANSCRIPTION_BACKEND, WHISPER_MODEL, WHISPER_WORKERS,
+                                                DEEPGRAM_TIMEOUT, PARAGRAPH_GAP, Transcript, SentenceAccumulator,
+                                                deepgram_transcript, is_url, local_copy, TranscriptionBackend,
+                                                DeepgramBackend, WhisperBackend, TRANSCRIPTION_BACKENDS,
+                                                get_transcription_backend)
+
+from .deadlines import get_latency_tracker, hedged
+
+# A second backend raced against a transcription slower than usual, e.g.
+# whisper behind deepgram; empty disables hedging
+TRANSCRIPTION_HEDGE_BACKEND = os.environ.get('TRANSCRIPTION_HEDGE_BACKEND', '')
+# Hedge threshold until enough transcriptions have been timed
+TRANSCRIPTION_HEDGE_AFTER = 60.0
+
+
+def transcribe(source: str, backend: str = TRANSCRIPTION_BACKEND,
+               hedge_backend: str = TRANSCRIPTION_HEDGE_BACKEND) -> Optional[Transcript]:
+    """Transcribe with the configured backend, racing hedge_backend against
+    it when it runs slower than usual"""
+    primary = get_transcription_backend(backend)
+    if not hedge_backend or hedge_backend == backend:
+        return primary.transcribe(source)
+    tracker = get_latency_tracker('transcription', backend, TRANSCRIPTION_HEDGE_AFTER)
+    return hedged(lambda: primary.transcribe(source),
+                  lambda: get_transcription_backend(hedge_backend).transcribe(source),
+                  tracker, 'transcription')
@@ -0,0 +1,583 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, List, Optional, Set
+
+import numpy as np
+
+from .governor import get_governor
+from .metrics import record_llm_usage
+from .result_store import PROCESSING_COLLECTION, MODEL_SUMMARY_SOURCE
+
+INDEX_DIR = os.environ.get('INDEX_DIR', 'index_data')
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'hashing')
+# INDEX_DIR starts empty on a new container, so the first worker to start
+# fills the index from the summaries and chapters stored in Firestore.
+# Set to 0 to skip it.
+VECTOR_BOOTSTRAP = os.environ.get('VECTOR_BOOTSTRAP', '1') != '0'
+BOOTSTRAP_BATCH = 256
+
+# Below this many vectors a full matrix product is faster than probing
+# inverted lists, so IVF only kicks in for larger catalogs.
+IVF_MIN_VECTORS = 20000
+IVF_PROBES = 8
+INITIAL_CAPACITY = 1024
+LOG_NAME = 'items.jsonl'
+# The item log is rewritten once it holds this many lines per row
+COMPACT_RATIO = 4
+COMPACT_MIN_LINES = 10000
+
+
+class EmbeddingBackend:
+    """Turns texts into L2-normalized float32 vectors"""
+    name = 'base'
+    dim = 0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashingEmbedder(EmbeddingBackend):
+    """Signed feature hashing of words, word bigrams and character trigrams.
+
+    Needs no model download or network, so indexes can be built and queried
+    offline. Character trigrams give some overlap between related word forms
+    ("neural" / "neuron"), which plain keyword matching misses.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = re.findall(r'\w+', text.lower().replace('_', ' '))
+        features = list(words)
+        features.extend(f'{a} {b}' for a, b in zip(words, words[1:]))
+        for word in words:
+            padded = f'#{word}#'
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+                sign = 1.0 if digest & 1 else -1.0
+                vectors[row, (digest >> 1) % self.dim] += sign
+        return normalize_rows(vectors)
+
+
+class SentenceTransformerEmbedder(EmbeddingBackend):
+    """Small local CPU model from sentence-transformers"""
+    name = 'sentence-transformers'
+
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=32, convert_to_numpy=True)
+        return normalize_rows(vectors.astype(np.float32))
+
+
+class OpenAIEmbedder(EmbeddingBackend):
+    """OpenAI embeddings API"""
+    name = 'openai'
+
+    def __init__(self, model_name: str = 'text-embedding-3-small', dim: int = 1536):
+        from openai import OpenAI
+        # Retries are the governor's
+        self.client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=0)
+        self.model_name = model_name
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        response = get_governor('openai').call(self.client.embeddings.create, model=self.model_name, input=texts)
+        record_llm_usage(self.model_name, getattr(response, 'usage', None))
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        return normalize_rows(vectors)
+
+
+EMBEDDING_BACKENDS = {
+    HashingEmbedder.name: HashingEmbedder,
+    SentenceTransformerEmbedder.name: SentenceTransformerEmbedder,
+    OpenAIEmbedder.name: OpenAIEmbedder,
+}
+
+
+def get_embedding_backend(name: str = EMBEDDING_BACKEND) -> EmbeddingBackend:
+    """Instantiate an embedding backend by name"""
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {name}")
+    return EMBEDDING_BACKENDS[name]()
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first"""
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def train_centroids(vectors: np.ndarray, n_lists: int, iterations: int = 10, sample: int = 50000,
+                    seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of rows, used as the IVF coarse quantizer"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+class VectorIndex:
+    """Memory-mapped matrix of embeddings with an optional IVF layer, shared
+    by every process on the host.
+
+    Rows live in {path}/vectors.f32. Their metadata is an append-only log,
+    {path}/items.jsonl, with one line per row written ({"row": n, "item":
+    {...}}, or a null item for a removed row), so storing an item appends a
+    line instead of rewriting the catalog. Writers hold an exclusive lock on
+    {path}/lock and first replay the lines other processes appended, so two
+    API workers never hand out the same row; searches replay new lines
+    first too. Removed rows are tombstoned and reused by later inserts, and
+    the log is rewritten once it is mostly superseded lines.
+    """
+
+    def __init__(self, path: str, backend: EmbeddingBackend):
+        self.path = path
+        self.backend = backend
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        self._header_path = os.path.join(path, 'meta.json')
+        self._log_path = os.path.join(path, LOG_NAME)
+        self._matrix_path = os.path.join(path, 'vectors.f32')
+        self._lock_path = os.path.join(path, 'lock')
+
+        with self._lock, self._file_lock():
+            self._open_store()
+            self._replay()
+            self._maybe_train()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._replay()
+            return len(self._rows)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            self._replay()
+            return key in self._rows
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock across processes sharing the index directory"""
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _open_store(self):
+        header = {}
+        if os.path.exists(self._header_path):
+            with open(self._header_path) as f:
+                header = json.load(f)
+            if header.get('backend') != self.backend.name or header.get('dim') != self.backend.dim:
+                print(f"Embedding backend changed, discarding vector index at {self.path}")
+                header = {}
+        if 'items' in header:
+            # Index written before the item log: its rows carry over
+            self._write_log([{'row': row, 'item': item} for row, item in enumerate(header['items'])])
+        elif not header:
+            for stale in (self._log_path, self._matrix_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        if 'items' in header or not header:
+            tmp_path = self._header_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'backend': self.backend.name, 'dim': self.backend.dim}, f)
+            os.replace(tmp_path, self._header_path)
+        self._reset()
+
+    def _reset(self):
+        """Forget the in-memory view, to rebuild it from the start of the log"""
+        self._items: List[Optional[Dict[str, Any]]] = []
+        self._rows: Dict[str, int] = {}
+        self._free: Set[int] = set()
+        self._log_offset = 0
+        self._log_inode: Optional[int] = None
+        self._log_lines = 0
+        self._capacity = max(self._file_rows(), INITIAL_CAPACITY)
+        self._matrix = self._open_matrix(self._capacity)
+
+        # Per-row kind codes (0 = empty) so kind filters stay vectorized
+        self._kind_codes: Dict[str, int] = {}
+        self._row_kinds = np.zeros(self._capacity, dtype=np.int16)
+
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[set] = []
+        self._list_of: Dict[int, int] = {}
+        self._trained_size = 0
+
+    def _file_rows(self) -> int:
+        if not os.path.exists(self._matrix_path):
+            return 0
+        return os.path.getsize(self._matrix_path) // (self.backend.dim * 4)
+
+    def _open_matrix(self, capacity: int) -> np.memmap:
+        mode = 'r+' if os.path.exists(self._matrix_path) else 'w+'
+        if mode == 'r+' and os.path.getsize(self._matrix_path) < capacity * self.backend.dim * 4:
+            with open(self._matrix_path, 'r+b') as f:
+                f.truncate(capacity * self.backend.dim * 4)
+        return np.memmap(self._matrix_path, dtype=np.float32, mode=mode,
+                         shape=(capacity, self.backend.dim))
+
+    def _kind_code(self, kind: Optional[str]) -> int:
+        return self._kind_codes.setdefault(kind, len(self._kind_codes) + 1)
+
+    def _grow(self, rows: int):
+        """Make room for at least `rows` rows, following the file if another
+        process already grew it"""
+        capacity = max(self._capacity, self._file_rows())
+        while capacity < rows:
+            capacity *= 2
+        self._matrix.flush()
+        del self._matrix
+        self._capacity = capacity
+        self._matrix = self._open_matrix(capacity)
+        self._row_kinds = np.resize(self._row_kinds, capacity)
+        self._row_kinds[len(self._items):] = 0
+
+    def _replay(self):
+        """Apply the log lines written since the last replay, by any process"""
+        try:
+            f = open(self._log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if self._log_inode is not None and inode != self._log_inode:
+                # Another process rewrote the log
+                self._reset()
+            self._log_inode = inode
+            f.seek(self._log_offset)
+            data = f.read()
+        # A line still being appended is picked up by the next replay
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+            self._log_lines += 1
+        self._log_offset += end
+
+    def _apply(self, record: Dict[str, Any]):
+        row, item = record['row'], record['item']
+        if row >= self._capacity:
+            self._grow(row + 1)
+        while len(self._items) <= row:
+            self._items.append(None)
+        old = self._items[row]
+        if old is not None and self._rows.get(old['key']) == row:
+            del self._rows[old['key']]
+        if row in self._list_of:
+            self._lists[self._list_of.pop(row)].discard(row)
+
+        self._items[row] = item
+        if item is None:
+            self._row_kinds[row] = 0
+            self._free.add(row)
+            return
+        self._free.discard(row)
+        self._rows[item['key']] = row
+        self._row_kinds[row] = self._kind_code(item.get('kind'))
+        self._assign_to_list(row, np.asarray(self._matrix[row]))
+
+    def _append(self, records: List[Dict[str, Any]]):
+        """Log rows just written to the matrix. The file lock is held and
+        the log replayed, so the offset is the end of the file."""
+        self._matrix.flush()
+        data = b''.join(json.dumps(record).encode() + b'\n' for record in records)
+        with open(self._log_path, 'ab') as f:
+            f.write(data)
+            self._log_inode = os.fstat(f.fileno()).st_ino
+        self._log_offset += len(data)
+        self._log_lines += len(records)
+        if self._log_lines > max(COMPACT_MIN_LINES, COMPACT_RATIO * len(self._items)):
+            self._write_log([{'row': row, 'item': item} for row, item in enumerate(self._items)])
+
+    def _write_log(self, records: List[Dict[str, Any]]):
+        """Replace the log with one line per row"""
+        tmp_path = self._log_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for record in records:
+                f.write(json.dumps(record).encode() + b'\n')
+            size = f.tell()
+        os.replace(tmp_path, self._log_path)
+        self._log_inode = os.stat(self._log_path).st_ino
+        self._log_offset = size
+        self._log_lines = len(records)
+
+    def upsert(self, items: List[Dict[str, Any]]):
+        """Embed and store items.
+
+        Each item needs a unique 'key' and the 'text' to embed; every other
+        field is kept as metadata and returned with search hits.
+        """
+        if not items:
+            return
+        vectors = self.backend.embed([item['text'] for item in items])
+
+        with self._lock, self._file_lock():
+            self._replay()
+            records = []
+            for item, vector in zip(items, vectors):
+                row = self._rows.get(item['key'])
+                if row is None:
+                    row = self._free.pop() if self._free else len(self._items)
+                    if row >= self._capacity:
+                        self._grow(row + 1)
+                self._matrix[row] = vector
+                record = {'row': row, 'item': {key: value for key, value in item.items() if key != 'text'}}
+                self._apply(record)
+                records.append(record)
+            self._append(records)
+            self._maybe_train()
+
+    def remove(self, keys: List[str]):
+        """Tombstone the rows for the given keys"""
+        with self._lock, self._file_lock():
+            self._replay()
+            self._remove(keys)
+
+    def remove_where(self, field: str, value: Any):
+        """Tombstone every row whose metadata field equals value"""
+        with self._lock, self._file_lock():
+            self._replay()
+            self._remove([item['key'] for item in self._items if item is not None and item.get(field) == value])
+
+    def _remove(self, keys: List[str]):
+        records = []
+        for key in keys:
+            row = self._rows.get(key)
+            if row is None:
+                continue
+            self._matrix[row] = 0.0
+            record = {'row': row, 'item': None}
+            self._apply(record)
+            records.append(record)
+        if records:
+            self._append(records)
+
+    def _maybe_train(self):
+        # Retrain the coarse quantizer whenever the catalog has doubled since
+        # the last training; in between, new rows join their nearest list.
+        size = len(self._rows)
+        if size < IVF_MIN_VECTORS or size < 2 * self._trained_size:
+            return
+        used = len(self._items)
+        matrix = np.asarray(self._matrix[:used])
+        n_lists = int(np.sqrt(size))
+        self._centroids = train_centroids(matrix, n_lists)
+        assignment = np.argmax(matrix @ self._centroids.T, axis=1)
+        self._lists = [set() for _ in range(n_lists)]
+        self._list_of = {}
+        for row in self._rows.values():
+            self._lists[assignment[row]].add(row)
+            self._list_of[row] = int(assignment[row])
+        self._trained_size = size
+
+    def _assign_to_list(self, row: int, vector: np.ndarray):
+        if self._centroids is None:
+            return
+        if row in self._list_of:
+            self._lists[self._list_of[row]].discard(row)
+        c = int(np.argmax(self._centroids @ vector))
+        self._lists[c].add(row)
+        self._list_of[row] = c
+
+    def search(self, query: str, k: int = 10, kind: Optional[str] = None,
+               exact: bool = False) -> List[Dict[str, Any]]:
+        """Return the k items closest to query by cosine similarity.
+
+        Uses the IVF lists when they have been trained and exact is False,
+        otherwise scores every row.
+        """
+        vector = self.backend.embed([query])[0]
+
+        with self._lock:
+            self._replay()
+            self._maybe_train()
+            used = len(self._items)
+            if not self._rows:
+                return []
+
+            if self._centroids is not None and not exact:
+                probes = top_k(self._centroids @ vector, IVF_PROBES)
+                rows = np.fromiter((row for c in probes for row in self._lists[c]), dtype=np.int64)
+            else:
+                rows = np.arange(used)
+
+            kinds = self._row_kinds[rows]
+            if kind is not None:
+                rows = rows[kinds == self._kind_codes.get(kind, -1)]
+            else:
+                rows = rows[kinds != 0]
+            if not len(rows):
+                return []
+
+            scores = np.asarray(self._matrix[rows]) @ vector
+            return [
+                {**self._items[rows[i]], 'score': float(scores[i])}
+                for i in top_k(scores, k)
+            ]
+
+
+_index: Optional[VectorIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index() -> VectorIndex:
+    """Return the process-wide vector index, opening it on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = VectorIndex(os.path.join(INDEX_DIR, 'vectors'), get_embedding_backend())
+    return _index
+
+
+def summary_item(video_id: str, video_path: str, summary: str, title: str = '') -> Dict[str, Any]:
+    return {
+        'key': f'video:{video_id}',
+        'kind': 'video',
+        'videoId': video_id,
+        'videoPath': video_path,
+        'title': title,
+        'text': f'{title}. {summary}' if title else summary,
+    }
+
+
+def chapter_items(video_id: str, video_path: str, chapters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Items for a video's chapters, embedding their text, or their summary
+    for chapters read back from Firestore, which keeps no text"""
+    return [
+        {
+            'key': f'chapter:{video_id}:{i}',
+            'kind': 'chapter',
+            'chapterOf': video_id,
+            'videoId': video_id,
+            'videoPath': video_path,
+            'chapter': i,
+            'start': chapter['start'],
+            'end': chapter['end'],
+            'text': chapter.get('text') or chapter.get('summary'),
+        }
+        for i, chapter in enumerate(chapters)
+        if chapter.get('text') or chapter.get('summary')
+    ]
+
+
+def index_video_summary(video_id: str, video_path: str, summary: str, title: str = '', missing: bool = False):
+    """Add or refresh the summary vector for a video; with missing, only add
+    it if the index does not hold one, e.g. for a summary read back from Firestore"""
+    index = get_vector_index()
+    if missing and f'video:{video_id}' in index:
+        return
+    index.upsert([summary_item(video_id, video_path, summary, title)])
+
+
+def index_video_chapters(video_id: str, video_path: str, chapters: List[Dict[str, Any]], missing: bool = False):
+    """Replace the chapter vectors for a video; with missing, only add them
+    if the index holds none"""
+    index = get_vector_index()
+    if missing and f'chapter:{video_id}:0' in index:
+        return
+    index.remove_where('chapterOf', video_id)
+    index.upsert(chapter_items(video_id, video_path, chapters))
+
+
+def bootstrap_vector_index(db) -> int:
+    """Index the summaries, and the chapters summarized with a model, stored
+    in Firestore that this host's index does not hold yet. Returns how many
+    items were added."""
+    index = get_vector_index()
+    pending: List[Dict[str, Any]] = []
+    added = 0
+
+    def add(items: List[Dict[str, Any]]):
+        nonlocal added
+        pending.extend(items)
+        if len(pending) >= BOOTSTRAP_BATCH:
+            index.upsert(pending)
+            added += len(pending)
+            pending.clear()
+
+    video_ids = {}
+    for doc in db.collection('videos').stream():
+        data = doc.to_dict() or {}
+        video_path = data.get('storagePath') or f"videos/{doc.id}"
+        video_ids[video_path] = doc.id
+        if data.get('summary') and f'video:{doc.id}' not in index:
+            add([summary_item(doc.id, video_path, data['summary'], data.get('suggestedTitle', ''))])
+
+    chapters = db.collection(PROCESSING_COLLECTION).where('summarySource', '==', MODEL_SUMMARY_SOURCE)
+    for doc in chapters.stream():
+        data = doc.to_dict() or {}
+        video_id = video_ids.get(data.get('path'))
+        if data.get('status') != 'completed' or not video_id or f'chapter:{video_id}:0' in index:
+            continue
+        add(chapter_items(video_id, data['path'], data.get('chapters') or []))
+
+    index.upsert(pending)
+    return added + len(pending)
+
+
+def start_bootstrap(client: Callable[[], Any]):
+    """Run bootstrap_vector_index in the background, in one process per
+    host: the others find the lock taken, or the marker it leaves when done"""
+    if not VECTOR_BOOTSTRAP:
+        return
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    marker = os.path.join(INDEX_DIR, 'bootstrapped')
+
+    def run():
+        with open(os.path.join(INDEX_DIR, 'bootstrap.lock'), 'a+') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            if os.path.exists(marker):
+                return
+            try:
+                added = bootstrap_vector_index(client())
+            except Exception as e:
+                print(f"Error bootstrapping vector index: {str(e)}")
+                return
+            open(marker, 'w').close()
+            print(f"Bootstrapped vector index with {added} items from Firestore")
+
+    threading.Thread(target=run, name='vector-bootstrap', daemon=True).start()
@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from tiptok_core.webvtt import (TRACK_PREFIX, CHAPTER_TRACK, CAPTION_TRACK, CONTENT_TYPE, CACHE_CONTROL, Cue,
+                                write_timestamp, write_text, write_track, chapter_cues, caption_cues, track_prefix,
+                                download_url, render_track, publish_tracks)
+
+_uploads = ThreadPoolExecutor(max_workers=2, thread_name_prefix='track-upload')
+
+
+def publish_tracks_later(bucket, db, writer, video_path: str, generation: str, chapters: List[Dict[str, Any]],
+                         sentences: Optional[List[Dict[str, Any]]]):
+    """Publish a video's tracks off the request path and record them on
+    the videos documents that point at it"""
+    def publish():
+        try:
+            record = publish_tracks(bucket, video_path, generation, chapters, sentences)
+            for doc in db.collection('videos').where('storagePath', '==', video_path).stream():
+                writer.update('videos', doc.id, record)
+        except Exception as e:
+            print(f"Error publishing tracks for {video_path}: {str(e)}")
+    _uploads.submit(publish)
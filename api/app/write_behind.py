@@ -0,0 +1,19 @@
+import atexit
+import threading
+from typing import Optional
+
+from tiptok_core.write_behind import WriteBehindWriter, MAX_BATCH, FLUSH_INTERVAL
+
+_writer: Optional[WriteBehindWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_write_behind(db) -> WriteBehindWriter:
+    """Return the process-wide write-behind writer, flushed at exit"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = WriteBehindWriter(db)
+                atexit.register(_writer.close)
+    return _writer
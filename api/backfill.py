@@ -0,0 +1,302 @@
+"""Reprocess stored videos with the current summary and chapter pipeline.
+
+Usage:
+    python backfill.py --missing-summary             # videos never summarized
+    python backfill.py --before 2024-06-01           # videos uploaded before a date
+    python backfill.py --user USER_ID --only chapters
+    python backfill.py --estimate                    # print the plan and its cost, then stop
+
+Runs the pipeline of app.routes in this process, so prompt or model changes
+reach existing videos without going through the HTTP API. Provider calls go
+through the same governors as the API's (GOVERNOR_BACKEND), so a backfill
+shares the providers' rate limits with live traffic instead of adding to
+them. Progress is saved under INDEX_DIR after every video; running again
+with the same filters skips what is done, and --restart forgets it.
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+from firebase_admin import firestore, storage
+
+from app.routes import (flights, summarize_video, chapter_video, derived_bucket, CHAPTER_SUMMARY_MODEL,
+                        GROUPING_WINDOW_TOKENS, GROUPING_OVERLAP_TOKENS, MERGE_PREVIEW_CHARS)
+from app.result_store import get_video_generation
+from app.transcript_archive import load_transcript
+from app.transcription_backends import TRANSCRIPTION_BACKEND
+from app.chapter_grouping import estimate_tokens, CHARS_PER_TOKEN
+from app.deadlines import deadline_scope, REQUEST_TIMEOUT
+from app.governor import PROVIDER_LIMITS
+from app.metrics import LLM_PRICES, TRANSCRIPTION_PRICES, llm_cost, transcription_cost
+from app.write_behind import get_write_behind
+from app.vector_index import INDEX_DIR
+
+BACKFILL_WORKERS = 4
+ESTIMATE_WORKERS = 16
+PROGRESS_INTERVAL = 10.0
+
+# Rough shape of a video for the estimate, from the prompts in app.routes.
+# Videos without an archived transcript are assumed to be the median length
+# of those with one, or DEFAULT_VIDEO_SECONDS.
+DEFAULT_VIDEO_SECONDS = 60.0
+SPOKEN_TOKENS_PER_MINUTE = 200
+PROMPT_OVERHEAD_TOKENS = 200
+COMPLETION_TOKENS = 150
+SHORT_COMPLETION_TOKENS = 50
+CHAPTER_SECONDS = 60.0
+GROUPING_MODEL = 'gpt-4'
+KEYWORD_MODEL = 'gpt-3.5-turbo'
+# Wall time of one video's pipeline when the providers answer promptly
+SECONDS_PER_VIDEO = 30.0
+
+
+def fetch_videos(db, user_id: Optional[str] = None, before: Optional[datetime] = None,
+                 missing_summary: bool = False) -> List[Dict[str, Any]]:
+    """Id and storage path of every video matching the filters"""
+    query = db.collection('videos')
+    if user_id:
+        query = query.where('userId', '==', user_id)
+    if before:
+        query = query.where('timestamp', '<', before)
+    videos = []
+    for doc in query.stream():
+        data = doc.to_dict() or {}
+        if missing_summary and data.get('summary'):
+            continue
+        videos.append({
+            'id': doc.id,
+            'path': data.get('storagePath') or f"videos/{doc.id}",
+        })
+    return videos
+
+
+def plan_video(bucket, derived, video: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the video's generation and, when its transcript is archived,
+    its length and transcript tokens"""
+    video['generation'] = get_video_generation(bucket, video['path'])
+    video['seconds'] = video['tokens'] = None
+    if video['generation'] is None:
+        return video
+    try:
+        archive = load_transcript(derived, video['path'], video['generation'])
+    except Exception as e:
+        print(f"Error loading transcript archive of {video['path']}: {str(e)}")
+        archive = None
+    if archive is not None:
+        video['seconds'] = archive.duration
+        video['tokens'] = estimate_tokens(archive.transcript)
+    return video
+
+
+def llm_price(model: str, prompt: float, completion: float) -> float:
+    prompt_price, completion_price = LLM_PRICES.get(model, (0.0, 0.0))
+    return (prompt * prompt_price + completion * completion_price) / 1000
+
+
+def estimate(videos: List[Dict[str, Any]], only: List[str], workers: int) -> Dict[str, float]:
+    """Expected spend, provider calls and wall time of a backfill"""
+    known = [video['seconds'] for video in videos if video['seconds'] is not None]
+    typical = statistics.median(known) if known else DEFAULT_VIDEO_SECONDS
+    totals = {'videos': len(videos), 'transcribe_minutes': 0.0, 'llm_calls': 0, 'llm_usd': 0.0,
+              'transcription_usd': 0.0}
+    for video in videos:
+        seconds = video['seconds'] if video['seconds'] is not None else typical
+        tokens = video['tokens'] if video['tokens'] is not None else seconds / 60 * SPOKEN_TOKENS_PER_MINUTE
+        if video['seconds'] is None:
+            totals['transcribe_minutes'] += seconds / 60
+
+        if 'summary' in only:
+            # Transcript summary, then keywords and a title from the summary
+            totals['llm_calls'] += 3
+            totals['llm_usd'] += llm_price(CHAPTER_SUMMARY_MODEL, tokens + PROMPT_OVERHEAD_TOKENS, COMPLETION_TOKENS)
+            totals['llm_usd'] += 2 * llm_price(KEYWORD_MODEL, COMPLETION_TOKENS + PROMPT_OVERHEAD_TOKENS,
+                                               SHORT_COMPLETION_TOKENS)
+        if 'chapters' in only:
+            # Overlapping grouping windows, a merge pass over chapter
+            # previews when there was more than one, and a summary per chapter
+            windows = max(1, math.ceil(tokens / (GROUPING_WINDOW_TOKENS - GROUPING_OVERLAP_TOKENS)))
+            chapters = max(1, round(seconds / CHAPTER_SECONDS))
+            totals['llm_calls'] += windows + (windows > 1) + chapters
+            totals['llm_usd'] += llm_price(GROUPING_MODEL,
+                                           tokens + windows * (GROUPING_OVERLAP_TOKENS + PROMPT_OVERHEAD_TOKENS),
+                                           windows * SHORT_COMPLETION_TOKENS)
+            if windows > 1:
+                totals['llm_usd'] += llm_price(GROUPING_MODEL,
+                                               chapters * MERGE_PREVIEW_CHARS / CHARS_PER_TOKEN
+                                               + PROMPT_OVERHEAD_TOKENS, SHORT_COMPLETION_TOKENS)
+            totals['llm_usd'] += llm_price(CHAPTER_SUMMARY_MODEL, tokens + chapters * PROMPT_OVERHEAD_TOKENS,
+                                           chapters * COMPLETION_TOKENS)
+
+    totals['transcription_usd'] = totals['transcribe_minutes'] * TRANSCRIPTION_PRICES.get(TRANSCRIPTION_BACKEND, 0.0)
+    # Bounded by our own workers or by the OpenAI governor's token bucket
+    totals['seconds'] = max(len(videos) * SECONDS_PER_VIDEO / max(workers, 1),
+                            totals['llm_calls'] / PROVIDER_LIMITS['openai']['rate'])
+    return totals
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+class Checkpoint:
+    """Videos a backfill has finished, saved after each one so a rerun
+    with the same filters picks up where the last stopped"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, str] = {}
+        self.failed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.done = data.get('done', {})
+            self.failed = data.get('failed', {})
+
+    def mark(self, video_id: str, generation: str, error: Optional[str] = None):
+        with self._lock:
+            if error is None:
+                self.done[video_id] = generation
+                self.failed.pop(video_id, None)
+            else:
+                self.failed[video_id] = error
+            partial = f"{self.path}.partial"
+            with open(partial, 'w') as f:
+                json.dump({'done': self.done, 'failed': self.failed}, f)
+            os.replace(partial, self.path)
+
+
+def process_video(video: Dict[str, Any], only: List[str], timeout: float) -> bool:
+    """Regenerate a video's summary and chapters. Returns False if a
+    provider failed and a fallback was served, which is not stored."""
+    path, generation = video['path'], video['generation']
+    complete = True
+    with deadline_scope(timeout):
+        if 'summary' in only:
+            result = flights.do(('summary', path, generation, True),
+                                summarize_video, path, video['id'], generation, True)
+            complete = complete and not result.get('degraded')
+        if 'chapters' in only:
+            result = flights.do(('chapters', path, generation, True),
+                                chapter_video, path, generation, True)
+            complete = complete and not result.get('degraded')
+    return complete
+
+
+def report(progress: Dict[str, Any], total: int, started: float, stop: threading.Event):
+    """Print throughput, time left and spend every PROGRESS_INTERVAL"""
+    while not stop.wait(PROGRESS_INTERVAL):
+        elapsed = time.time() - started
+        finished = progress['done'] + progress['failed']
+        rate = finished / elapsed if elapsed else 0.0
+        left = format_duration((total - finished) / rate) if rate else '?'
+        print(f"{finished}/{total} ({progress['failed']} failed), {rate * 60:.1f} videos/min, "
+              f"{left} left, ${llm_cost.total() + transcription_cost.total():.2f} spent", flush=True)
+
+
+def parse_date(text: str) -> datetime:
+    return datetime.fromisoformat(text).replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', help='Only this creator\'s videos')
+    parser.add_argument('--before', type=parse_date, help='Only videos uploaded before this date (YYYY-MM-DD)')
+    parser.add_argument('--missing-summary', action='store_true', help='Only videos without a summary')
+    parser.add_argument('--only', choices=['summary', 'chapters'], help='Regenerate just one of the two')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='Videos processed at once')
+    parser.add_argument('--limit', type=int, help='Process at most this many videos')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help='Seconds allowed per video')
+    parser.add_argument('--estimate', action='store_true', help='Print the estimate and stop')
+    parser.add_argument('--yes', action='store_true', help='Start without asking after the estimate')
+    parser.add_argument('--restart', action='store_true', help='Forget the progress of earlier runs')
+    args = parser.parse_args()
+    only = [args.only] if args.only else ['summary', 'chapters']
+
+    scope = '_'.join([f"user-{args.user}" if args.user else 'catalog']
+                     + ([f"before-{args.before.date()}"] if args.before else [])
+                     + (['missing-summary'] if args.missing_summary else [])
+                     + only)
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    checkpoint_path = os.path.join(INDEX_DIR, f'backfill_{scope}.json')
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    db = firestore.client()
+    bucket = storage.bucket()
+    derived = derived_bucket()
+    started = time.time()
+    videos = fetch_videos(db, args.user, args.before, args.missing_summary)
+    videos = [video for video in videos if video['id'] not in checkpoint.done]
+    if args.limit is not None:
+        videos = videos[:args.limit]
+    print(f"Selected {len(videos)} videos in {time.time() - started:.1f}s "
+          f"({len(checkpoint.done)} done by earlier runs)")
+    if not videos:
+        return
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=ESTIMATE_WORKERS) as executor:
+        videos = list(executor.map(lambda video: plan_video(bucket, derived, video), videos))
+    missing = [video for video in videos if video['generation'] is None]
+    videos = [video for video in videos if video['generation'] is not None]
+    if missing:
+        print(f"Skipping {len(missing)} videos whose file is missing from storage")
+    plan = estimate(videos, only, args.workers)
+    print(f"Planned in {time.time() - started:.1f}s: {plan['videos']} videos, "
+          f"{plan['transcribe_minutes']:.0f} audio minutes to transcribe, about {plan['llm_calls']} LLM calls")
+    print(f"Estimated cost ${plan['llm_usd'] + plan['transcription_usd']:.2f} "
+          f"(LLM ${plan['llm_usd']:.2f}, transcription ${plan['transcription_usd']:.2f}), "
+          f"about {format_duration(plan['seconds'])} with {args.workers} workers")
+    if args.estimate or not videos:
+        return
+    if not args.yes:
+        if not sys.stdin.isatty() or input("Start? [y/N] ").strip().lower() not in ('y', 'yes'):
+            print("Not started")
+            return
+
+    progress = {'done': 0, 'failed': 0}
+    started = time.time()
+    stop = threading.Event()
+    reporter = threading.Thread(target=report, args=(progress, len(videos), started, stop), daemon=True)
+    reporter.start()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='backfill') as executor:
+            futures = {executor.submit(process_video, video, only, args.timeout): video for video in videos}
+            for future in as_completed(futures):
+                video = futures[future]
+                try:
+                    error = None if future.result() else 'degraded'
+                except Exception as e:
+                    error = f"{type(e).__name__}: {str(e)}"
+                checkpoint.mark(video['id'], video['generation'], error)
+                progress['failed' if error else 'done'] += 1
+                if error:
+                    print(f"Failed {video['path']}: {error}")
+    finally:
+        stop.set()
+        # Summaries are queued on the write-behind writer; commit them before exiting
+        get_write_behind(firestore.client()).flush(timeout=60)
+
+    elapsed = time.time() - started
+    print(f"Processed {progress['done']} videos ({progress['failed']} failed) in {format_duration(elapsed)}, "
+          f"{len(videos) / elapsed * 60:.1f} videos/min, "
+          f"${llm_cost.total() + transcription_cost.total():.2f} spent")
+    if progress['failed']:
+        print(f"Failed videos are listed in {checkpoint_path}; run again to retry them")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""Offline benchmarks for the chapters API.
+
+Run from the api directory:
+    python -m benchmarks.load    # end-to-end load against local provider fakes
+    python -m benchmarks.micro   # transcript parsing and chaptering on synthetic input
+    python -m benchmarks.live    # chapters after upload with and without live transcription
+    python -m benchmarks.transcribe  # throughput and cost per audio hour of transcription backends
+    python -m benchmarks.fingerprint  # audio fingerprint speed and re-upload match accuracy
+"""
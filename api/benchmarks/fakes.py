@@ -0,0 +1,642 @@
+"""Local stand-ins for Deepgram (prerecorded and streaming), OpenAI,
+signed-URL storage and Firestore.
+
+Each fake answers with realistically shaped payloads after a configurable
+delay, and fails a configurable fraction of calls, so the pipeline's retry
+and concurrency behaviour can be measured without network access or keys.
+"""
+import asyncio
+import copy
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+WORDS = (
+    'model training data gradient loss layer network python function class variable '
+    'loop list array index query database table schema server request response cache '
+    'latency memory thread process deploy container kubernetes docker image build test '
+    'debug error exception config key value token vector search ranking embedding '
+    'video audio chapter summary keyword playlist upload stream transcode frame'
+).split()
+
+
+@dataclass
+class Faults:
+    """Latency, jitter and failure injection shared by every fake"""
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+
+    def delay(self):
+        seconds = self.latency + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def synthetic_sentence(rng: random.Random, words: int) -> str:
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def synthetic_transcript(duration: float, seed: int = 0) -> Dict[str, Any]:
+    """A Deepgram prerecorded response covering `duration` seconds of speech"""
+    rng = random.Random(seed)
+    paragraphs = []
+    position = 0.0
+    while position < duration:
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+            if position >= duration:
+                break
+            length = rng.uniform(2.0, 8.0)
+            sentences.append({
+                'text': synthetic_sentence(rng, max(3, int(length * 2.5))),
+                'start': round(position, 2),
+                'end': round(min(position + length, duration), 2),
+            })
+            position += length + rng.uniform(0.0, 0.6)
+        paragraphs.append({
+            'sentences': sentences,
+            'start': sentences[0]['start'],
+            'end': sentences[-1]['end'],
+            'num_words': sum(len(sentence['text'].split()) for sentence in sentences),
+        })
+    transcript = ' '.join(sentence['text'] for para in paragraphs for sentence in para['sentences'])
+    return {
+        'metadata': {'request_id': f'bench-{seed}', 'duration': duration, 'channels': 1},
+        'results': {
+            'channels': [{
+                'alternatives': [{
+                    'transcript': transcript,
+                    'confidence': 0.98,
+                    'paragraphs': {'transcript': transcript, 'paragraphs': paragraphs},
+                }]
+            }]
+        },
+    }
+
+
+class FakeServer:
+    """Threaded HTTP server that routes every request to handle()"""
+
+    def __init__(self, faults: Optional[Faults] = None):
+        self.faults = faults or Faults()
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handle(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        """Return (status, JSON-able payload or raw bytes)"""
+        raise NotImplementedError
+
+    def error_payload(self, status: int) -> Any:
+        return {'error': {'message': 'injected failure', 'code': status}}
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    # urllib streams file uploads without a Content-Length
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                        if size == 0:
+                            return b''.join(chunks)
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _respond(self, method: str):
+                body = self._body()
+                with fake._lock:
+                    fake.requests += 1
+                fake.faults.delay()
+                if fake.faults.should_fail():
+                    with fake._lock:
+                        fake.failures += 1
+                    status, payload = fake.faults.error_status, fake.error_payload(fake.faults.error_status)
+                else:
+                    status, payload = fake.handle(method, self.path, body)
+                if isinstance(payload, bytes):
+                    data, content_type = payload, 'application/octet-stream'
+                else:
+                    data, content_type = json.dumps(payload).encode(), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class FakeStorage(FakeServer):
+    """Serves media bytes for the signed URLs handed out by FakeBucket, and
+    keeps objects the API uploads in memory"""
+
+    def __init__(self, faults: Optional[Faults] = None, media_bytes: int = 256 * 1024):
+        super().__init__(faults)
+        self.media = random.randbytes(media_bytes)
+        # name -> (data, metadata)
+        self.objects: Dict[str, Tuple[bytes, Dict[str, str]]] = {}
+
+    def handle(self, method, path, body):
+        return 200, self.media
+
+    def bucket(self, name: Optional[str] = None) -> 'FakeBucket':
+        return FakeBucket(self)
+
+
+class FakeBlob:
+    def __init__(self, storage: FakeStorage, name: str):
+        self.storage = storage
+        self.name = name
+        self.generation = 1
+        self.metadata: Optional[Dict[str, str]] = None
+
+    def generate_signed_url(self, **kwargs) -> str:
+        return f'{self.storage.url}/{self.name}?X-Goog-Signature=bench'
+
+    def upload_from_string(self, data: bytes, content_type: Optional[str] = None):
+        self.storage.faults.delay()
+        self.storage.objects[self.name] = (bytes(data), dict(self.metadata or {}))
+
+    def upload_from_file(self, file, content_type: Optional[str] = None):
+        self.upload_from_string(file.read(), content_type)
+
+    def download_to_filename(self, filename: str):
+        self.storage.faults.delay()
+        with open(filename, 'wb') as f:
+            f.write(self.storage.objects[self.name][0])
+
+
+class FakeBucket:
+    def __init__(self, storage: FakeStorage):
+        self.storage = storage
+        self.name = 'bench'
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self.storage, name)
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        blob = FakeBlob(self.storage, name)
+        if name in self.storage.objects:
+            blob.metadata = dict(self.storage.objects[name][1])
+        elif not name.startswith('videos/'):
+            return None
+        return blob
+
+
+class FakeDeepgram(FakeServer):
+    """POST /v1/listen: fetches the source URL like Deepgram does (or takes
+    an uploaded file), then answers with a synthetic transcript of `audio_seconds`"""
+
+    def __init__(self, faults: Optional[Faults] = None, audio_seconds: float = 90.0, fetch_media: bool = True):
+        super().__init__(faults)
+        self.audio_seconds = audio_seconds
+        self.fetch_media = fetch_media
+        self._responses: Dict[int, Dict[str, Any]] = {}
+
+    def error_payload(self, status):
+        return {'err_code': 'INJECTED', 'err_msg': 'injected failure', 'http_status': status}
+
+    def handle(self, method, path, body):
+        if method != 'POST' or not path.startswith('/v1/listen'):
+            return 404, {'err_code': 'NOT_FOUND', 'err_msg': path}
+        try:
+            source = json.loads(body or b'{}')
+        except ValueError:
+            # An uploaded file rather than a URL to fetch
+            source = {'buffer': len(body)}
+        if self.fetch_media and source.get('url'):
+            try:
+                with urllib.request.urlopen(source['url']) as media:
+                    media.read()
+            except urllib.error.HTTPError as e:
+                # Deepgram reports an unreadable source as a client error
+                return 400, {'err_code': 'REMOTE_CONTENT_ERROR', 'err_msg': f'Source returned {e.code}'}
+        seed = hash(source.get('url', source.get('buffer', ''))) % 8
+        if seed not in self._responses:
+            self._responses[seed] = synthetic_transcript(self.audio_seconds, seed)
+        return 200, self._responses[seed]
+
+
+def synthetic_words(seed: int = 0) -> Iterator[Dict[str, Any]]:
+    """An endless stream of timed words in sentences and paragraphs, shaped
+    like the words of Deepgram streaming results"""
+    rng = random.Random(seed)
+    position = 0.0
+    while True:
+        for _ in range(rng.randint(3, 7)):
+            for word in synthetic_sentence(rng, rng.randint(5, 20)).split():
+                yield {
+                    'word': word.lower().rstrip('.'),
+                    'punctuated_word': word,
+                    'start': round(position, 2),
+                    'end': round(position + 0.3, 2),
+                    'confidence': 0.98,
+                }
+                position += 0.4
+            position += rng.uniform(0.0, 0.6)
+        # Pause between paragraphs
+        position += 2.0
+
+
+class FakeDeepgramLive:
+    """Websocket /v1/listen speaking Deepgram's streaming protocol.
+
+    Audio is never decoded: every `bytes_per_second` received counts as a
+    second of speech, and final results for the words it covers come back
+    after the configured latency. CloseStream flushes the rest, sends the
+    Metadata message and closes, like Deepgram.
+    """
+
+    def __init__(self, faults: Optional[Faults] = None, bytes_per_second: int = 32000,
+                 result_interval: float = 1.0):
+        self.faults = faults or Faults()
+        self.bytes_per_second = bytes_per_second
+        self.result_interval = result_interval
+        self.requests = 0
+        self.failures = 0
+        self.audio_seconds = 0.0
+        self._loop = asyncio.new_event_loop()
+        self._runner: Optional[web.AppRunner] = None
+        self._port = 0
+
+    @property
+    def url(self) -> str:
+        return f'ws://127.0.0.1:{self._port}'
+
+    def _due(self) -> float:
+        return time.monotonic() + max(0.0, self.faults.latency + random.uniform(-self.faults.jitter, self.faults.jitter))
+
+    @staticmethod
+    def _results(words: List[Dict[str, Any]], speech_final: bool) -> Dict[str, Any]:
+        return {
+            'type': 'Results',
+            'start': words[0]['start'] if words else 0.0,
+            'duration': (words[-1]['end'] - words[0]['start']) if words else 0.0,
+            'is_final': True,
+            'speech_final': speech_final,
+            'channel': {'alternatives': [{
+                'transcript': ' '.join(word['punctuated_word'] for word in words),
+                'confidence': 0.98,
+                'words': words,
+            }]},
+        }
+
+    async def handle(self, request: web.Request):
+        self.requests += 1
+        if not request.headers.get('Authorization', '').startswith('Token '):
+            return web.json_response({'err_code': 'INVALID_AUTH', 'err_msg': 'Missing token'}, status=401)
+        await asyncio.sleep(max(0.0, self._due() - time.monotonic()))
+        if self.faults.should_fail():
+            self.failures += 1
+            return web.json_response({'err_code': 'INJECTED', 'err_msg': 'injected failure'},
+                                     status=self.faults.error_status)
+
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        words = synthetic_words(self.requests)
+        pending = next(words)
+        received = 0
+        sent_until = 0.0
+        # Results go out `latency` after the audio they cover arrived, without
+        # holding up the audio behind them
+        outbox: asyncio.Queue = asyncio.Queue()
+
+        async def sender():
+            while True:
+                due, message = await outbox.get()
+                await asyncio.sleep(max(0.0, due - time.monotonic()))
+                await socket.send_str(json.dumps(message))
+                if message['type'] == 'Metadata':
+                    await socket.close()
+                    return
+
+        def results_until(seconds: float, speech_final: bool = False):
+            nonlocal pending
+            batch = []
+            while pending['end'] <= seconds:
+                batch.append(pending)
+                pending = next(words)
+            if batch or speech_final:
+                outbox.put_nowait((self._due(), self._results(batch, speech_final)))
+
+        sending = asyncio.create_task(sender())
+        closing = False
+        async for message in socket:
+            if message.type == web.WSMsgType.BINARY:
+                received += len(message.data)
+                heard = received / self.bytes_per_second
+                if heard - sent_until >= self.result_interval:
+                    results_until(heard)
+                    sent_until = heard
+            elif message.type == web.WSMsgType.TEXT:
+                if json.loads(message.data).get('type') == 'CloseStream':
+                    heard = received / self.bytes_per_second
+                    results_until(heard, speech_final=True)
+                    closing = True
+                    self.audio_seconds += heard
+                    outbox.put_nowait((self._due(), {
+                        'type': 'Metadata',
+                        'request_id': f'bench-live-{self.requests}',
+                        'sha256': '0' * 64,
+                        'duration': heard,
+                        'channels': 1,
+                    }))
+                    break
+            else:
+                break
+        if closing:
+            await sending
+        else:
+            sending.cancel()
+        await socket.close()
+        return socket
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/v1/listen', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self._port = site._server.sockets[0].getsockname()[1]
+
+    def start(self) -> str:
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self.url
+
+    def stop(self):
+        if self._runner is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class FakeOpenAI(FakeServer):
+    """POST /v1/chat/completions with answers shaped for each prompt the API sends"""
+
+    def __init__(self, faults: Optional[Faults] = None, blocks_per_chapter: int = 4):
+        super().__init__(faults)
+        self.blocks_per_chapter = blocks_per_chapter
+
+    def answer(self, prompt: str) -> str:
+        blocks = [int(i) for i in re.findall(r'^(?:Block|Chapter) (\d+):', prompt, re.MULTILINE)]
+        if blocks:
+            groups = [blocks[i:i + self.blocks_per_chapter] for i in range(0, len(blocks), self.blocks_per_chapter)]
+            return json.dumps(groups)
+        words = list(dict.fromkeys(word for word in re.findall(r'[a-z]+', prompt.lower()) if word in WORDS))
+        words = words or list(WORDS)
+        if 'key terms' in prompt:
+            return ' '.join(words[:6])
+        if 'title' in prompt:
+            return ' '.join(word.capitalize() for word in words[:3])
+        return 'This section covers ' + ', '.join(words[:5]) + '.'
+
+    def handle(self, method, path, body):
+        if method != 'POST' or not path.startswith('/v1/chat/completions'):
+            return 404, {'error': {'message': f'Unknown path {path}'}}
+        request = json.loads(body or b'{}')
+        prompt = '\n'.join(message.get('content', '') for message in request.get('messages', []))
+        content = self.answer(prompt)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = max(1, len(content) // 4)
+        return 200, {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-3.5-turbo'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: Optional[Dict[str, Any]], reference: 'FakeDocument'):
+        self.id = doc_id
+        self.exists = data is not None
+        self.reference = reference
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data)
+
+
+class FakeDocument:
+    def __init__(self, collection: 'FakeCollection', doc_id: str):
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self) -> FakeSnapshot:
+        self.collection.db.faults.delay()
+        return FakeSnapshot(self.id, self.collection.docs.get(self.id), self)
+
+    def _set(self, data: Dict[str, Any], merge: bool):
+        change = 'MODIFIED' if self.id in self.collection.docs else 'ADDED'
+        if merge and self.id in self.collection.docs:
+            self.collection.docs[self.id].update(copy.deepcopy(data))
+        else:
+            self.collection.docs[self.id] = copy.deepcopy(data)
+        self.collection.changed(self.id, change)
+
+    def _update(self, data: Dict[str, Any]):
+        if self.id not in self.collection.docs:
+            raise KeyError(f'No document to update: {self.collection.name}/{self.id}')
+        self.collection.docs[self.id].update(copy.deepcopy(data))
+        self.collection.changed(self.id, 'MODIFIED')
+
+    def _delete(self):
+        if self.collection.docs.pop(self.id, None) is not None:
+            self.collection.changed(self.id, 'REMOVED')
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self.collection.db.write()
+        with self.collection.db.lock:
+            self._set(data, merge)
+
+    def update(self, data: Dict[str, Any]):
+        self.collection.db.write()
+        with self.collection.db.lock:
+            self._update(data)
+
+    def delete(self):
+        self.collection.db.write()
+        with self.collection.db.lock:
+            self._delete()
+
+
+class FakeCollection:
+    def __init__(self, db: 'FakeFirestore', name: str):
+        self.db = db
+        self.name = name
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.filters: List[Tuple[str, str, Any]] = []
+        self.fields: Optional[List[str]] = None
+        self.listeners: List = []
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self, doc_id or f'{random.getrandbits(64):016x}')
+
+    def add(self, data: Dict[str, Any]) -> Tuple[None, FakeDocument]:
+        """Create a document with an auto id, as the client does for videos"""
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+    def _query(self) -> 'FakeCollection':
+        query = FakeCollection(self.db, self.name)
+        query.docs = self.docs
+        query.listeners = self.listeners
+        query.filters = self.filters
+        query.fields = self.fields
+        return query
+
+    def where(self, field: str, op: str, value: Any) -> 'FakeCollection':
+        if op not in ('==', 'array_contains_any'):
+            raise NotImplementedError(f'FakeFirestore only supports == and array_contains_any filters, not {op}')
+        query = self._query()
+        query.filters = self.filters + [(field, op, value)]
+        return query
+
+    def select(self, fields: List[str]) -> 'FakeCollection':
+        query = self._query()
+        query.fields = list(fields)
+        return query
+
+    @staticmethod
+    def _matches(data: Dict[str, Any], field: str, op: str, value: Any) -> bool:
+        if op == 'array_contains_any':
+            return any(item in value for item in data.get(field) or [])
+        return data.get(field) == value
+
+    def stream(self):
+        self.db.faults.delay()
+        with self.db.lock:
+            items = list(self.docs.items())
+        for doc_id, data in items:
+            if all(self._matches(data, field, op, value) for field, op, value in self.filters):
+                if self.fields is not None:
+                    data = {field: data[field] for field in self.fields if field in data}
+                yield FakeSnapshot(doc_id, copy.deepcopy(data), FakeDocument(self, doc_id))
+
+    get = stream
+
+    def on_snapshot(self, callback):
+        """Deliver the collection to callback, then every change to it as
+        it is written. Unlike Firestore's listener the callback runs on the
+        writing thread, so a change is visible as soon as the write returns."""
+        with self.db.lock:
+            docs = [FakeSnapshot(doc_id, copy.deepcopy(data), FakeDocument(self, doc_id))
+                    for doc_id, data in self.docs.items()]
+            self.listeners.append(callback)
+        callback(docs, [SimpleNamespace(type=SimpleNamespace(name='ADDED'), document=doc) for doc in docs], None)
+        return SimpleNamespace(unsubscribe=lambda: self.listeners.remove(callback))
+
+    def changed(self, doc_id: str, change: str):
+        if not self.listeners:
+            return
+        data = self.docs.get(doc_id)
+        document = FakeSnapshot(doc_id, copy.deepcopy(data), FakeDocument(self, doc_id))
+        for callback in list(self.listeners):
+            callback([], [SimpleNamespace(type=SimpleNamespace(name=change), document=document)], None)
+
+
+class FakeBatch:
+    """Applies its writes together for the cost of one round trip"""
+
+    def __init__(self, db: 'FakeFirestore'):
+        self.db = db
+        self._writes = []
+
+    def set(self, ref: FakeDocument, data: Dict[str, Any], merge: bool = False):
+        self._writes.append(lambda: ref._set(data, merge))
+
+    def update(self, ref: FakeDocument, data: Dict[str, Any]):
+        self._writes.append(lambda: ref._update(data))
+
+    def delete(self, ref: FakeDocument):
+        self._writes.append(ref._delete)
+
+    def commit(self):
+        self.db.write()
+        with self.db.lock:
+            for write in self._writes:
+                write()
+
+
+class FakeFirestore:
+    """In-process Firestore client covering the calls the API makes"""
+
+    def __init__(self, faults: Optional[Faults] = None):
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def collection(self, name: str) -> FakeCollection:
+        with self.lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(self, name)
+            return self._collections[name]
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    def write(self):
+        self.faults.delay()
+        if self.faults.should_fail():
+            raise RuntimeError('injected Firestore failure')
+        with self.lock:
+            self.writes += 1
@@ -0,0 +1,121 @@
+"""Measure audio fingerprinting speed and how reliably re-uploads are
+matched, on synthetic audio so no media or ffmpeg is needed.
+
+Usage (from the api directory):
+    python -m benchmarks.fingerprint
+    python -m benchmarks.fingerprint --videos 200 --minutes 10 --noise 0.05
+
+Stores --videos fingerprints in an in-process Firestore, then looks up
+noisy full copies, noisy clips cut at random offsets and unrelated audio
+through their anchors, and reports how many were matched to the right
+video at the right offset.
+"""
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+os.environ.setdefault('GOVERNOR_BACKEND', 'memory')
+
+from app.audio_fingerprint import SAMPLE_RATE, fingerprint, load_candidates  # noqa: E402
+from tiptok_core.audio_fingerprint import save_fingerprint  # noqa: E402
+
+from .fakes import FakeFirestore  # noqa: E402
+
+# A clip's offset counts as right within this many seconds
+OFFSET_TOLERANCE = 0.1
+
+
+def synthetic_audio(seconds: float, seed: int) -> np.ndarray:
+    """Chords of random tones changing every quarter second over a noise floor"""
+    rng = np.random.default_rng(seed)
+    count = int(seconds * SAMPLE_RATE)
+    t = np.arange(count) / SAMPLE_RATE
+    audio = rng.normal(0, 0.05, count).astype(np.float32)
+    step = SAMPLE_RATE // 4
+    for start in range(0, count, step):
+        part = slice(start, start + step)
+        for _ in range(3):
+            audio[part] += np.sin(2 * np.pi * rng.uniform(100, 3500) * t[part]) * rng.uniform(0.1, 0.3)
+    return (audio / np.abs(audio).max() * 20000).astype(np.int16)
+
+
+def re_encode(audio: np.ndarray, noise: float, seed: int) -> np.ndarray:
+    """A quieter copy with added noise, standing in for a lossy re-encode"""
+    rng = np.random.default_rng(seed)
+    copy = audio.astype(np.float32) * 0.6 + rng.normal(0, noise * 32768, len(audio))
+    return np.clip(copy, -32768, 32767).astype(np.int16)
+
+
+class Writer:
+    """Writes straight to the store instead of queueing"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def set(self, collection: str, doc_id: str, data):
+        self.db.collection(collection).document(doc_id).set(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--videos', type=int, default=50, help='Originals in the index')
+    parser.add_argument('--minutes', type=float, default=5.0, help='Length of each original')
+    parser.add_argument('--queries', type=int, default=20, help='Lookups of each kind')
+    parser.add_argument('--clip-seconds', type=float, default=60.0, help='Length of the clips looked up')
+    parser.add_argument('--noise', type=float, default=0.02, help='Noise added to copies, as a fraction of full scale')
+    args = parser.parse_args()
+
+    db = FakeFirestore()
+    originals = {}
+    elapsed = 0.0
+    hash_count = 0
+    for i in range(args.videos):
+        audio = synthetic_audio(args.minutes * 60, seed=i)
+        started = time.perf_counter()
+        hashes, times = fingerprint(audio)
+        elapsed += time.perf_counter() - started
+        save_fingerprint(db, Writer(db), f'videos/bench/{i:05d}.mp4', '1', len(audio) / SAMPLE_RATE, hashes, times)
+        originals[i] = audio
+        hash_count += len(hashes)
+    audio_seconds = args.videos * args.minutes * 60
+    print(f"fingerprinted {args.videos} x {args.minutes:g} min in {elapsed:.1f}s "
+          f"({audio_seconds / elapsed:.0f}x real time, {hash_count / audio_seconds:.0f} hashes/s of audio)")
+
+    rng = random.Random(0)
+    print(f"{'query':<8} {'count':>5} {'right':>6} {'wrong':>6} {'missed':>7} {'lookup p50':>11}")
+    for kind in ('copy', 'clip', 'new'):
+        right = wrong = missed = 0
+        lookups = []
+        for q in range(args.queries):
+            video = rng.randrange(args.videos)
+            if kind == 'new':
+                audio, offset = synthetic_audio(args.clip_seconds, seed=10 ** 6 + q), None
+            elif kind == 'copy':
+                audio, offset = re_encode(originals[video], args.noise, seed=q), 0.0
+            else:
+                offset = rng.uniform(0, args.minutes * 60 - args.clip_seconds)
+                first = int(offset * SAMPLE_RATE)
+                audio = re_encode(originals[video][first:first + int(args.clip_seconds * SAMPLE_RATE)],
+                                  args.noise, seed=q)
+            hashes, times = fingerprint(audio)
+            started = time.perf_counter()
+            match = load_candidates(db, hashes).match(hashes, times, len(audio) / SAMPLE_RATE)
+            lookups.append(time.perf_counter() - started)
+            if match is None:
+                missed += offset is not None
+                right += offset is None
+            elif (offset is not None and match.video_path == f'videos/bench/{video:05d}.mp4'
+                  and abs(match.offset - offset) <= OFFSET_TOLERANCE):
+                right += 1
+            else:
+                wrong += 1
+        lookups.sort()
+        print(f"{kind:<8} {args.queries:>5} {right:>6} {wrong:>6} {missed:>7} "
+              f"{lookups[len(lookups) // 2] * 1000:>9.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Compare how long after an upload completes its chapters are ready when
+the audio is transcribed live during the upload against transcribing it
+afterwards, using local fakes of every provider.
+
+Usage (from the api directory):
+    python -m benchmarks.live
+    python -m benchmarks.live --uploads 8 --audio-minutes 5 --upload-speed 20
+    python -m benchmarks.live --deepgram-latency 8 --live-latency 0.3
+
+The upload itself is simulated: audio chunks are paced as if the video
+were uploading at --upload-speed times real time, and the video counts as
+stored once the last chunk has been sent.
+"""
+import argparse
+import json
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
+
+from .fakes import Faults, FakeDeepgramLive
+from .load import percentile, peak_rss_mb, post, seed_videos, start_api, start_fakes
+
+
+def call(url: str, data: bytes, content_type: str, timeout: float) -> Tuple[int, Dict[str, Any]]:
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def simulate_upload(args, send_chunk=None) -> float:
+    """Pace the chunks of a video's audio like an upload; returns when it completes"""
+    chunk_bytes = int(args.chunk_seconds * args.bytes_per_second)
+    chunks = max(1, int(args.audio_minutes * 60 / args.chunk_seconds))
+    for _ in range(chunks):
+        time.sleep(args.chunk_seconds / args.upload_speed)
+        if send_chunk is not None:
+            send_chunk(random.randbytes(chunk_bytes))
+    return time.perf_counter()
+
+
+def live_upload(base_url: str, video_path: str, args) -> Dict[str, float]:
+    status, body = call(base_url + '/api/live/start', json.dumps({'videoPath': video_path}).encode(),
+                        'application/json', args.timeout)
+    if status != 201:
+        raise RuntimeError(f"live/start returned {status}: {body}")
+    session = f"{base_url}/api/live/{body['sessionId']}"
+
+    def send_chunk(chunk: bytes):
+        status, body = call(session + '/audio', chunk, 'application/octet-stream', args.timeout)
+        if status != 202:
+            raise RuntimeError(f"live audio returned {status}: {body}")
+
+    uploaded = simulate_upload(args, send_chunk)
+    status, body = call(session + '/finish', b'', 'application/json', args.timeout)
+    if status != 202:
+        raise RuntimeError(f"live/finish returned {status}: {body}")
+    finished = time.perf_counter()
+    status = post(base_url + '/api/generate_chapters', {'videoPath': video_path}, args.timeout)
+    return {'finish': finished - uploaded, 'chapters': time.perf_counter() - uploaded, 'status': status}
+
+
+def batch_upload(base_url: str, video_path: str, args) -> Dict[str, float]:
+    uploaded = simulate_upload(args)
+    status = post(base_url + '/api/generate_chapters', {'videoPath': video_path}, args.timeout)
+    return {'finish': 0.0, 'chapters': time.perf_counter() - uploaded, 'status': status}
+
+
+def run(base_url: str, paths: List[str], upload, args) -> List[Dict[str, float]]:
+    with ThreadPoolExecutor(max_workers=args.uploads) as executor:
+        return list(executor.map(lambda path: upload(base_url, path, args), paths))
+
+
+def report(name: str, results: List[Dict[str, float]]):
+    ready = [result['chapters'] for result in results]
+    errors = sum(1 for result in results if result['status'] != 200)
+    print(f"{name:<6} {len(results):>7} {errors:>6} {percentile(ready, 0.5):>7.2f}s "
+          f"{percentile(ready, 0.95):>7.2f}s {max(ready):>7.2f}s "
+          f"{percentile([result['finish'] for result in results], 0.5):>9.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=4, help='Concurrent uploads per mode')
+    parser.add_argument('--audio-minutes', type=float, default=3.0, help='Length of each upload')
+    parser.add_argument('--upload-speed', type=float, default=30.0, help='Upload speed as a multiple of real time')
+    parser.add_argument('--chunk-seconds', type=float, default=5.0, help='Seconds of audio per chunk')
+    parser.add_argument('--bytes-per-second', type=int, default=32000, help='Audio bitrate (16 kHz linear16 mono)')
+    parser.add_argument('--deepgram-latency', type=float, default=5.0, help='Seconds per prerecorded Deepgram call')
+    parser.add_argument('--live-latency', type=float, default=0.3, help='Seconds before each streaming result')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='Seconds per OpenAI call')
+    parser.add_argument('--storage-latency', type=float, default=0.01, help='Seconds per media fetch')
+    parser.add_argument('--firestore-latency', type=float, default=0.02, help='Seconds per Firestore call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Uniform +/- jitter added to every latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of provider calls that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of injected failures')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Client timeout per request')
+    args = parser.parse_args()
+
+    fakes = start_fakes(args)
+    fakes['deepgram_live'] = FakeDeepgramLive(
+        Faults(latency=args.live_latency, jitter=args.jitter, error_rate=args.error_rate,
+               error_status=args.error_status),
+        bytes_per_second=args.bytes_per_second)
+    os.environ['DEEPGRAM_LIVE_URL'] = fakes['deepgram_live'].start() + '/v1'
+    base_url, server = start_api(fakes)
+    paths = seed_videos(fakes['firestore'], args.uploads * 2)
+
+    print(f"{args.uploads} concurrent uploads of {args.audio_minutes:g} minutes at {args.upload_speed:g}x real time")
+    print(f"{'mode':<6} {'uploads':>7} {'errors':>6} {'p50':>8} {'p95':>8} {'max':>8} {'finish':>10}")
+    print("(seconds from upload complete to chapters returned)")
+    try:
+        report('live', run(base_url, paths[:args.uploads], live_upload, args))
+        report('batch', run(base_url, paths[args.uploads:], batch_upload, args))
+        print(f"deepgram fake: {fakes['deepgram'].requests} prerecorded calls, "
+              f"{fakes['deepgram_live'].requests} streams, {fakes['deepgram_live'].audio_seconds:.0f}s streamed")
+        print(f"peak RSS: {peak_rss_mb():.1f} MB")
+    finally:
+        server.shutdown()
+        for name in ('storage', 'deepgram', 'openai', 'deepgram_live'):
+            fakes[name].stop()
+
+
+if __name__ == '__main__':
+    main()
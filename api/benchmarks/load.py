@@ -0,0 +1,193 @@
+"""Drive /api/get_summary and /api/generate_chapters under concurrent load
+against local fakes of every external provider.
+
+Usage (from the api directory):
+    python -m benchmarks.load
+    python -m benchmarks.load --requests 200 --concurrency 32 --audio-minutes 10
+    python -m benchmarks.load --error-rate 0.05 --deepgram-latency 2 --openai-latency 0.5
+
+Prints throughput, p50/p95/p99 latency per endpoint and the peak RSS of the
+process, which hosts both the API and the fakes.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Tuple
+
+from .fakes import Faults, FakeDeepgram, FakeOpenAI, FakeStorage, FakeFirestore
+
+ENDPOINTS = {
+    'summary': '/api/get_summary',
+    'chapters': '/api/generate_chapters',
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def start_fakes(args) -> Dict[str, Any]:
+    """Start the provider fakes and point the API's clients at them"""
+    def faults(latency: float) -> Faults:
+        return Faults(latency=latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status)
+
+    fakes = {
+        'storage': FakeStorage(faults(args.storage_latency)),
+        'deepgram': FakeDeepgram(faults(args.deepgram_latency), audio_seconds=args.audio_minutes * 60),
+        'openai': FakeOpenAI(faults(args.openai_latency)),
+    }
+    for fake in fakes.values():
+        fake.start()
+    fakes['firestore'] = FakeFirestore(Faults(latency=args.firestore_latency, jitter=args.jitter))
+
+    os.environ['DEEPGRAM_API_URL'] = fakes['deepgram'].url + '/v1'
+    os.environ['DEEPGRAM_API_KEY'] = 'b' * 40
+    os.environ['OPENAI_BASE_URL'] = fakes['openai'].url + '/v1'
+    os.environ['OPENAI_API_KEY'] = 'sk-bench'
+    # Keep limiter state and indexes out of the real data directory
+    os.environ.setdefault('GOVERNOR_BACKEND', 'memory')
+    os.environ.setdefault('EMBEDDING_BACKEND', 'hashing')
+    os.environ.setdefault('INDEX_DIR', tempfile.mkdtemp(prefix='tiptok-bench-'))
+    # The fake media is random bytes with no audio to fingerprint
+    os.environ.setdefault('AUDIO_DEDUP', '0')
+    return fakes
+
+
+def start_api(fakes: Dict[str, Any]) -> Tuple[str, Any]:
+    """Import the app with Firebase swapped for the fakes and serve it on a local port"""
+    import firebase_admin
+    from firebase_admin import credentials
+    from werkzeug.serving import make_server
+
+    # routes.py reuses an initialized app instead of reading the credentials
+    # file; the fakes below replace every client it would create
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.ApplicationDefault(), {
+            'projectId': 'bench', 'storageBucket': 'bench'})
+
+    from app import create_app, routes
+    routes.storage = SimpleNamespace(bucket=fakes['storage'].bucket)
+    routes.firestore = SimpleNamespace(client=lambda: fakes['firestore'],
+                                       SERVER_TIMESTAMP=routes.firestore.SERVER_TIMESTAMP)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def seed_videos(db: FakeFirestore, count: int) -> List[str]:
+    paths = []
+    for i in range(count):
+        video_id = f'bench{i:05d}'
+        db.collection('videos').document(video_id).set({'userId': 'bench', 'title': f'Video {i}',
+                                                         'storagePath': f'videos/{video_id}'})
+        paths.append(f'videos/{video_id}')
+    return paths
+
+
+def post(url: str, payload: Dict[str, Any], timeout: float) -> int:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_load(base_url: str, jobs: List[Tuple[str, str]], concurrency: int, timeout: float, force: bool):
+    """Send every (endpoint, videoPath) job and collect (endpoint, status, seconds)"""
+    def send(job):
+        endpoint, video_path = job
+        started = time.perf_counter()
+        try:
+            status = post(base_url + ENDPOINTS[endpoint], {'videoPath': video_path, 'force': force}, timeout)
+        except Exception:
+            status = 0
+        return endpoint, status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, jobs))
+    return results, time.perf_counter() - started
+
+
+def report(results, elapsed: float, fakes: Dict[str, Any]):
+    print(f"\n{len(results)} requests in {elapsed:.2f}s ({len(results) / elapsed:.1f} req/s)")
+    print(f"{'endpoint':<10} {'count':>6} {'errors':>6} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for endpoint in ENDPOINTS:
+        latencies = [seconds for name, status, seconds in results if name == endpoint]
+        if not latencies:
+            continue
+        errors = sum(1 for name, status, _ in results if name == endpoint and status != 200)
+        print(f"{endpoint:<10} {len(latencies):>6} {errors:>6} {len(latencies) / elapsed:>7.1f} "
+              f"{percentile(latencies, 0.50):>7.3f}s {percentile(latencies, 0.95):>7.3f}s "
+              f"{percentile(latencies, 0.99):>7.3f}s {max(latencies):>7.3f}s")
+    for name in ('storage', 'deepgram', 'openai'):
+        fake = fakes[name]
+        print(f"{name} fake: {fake.requests} calls, {fake.failures} injected failures")
+    print(f"firestore fake: {fakes['firestore'].writes} writes")
+    print(f"peak RSS: {peak_rss_mb():.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100, help='Total requests to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+    parser.add_argument('--endpoint', choices=['summary', 'chapters', 'both'], default='both')
+    parser.add_argument('--videos', type=int, default=50, help='Distinct videos to spread requests over')
+    parser.add_argument('--audio-minutes', type=float, default=1.5, help='Length of each synthetic transcript')
+    parser.add_argument('--deepgram-latency', type=float, default=0.5, help='Seconds per Deepgram call')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='Seconds per OpenAI call')
+    parser.add_argument('--storage-latency', type=float, default=0.01, help='Seconds per media fetch')
+    parser.add_argument('--firestore-latency', type=float, default=0.02, help='Seconds per Firestore call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Uniform +/- jitter added to every latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of provider calls that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of injected failures')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Client timeout per request')
+    parser.add_argument('--stored', action='store_true',
+                        help='Let the API serve stored results instead of forcing reprocessing')
+    args = parser.parse_args()
+
+    fakes = start_fakes(args)
+    base_url, server = start_api(fakes)
+    paths = seed_videos(fakes['firestore'], args.videos)
+
+    endpoints = list(ENDPOINTS) if args.endpoint == 'both' else [args.endpoint]
+    jobs = [(endpoints[i % len(endpoints)], paths[i % len(paths)]) for i in range(args.requests)]
+    print(f"Sending {len(jobs)} requests to {base_url} with concurrency {args.concurrency}")
+
+    try:
+        results, elapsed = run_load(base_url, jobs, args.concurrency, args.timeout, not args.stored)
+        report(results, elapsed, fakes)
+    finally:
+        server.shutdown()
+        for name in ('storage', 'deepgram', 'openai'):
+            fakes[name].stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Micro-benchmarks for transcript parsing and chaptering on synthetic
+multi-hour transcripts.
+
+Usage (from the api directory):
+    python -m benchmarks.micro
+    python -m benchmarks.micro --hours 1 4 8 --repeat 5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+from .fakes import synthetic_transcript
+
+# transcription.py refuses to import without a key; nothing here calls Deepgram
+os.environ.setdefault('DEEPGRAM_API_KEY', 'b' * 40)
+os.environ.setdefault('GOVERNOR_BACKEND', 'memory')
+
+import transcription  # noqa: E402
+from app.transcript_archive import TranscriptArchive  # noqa: E402
+
+
+def measure(fn: Callable, repeat: int) -> Tuple[float, float, float]:
+    """Best and median wall time over `repeat` runs, and peak traced memory in MB"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    return timings[0], timings[len(timings) // 2], peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, nargs='+', default=[1, 2, 4], help='Transcript lengths to test')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per benchmark')
+    parser.add_argument('--chapter-seconds', type=float, default=30.0, help='Target chapter duration')
+    args = parser.parse_args()
+
+    print(f"{'benchmark':<20} {'hours':>5} {'sentences':>9} {'best':>9} {'median':>9} {'peak MB':>8}")
+    for hours in args.hours:
+        response = synthetic_transcript(hours * 3600)
+        data = transcription.extract_transcript(response)
+        sentences = sum(len(para['sentences']) for para in data['paragraphs'])
+        raw = json.dumps(response)
+        archive_path = os.path.join(tempfile.mkdtemp(prefix='tiptok-micro-'), 'transcript.ttrx')
+        alternative = response['results']['channels'][0]['alternatives'][0]
+        TranscriptArchive.from_deepgram(alternative).write(archive_path)
+
+        benchmarks = {
+            'extract_transcript': lambda: transcription.extract_transcript(response),
+            'generate_chapters': lambda: transcription.generate_chapters(data, args.chapter_seconds),
+            'json_load': lambda: json.loads(raw),
+            'archive_open': lambda: TranscriptArchive.open(archive_path),
+            'archive_sentences': lambda: TranscriptArchive.open(archive_path).sentences(),
+        }
+        for name, fn in benchmarks.items():
+            best, median, peak = measure(fn, args.repeat)
+            print(f"{name:<20} {hours:>5g} {sentences:>9} {best * 1000:>7.3f}ms {median * 1000:>7.3f}ms {peak:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
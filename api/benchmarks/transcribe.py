@@ -0,0 +1,75 @@
+"""Compare transcription backends on throughput and cost per audio hour.
+
+Usage (from the api directory):
+    python -m benchmarks.transcribe clip1.mp4 clip2.mp4 --backends deepgram whisper
+    python -m benchmarks.transcribe --fake --files 16 --audio-minutes 10
+
+Each backend transcribes every source as one batch. Real sources need
+DEEPGRAM_API_KEY for Deepgram and faster-whisper installed for whisper;
+--fake runs Deepgram against the local stand-in instead. Cost per audio
+hour adds the provider's price to the host time spent, at --host-price.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from .fakes import Faults, FakeDeepgram, FakeStorage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='*', help='Media URLs or local files')
+    parser.add_argument('--backends', nargs='+', default=['deepgram', 'whisper'])
+    parser.add_argument('--fake', action='store_true', help='Transcribe synthetic media with the Deepgram fake')
+    parser.add_argument('--files', type=int, default=8, help='Synthetic files with --fake')
+    parser.add_argument('--audio-minutes', type=float, default=5.0, help='Length of each synthetic file')
+    parser.add_argument('--deepgram-latency', type=float, default=2.0, help='Seconds per fake Deepgram call')
+    parser.add_argument('--host-price', type=float, default=0.17,
+                        help='USD per hour of the host running the backend (default: 4 vCPU on-demand)')
+    args = parser.parse_args()
+
+    sources = list(args.sources)
+    if args.fake:
+        storage = FakeStorage()
+        storage.start()
+        deepgram = FakeDeepgram(Faults(latency=args.deepgram_latency), audio_seconds=args.audio_minutes * 60)
+        os.environ['DEEPGRAM_API_URL'] = deepgram.start() + '/v1'
+        os.environ.setdefault('DEEPGRAM_API_KEY', 'b' * 40)
+        sources += [f'{storage.url}/videos/bench{i:05d}.mp4' for i in range(args.files)]
+    if not sources:
+        parser.error('give some sources or --fake')
+    os.environ.setdefault('GOVERNOR_BACKEND', 'memory')
+    os.environ.setdefault('INDEX_DIR', tempfile.mkdtemp(prefix='tiptok-bench-'))
+
+    from app.metrics import TRANSCRIPTION_PRICES
+    from app.transcription_backends import get_transcription_backend
+
+    print(f"{len(sources)} sources")
+    print(f"{'backend':<10} {'files':>5} {'failed':>6} {'audio h':>8} {'load':>7} {'wall':>8} "
+          f"{'x realtime':>10} {'$/audio h':>10}")
+    for name in args.backends:
+        started = time.perf_counter()
+        try:
+            backend = get_transcription_backend(name)
+        except ImportError as e:
+            print(f"{name:<10} skipped: {e}")
+            continue
+        loaded = time.perf_counter()
+        transcripts = backend.transcribe_batch(sources)
+        wall = time.perf_counter() - loaded
+
+        audio_hours = sum(transcript.duration for transcript in transcripts if transcript) / 3600
+        failed = sum(1 for transcript in transcripts if transcript is None)
+        if audio_hours:
+            provider = TRANSCRIPTION_PRICES.get(name, 0.0) * 60
+            host = args.host_price * (wall / 3600) / audio_hours
+            realtime, cost = f'{audio_hours * 3600 / wall:>9.1f}x', f'{provider + host:>10.3f}'
+        else:
+            realtime, cost = f"{'-':>10}", f"{'-':>10}"
+        print(f"{name:<10} {len(sources):>5} {failed:>6} {audio_hours:>8.2f} {loaded - started:>6.1f}s "
+              f"{wall:>7.1f}s {realtime} {cost}")
+
+
+if __name__ == '__main__':
+    main()
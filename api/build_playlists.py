@@ -0,0 +1,152 @@
+"""Cluster the video catalog into proposed playlists and name them.
+
+Usage:
+    python build_playlists.py                 # whole catalog, incremental
+    python build_playlists.py --user USER_ID  # one creator's videos
+    python build_playlists.py --full          # refit vocabulary and topics
+    python build_playlists.py --dry-run       # print instead of writing
+
+Proposals are written to the suggestedplaylists collection in the same shape
+as playlists, so the app can offer them to creators to accept.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+
+from firebase_admin import firestore
+
+from app.routes import generate_playlist_title
+from app.playlist_clustering import cluster_videos, reuse_titles, save_model, load_model
+from app.vector_index import INDEX_DIR
+
+TITLE_WORKERS = 8
+# Enough of each summary for GPT to see what the playlist is about without
+# sending every transcript
+SUMMARY_CHARS = 300
+MAX_SUMMARIES_PER_TITLE = 10
+FIRESTORE_BATCH_SIZE = 500
+
+
+def fetch_videos(db, user_id: str = None) -> List[Dict[str, Any]]:
+    """Load id, keywords and summary for every summarized video"""
+    query = db.collection('videos')
+    if user_id:
+        query = query.where('userId', '==', user_id)
+    videos = []
+    for doc in query.stream():
+        data = doc.to_dict() or {}
+        if not data.get('keywords') and not data.get('summary'):
+            continue
+        videos.append({
+            'id': doc.id,
+            'userId': data.get('userId'),
+            'keywords': data.get('keywords', []),
+            'summary': data.get('summary', ''),
+        })
+    return videos
+
+
+def title_for(playlist: Dict[str, Any], summaries: Dict[str, str]) -> str:
+    """Ask GPT for one title covering the videos of a playlist"""
+    text = '\n'.join(
+        f"- {summaries[video_id][:SUMMARY_CHARS]}"
+        for video_id in playlist['videoIds'][:MAX_SUMMARIES_PER_TITLE]
+        if summaries.get(video_id)
+    )
+    return generate_playlist_title(f"A series of videos covering:\n{text}")
+
+
+def write_playlists(db, scope: str, playlists: List[Dict[str, Any]], owners: Dict[str, str]):
+    """Replace the proposals for a scope with the new playlists"""
+    collection = db.collection('suggestedplaylists')
+    stale = [doc.reference for doc in collection.where('scope', '==', scope).stream()]
+
+    batch = db.batch()
+    pending = 0
+    for ref in stale:
+        batch.delete(ref)
+        pending += 1
+        if pending == FIRESTORE_BATCH_SIZE:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    for playlist in playlists:
+        batch.set(collection.document(), {
+            'scope': scope,
+            'userId': owners.get(playlist['videoIds'][0]),
+            'title': playlist['title'],
+            'videoIds': playlist['videoIds'],
+            'videoCount': len(playlist['videoIds']),
+            'privacy': 'private',
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        })
+        pending += 1
+        if pending == FIRESTORE_BATCH_SIZE:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', help='Only cluster this creator\'s videos')
+    parser.add_argument('--full', action='store_true', help='Ignore the saved model and recluster from scratch')
+    parser.add_argument('--target-size', type=int, default=8, help='Rough number of videos per playlist')
+    parser.add_argument('--dry-run', action='store_true', help='Print playlists instead of writing them')
+    args = parser.parse_args()
+
+    scope = f"user_{args.user}" if args.user else 'catalog'
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    model_path = os.path.join(INDEX_DIR, f'playlists_{scope}.npz')
+    playlists_path = os.path.join(INDEX_DIR, f'playlists_{scope}.json')
+
+    db = firestore.client()
+    started = time.time()
+    videos = fetch_videos(db, args.user)
+    print(f"Loaded {len(videos)} videos in {time.time() - started:.1f}s")
+    if not videos:
+        return
+
+    previous_model = None
+    previous_playlists = []
+    if not args.full and os.path.exists(model_path) and os.path.exists(playlists_path):
+        previous_model = load_model(model_path)
+        with open(playlists_path) as f:
+            previous_playlists = json.load(f)
+
+    started = time.time()
+    result = cluster_videos(videos, previous=previous_model, target_size=args.target_size)
+    playlists = result['playlists']
+    print(f"Clustered into {len(playlists)} playlists in {time.time() - started:.1f}s")
+
+    reused = reuse_titles(playlists, previous_playlists)
+    summaries = {video['id']: video['summary'] for video in videos}
+    untitled = [playlist for playlist in playlists if 'title' not in playlist]
+    print(f"Reusing {reused} titles, generating {len(untitled)}")
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=TITLE_WORKERS) as executor:
+        titles = executor.map(lambda playlist: title_for(playlist, summaries), untitled)
+        for playlist, title in zip(untitled, titles):
+            playlist['title'] = title
+    print(f"Generated titles in {time.time() - started:.1f}s")
+
+    if args.dry_run:
+        for playlist in playlists:
+            print(f"{playlist['title']}: {', '.join(playlist['videoIds'])}")
+        return
+
+    owners = {video['id']: video['userId'] for video in videos}
+    write_playlists(db, scope, playlists, owners)
+    save_model(model_path, result['model'])
+    with open(playlists_path, 'w') as f:
+        json.dump(playlists, f)
+    print(f"Wrote {len(playlists)} playlist proposals for {scope}")
+
+
+if __name__ == '__main__':
+    main()
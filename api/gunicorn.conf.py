@@ -0,0 +1,31 @@
+"""Gunicorn settings for the API container"""
+import os
+import tempfile
+
+
+def on_starting(server):
+    """Set up what the workers share before they are forked: the metrics
+    directory, and the live host so a live session's requests can reach it
+    from any worker"""
+    # Workers write their metrics here for /api/metrics to sum; a fresh
+    # directory each start so an earlier run's workers aren't counted. Set
+    # before anything imports app.metrics, which reads it at import.
+    if not os.environ.get('METRICS_DIR'):
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='tiptok-metrics-')
+
+    from app.live_transcription import LIVE_HOST_ADDRESS, LIVE_HOST_AUTHKEY, start_live_host
+
+    address = os.path.join(tempfile.gettempdir(), f'tiptok-live-{os.getpid()}.sock')
+    authkey = os.urandom(32)
+    # Workers inherit the environment
+    os.environ[LIVE_HOST_ADDRESS] = address
+    os.environ[LIVE_HOST_AUTHKEY] = authkey.hex()
+    # Kept on the arbiter so the host is shut down when it exits
+    server.live_host = start_live_host(address, authkey)
+
+
+def child_exit(server, worker):
+    """Drop an exited worker's gauges from the summed metrics"""
+    from app.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
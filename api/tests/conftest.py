@@ -0,0 +1,9 @@
+import pytest
+
+from benchmarks.fakes import FakeFirestore
+
+
+@pytest.fixture
+def db():
+    """In-process Firestore with no latency or faults"""
+    return FakeFirestore()
@@ -0,0 +1,52 @@
+import numpy as np
+
+from tiptok_core.audio_fingerprint import (SAMPLE_RATE, HOP_SIZE, FRAME_SECONDS, FingerprintIndex, fingerprint,
+                                           load_candidates, save_fingerprint)
+from tiptok_core.write_behind import WriteBehindWriter
+
+
+def noise(seconds: float, seed: int) -> np.ndarray:
+    return (np.random.default_rng(seed).standard_normal(int(seconds * SAMPLE_RATE)) * 3000).astype('<i2')
+
+
+def indexed(*videos):
+    index = FingerprintIndex()
+    for path, samples in videos:
+        index.upsert(path, '1', len(samples) / SAMPLE_RATE, *fingerprint(samples))
+    return index
+
+
+def test_a_trimmed_clip_matches_at_its_offset():
+    original = noise(30, seed=1)
+    index = indexed(('videos/original', original), ('videos/other', noise(30, seed=2)))
+    clip = original[HOP_SIZE * 400:HOP_SIZE * 1200]
+
+    match = index.match(*fingerprint(clip), len(clip) / SAMPLE_RATE)
+    assert match.video_path == 'videos/original'
+    assert abs(match.offset - 400 * FRAME_SECONDS) <= FRAME_SECONDS
+    assert not match.exact
+
+
+def test_unrelated_audio_and_the_upload_itself_do_not_match():
+    original = noise(20, seed=1)
+    index = indexed(('videos/original', original))
+
+    assert index.match(*fingerprint(noise(20, seed=3)), 20.0) is None
+    assert index.match(*fingerprint(original), 20.0, exclude='videos/original') is None
+    assert index.match(*fingerprint(original), 20.0).exact
+
+
+def test_lookups_fetch_only_fingerprints_sharing_anchors(db):
+    writer = WriteBehindWriter(db, flush_interval=0.05)
+    original = noise(60, seed=1)
+    for path, samples in (('videos/original', original), ('videos/other', noise(60, seed=2))):
+        save_fingerprint(db, writer, path, '1', len(samples) / SAMPLE_RATE, *fingerprint(samples))
+    assert writer.flush(timeout=5)
+    writer.close(timeout=5)
+    clip = original[HOP_SIZE * 400:HOP_SIZE * 2400]
+    hashes, times = fingerprint(clip)
+
+    candidates = load_candidates(db, hashes)
+    assert candidates.get('videos/other') is None
+    assert candidates.match(hashes, times, len(clip) / SAMPLE_RATE).video_path == 'videos/original'
+    assert not len(load_candidates(db, hashes, exclude='videos/original'))
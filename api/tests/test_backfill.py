@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def backfill():
+    """The backfill module, importing app.routes the way the load benchmark
+    does: against an initialized Firebase app rather than a credentials file"""
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.ApplicationDefault(), {'projectId': 'test', 'storageBucket': 'test'})
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+    import backfill
+    return backfill
+
+
+def video(backfill, seconds=None, tokens=None):
+    return {'id': 'v', 'path': 'videos/v', 'generation': '1', 'seconds': seconds, 'tokens': tokens}
+
+
+def test_filters_select_videos(backfill, db):
+    videos = db.collection('videos')
+    videos.document('a').set({'userId': 'u1', 'storagePath': 'videos/u1/a.mp4', 'summary': 'Done'})
+    videos.document('b').set({'userId': 'u1', 'storagePath': 'videos/u1/b.mp4'})
+    videos.document('c').set({'userId': 'u2'})
+
+    assert [v['id'] for v in backfill.fetch_videos(db, user_id='u1')] == ['a', 'b']
+    assert backfill.fetch_videos(db, missing_summary=True) == [
+        {'id': 'b', 'path': 'videos/u1/b.mp4'}, {'id': 'c', 'path': 'videos/c'}]
+
+
+def test_long_transcripts_are_estimated_as_several_windows(backfill):
+    short = backfill.estimate([video(backfill, 60.0, 200)], ['chapters'], workers=1)
+    long = backfill.estimate([video(backfill, 3600.0, 12000)], ['chapters'], workers=1)
+    assert short['llm_calls'] == 2
+    # Five windows, a merge pass and sixty chapter summaries
+    assert long['llm_calls'] == 5 + 1 + 60
+    assert long['llm_usd'] > short['llm_usd'] > 0
+    assert short['transcribe_minutes'] == 0
+
+
+def test_videos_without_a_transcript_are_estimated_at_the_median(backfill):
+    plan = backfill.estimate([video(backfill, 120.0, 400), video(backfill)], ['summary'], workers=1)
+    assert plan['transcribe_minutes'] == 2.0
+    assert plan['llm_calls'] == 6
+
+
+def test_checkpoint_survives_a_restart(backfill, tmp_path):
+    path = str(tmp_path / 'backfill.json')
+    checkpoint = backfill.Checkpoint(path)
+    checkpoint.mark('a', '1')
+    checkpoint.mark('b', '1', error='degraded')
+    checkpoint.mark('c', '1', error='RuntimeError: boom')
+    checkpoint.mark('c', '2')
+
+    reloaded = backfill.Checkpoint(path)
+    assert reloaded.done == {'a': '1', 'c': '2'}
+    assert reloaded.failed == {'b': 'degraded'}
+
+
+def test_durations_read_as_minutes_or_hours(backfill):
+    assert backfill.format_duration(75) == '1m15s'
+    assert backfill.format_duration(3 * 3600 + 5 * 60) == '3h05m'
@@ -0,0 +1,73 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from benchmarks.fakes import FakeDeepgram, FakeOpenAI, FakeFirestore, Faults, synthetic_transcript
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(server):
+        servers.append(server)
+        return server.start()
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_synthetic_transcript_covers_the_duration():
+    paragraphs = synthetic_transcript(60.0)['results']['channels'][0]['alternatives'][0]['paragraphs']['paragraphs']
+    sentences = [sentence for para in paragraphs for sentence in para['sentences']]
+    assert sentences[0]['start'] == 0.0
+    assert 54.0 <= sentences[-1]['end'] <= 60.0
+    assert all(a['end'] <= b['start'] for a, b in zip(sentences, sentences[1:]))
+
+
+def test_fake_deepgram_answers_like_prerecorded(serve):
+    url = serve(FakeDeepgram(audio_seconds=30.0, fetch_media=False))
+    response = post(f'{url}/v1/listen', {'url': 'https://example.com/video.mp4'})
+    assert response['metadata']['duration'] == 30.0
+
+
+def test_fake_openai_groups_numbered_blocks(serve):
+    url = serve(FakeOpenAI(blocks_per_chapter=2))
+    prompt = '\n'.join(f'Block {i}: text' for i in range(5))
+    response = post(f'{url}/v1/chat/completions', {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': prompt}]})
+    assert json.loads(response['choices'][0]['message']['content']) == [[0, 1], [2, 3], [4]]
+    assert response['usage']['prompt_tokens'] > 0
+
+
+def test_injected_failures_use_the_configured_status(serve):
+    fake = FakeOpenAI(Faults(error_rate=1.0, error_status=429))
+    url = serve(fake)
+    with pytest.raises(urllib.error.HTTPError) as raised:
+        post(f'{url}/v1/chat/completions', {'messages': []})
+    assert raised.value.code == 429
+    assert fake.failures == fake.requests == 1
+
+
+def test_fake_firestore_batches_and_queries():
+    db = FakeFirestore()
+    videos = db.collection('videos')
+    batch = db.batch()
+    batch.set(videos.document('a'), {'storagePath': 'videos/u/a.mp4', 'title': 'A'})
+    batch.set(videos.document('b'), {'storagePath': 'videos/u/b.mp4'})
+    batch.commit()
+    videos.document('a').set({'title': 'Renamed'}, merge=True)
+
+    assert db.writes == 2
+    assert [doc.id for doc in videos.where('storagePath', '==', 'videos/u/a.mp4').stream()] == ['a']
+    assert videos.document('a').get().to_dict() == {'storagePath': 'videos/u/a.mp4', 'title': 'Renamed'}
+    with pytest.raises(KeyError):
+        videos.document('missing').update({'title': 'x'})
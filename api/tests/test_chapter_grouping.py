@@ -0,0 +1,36 @@
+from app.chapter_grouping import plan_windows, parse_groups, groups_from_starts, reconcile_windows
+
+
+def test_windows_cover_every_block_with_overlap():
+    blocks = [{'text': 'x' * 36} for _ in range(20)]
+    windows = plan_windows(blocks, max_tokens=60, overlap_tokens=15)
+
+    assert windows[0][0] == 0 and windows[-1][1] == len(blocks)
+    for (start, end), (next_start, next_end) in zip(windows, windows[1:]):
+        assert start < next_start < end < next_end
+
+
+def test_windows_are_sized_by_the_given_counter():
+    blocks = [{'text': 'a b c d e f g h'} for _ in range(10)]
+    words = lambda text: len(text.split())
+
+    # Counted a token a word, one block fits where the character estimate
+    # would fit two
+    assert plan_windows(blocks, 16, 0, count=words)[0] == (0, 1)
+    assert plan_windows(blocks, 16, 0)[0] == (0, 2)
+
+
+def test_a_block_larger_than_a_window_gets_one_to_itself():
+    blocks = [{'text': 'short'}, {'text': 'long ' * 100}, {'text': 'short'}]
+    assert plan_windows(blocks, 20, 0) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_groups_from_model_output():
+    assert parse_groups('[[0], [1, 2], [3]]', 4) == [0, 1, 3]
+    assert groups_from_starts([0, 1, 3], 4) == [[0], [1, 2], [3]]
+
+
+def test_reconciled_windows_keep_starts_in_order():
+    starts = reconcile_windows([(0, 6), (4, 10)], [[0, 3, 5], [4, 5, 8]])
+    assert starts == sorted(set(starts))
+    assert starts[0] == 0 and 8 in starts
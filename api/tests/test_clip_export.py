@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from app import clip_export
+from app.clip_export import KeyframeIndex, plan_clips, load_keyframes, keyframe_path
+from benchmarks.fakes import FakeStorage
+
+KEYFRAMES = KeyframeIndex(np.array([0.0, 2.0, 4.0, 6.0, 8.0]), 10.0)
+
+
+def chapter(start, end):
+    return {'start': start, 'end': end, 'summary': f'{start}-{end}'}
+
+
+def test_starts_snap_to_the_keyframe_before():
+    assert [KEYFRAMES.snap(t) for t in (0.0, 1.9, 2.0, 7.5, 30.0)] == [0.0, 0.0, 2.0, 6.0, 8.0]
+    assert KeyframeIndex(np.array([]), 0.0).snap(5.0) == 0.0
+
+
+def test_clips_tile_the_video():
+    clips = plan_clips([chapter(0.0, 3.1), chapter(3.1, 7.0), chapter(7.0, 10.0)], KEYFRAMES)
+    assert [(clip['start'], clip['end']) for clip in clips] == [(0.0, 2.0), (2.0, 6.0), (6.0, 10.0)]
+    assert [clip['chapterStart'] for clip in clips] == [0.0, 3.1, 7.0]
+
+
+def test_a_chapter_snapped_onto_the_next_ones_keyframe_gets_no_clip():
+    clips = plan_clips([chapter(0.0, 4.5), chapter(4.5, 5.0), chapter(5.0, 10.0)], KEYFRAMES)
+    assert [(clip['chapter'], clip['start'], clip['end']) for clip in clips] == [(0, 0.0, 4.0), (2, 4.0, 10.0)]
+
+
+def test_keyframe_index_is_probed_once_per_generation(tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_export, 'KEYFRAME_CACHE_DIR', str(tmp_path))
+    probes = []
+    monkeypatch.setattr(clip_export, 'probe_keyframes', lambda source: probes.append(source) or KEYFRAMES)
+    storage = FakeStorage()
+    bucket = storage.bucket()
+
+    assert len(load_keyframes(bucket, 'videos/u/clip.mp4', '7', 'clip.mp4')) == 5
+    assert storage.objects[keyframe_path('videos/u/clip.mp4')][1] == {'videoGeneration': '7'}
+    assert load_keyframes(bucket, 'videos/u/clip.mp4', '7', 'clip.mp4').duration == 10.0
+    assert probes == ['clip.mp4']
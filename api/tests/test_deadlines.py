@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.deadlines import (LatencyTracker, DeadlineExceeded, deadline_scope, detached_deadline, remaining,
+                           call_timeout, check_deadline, carry_deadline, hedged, HEDGE_MIN_SAMPLES)
+
+
+def test_scopes_only_tighten_the_deadline():
+    assert remaining() is None and call_timeout(30.0) == 30.0
+    with deadline_scope(10):
+        with deadline_scope(100):
+            assert remaining() <= 10
+        with detached_deadline(100):
+            assert remaining() > 10
+        assert call_timeout(30.0) <= 10
+    assert remaining() is None
+
+
+def test_passed_deadlines_stop_work():
+    with deadline_scope(0):
+        assert call_timeout(30.0) == 0.0
+        with pytest.raises(DeadlineExceeded):
+            check_deadline('test')
+
+
+def test_deadline_follows_work_into_executors():
+    with deadline_scope(5), ThreadPoolExecutor(max_workers=1) as executor:
+        assert 0 < executor.submit(carry_deadline(remaining)).result() <= 5
+        assert executor.submit(remaining).result() is None
+
+
+def test_threshold_is_the_default_until_enough_samples():
+    tracker = LatencyTracker(default_threshold=7.0)
+    for seconds in range(HEDGE_MIN_SAMPLES - 1):
+        tracker.observe(float(seconds))
+    assert tracker.threshold() == 7.0
+    for seconds in range(100):
+        tracker.observe(float(seconds))
+    assert 90.0 <= tracker.threshold() <= 99.0
+
+
+def slow(seconds, result):
+    def call():
+        time.sleep(seconds)
+        return result
+    return call
+
+
+def test_a_slow_primary_is_raced_by_the_hedge():
+    started = time.monotonic()
+    assert hedged(slow(2.0, 'primary'), slow(0.0, 'hedge'), LatencyTracker(0.05), 'test') == 'hedge'
+    assert time.monotonic() - started < 1.0
+
+
+def test_a_fast_primary_is_not_hedged():
+    hedges = []
+    secondary = lambda: hedges.append(1) or 'hedge'
+    assert hedged(slow(0.0, 'primary'), secondary, LatencyTracker(1.0), 'test') == 'primary'
+    assert not hedges
+
+
+def test_a_failing_primary_is_not_hedged():
+    def fail():
+        raise RuntimeError('down')
+    with pytest.raises(RuntimeError):
+        hedged(fail, slow(0.0, 'hedge'), LatencyTracker(1.0), 'test')
+
+
+def test_waiting_stops_at_the_deadline():
+    release = threading.Event()
+    with deadline_scope(0.1), pytest.raises(DeadlineExceeded):
+        hedged(release.wait, None, LatencyTracker(0.01), 'test')
+    release.set()
@@ -0,0 +1,100 @@
+import pytest
+
+from tiptok_core import governor
+from tiptok_core.governor import (Governor, MemoryBackend, SQLiteBackend, next_limit, status_of, is_retryable,
+                                  DECREASE_COOLDOWN)
+
+CONFIG = {'rate': 1000.0, 'burst': 1000.0, 'min_concurrency': 1, 'initial_concurrency': 4,
+          'max_concurrency': 8, 'latency_target': 10.0}
+
+
+class ProviderError(Exception):
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.status_code = status
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(governor, 'backoff_delay', lambda attempt, error=None: 0.0)
+
+
+def test_aimd_grows_additively_and_halves_once_per_cooldown():
+    limit, last = next_limit(4.0, 'ok', CONFIG, 0.0, 100.0)
+    assert limit == pytest.approx(4.25) and last == 0.0
+    limit, last = next_limit(limit, 'throttled', CONFIG, last, 100.0)
+    assert limit == pytest.approx(2.125) and last == 100.0
+    # A second 429 from a call already in flight is the same congestion
+    assert next_limit(limit, 'throttled', CONFIG, last, 100.0 + DECREASE_COOLDOWN / 2)[0] == limit
+    assert next_limit(1.0, 'slow', CONFIG, 0.0, 100.0)[0] == CONFIG['min_concurrency']
+    assert next_limit(8.0, 'ok', CONFIG, 0.0, 100.0)[0] == CONFIG['max_concurrency']
+    assert next_limit(4.0, 'error', CONFIG, 0.0, 100.0)[0] == 4.0
+
+
+def test_concurrency_slots_are_bounded_by_the_limit():
+    backend = MemoryBackend()
+    leases = [backend.try_acquire('p', CONFIG)[0] for _ in range(4)]
+    assert all(leases)
+    assert backend.try_acquire('p', CONFIG)[0] is None
+    backend.release(leases[0], 'p', CONFIG, 'ok')
+    assert backend.try_acquire('p', CONFIG)[0] is not None
+
+
+def test_token_bucket_asks_to_wait_when_empty():
+    config = {**CONFIG, 'rate': 2.0, 'burst': 1.0}
+    backend = MemoryBackend()
+    lease, _ = backend.try_acquire('p', config)
+    backend.release(lease, 'p', config, 'ok')
+    lease, wait = backend.try_acquire('p', config)
+    assert lease is None and 0 < wait <= 0.5
+
+
+def test_sqlite_backend_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'governor.db')
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    leases = [first.try_acquire('p', CONFIG)[0] for _ in range(2)] + \
+        [second.try_acquire('p', CONFIG)[0] for _ in range(2)]
+    assert all(leases)
+    assert second.try_acquire('p', CONFIG)[0] is None
+    first.release(leases[0], 'p', CONFIG, 'throttled')
+    assert second.snapshot('p')['limit'] == 2.0
+
+
+def test_call_retries_throttling_and_halves_the_limit():
+    backend = MemoryBackend()
+    gov = Governor('p', backend, CONFIG)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ProviderError(429)
+        return 'done'
+
+    assert gov.call(flaky) == 'done'
+    assert len(attempts) == 3
+    snapshot = backend.snapshot('p')
+    assert snapshot['inflight'] == 0 and snapshot['limit'] < CONFIG['initial_concurrency']
+
+
+def test_call_does_not_retry_client_errors():
+    gov = Governor('p', MemoryBackend(), CONFIG)
+    attempts = []
+
+    def bad_request():
+        attempts.append(1)
+        raise ProviderError(400)
+
+    with pytest.raises(ProviderError):
+        gov.call(bad_request)
+    assert len(attempts) == 1
+
+
+def test_status_of_reads_sdk_errors():
+    assert status_of(ProviderError(503)) == 503
+    assert status_of(Exception('DG: {"err_code":"TOO_MANY_REQUESTS"} 429')) == 429
+    assert status_of(Exception('Request failed (Status: 502)')) == 502
+    # Numbers that are not a status do not make an error retryable
+    assert status_of(Exception('Decoded 512 frames in 503 ms')) is None
+    assert not is_retryable(RuntimeError('segment 500 of 900 is unreadable'))
+    assert is_retryable(TimeoutError()) and not is_retryable(ValueError('nope'))
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from app import live_transcription
+from app.live_transcription import (LIVE_HOST_ADDRESS, LIVE_HOST_AUTHKEY, LiveHost, LiveSessionError,
+                                    start_live_host)
+from benchmarks.fakes import FakeDeepgramLive
+from tiptok_core import governor
+
+
+@pytest.fixture
+def host(monkeypatch, tmp_path):
+    """A live host against a fake Deepgram, as gunicorn.conf.py starts it"""
+    deepgram = FakeDeepgramLive(bytes_per_second=1000, result_interval=0.5)
+    monkeypatch.setenv('DEEPGRAM_LIVE_URL', deepgram.start() + '/v1')
+    monkeypatch.setenv('DEEPGRAM_API_KEY', 'test')
+    monkeypatch.setattr(governor, '_backend', governor.MemoryBackend())
+    monkeypatch.setattr(governor, '_governors', {})
+    # Firebase is not needed with the memory governor
+    monkeypatch.setattr(live_transcription, '_init_live_host', lambda: None)
+    address, authkey = str(tmp_path / 'live.sock'), os.urandom(16)
+    host = start_live_host(address, authkey)
+    yield address, authkey
+    host.shutdown()
+    deepgram.stop()
+
+
+def worker(address: str, authkey: bytes):
+    connection = LiveHost(address=address, authkey=authkey)
+    connection.connect()
+    return connection.transcriber()
+
+
+def test_any_worker_reaches_a_session(host):
+    first, second = worker(*host), worker(*host)
+    session_id = first.start('videos/user/clip.mp4', {})
+    for _ in range(4):
+        second.send(session_id, bytes(1000))
+    assert first.video_path(session_id) == 'videos/user/clip.mp4'
+    assert second.status(session_id)['bytesReceived'] == 4000
+
+    archive = first.finish(session_id)
+    assert len(archive) > 0 and archive.duration > 0
+    assert second.finish(session_id).to_bytes() == archive.to_bytes()
+    with pytest.raises(LiveSessionError):
+        second.send(session_id, bytes(1000))
+    second.discard(session_id)
+    with pytest.raises(KeyError):
+        first.status(session_id)
+
+
+def test_workers_connect_to_the_host_from_the_environment(host, monkeypatch):
+    address, authkey = host
+    monkeypatch.setenv(LIVE_HOST_ADDRESS, address)
+    monkeypatch.setenv(LIVE_HOST_AUTHKEY, authkey.hex())
+    monkeypatch.setattr(live_transcription, '_transcriber', None)
+    session_id = worker(*host).start('videos/user/clip.mp4', {})
+    assert live_transcription.get_live_transcriber().video_path(session_id) == 'videos/user/clip.mp4'
@@ -0,0 +1,114 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+from app import metrics
+from app.metrics import Counter, Histogram, Registry, stage, timed, record_llm_usage
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, stage='group')
+
+    assert histogram.render() == [
+        'latency_seconds_bucket{stage="group",le="0.1"} 1',
+        'latency_seconds_bucket{stage="group",le="1"} 3',
+        'latency_seconds_bucket{stage="group",le="+Inf"} 4',
+        'latency_seconds_sum{stage="group"} 4.05',
+        'latency_seconds_count{stage="group"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.register(Counter('calls_total', 'Calls'))
+    counter.inc(call='say "hi"\n')
+    assert 'calls_total{call="say \\"hi\\"\\n"} 1' in registry.render().splitlines()
+
+
+def test_stage_counts_errors_and_time():
+    errors = metrics.stage_errors.total()
+    with pytest.raises(RuntimeError):
+        with stage('test_failing_stage'):
+            raise RuntimeError("boom")
+
+    @timed('test_timed_stage')
+    def work():
+        return 42
+
+    assert work() == 42
+    assert metrics.stage_errors.total() == errors + 1
+    rendered = metrics.registry.render()
+    assert 'tiptok_stage_duration_seconds_count{stage="test_failing_stage"} 1' in rendered
+    assert 'tiptok_stage_duration_seconds_count{stage="test_timed_stage"} 1' in rendered
+    assert 'tiptok_stage_in_flight{stage="test_timed_stage"} 0' in rendered
+
+
+def test_llm_usage_is_costed_by_model():
+    cost = metrics.llm_cost.total()
+    record_llm_usage('gpt-4', SimpleNamespace(prompt_tokens=1000, completion_tokens=500), call='test')
+    record_llm_usage('some-unpriced-model', SimpleNamespace(prompt_tokens=1000, completion_tokens=500))
+    assert metrics.llm_cost.total() == pytest.approx(cost + 0.03 + 0.03)
+
+
+def test_worker_snapshots_are_summed():
+    registry = Registry()
+    counter = registry.register(Counter('calls_total', 'Calls'))
+    histogram = registry.register(Histogram('latency_seconds', 'Latency', buckets=(1.0,)))
+    counter.inc(call='a')
+    histogram.observe(0.5)
+    first = registry.snapshot()
+    counter.inc(2, call='a')
+    counter.inc(call='b')
+    histogram.observe(3.0)
+
+    lines = registry.render([first, registry.snapshot()]).splitlines()
+    assert 'calls_total{call="a"} 4' in lines
+    assert 'calls_total{call="b"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_count 3' in lines
+
+
+def test_an_exited_workers_gauges_are_dropped(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    metrics.stage_in_flight.inc(stage='test_exited_worker')
+    metrics.stage_errors.inc(stage='test_exited_worker')
+    metrics.write_snapshot()
+    metrics.stage_in_flight.dec(stage='test_exited_worker')
+    (tmp_path / '1.json').write_text((tmp_path / f'{os.getpid()}.json').read_text())
+
+    metrics.mark_process_dead(1)
+    rendered = metrics.render_metrics()
+    assert 'tiptok_stage_in_flight{stage="test_exited_worker"} 0' in rendered
+    assert 'tiptok_stage_errors_total{stage="test_exited_worker"} 2' in rendered
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'secret')
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+
+    return app.test_client()
+
+
+def test_metrics_endpoint_serves_the_registry(client):
+    client.get('/ping')
+    response = client.get('/api/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'tiptok_http_requests_total{endpoint="ping",status="200"} 1' in response.get_data(as_text=True)
+
+
+def test_metrics_endpoint_needs_the_token(monkeypatch, client):
+    assert client.get('/api/metrics').status_code == 404
+    assert client.get('/api/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', '')
+    assert client.get('/api/metrics', headers={'Authorization': 'Bearer '}).status_code == 404
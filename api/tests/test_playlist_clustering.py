@@ -0,0 +1,51 @@
+import numpy as np
+
+from app.playlist_clustering import cluster_videos, reuse_titles, save_model, load_model
+
+TOPICS = {
+    'cooking': ['pasta', 'sauce', 'kitchen', 'recipe'],
+    'welding': ['torch', 'steel', 'weld', 'safety'],
+    'python': ['python', 'numpy', 'function', 'loop'],
+}
+
+
+def catalog(per_topic=8):
+    rng = np.random.default_rng(1)
+    videos = []
+    for topic, words in TOPICS.items():
+        for i in range(per_topic):
+            keywords = list(rng.choice(words, 3, replace=False))
+            videos.append({'id': f'{topic}-{i}', 'keywords': keywords, 'summary': f'A video about {topic}'})
+    return videos
+
+
+def topic_of(video_id):
+    return video_id.split('-')[0]
+
+
+def test_playlists_keep_to_one_topic():
+    result = cluster_videos(catalog(), target_size=8)
+    assert result['playlists']
+    for playlist in result['playlists']:
+        assert len({topic_of(video_id) for video_id in playlist['videoIds']}) == 1
+
+
+def test_unchanged_catalog_keeps_its_playlists(tmp_path):
+    videos = catalog()
+    first = cluster_videos(videos, target_size=8)
+    path = str(tmp_path / 'model.npz')
+    save_model(path, first['model'])
+
+    second = cluster_videos(videos, previous=load_model(path), target_size=8)
+    assert sorted(map(sorted, (p['videoIds'] for p in second['playlists']))) == \
+        sorted(map(sorted, (p['videoIds'] for p in first['playlists'])))
+
+
+def test_titles_carry_over_when_membership_barely_changes():
+    previous = [{'videoIds': [str(i) for i in range(10)], 'title': 'Welding basics'}]
+    kept = {'videoIds': [str(i) for i in range(9)] + ['new']}
+    reshuffled = {'videoIds': ['0', '1', 'x', 'y', 'z']}
+
+    assert reuse_titles([kept, reshuffled], previous) == 1
+    assert kept['title'] == 'Welding basics'
+    assert 'title' not in reshuffled
@@ -0,0 +1,65 @@
+import pytest
+
+from app.prompt_budget import (remove_filler, drop_repeats, compact_text, compact_blocks, count_tokens,
+                               prompt_budget, check_prompt, PromptBudgetExceeded, ELISION)
+
+MODEL = 'gpt-3.5-turbo'
+
+
+@pytest.mark.parametrize('text, compacted', [
+    ('Um, so we start here.', 'so we start here.'),
+    ('I I think it works', 'I think it works'),
+    ('th- that is the w-w-way', 'that is the way'),
+    ('Uh I I mean, yes', 'yes'),
+    ('you know, the valve', 'the valve'),
+])
+def test_filler_and_stutters_are_removed(text, compacted):
+    assert remove_filler(text) == compacted
+
+
+@pytest.mark.parametrize('text', [
+    'We had had enough of it.',
+    'He said that that was fine.',
+    'What it is is a check.',
+    'We re-read the manual.',
+    'Do you know what it does?',
+])
+def test_repeated_words_that_are_meant_are_kept(text):
+    assert remove_filler(text) == text
+
+
+def test_repeated_sentences_are_dropped_across_texts():
+    seen = set()
+    assert drop_repeats('Close the valve. Check the gauge.', seen) == 'Close the valve. Check the gauge.'
+    assert drop_repeats('Check the gauge! Then open it.', seen) == 'Then open it.'
+
+
+def test_text_within_budget_is_untouched():
+    text = 'Um, a short transcript.'
+    assert compact_text(text, 1000, MODEL, 'test') == text
+
+
+def test_long_text_is_cut_evenly_to_budget():
+    sentences = [f'Step {i} is to check the part numbered {i}.' for i in range(200)]
+    text = compact_text(' '.join(sentences), 300, MODEL, 'test')
+
+    assert count_tokens(text, MODEL) <= 300
+    assert text.startswith(sentences[0])
+    assert ELISION in text
+    # The end of the transcript is still represented
+    assert any(sentence in text for sentence in sentences[150:])
+
+
+def test_blocks_keep_their_count():
+    texts = [f'Block {i} talks about part {i}. ' * 40 for i in range(10)] + ['Block 0 talks about part 0.']
+    compacted = compact_blocks(texts, 500, MODEL, 'test')
+
+    assert len(compacted) == len(texts)
+    assert compacted[-1] == ELISION
+    assert sum(count_tokens(text, MODEL) for text in compacted) <= 500
+
+
+def test_budget_stays_within_the_context():
+    assert prompt_budget('summarize_chapter_with_gpt', 'gpt-4') < 8192
+    with pytest.raises(PromptBudgetExceeded):
+        check_prompt([{'role': 'user', 'content': 'word ' * 40000}], 'gpt-4')
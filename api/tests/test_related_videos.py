@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from app import related_videos
+from app.related_videos import RelatedVideos, get_related_videos, update_related_videos
+from app.result_store import video_doc_id
+
+
+@pytest.fixture
+def fresh_table(monkeypatch):
+    monkeypatch.setattr(related_videos, '_related', None)
+
+
+def related_ids(table, video_id):
+    return [other for other, _ in table.neighbours(video_id)]
+
+
+def test_shared_keywords_rank_neighbours():
+    table = RelatedVideos()
+    table.load({
+        'a': ['python', 'machine_learning'],
+        'b': ['python', 'machine_learning', 'numpy'],
+        'c': ['python', 'web'],
+        'd': ['cooking'],
+    })
+    assert related_ids(table, 'a') == ['b', 'c']
+    assert related_ids(table, 'd') == []
+
+
+def test_incremental_updates_match_a_full_rebuild():
+    rng = random.Random(7)
+    vocabulary = [f'term{i}' for i in range(30)]
+    catalog = {f'v{i}': rng.sample(vocabulary, 3) for i in range(60)}
+    table = RelatedVideos(k=5)
+    table.load(catalog)
+    for _ in range(40):
+        video_id = f'v{rng.randrange(70)}'
+        catalog[video_id] = rng.sample(vocabulary, rng.randrange(4))
+        table.update(video_id, catalog[video_id])
+
+    rebuilt = RelatedVideos(k=5)
+    rebuilt.load(catalog)
+    # IDF is frozen between rebuilds, so compare the sets of neighbours
+    # that share a term rather than exact scores
+    for video_id in catalog:
+        assert set(related_ids(table, video_id)) <= {
+            other for other in catalog
+            if other != video_id and set(catalog[other]) & set(catalog[video_id])
+        }
+        assert len(related_ids(table, video_id)) == len(related_ids(rebuilt, video_id))
+
+
+def test_table_follows_keywords_written_elsewhere(db, fresh_table):
+    db.collection('videos').document('a').set({'keywords': ['python', 'flask']})
+    table = get_related_videos(db)
+    assert related_ids(table, 'a') == []
+
+    db.collection('videos').document('b').set({'keywords': ['python', 'django']})
+    assert related_ids(table, 'a') == ['b']
+
+    db.collection('videos').document('b').delete()
+    assert related_ids(table, 'a') == []
+
+
+def test_auto_id_videos_are_related_by_their_document_id(db, fresh_table):
+    first = db.collection('videos').add({'storagePath': 'videos/u/first.mp4', 'keywords': ['python', 'flask']})[1]
+    second = db.collection('videos').add({'storagePath': 'videos/u/second.mp4'})[1]
+    table = get_related_videos(db)
+
+    update_related_videos(video_doc_id(db, 'videos/u/second.mp4'), ['python', 'django'])
+    second.update({'keywords': ['python', 'django']})
+    assert len(table) == 2
+    assert related_ids(table, first.id) == [second.id]
@@ -0,0 +1,144 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+from app import result_store, write_behind
+from app.result_store import (PROCESSING_COLLECTION, TRIGGER_SUMMARY_SOURCE, MODEL_SUMMARY_SOURCE, load_chapters,
+                              load_trigger_chapters, load_summary, wait_for_trigger, conditional_response, wants_refresh, video_doc_id,
+                              CACHE_CONTROL)
+
+PATH = 'videos/user/clip.mp4'
+CHAPTERS = [{'start': 0, 'end': 5, 'summary': 'Opening sentence.'}]
+
+
+def store(db, **fields):
+    db.collection(PROCESSING_COLLECTION).document('clip').set({
+        'status': 'completed', 'generation': '7', 'chapters': CHAPTERS, **fields})
+
+
+def test_model_chapters_are_served_for_their_generation(db):
+    store(db, summarySource=MODEL_SUMMARY_SOURCE, suggestedTitle='Clip')
+    stored = load_chapters(db, PATH, '7')
+    assert stored['chapters'] == CHAPTERS and stored['suggested_title'] == 'Clip'
+    assert load_chapters(db, PATH, '8') is None
+
+
+def test_trigger_placeholders_are_not_served(db):
+    store(db, summarySource=TRIGGER_SUMMARY_SOURCE)
+    assert load_chapters(db, PATH, '7') is None
+    assert load_trigger_chapters(db, PATH, '7') == CHAPTERS
+    assert load_trigger_chapters(db, PATH, '8') is None
+
+
+def test_unfinished_runs_are_not_served(db):
+    store(db, status='processing')
+    assert load_chapters(db, PATH, '7') is None
+
+
+def test_summaries_only_count_for_their_generation(db):
+    db.collection('videos').document('clip').set({'summary': 'S', 'summaryGeneration': '7', 'keywords': ['k']})
+    assert load_summary(db, 'clip', '7') == {'summary': 'S', 'keywords': ['k'], 'suggested_title': 'Untitled Video'}
+    assert load_summary(db, 'clip', '6') is None
+
+
+def test_videos_are_found_by_storage_path_then_by_file_name(db):
+    video = db.collection('videos').add({'storagePath': PATH})[1]
+    db.collection('videos').document('legacy').set({'title': 'Uploaded before storagePath'})
+    assert video_doc_id(db, PATH) == video.id
+    assert video_doc_id(db, 'videos/legacy') == 'legacy'
+    assert video_doc_id(db, 'videos/user/missing.mp4') is None
+
+
+@pytest.fixture
+def routes(monkeypatch, db):
+    """app.routes against the fake Firestore, with the models stubbed out"""
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.ApplicationDefault(), {'projectId': 'test', 'storageBucket': 'test'})
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+    from app import routes
+    monkeypatch.setattr(write_behind, '_writer', None)
+    monkeypatch.setattr(routes.firestore, 'client', lambda: db)
+    monkeypatch.setattr(routes, 'find_source_upload', lambda video_path, generation: None)
+    monkeypatch.setattr(routes, 'index_video_summary', lambda *args, **kwargs: None)
+    monkeypatch.setattr(routes, 'summarize_chapter_with_gpt', lambda paragraphs: 'A clip.')
+    monkeypatch.setattr(routes, 'extract_keywords_with_gpt', lambda summary: ['clip'])
+    monkeypatch.setattr(routes, 'generate_playlist_title', lambda summary: 'Clip')
+    yield routes
+    write_behind.get_write_behind(db).close(timeout=5)
+
+
+def test_summaries_of_auto_id_videos_are_read_back(routes, monkeypatch, db):
+    video = db.collection('videos').add({'storagePath': PATH})[1]
+    monkeypatch.setattr(routes, 'get_transcript', lambda video_path, generation: SimpleNamespace(transcript='Hello.'))
+    video_id = video_doc_id(db, PATH)
+    first = routes.summarize_video(PATH, video_id, '7', False)
+    assert write_behind.get_write_behind(db).flush(timeout=5)
+    assert video.get().to_dict()['summary'] == 'A clip.'
+
+    monkeypatch.setattr(routes, 'get_transcript', lambda video_path, generation: pytest.fail('transcribed again'))
+    assert routes.summarize_video(PATH, video_id, '7', False) == first
+
+
+def test_unchanged_results_revalidate_as_not_modified():
+    app = Flask(__name__)
+    payload = {'video_id': PATH, 'chapters': CHAPTERS}
+    with app.test_request_context('/'):
+        first = conditional_response(payload)
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and first.headers['Cache-Control'] == CACHE_CONTROL
+
+    with app.test_request_context('/', headers={'If-None-Match': etag}):
+        assert conditional_response(payload).status_code == 304
+    with app.test_request_context('/', headers={'If-None-Match': etag}):
+        assert conditional_response({**payload, 'chapters': []}).status_code == 200
+
+
+def test_refresh_is_requested_by_body_or_query():
+    app = Flask(__name__)
+    with app.test_request_context('/?force=true'):
+        assert wants_refresh(None)
+        assert not wants_refresh({'force': False})
+    with app.test_request_context('/'):
+        assert wants_refresh({'force': '1'})
+        assert not wants_refresh({})
+
+
+def test_waits_for_the_trigger_processing_this_generation(db, monkeypatch):
+    monkeypatch.setattr(result_store, 'TRIGGER_POLL_INTERVAL', 0.01)
+    store(db, status='processing', created_at=datetime.now(timezone.utc))
+    timer = threading.Timer(0.1, lambda: store(db, summarySource=MODEL_SUMMARY_SOURCE))
+    timer.start()
+    assert wait_for_trigger(db, PATH, '7', timeout=5)['chapters'] == CHAPTERS
+    timer.join()
+
+
+def test_a_dead_trigger_run_is_not_waited_for(db):
+    store(db, status='processing', created_at=datetime.now(timezone.utc) - timedelta(hours=1))
+    assert wait_for_trigger(db, PATH, '7', timeout=5) is None
+
+
+def test_trigger_chapters_are_summarized_from_its_transcript(routes, monkeypatch, db):
+    store(db, summarySource=TRIGGER_SUMMARY_SOURCE,
+          chapters=[{'start': 0, 'end': 5, 'summary': 'Hi.'}, {'start': 5, 'end': 9, 'summary': 'Next.'}])
+    archive = routes.TranscriptArchive.from_paragraphs([
+        [{'text': 'Hi.', 'start': 0, 'end': 2}, {'text': 'More.', 'start': 2, 'end': 5}],
+        [{'text': 'Next.', 'start': 5, 'end': 9}]])
+    monkeypatch.setattr(routes, 'get_transcript', lambda video_path, generation: archive)
+    monkeypatch.setattr(routes, 'find_source_upload', lambda video_path, generation: pytest.fail('fingerprinted'))
+    monkeypatch.setattr(routes, 'group_blocks_with_gpt', lambda blocks: pytest.fail('grouped again'))
+    monkeypatch.setattr(routes, 'derived_bucket', lambda: None)
+    monkeypatch.setattr(routes, 'publish_tracks_later', lambda *args: None)
+
+    result = routes.chapter_video(PATH, '7', False, await_trigger=False)
+    assert [(chapter['start'], chapter['end'], chapter['summary']) for chapter in result['chapters']] == [
+        (0.0, 5.0, 'A clip.'), (5.0, 9.0, 'A clip.')]
+    assert write_behind.get_write_behind(db).flush(timeout=5)
+    assert load_chapters(db, PATH, '7')['suggested_title'] == 'Clip'
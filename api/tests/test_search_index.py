@@ -0,0 +1,73 @@
+import pytest
+
+from app import search_index
+from app.result_store import video_doc_id
+from app.search_index import InvertedIndex, expand_keyword, get_search_index, update_search_index
+
+
+@pytest.fixture
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(search_index, '_index', None)
+
+
+def test_expand_keyword_indexes_compound_parts():
+    assert expand_keyword('Machine_Learning') == ['machine_learning', 'machine', 'learning', 'machinelearning']
+
+
+def test_search_ranks_keyword_over_summary_match():
+    index = InvertedIndex()
+    index.upsert('a', keywords=['python'], summary='an intro')
+    index.upsert('b', keywords=['java'], summary='mentions python once')
+    results = index.search('python')
+    assert [result['videoId'] for result in results] == ['a', 'b']
+    assert results[0]['matchedKeywords'] == ['python']
+
+
+def test_search_matches_substrings_of_compound_keywords():
+    index = InvertedIndex()
+    index.upsert('a', keywords=['machine_learning'])
+    assert [result['videoId'] for result in index.search('learn')] == ['a']
+
+
+def test_upsert_replaces_and_remove_drops():
+    index = InvertedIndex()
+    index.upsert('a', keywords=['python'])
+    index.upsert('a', keywords=['rust'])
+    assert index.search('python') == []
+    assert [result['videoId'] for result in index.search('rust')] == ['a']
+    index.remove('a')
+    assert len(index) == 0 and index.complete('ru') == []
+
+
+def test_index_follows_writes_from_other_workers(db, fresh_index):
+    db.collection('videos').document('a').set({'keywords': ['python'], 'summary': 'Intro to python'})
+    db.collection('videos').document('untouched').set({'title': 'No summary yet'})
+    index = get_search_index(db)
+    assert len(index) == 1
+
+    # Written by another worker or a backfill: only Firestore sees it
+    db.collection('videos').document('b').set({'keywords': ['rust'], 'suggestedTitle': 'Rust basics'})
+    assert [result['videoId'] for result in index.search('rust')] == ['b']
+
+    db.collection('videos').document('a').update({'keywords': ['go']})
+    # Still in the summary, no longer a keyword
+    assert index.search('python')[0]['matchedKeywords'] == []
+    assert [result['videoId'] for result in index.search('go')] == ['a']
+
+    db.collection('videos').document('b').delete()
+    assert index.search('rust') == []
+
+
+def test_update_search_index_applies_locally_before_the_write_lands(db, fresh_index):
+    index = get_search_index(db)
+    update_search_index('c', ['kotlin'], 'Kotlin', 'A kotlin tour')
+    assert [result['videoId'] for result in index.search('kotlin')] == ['c']
+
+
+def test_a_summary_of_an_auto_id_video_is_indexed_once(db, fresh_index):
+    video = db.collection('videos').add({'storagePath': 'videos/user/clip.mp4', 'summary': 'Old summary'})[1]
+    index = get_search_index(db)
+    update_search_index(video_doc_id(db, 'videos/user/clip.mp4'), ['kotlin'], 'Kotlin', 'A kotlin tour')
+    video.update({'keywords': ['kotlin'], 'suggestedTitle': 'Kotlin', 'summary': 'A kotlin tour'})
+    assert len(index) == 1
+    assert [result['videoId'] for result in index.search('kotlin')] == [video.id]
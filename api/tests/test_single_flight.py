@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from app.deadlines import DeadlineExceeded, check_deadline, deadline_scope, remaining
+from app.single_flight import SingleFlight, SQLiteLockBackend
+
+
+def in_thread(fn):
+    """Run fn in a thread; returns a function giving its result or raising its error"""
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except BaseException as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def join():
+        thread.join(5)
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+    return join
+
+
+def test_a_short_timeout_only_fails_its_own_caller():
+    flights = SingleFlight(work_timeout=5)
+    calls, deadlines = [], []
+
+    def job():
+        calls.append(1)
+        deadlines.append(remaining())
+        time.sleep(0.3)
+        return 'done'
+
+    def impatient():
+        with deadline_scope(0.05):
+            return flights.do('key', job)
+    leader = in_thread(impatient)
+    time.sleep(0.02)
+    follower = in_thread(lambda: flights.do('key', job))
+
+    with pytest.raises(DeadlineExceeded):
+        leader()
+    assert follower() == 'done'
+    assert len(calls) == 1
+    # The job ran under the flight's own deadline, not the leader's 50ms
+    assert deadlines[0] > 4
+
+
+def test_errors_are_shared():
+    flights = SingleFlight()
+    calls = []
+
+    def job():
+        calls.append(1)
+        time.sleep(0.1)
+        raise ValueError('no such video')
+
+    waiters = [in_thread(lambda: flights.do('key', job)) for _ in range(3)]
+    for waiter in waiters:
+        with pytest.raises(ValueError):
+            waiter()
+    assert len(calls) == 1 and flights.in_flight() == 0
+
+
+def test_a_caller_with_time_left_restarts_a_job_that_ran_out():
+    flights = SingleFlight(work_timeout=0.1)
+    calls = []
+
+    def job():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.15)
+            check_deadline('job')
+        return 'done'
+
+    def short():
+        with deadline_scope(0.05):
+            return flights.do('key', job)
+
+    def long():
+        with deadline_scope(5):
+            return flights.do('key', job)
+    first = in_thread(short)
+    time.sleep(0.02)
+    second = in_thread(long)
+
+    with pytest.raises(DeadlineExceeded):
+        first()
+    assert second() == 'done'
+    assert len(calls) == 2
+
+
+def test_processes_wait_for_each_others_lock(tmp_path):
+    path = str(tmp_path / 'locks.db')
+    released = []
+    first = SingleFlight(SQLiteLockBackend(path), before_release=lambda: released.append('first'))
+    second = SingleFlight(SQLiteLockBackend(path), before_release=lambda: released.append('second'))
+    order = []
+
+    def job(name):
+        order.append(f'{name} start')
+        time.sleep(0.2)
+        order.append(f'{name} end')
+        return name
+
+    one = in_thread(lambda: first.do(('chapters', 'videos/a'), job, 'first'))
+    time.sleep(0.05)
+    two = in_thread(lambda: second.do(('chapters', 'videos/a'), job, 'second'))
+    assert (one(), two()) == ('first', 'second')
+    assert order == ['first start', 'first end', 'second start', 'second end']
+    assert released == ['first', 'second']
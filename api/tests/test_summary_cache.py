@@ -0,0 +1,40 @@
+import pytest
+
+from app import write_behind
+from app.summary_cache import SummaryCache, summary_key, CACHE_COLLECTION
+
+
+@pytest.fixture(autouse=True)
+def fresh_writer(monkeypatch):
+    monkeypatch.setattr(write_behind, '_writer', None)
+
+
+def test_key_ignores_whitespace_but_not_model():
+    assert summary_key('Close  the\nvalve.', 'gpt-3.5-turbo') == summary_key('Close the valve.', 'gpt-3.5-turbo')
+    assert summary_key('Close the valve.', 'gpt-3.5-turbo') != summary_key('Close the valve.', 'gpt-4')
+    assert summary_key('Close the valve.', 'gpt-4') != summary_key('Open the valve.', 'gpt-4')
+
+
+def test_memory_entries_are_bounded_least_recently_used_first():
+    cache = SummaryCache(max_entries=2)
+    cache.put('a', 'A', 'gpt-4')
+    cache.put('b', 'B', 'gpt-4')
+    cache.get('a')
+    cache.put('c', 'C', 'gpt-4')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('A', None, 'C')
+
+
+def test_summaries_are_shared_through_firestore(db):
+    key = summary_key('Close the valve.', 'gpt-4')
+    SummaryCache(db).put(key, 'Closing the valve', 'gpt-4')
+    assert write_behind.get_write_behind(db).flush(timeout=5)
+
+    assert db.collection(CACHE_COLLECTION).document(key).get().to_dict()['model'] == 'gpt-4'
+    assert SummaryCache(db).get(key) == 'Closing the valve'
+
+
+def test_firestore_errors_are_a_miss(db, monkeypatch):
+    def unavailable(name):
+        raise RuntimeError('unavailable')
+    monkeypatch.setattr(db, 'collection', unavailable)
+    assert SummaryCache(db).get('key') is None
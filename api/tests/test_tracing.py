@@ -0,0 +1,88 @@
+import contextvars
+import json
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from app import tracing
+from app.tracing import Trace, span, traced, current_trace
+
+
+def test_spans_are_free_outside_a_trace():
+    with span('anything', key='value') as recorded:
+        recorded.set(more=1)
+    assert current_trace() is None
+
+
+def test_spans_follow_work_onto_other_threads(tmp_path):
+    trace = Trace('request')
+    token = tracing._trace.set(trace)
+    try:
+        @traced('inner')
+        def inner():
+            pass
+
+        with span('outer', video='v1') as outer:
+            worker = threading.Thread(target=contextvars.copy_context().run, args=(inner,), name='worker')
+            worker.start()
+            worker.join()
+            outer.set(chapters=3)
+        with pytest.raises(ValueError):
+            with span('failing'):
+                raise ValueError()
+    finally:
+        tracing._trace.reset(token)
+
+    events = {event['name']: event for event in trace.events}
+    assert events['outer']['args'] == {'trace_id': trace.trace_id, 'video': 'v1', 'chapters': 3}
+    assert events['inner']['tid'] != events['outer']['tid']
+    assert events['failing']['args']['error'] == 'ValueError'
+    assert not trace.active
+
+    path = str(tmp_path / 'traces.json')
+    trace.export(path)
+    trace.export(path)
+    with open(path) as f:
+        exported = json.loads(f.read().rstrip(',\n') + ']')
+    assert sum(event['name'] == 'outer' for event in exported) == 2
+    assert {'name': 'thread_name', 'ph': 'M'}.items() <= exported[0].items()
+
+
+@pytest.fixture
+def traced_app(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, 'TRACE_TOKEN', 'secret')
+    monkeypatch.setattr(tracing, 'PROFILE_DIR', str(tmp_path))
+    exported = []
+    monkeypatch.setattr(Trace, 'export', lambda self: exported.append(self))
+    app = Flask(__name__)
+    tracing.init_app(app)
+
+    @app.route('/work')
+    def work():
+        with span('step'):
+            time.sleep(0.05)
+        return 'done'
+    return app, exported
+
+
+def test_only_requests_with_the_token_are_traced(traced_app):
+    app, exported = traced_app
+    client = app.test_client()
+
+    assert 'X-Trace-Id' not in client.get('/work', headers={tracing.TRACE_HEADER: 'guess'}).headers
+    response = client.get('/work', headers={tracing.TRACE_HEADER: 'secret'})
+    assert [trace.trace_id for trace in exported] == [response.headers['X-Trace-Id']]
+    request_span = next(event for event in exported[0].events if event['name'] == 'work')
+    assert request_span['args']['status'] == 200
+
+
+def test_profiled_requests_write_collapsed_stacks(traced_app, tmp_path):
+    app, exported = traced_app
+    app.test_client().get('/work', headers={tracing.PROFILE_HEADER: 'secret'})
+
+    with open(tmp_path / f'{exported[0].trace_id}.folded') as f:
+        stacks = f.read().splitlines()
+    assert stacks and all(stack.rsplit(' ', 1)[1].isdigit() for stack in stacks)
+    assert any('work (test_tracing.py' in stack for stack in stacks)
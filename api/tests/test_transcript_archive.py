@@ -0,0 +1,60 @@
+import pickle
+
+import pytest
+
+from app import transcript_archive
+from app.transcript_archive import TranscriptArchive, archive_path, load_transcript
+from benchmarks.fakes import FakeStorage
+
+PARAGRAPHS = [
+    [{'text': 'Welcome to the course.', 'start': 0.0, 'end': 2.0},
+     {'text': 'Today: welding.', 'start': 2.5, 'end': 4.0}],
+    [{'text': 'Safety comes first — always.', 'start': 5.0, 'end': 8.0}],
+]
+
+
+@pytest.fixture
+def archive():
+    return TranscriptArchive.from_paragraphs(PARAGRAPHS)
+
+
+def test_paragraphs_round_trip(archive):
+    assert len(archive) == 3
+    assert archive.duration == 8.0
+    assert list(archive.paragraphs()) == PARAGRAPHS
+    assert archive.transcript == 'Welcome to the course. Today: welding. Safety comes first — always.'
+
+
+def test_memory_mapped_file_reads_the_same(archive, tmp_path):
+    path = str(tmp_path / 'clip.ttrx')
+    archive.write(path)
+    assert list(TranscriptArchive.open(path).paragraphs()) == PARAGRAPHS
+
+
+def test_pickles_as_its_bytes(archive):
+    assert list(pickle.loads(pickle.dumps(archive)).paragraphs()) == PARAGRAPHS
+
+
+def test_sentences_between_times(archive):
+    assert [sentence['text'] for sentence in archive.between(2.0, 6.0)] == ['Today: welding.',
+                                                                          'Safety comes first — always.']
+
+
+def test_clip_moves_times_onto_the_clip(archive):
+    clip = archive.clip(3.0, 7.0)
+    assert clip.duration == 4.0
+    assert list(clip.paragraphs()) == [
+        [{'text': 'Today: welding.', 'start': 0.0, 'end': 1.0}],
+        [{'text': 'Safety comes first — always.', 'start': 2.0, 'end': 4.0}],
+    ]
+
+
+def test_only_the_archive_of_the_generation_is_loaded(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(transcript_archive, 'ARCHIVE_CACHE_DIR', str(tmp_path))
+    bucket = FakeStorage().bucket()
+    blob = bucket.blob(archive_path('videos/u/clip.mp4'))
+    blob.metadata = {'videoGeneration': '7'}
+    blob.upload_from_string(archive.to_bytes())
+
+    assert load_transcript(bucket, 'videos/u/clip.mp4', '8') is None
+    assert list(load_transcript(bucket, 'videos/u/clip.mp4', '7').paragraphs()) == PARAGRAPHS
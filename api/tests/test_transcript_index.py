@@ -0,0 +1,68 @@
+import pytest
+
+from app import transcript_index, write_behind
+from app.transcript_index import (SentenceIndex, build_sentence_entries, make_snippet, get_transcript_index,
+                                  save_transcript_index, INDEX_COLLECTION)
+
+BLOCKS = [
+    {'start': 0.0, 'end': 4.0, 'text': 'Welcome to the course.'},
+    {'start': 4.0, 'end': 9.0, 'text': 'Gradient descent follows the slope downhill.'},
+    {'start': 9.0, 'end': 14.0, 'text': 'Each step uses the learning rate.'},
+]
+CHAPTERS = [{'start': 0.0, 'end': 4.0}, {'start': 4.0, 'end': 14.0}]
+
+
+@pytest.fixture
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(transcript_index, '_index', None)
+    monkeypatch.setattr(write_behind, '_writer', None)
+
+
+def test_sentence_entries_carry_their_chapter():
+    sentences = build_sentence_entries(BLOCKS, [[0], [1, 2]])
+    assert [sentence['chapter'] for sentence in sentences] == [0, 1, 1]
+
+
+def test_search_returns_timestamps_and_chapter_range():
+    index = SentenceIndex()
+    index.upsert('v1', 'videos/u/v1.mp4', build_sentence_entries(BLOCKS, [[0], [1, 2]]), CHAPTERS)
+    hit = index.search('gradient descent')[0]
+    assert (hit['videoId'], hit['start'], hit['chapter'], hit['chapterStart'], hit['chapterEnd']) == \
+        ('v1', 4.0, 1, 4.0, 14.0)
+
+
+def test_search_caps_hits_per_video():
+    index = SentenceIndex()
+    sentences = [{'start': float(i), 'end': i + 1.0, 'text': f'python tip {i}', 'chapter': None} for i in range(10)]
+    index.upsert('v1', 'videos/u/v1.mp4', sentences, [])
+    assert len(index.search('python', per_video=2)) == 2
+
+
+def test_snippet_is_trimmed_around_the_match():
+    text = 'x' * 300 + ' needle ' + 'y' * 300
+    snippet = make_snippet(text, ['needle'])
+    assert 'needle' in snippet and snippet.startswith('…') and snippet.endswith('…')
+
+
+def test_index_follows_transcripts_saved_elsewhere(db, fresh_index):
+    index = get_transcript_index(db)
+    assert len(index) == 0
+
+    db.collection(INDEX_COLLECTION).document('v2').set({
+        'videoPath': 'videos/u/v2.mp4',
+        'sentences': build_sentence_entries(BLOCKS, [[0, 1, 2]]),
+        'chapters': [{'start': 0.0, 'end': 14.0}],
+    })
+    assert [hit['videoId'] for hit in index.search('learning rate')] == ['v2']
+
+    db.collection(INDEX_COLLECTION).document('v2').delete()
+    assert index.search('learning rate') == []
+
+
+def test_save_applies_locally_and_persists(db, fresh_index):
+    index = get_transcript_index(db)
+    chapters = [{'start': 0.0, 'end': 14.0, 'summary': 'All of it'}]
+    save_transcript_index(db, 'v3', 'videos/u/v3.mp4', build_sentence_entries(BLOCKS, [[0, 1, 2]]), chapters)
+    assert [hit['videoId'] for hit in index.search('welcome')] == ['v3']
+    assert write_behind.get_write_behind(db).flush(timeout=5)
+    assert db.collection(INDEX_COLLECTION).docs['v3']['chapters'] == [{'start': 0.0, 'end': 14.0}]
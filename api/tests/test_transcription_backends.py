@@ -0,0 +1,72 @@
+import pytest
+
+from benchmarks.fakes import FakeDeepgram, Faults
+from tiptok_core.transcription_backends import (SentenceAccumulator, TranscriptionBackend, DeepgramBackend,
+                                                deepgram_transcript, get_transcription_backend)
+
+
+def word(text, start, end):
+    return {'word': text.strip('.?!').lower(), 'punctuated_word': text, 'start': start, 'end': end}
+
+
+def test_words_become_sentences_and_paragraphs():
+    accumulator = SentenceAccumulator(paragraph_gap=1.0)
+    accumulator.add([word('Hello', 0.0, 0.4), word('there.', 0.5, 0.9), word('Ready', 1.0, 1.3)])
+    accumulator.add([word('now', 1.4, 1.6)], utterance_end=True)
+    accumulator.add([word('Next', 4.0, 4.3), word('part', 4.4, 4.8)])
+
+    transcript = accumulator.transcript('whisper')
+    assert transcript.paragraphs == [
+        [{'text': 'Hello there.', 'start': 0.0, 'end': 0.9}, {'text': 'Ready now', 'start': 1.0, 'end': 1.6}],
+        [{'text': 'Next part', 'start': 4.0, 'end': 4.8}],
+    ]
+    assert transcript.duration == 4.8
+
+
+def test_deepgram_without_paragraphs_keeps_the_text():
+    transcript = deepgram_transcript({'transcript': 'Just words'}, duration=3.0)
+    assert transcript.paragraphs == [[{'text': 'Just words', 'start': 0.0, 'end': 3.0}]]
+
+
+class Flaky(TranscriptionBackend):
+    name = 'flaky'
+
+    def transcribe(self, source):
+        if source == 'broken':
+            raise RuntimeError('unreadable')
+        return source
+
+
+def test_batches_keep_order_and_isolate_failures():
+    assert Flaky().transcribe_batch(['a', 'broken', 'c']) == ['a', None, 'c']
+
+
+def test_unknown_backends_are_rejected():
+    with pytest.raises(ValueError):
+        get_transcription_backend('carrier-pigeon')
+
+
+@pytest.fixture
+def deepgram(monkeypatch):
+    servers = []
+
+    def start(fake):
+        servers.append(fake)
+        monkeypatch.setenv('DEEPGRAM_API_URL', fake.start() + '/v1')
+        monkeypatch.setenv('DEEPGRAM_API_KEY', 'b' * 40)
+        return DeepgramBackend()
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_deepgram_backend_normalizes_the_response(deepgram):
+    transcript = deepgram(FakeDeepgram(audio_seconds=30.0, fetch_media=False)).transcribe('https://example.com/a.mp4')
+    assert transcript.backend == 'deepgram'
+    assert transcript.duration == 30.0
+    assert transcript.paragraphs and all(sentence['text'] for sentence in transcript.sentences())
+
+
+def test_deepgram_backend_treats_unreadable_media_as_no_speech(deepgram):
+    backend = deepgram(FakeDeepgram(Faults(error_rate=1.0, error_status=400), fetch_media=False))
+    assert backend.transcribe('https://example.com/a.mp4') is None
@@ -0,0 +1,139 @@
+import json
+import os
+
+import pytest
+
+from app import vector_index
+from app.vector_index import VectorIndex, HashingEmbedder
+
+
+def video(video_id, text):
+    return {'key': f'video:{video_id}', 'kind': 'video', 'videoId': video_id, 'text': text}
+
+
+def keys(index, query, **kwargs):
+    return {hit['key'] for hit in index.search(query, **kwargs)}
+
+
+def test_search_finds_nearest_and_filters_by_kind(tmp_path):
+    index = VectorIndex(str(tmp_path), HashingEmbedder())
+    index.upsert([video('a', 'neural networks and deep learning'), video('b', 'baking sourdough bread'),
+                  {'key': 'chapter:a:0', 'kind': 'chapter', 'text': 'training neural networks'}])
+    assert index.search('neural nets', k=1, kind='video')[0]['key'] == 'video:a'
+    assert keys(index, 'neural', kind='chapter') == {'chapter:a:0'}
+    assert 'text' not in index.search('bread', k=1)[0]
+
+
+def test_two_writers_on_one_directory_keep_both_videos(tmp_path):
+    # Two API workers open the same index
+    first = VectorIndex(str(tmp_path), HashingEmbedder())
+    second = VectorIndex(str(tmp_path), HashingEmbedder())
+    first.upsert([video('a', 'python decorators explained')])
+    second.upsert([video('b', 'rust ownership and borrowing')])
+
+    assert keys(first, 'rust ownership', k=5) == {'video:a', 'video:b'}
+    assert first.search('rust ownership', k=1)[0]['key'] == 'video:b'
+    assert second.search('python decorators', k=1)[0]['key'] == 'video:a'
+
+    reopened = VectorIndex(str(tmp_path), HashingEmbedder())
+    assert len(reopened) == 2
+    assert reopened.search('python decorators', k=1)[0]['key'] == 'video:a'
+
+
+def test_rows_are_not_reused_by_another_writer(tmp_path):
+    first = VectorIndex(str(tmp_path), HashingEmbedder())
+    second = VectorIndex(str(tmp_path), HashingEmbedder())
+    first.upsert([video('a', 'alpha')])
+    first.remove(['video:a'])
+    second.upsert([video('b', 'beta')])
+    # The freed row went to b, so c must not land on it
+    first.upsert([video('c', 'gamma')])
+    reopened = VectorIndex(str(tmp_path), HashingEmbedder())
+    assert {item['key'] for item in reopened._items if item} == {'video:b', 'video:c'}
+    assert reopened.search('beta', k=1)[0]['key'] == 'video:b'
+
+
+def test_growth_in_one_process_is_followed_by_the_other(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, 'INITIAL_CAPACITY', 2)
+    first = VectorIndex(str(tmp_path), HashingEmbedder())
+    second = VectorIndex(str(tmp_path), HashingEmbedder())
+    first.upsert([video(str(i), f'topic number {i}') for i in range(5)])
+    second.upsert([video('late', 'late arrival')])
+    assert len(first) == len(second) == 6
+    assert first.search('late arrival', k=1)[0]['key'] == 'video:late'
+
+
+def test_storing_appends_a_line_per_item(tmp_path):
+    index = VectorIndex(str(tmp_path), HashingEmbedder())
+    index.upsert([video('a', 'one'), video('b', 'two')])
+    index.upsert([video('a', 'one again')])
+    with open(tmp_path / 'items.jsonl') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['row'] for line in lines] == [0, 1, 0]
+
+
+def test_log_is_compacted_and_other_processes_follow(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, 'COMPACT_MIN_LINES', 5)
+    first = VectorIndex(str(tmp_path), HashingEmbedder())
+    second = VectorIndex(str(tmp_path), HashingEmbedder())
+    for i in range(8):
+        first.upsert([video('a', f'revision {i}')])
+    with open(tmp_path / 'items.jsonl') as f:
+        assert len(f.readlines()) < 8
+    second.upsert([video('b', 'another video')])
+    assert len(first) == 2 and first.search('another video', k=1)[0]['key'] == 'video:b'
+
+
+def test_index_written_before_the_item_log_carries_over(tmp_path):
+    backend = HashingEmbedder()
+    old = VectorIndex(str(tmp_path), backend)
+    old.upsert([video('a', 'legacy video')])
+    items = [json.loads(line)['item'] for line in open(tmp_path / 'items.jsonl')]
+    os.remove(tmp_path / 'items.jsonl')
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump({'backend': backend.name, 'dim': backend.dim, 'capacity': 1024, 'items': items}, f)
+
+    index = VectorIndex(str(tmp_path), backend)
+    assert index.search('legacy video', k=1)[0]['key'] == 'video:a'
+    assert 'items' not in json.load(open(tmp_path / 'meta.json'))
+
+
+def test_changing_backend_discards_the_index(tmp_path):
+    VectorIndex(str(tmp_path), HashingEmbedder()).upsert([video('a', 'something')])
+    assert len(VectorIndex(str(tmp_path), HashingEmbedder(dim=64))) == 0
+
+
+def test_concurrent_writers_get_distinct_rows(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    workers = [VectorIndex(str(tmp_path), HashingEmbedder()) for _ in range(2)]
+
+    def write(worker):
+        index = workers[worker]
+        for i in range(40):
+            index.upsert([video(f'{worker}-{i}', f'video {i} from worker {worker}')])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(write, range(2)))
+    reopened = VectorIndex(str(tmp_path), HashingEmbedder())
+    assert len(reopened) == 80
+    rows = [reopened._rows[f'video:{worker}-{i}'] for worker in range(2) for i in range(40)]
+    assert sorted(rows) == list(range(80))
+
+
+def test_a_fresh_index_is_bootstrapped_from_firestore(tmp_path, monkeypatch, db):
+    monkeypatch.setattr(vector_index, '_index', VectorIndex(str(tmp_path), HashingEmbedder()))
+    video_id = db.collection('videos').add({'storagePath': 'videos/u/a.mp4', 'summary': 'Sourdough baking at home',
+                                            'suggestedTitle': 'Bread'})[1].id
+    db.collection('videos').document('pending').set({'storagePath': 'videos/u/b.mp4'})
+    db.collection('videoprocessing').document('a').set({
+        'status': 'completed', 'path': 'videos/u/a.mp4', 'summarySource': 'model',
+        'chapters': [{'start': 0, 'end': 5, 'summary': 'Mixing the dough'},
+                     {'start': 5, 'end': 9, 'summary': 'Shaping the loaf'}]})
+    db.collection('videoprocessing').document('b').set({
+        'status': 'completed', 'path': 'videos/u/b.mp4', 'summarySource': 'trigger',
+        'chapters': [{'start': 0, 'end': 5, 'summary': 'Placeholder'}]})
+
+    assert vector_index.bootstrap_vector_index(db) == 3
+    assert vector_index.get_vector_index().search('shaping loaf', k=1, kind='chapter')[0]['key'] == f'chapter:{video_id}:1'
+    # Everything is held now, so a second run adds nothing
+    assert vector_index.bootstrap_vector_index(db) == 0
@@ -0,0 +1,48 @@
+import io
+from types import SimpleNamespace
+
+from tiptok_core.webvtt import (CAPTION_MAX_CHARS, CACHE_CONTROL, caption_cues, chapter_cues, publish_tracks,
+                                track_prefix, write_track)
+
+
+def test_track_escapes_reserved_text_and_numbers_cues():
+    out = io.StringIO()
+    write_track(out, [(0.0, 61.5, 'a < b & c --> d'), (3661.25, 3662.0, 'line\nbreak')], prefix='chapter-')
+    assert out.getvalue() == ('WEBVTT\n\nchapter-1\n00:00:00.000 --> 00:01:01.500\na &lt; b &amp; c --&gt; d\n'
+                              '\nchapter-2\n01:01:01.250 --> 01:01:02.000\nline break\n')
+
+
+def test_long_sentences_are_split_between_words_in_order():
+    text = ' '.join(f'word{i}' for i in range(60))
+    cues = list(caption_cues([{'text': text, 'start': 10.0, 'end': 30.0}]))
+    assert len(cues) > 1
+    assert ' '.join(cue[2] for cue in cues) == text
+    assert all(len(cue[2]) <= CAPTION_MAX_CHARS * 1.2 for cue in cues)
+    assert cues[0][0] == 10.0 and cues[-1][1] == 30.0
+    assert all(a[1] <= b[0] for a, b in zip(cues, cues[1:]))
+
+
+def test_chapters_are_titled_from_their_summaries():
+    cues = list(chapter_cues([{'start': 0, 'end': 5, 'summary': 'Intro. More detail'},
+                              {'start': 5, 'end': 9, 'summary': ''}]))
+    assert cues == [(0.0, 5.0, 'Intro'), (5.0, 9.0, 'Chapter 2')]
+
+
+def test_publish_uploads_both_tracks_under_the_video_prefix():
+    uploads = {}
+
+    class Blob:
+        def __init__(self, name):
+            self.name = name
+
+        def upload_from_file(self, track, content_type):
+            uploads[self.name] = (track.read().decode(), self.cache_control)
+
+    bucket = SimpleNamespace(name='bucket', blob=Blob)
+    record = publish_tracks(bucket, 'videos/user/clip.mp4', '7', [{'start': 0, 'end': 2, 'summary': 'Hi'}],
+                            [{'text': 'Hello there.', 'start': 0, 'end': 2}])
+    prefix = track_prefix('videos/user/clip.mp4')
+    assert prefix == 'tracks/user/clip/'
+    assert set(uploads) == {prefix + 'chapters.vtt', prefix + 'captions.vtt'}
+    assert all(cache == CACHE_CONTROL for _, cache in uploads.values())
+    assert record['tracksGeneration'] == '7' and record['captionTrackPath'] == prefix + 'captions.vtt'
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from tiptok_core import write_behind
+from tiptok_core.write_behind import WriteBehindWriter
+
+
+class NotFound(Exception):
+    code = 404
+
+
+@pytest.fixture(autouse=True)
+def backoff(monkeypatch):
+    """Attempts passed to the retry backoff, which waits 0.1s"""
+    attempts = []
+    monkeypatch.setattr(write_behind, 'backoff_delay', lambda attempt, error=None: attempts.append(attempt) or 0.1)
+    return attempts
+
+
+@pytest.fixture
+def writer(db):
+    writer = WriteBehindWriter(db, flush_interval=0.05)
+    yield writer
+    writer.close(timeout=5)
+
+
+def doc(db, collection, doc_id):
+    return db.collection(collection).document(doc_id).get().to_dict()
+
+
+def fail_commits(monkeypatch, db, failures, before=None):
+    """Fail the next `failures` commits, calling before() ahead of each"""
+    write = db.write
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if before:
+            before(len(calls))
+        if len(calls) <= failures:
+            raise RuntimeError('unavailable')
+        write()
+    monkeypatch.setattr(db, 'write', flaky)
+    return calls
+
+
+def test_flush_waits_for_queued_writes(db, writer):
+    writer.set('videos', 'a', {'title': 'A'})
+    writer.update('videos', 'a', {'views': 1})
+    assert writer.flush(timeout=5)
+    assert doc(db, 'videos', 'a') == {'title': 'A', 'views': 1}
+
+
+def test_failed_writes_are_retried_until_they_land(monkeypatch, db, writer):
+    fail_commits(monkeypatch, db, failures=3)
+    writer.set('videos', 'a', {'title': 'A'})
+    assert writer.flush(timeout=5)
+    assert doc(db, 'videos', 'a') == {'title': 'A'}
+
+
+def test_retries_back_off(monkeypatch, db, writer, backoff):
+    commits = []
+    fail_commits(monkeypatch, db, failures=2, before=lambda call: commits.append(time.monotonic()))
+    writer.set('videos', 'a', {'title': 'A'})
+    assert writer.flush(timeout=5)
+    # The batch and the write alone fail, then the retry waits out the backoff
+    assert backoff == [1]
+    assert commits[2] - commits[1] >= 0.1
+
+
+def test_a_retried_write_goes_under_newer_writes(monkeypatch, db, writer):
+    def newer(call):
+        if call == 1:
+            writer.update('videos', 'a', {'title': 'new', 'views': 2})
+    writer.set('videos', 'a', {'title': 'old', 'tags': ['x']})
+    fail_commits(monkeypatch, db, failures=2, before=newer)
+    assert writer.flush(timeout=5)
+    assert doc(db, 'videos', 'a') == {'title': 'new', 'tags': ['x'], 'views': 2}
+
+
+def test_dropped_writes_fail_the_flush_once(monkeypatch, db, writer):
+    real_update = type(db.collection('videos').document('a'))._update
+
+    def update(self, data):
+        if self.id == 'missing':
+            raise NotFound('no document')
+        real_update(self, data)
+    monkeypatch.setattr(type(db.collection('videos').document('a')), '_update', update)
+
+    writer.update('videos', 'missing', {'views': 1})
+    writer.set('videos', 'a', {'title': 'A'})
+    assert not writer.flush(timeout=5)
+    assert doc(db, 'videos', 'a') == {'title': 'A'}
+    writer.set('videos', 'b', {'title': 'B'})
+    assert writer.flush(timeout=5)
+
+
+def test_flush_waits_for_older_writes_in_a_later_batch(monkeypatch, db):
+    writer = WriteBehindWriter(db, max_batch=1, flush_interval=0.05)
+    release = threading.Event()
+    fail_commits(monkeypatch, db, failures=0, before=lambda call: call == 2 and release.wait(5))
+    try:
+        writer.set('videos', 'x', {'n': 1})
+        writer.set('videos', 'y', {'n': 2})
+        # Coalesces into the first batch with a seq above y's
+        writer.set('videos', 'x', {'n': 3})
+        assert not writer.flush(timeout=0.3)
+        release.set()
+        assert writer.flush(timeout=5)
+        assert doc(db, 'videos', 'y') == {'n': 2}
+    finally:
+        release.set()
+        writer.close(timeout=5)
@@ -0,0 +1,8 @@
+"""Modules shared by the API and the storage trigger.
+
+The canonical copy lives here, under api/. The functions directory is
+deployed on its own, so firebase.json's predeploy step copies this package
+into it (scripts/vendor_core.py; run it by hand before using the emulator
+or functions/test_local.py). Nothing here imports the API: the API plugs
+its metrics, tracing, deadlines and governors in through hooks.
+"""
@@ -0,0 +1,364 @@
+import hashlib
+import os
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from . import hooks
+
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+# Set to 0 to transcribe every upload without looking for an earlier copy
+AUDIO_DEDUP = os.environ.get('AUDIO_DEDUP', '1') != '0'
+DECODE_TIMEOUT = 300.0
+
+# Audio is fingerprinted as 8 kHz mono; speech and music both keep their
+# strongest peaks below 4 kHz
+SAMPLE_RATE = 8000
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+FRAME_SECONDS = HOP_SIZE / SAMPLE_RATE
+FREQ_BINS = FRAME_SIZE // 2
+# Spectrogram frames processed at once, bounding memory on long videos
+BLOCK_FRAMES = 4096
+
+# A peak is the loudest point in a PEAK_FRAMES x PEAK_BINS neighbourhood
+PEAK_FRAMES = 15
+PEAK_BINS = 15
+PEAKS_PER_SECOND = 12
+# Each peak is paired with the next FAN_OUT peaks at most MAX_PAIR_FRAMES
+# later; a hash packs both frequencies (9 bits each) and the gap (6 bits)
+FAN_OUT = 5
+MAX_PAIR_FRAMES = 63
+# PEAKS_PER_SECOND x FAN_OUT is about 60 hashes a second, so this is about
+# 33 minutes of audio; keeps a video's fingerprint under Firestore's 1 MiB
+# document limit. Longer audio is truncated: only its first 33 minutes are
+# fingerprinted and matched.
+MAX_HASHES = 120_000
+# Hashes this common (silence, hum) say nothing about which video matched
+MAX_POSTINGS = 2000
+
+# A match needs this many hashes agreeing on one time offset, and at
+# least this fraction of the new upload's hashes
+MIN_MATCHES = 25
+MIN_COVERAGE = 0.05
+# Slack, in seconds, for trimmed edges when deciding an upload lies inside
+# an earlier one, and for calling it an exact copy
+EDGE_TOLERANCE = 2.0
+
+# About one hash in ANCHOR_MODULUS is an anchor, chosen by hash value so a
+# clip and the upload it was cut from share anchors. A fingerprint document
+# lists its anchors, and lookups query those lists for the upload's anchors
+# instead of loading every fingerprint. MAX_ANCHORS covers the anchors of
+# MAX_HASHES hashes, well under Firestore's 40,000 index entries a document.
+ANCHOR_MODULUS = 16
+MAX_ANCHORS = 8000
+# Firestore allows 30 values in an array-contains-any filter
+ANCHORS_PER_QUERY = 30
+MAX_ANCHOR_QUERIES = 10
+# Fingerprints sharing fewer anchors are not fetched, nor more than
+# MAX_CANDIDATES of them
+MIN_ANCHOR_HITS = 1
+MAX_CANDIDATES = 10
+
+FINGERPRINT_COLLECTION = 'audiofingerprints'
+LOOKUPS_METRIC = 'tiptok_fingerprint_lookups_total'
+
+WINDOW = np.hanning(FRAME_SIZE).astype(np.float32)
+
+
+@dataclass
+class FingerprintMatch:
+    """An earlier upload whose audio contains this one.
+
+    The new upload's time t is the earlier upload's time t + offset.
+    """
+    video_path: str
+    generation: str
+    offset: float
+    duration: float
+    source_duration: float
+    matches: int
+    coverage: float
+
+    @property
+    def exact(self) -> bool:
+        """The same recording end to end, not a trimmed part of it"""
+        return abs(self.offset) <= EDGE_TOLERANCE and self.source_duration - self.duration <= 2 * EDGE_TOLERANCE
+
+
+def decode_audio(source: str) -> np.ndarray:
+    """16-bit mono samples of a media URL or file at SAMPLE_RATE, decoded by ffmpeg"""
+    command = [FFMPEG, '-nostdin', '-v', 'error', '-i', source, '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE),
+               '-f', 's16le', '-']
+    result = subprocess.run(command, capture_output=True, timeout=hooks.call_timeout(DECODE_TIMEOUT))
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', errors='replace').strip()[-300:]
+        raise RuntimeError(f"ffmpeg could not decode {source[:100]}: {message}")
+    return np.frombuffer(result.stdout, dtype='<i2')
+
+
+def _frame_count(samples: np.ndarray) -> int:
+    return 0 if len(samples) < FRAME_SIZE else 1 + (len(samples) - FRAME_SIZE) // HOP_SIZE
+
+
+def _spectrogram(samples: np.ndarray, first: int, count: int) -> np.ndarray:
+    """Log magnitudes of `count` frames starting at frame `first`"""
+    chunk = samples[first * HOP_SIZE:(first + count - 1) * HOP_SIZE + FRAME_SIZE].astype(np.float32)
+    frames = sliding_window_view(chunk, FRAME_SIZE)[::HOP_SIZE]
+    return np.log1p(np.abs(np.fft.rfft(frames * WINDOW, axis=1))[:, :FREQ_BINS]).astype(np.float32)
+
+
+def _sliding_max(values: np.ndarray, size: int, axis: int) -> np.ndarray:
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (size // 2, size // 2)
+    padded = np.pad(values, pad, constant_values=-np.inf)
+    return sliding_window_view(padded, size, axis=axis).max(axis=-1)
+
+
+def find_peaks(samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Frames and frequency bins of the spectrogram's local maxima, keeping
+    the strongest PEAKS_PER_SECOND in each second"""
+    frames = _frame_count(samples)
+    margin = PEAK_FRAMES // 2
+    times, bins, strengths = [], [], []
+    for first in range(0, frames, BLOCK_FRAMES):
+        # Overlap neighbouring blocks so peaks near a block edge see their whole neighbourhood
+        lo, hi = max(0, first - margin), min(frames, first + BLOCK_FRAMES + margin)
+        spectrum = _spectrogram(samples, lo, hi - lo)
+        local_max = _sliding_max(_sliding_max(spectrum, PEAK_FRAMES, 0), PEAK_BINS, 1)
+        t, f = np.nonzero((spectrum == local_max) & (spectrum > spectrum.mean()))
+        inner = (t + lo >= first) & (t + lo < first + BLOCK_FRAMES)
+        t, f = t[inner], f[inner]
+        times.append(t + lo)
+        bins.append(f)
+        strengths.append(spectrum[t, f])
+    if not times:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    times, bins, strengths = np.concatenate(times), np.concatenate(bins), np.concatenate(strengths)
+
+    second = times // int(round(1 / FRAME_SECONDS))
+    order = np.lexsort((-strengths, second))
+    rank = np.arange(len(order)) - np.searchsorted(second[order], second[order], side='left')
+    keep = order[rank < PEAKS_PER_SECOND]
+    keep = keep[np.lexsort((bins[keep], times[keep]))]
+    return times[keep].astype(np.int64), bins[keep].astype(np.int64)
+
+
+@hooks.timed('fingerprint_audio')
+def fingerprint(samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Landmark hashes of audio and the frame each one starts at.
+
+    Each hash pairs a spectrogram peak with one of the peaks just after it,
+    so it survives re-encoding, volume changes and trimming, and matching
+    hashes between two files line up at the offset between them.
+    """
+    times, bins = find_peaks(samples)
+    hashes, starts = [], []
+    for k in range(1, FAN_OUT + 1):
+        gap = times[k:] - times[:-k]
+        paired = (gap > 0) & (gap <= MAX_PAIR_FRAMES)
+        hashes.append((bins[:-k][paired] << 15) | (bins[k:][paired] << 6) | gap[paired])
+        starts.append(times[:-k][paired])
+    hashes = np.concatenate(hashes).astype(np.uint32) if hashes else np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate(starts).astype(np.uint32) if starts else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(starts, kind='stable')[:MAX_HASHES]
+    return hashes[order], starts[order]
+
+
+def anchors(hashes: np.ndarray, limit: int) -> List[int]:
+    """Up to `limit` distinct anchor hashes, spread evenly over the audio"""
+    # Multiplicative hashing, so anchors do not all share the same gap bits
+    mixed = (hashes.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+    chosen = hashes[mixed % np.uint64(ANCHOR_MODULUS) == 0]
+    _, first = np.unique(chosen, return_index=True)
+    chosen = chosen[np.sort(first)]
+    if len(chosen) > limit:
+        chosen = chosen[np.linspace(0, len(chosen) - 1, limit).astype(np.int64)]
+    return [int(value) for value in chosen]
+
+
+class FingerprintIndex:
+    """Landmark hashes of fingerprinted uploads, looked up by hash.
+
+    Uploads are kept as separate arrays and merged into one table sorted by
+    hash the first time a lookup follows a change, so a lookup is a binary
+    search per hash rather than a pass over every video.
+    """
+
+    def __init__(self):
+        self._videos: Dict[str, Dict[str, Any]] = {}
+        self._table: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._videos)
+
+    def get(self, video_path: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._videos.get(video_path)
+
+    def upsert(self, video_path: str, generation: str, duration: float, hashes: np.ndarray, times: np.ndarray):
+        with self._lock:
+            self._videos[video_path] = {
+                'generation': generation,
+                'duration': duration,
+                'hashes': hashes,
+                'times': times,
+            }
+            self._table = None
+
+    def remove(self, video_path: str):
+        with self._lock:
+            if self._videos.pop(video_path, None) is not None:
+                self._table = None
+
+    def _build_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+        paths = list(self._videos)
+        if not paths:
+            empty = np.zeros(0, dtype=np.uint32)
+            return empty, empty, np.zeros(0, dtype=np.int32), paths
+        hashes = np.concatenate([self._videos[path]['hashes'] for path in paths])
+        times = np.concatenate([self._videos[path]['times'] for path in paths])
+        rows = np.repeat(np.arange(len(paths), dtype=np.int32),
+                         [len(self._videos[path]['hashes']) for path in paths])
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order], times[order], rows[order], paths
+
+    def match(self, hashes: np.ndarray, times: np.ndarray, duration: float,
+              exclude: Optional[str] = None) -> Optional[FingerprintMatch]:
+        """The earlier upload containing this audio, if any: the one with the
+        most hashes agreeing on a single time offset"""
+        with self._lock:
+            if self._table is None:
+                self._table = self._build_table()
+            table_hashes, table_times, table_rows, paths = self._table
+            videos = dict(self._videos)
+        if not len(hashes) or not len(table_hashes):
+            return None
+
+        lo = np.searchsorted(table_hashes, hashes, side='left')
+        hi = np.searchsorted(table_hashes, hashes, side='right')
+        counts = np.where(hi - lo > MAX_POSTINGS, 0, hi - lo)
+        total = int(counts.sum())
+        if not total:
+            return None
+        query = np.repeat(np.arange(len(hashes)), counts)
+        entries = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        rows = table_rows[entries].astype(np.int64)
+        offsets = table_times[entries].astype(np.int64) - times[query].astype(np.int64)
+        if exclude is not None and exclude in paths:
+            keep = rows != paths.index(exclude)
+            rows, offsets = rows[keep], offsets[keep]
+        if not len(rows):
+            return None
+
+        # Count hashes per (video, offset); frames can shift by one between
+        # encodings, so neighbouring offsets count towards each other
+        keys = (rows << 32) | (offsets + (1 << 31))
+        unique, tally = np.unique(keys, return_counts=True)
+        smoothed = tally.copy()
+        for step in (-1, 1):
+            neighbour = np.searchsorted(unique, unique + step)
+            found = neighbour < len(unique)
+            found[found] = unique[neighbour[found]] == unique[found] + step
+            smoothed[found] += tally[neighbour[found]]
+        best = int(np.argmax(smoothed))
+        matches = int(smoothed[best])
+        coverage = matches / len(hashes)
+        if matches < MIN_MATCHES or coverage < MIN_COVERAGE:
+            return None
+
+        row = int(unique[best] >> 32)
+        offset = float(int(unique[best] & 0xFFFFFFFF) - (1 << 31)) * FRAME_SECONDS
+        source = videos[paths[row]]
+        if offset < -EDGE_TOLERANCE or offset + duration > source['duration'] + EDGE_TOLERANCE:
+            # Overlaps the earlier upload but has audio it does not
+            return None
+        return FingerprintMatch(paths[row], source['generation'], max(0.0, offset), duration,
+                                source['duration'], matches, coverage)
+
+
+def _document_id(video_path: str) -> str:
+    # Video paths contain slashes, which document ids cannot
+    return hashlib.sha1(video_path.encode('utf-8')).hexdigest()
+
+
+def _decode(data: Dict[str, Any]) -> Tuple[str, float, np.ndarray, np.ndarray]:
+    return (str(data.get('generation', '')), float(data.get('duration', 0.0)),
+            np.frombuffer(data.get('hashes', b''), dtype='<u4'), np.frombuffer(data.get('times', b''), dtype='<u4'))
+
+
+def load_fingerprint(db, video_path: str) -> Optional[Tuple[str, float, np.ndarray, np.ndarray]]:
+    """The persisted generation, duration, hashes and times of a video's fingerprint"""
+    doc = db.collection(FINGERPRINT_COLLECTION).document(_document_id(video_path)).get()
+    data = doc.to_dict() if doc.exists else None
+    return _decode(data) if data else None
+
+
+def load_candidates(db, hashes: np.ndarray, exclude: Optional[str] = None) -> FingerprintIndex:
+    """An index of the fingerprints sharing the most anchors with these hashes.
+
+    Queries the fingerprints' anchor lists, reading only the lists, and
+    fetches the whole fingerprint of at most MAX_CANDIDATES of them.
+    """
+    query = anchors(hashes, ANCHORS_PER_QUERY * MAX_ANCHOR_QUERIES)
+    wanted = set(query)
+    hits: Dict[str, int] = {}
+    collection = db.collection(FINGERPRINT_COLLECTION)
+    for first in range(0, len(query), ANCHORS_PER_QUERY):
+        chunk = query[first:first + ANCHORS_PER_QUERY]
+        for doc in collection.where('anchors', 'array_contains_any', chunk).select(['videoPath', 'anchors']).stream():
+            data = doc.to_dict() or {}
+            if data.get('videoPath') and data['videoPath'] != exclude:
+                hits[doc.id] = len(wanted.intersection(data.get('anchors', [])))
+
+    index = FingerprintIndex()
+    ranked = sorted((doc_id for doc_id in hits if hits[doc_id] >= MIN_ANCHOR_HITS), key=hits.get, reverse=True)
+    for doc_id in ranked[:MAX_CANDIDATES]:
+        doc = collection.document(doc_id).get()
+        data = doc.to_dict() if doc.exists else None
+        if data and data.get('videoPath'):
+            index.upsert(data['videoPath'], *_decode(data))
+    return index
+
+
+def save_fingerprint(db, writer, video_path: str, generation: str, duration: float,
+                     hashes: np.ndarray, times: np.ndarray):
+    """Queue a video's fingerprint, and the anchors it is found by, on the writer"""
+    writer.set(FINGERPRINT_COLLECTION, _document_id(video_path), {
+        'videoPath': video_path,
+        'generation': generation,
+        'duration': duration,
+        'hashes': hashes.astype('<u4').tobytes(),
+        'times': times.astype('<u4').tobytes(),
+        'anchors': anchors(hashes, MAX_ANCHORS),
+    })
+
+
+def find_duplicate(db, writer, source: str, video_path: str, generation: str) -> Optional[FingerprintMatch]:
+    """The earlier upload this upload's audio was cut from, if any.
+
+    The upload is fingerprinted (once per generation) and saved so later
+    re-uploads of it are found too.
+    """
+    known = load_fingerprint(db, video_path)
+    if known is not None and known[0] == generation:
+        _, duration, hashes, times = known
+    else:
+        samples = decode_audio(source)
+        duration = len(samples) / SAMPLE_RATE
+        hashes, times = fingerprint(samples)
+        save_fingerprint(db, writer, video_path, generation, duration, hashes, times)
+
+    match = load_candidates(db, hashes, exclude=video_path).match(hashes, times, duration)
+    if match is None:
+        hooks.count(LOOKUPS_METRIC, outcome='miss')
+    else:
+        hooks.count(LOOKUPS_METRIC, outcome='exact' if match.exact else 'clip')
+        print(f"{video_path} matches {match.video_path} from {match.offset:.1f}s "
+              f"({match.matches} hashes, {match.coverage:.0%} coverage)")
+    return match
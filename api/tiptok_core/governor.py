@@ -0,0 +1,477 @@
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Any, Callable, Optional, Tuple
+
+from . import hooks
+
+# Defaults per provider. rate/burst feed the token bucket, the concurrency
+# bounds and latency target drive the AIMD controller.
+PROVIDER_LIMITS: Dict[str, Dict[str, float]] = {
+    'deepgram': {
+        'rate': 5.0,
+        'burst': 10.0,
+        'min_concurrency': 1,
+        'initial_concurrency': 8,
+        'max_concurrency': 50,
+        'latency_target': 120.0,
+    },
+    'openai': {
+        'rate': 20.0,
+        'burst': 40.0,
+        'min_concurrency': 1,
+        'initial_concurrency': 8,
+        'max_concurrency': 64,
+        'latency_target': 30.0,
+    },
+}
+
+GOVERNOR_BACKEND = os.environ.get('GOVERNOR_BACKEND', 'sqlite')
+GOVERNOR_DB = os.environ.get('GOVERNOR_DB', os.path.join(os.environ.get('INDEX_DIR', 'index_data'), 'governor.db'))
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Only halve the limit once per window, so a burst of 429s from calls that
+# were already in flight counts as one congestion signal.
+DECREASE_COOLDOWN = 5.0
+# A slot whose holder died without releasing it is reclaimed after this long
+LEASE_SECONDS = 600.0
+POLL_INTERVAL = 0.05
+# Waits between polls of a remote backend grow like retry backoff up to this
+REMOTE_POLL_CAP = 5.0
+# The Deepgram SDK raises plain exceptions with the status in the message,
+# after 'status' or 'HTTP', or after Deepgram's err_code
+STATUS_IN_MESSAGE = re.compile(r'(?:\bstatus(?:[ _]code)?|\bHTTP|"err_code"\s*:\s*"[A-Z_]+"\W?)\W{0,3}([45]\d\d)\b',
+                               re.IGNORECASE)
+
+
+class RateLimitBackend:
+    """Shared limiter state: token buckets, in-flight leases and AIMD limits.
+
+    Implementations must make try_acquire and release atomic across every
+    process that shares the backend.
+    """
+
+    def try_acquire(self, provider: str, config: Dict[str, float]) -> Tuple[Optional[str], float]:
+        """Take a token and a concurrency slot.
+
+        Returns:
+            (lease_id, 0) on success, or (None, seconds to wait) otherwise
+        """
+        raise NotImplementedError
+
+    def release(self, lease_id: str, provider: str, config: Dict[str, float], outcome: str):
+        """Return a slot and feed the call's outcome ('ok', 'slow', 'throttled'
+        or 'error') to the concurrency controller"""
+        raise NotImplementedError
+
+    def snapshot(self, provider: str) -> Dict[str, float]:
+        """Current limit, in-flight count and tokens for a provider"""
+        raise NotImplementedError
+
+    def poll_delay(self, polls: int) -> float:
+        """Least wait before polling again after `polls` failed acquires"""
+        return POLL_INTERVAL
+
+
+def next_limit(limit: float, outcome: str, config: Dict[str, float], last_decrease: float,
+               now: float) -> Tuple[float, float]:
+    """AIMD step: grow by 1/limit per success, halve on congestion"""
+    if outcome in ('throttled', 'slow'):
+        if now - last_decrease < DECREASE_COOLDOWN:
+            return limit, last_decrease
+        return max(config['min_concurrency'], limit / 2), now
+    if outcome == 'ok':
+        return min(config['max_concurrency'], limit + 1.0 / max(limit, 1.0)), last_decrease
+    return limit, last_decrease
+
+
+def refill(tokens: float, updated: float, config: Dict[str, float], now: float) -> float:
+    return min(config['burst'], tokens + (now - updated) * config['rate'])
+
+
+class MemoryBackend(RateLimitBackend):
+    """Single-process backend"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict[str, Any]] = {}
+
+    def _get(self, provider: str, config: Dict[str, float], now: float) -> Dict[str, Any]:
+        if provider not in self._state:
+            self._state[provider] = {
+                'tokens': config['burst'],
+                'updated': now,
+                'limit': float(config['initial_concurrency']),
+                'last_decrease': 0.0,
+                'leases': {},
+            }
+        return self._state[provider]
+
+    def try_acquire(self, provider: str, config: Dict[str, float]) -> Tuple[Optional[str], float]:
+        now = time.time()
+        with self._lock:
+            state = self._get(provider, config, now)
+            state['leases'] = {lease: expiry for lease, expiry in state['leases'].items() if expiry > now}
+            state['tokens'] = refill(state['tokens'], state['updated'], config, now)
+            state['updated'] = now
+            if len(state['leases']) >= int(state['limit']):
+                return None, POLL_INTERVAL
+            if state['tokens'] < 1:
+                return None, (1 - state['tokens']) / config['rate']
+            state['tokens'] -= 1
+            lease_id = uuid.uuid4().hex
+            state['leases'][lease_id] = now + LEASE_SECONDS
+            return lease_id, 0.0
+
+    def release(self, lease_id: str, provider: str, config: Dict[str, float], outcome: str):
+        now = time.time()
+        with self._lock:
+            state = self._get(provider, config, now)
+            state['leases'].pop(lease_id, None)
+            state['limit'], state['last_decrease'] = next_limit(
+                state['limit'], outcome, config, state['last_decrease'], now)
+
+    def snapshot(self, provider: str) -> Dict[str, float]:
+        with self._lock:
+            state = self._state.get(provider)
+            if state is None:
+                return {}
+            return {'limit': state['limit'], 'inflight': len(state['leases']), 'tokens': state['tokens']}
+
+
+class SQLiteBackend(RateLimitBackend):
+    """Backend shared by every process on the host through one SQLite file.
+
+    Gunicorn workers, the dev server and backfill scripts pointing at the
+    same GOVERNOR_DB see one set of buckets and limits.
+    """
+
+    def __init__(self, path: str = GOVERNOR_DB):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    provider TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    concurrency_limit REAL NOT NULL,
+                    last_decrease REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS leases (
+                    id TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS leases_provider ON leases (provider, expires);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _bucket(self, conn: sqlite3.Connection, provider: str, config: Dict[str, float],
+                now: float) -> Tuple[float, float, float, float]:
+        row = conn.execute(
+            'SELECT tokens, updated, concurrency_limit, last_decrease FROM buckets WHERE provider = ?',
+            (provider,)).fetchone()
+        if row is None:
+            row = (config['burst'], now, float(config['initial_concurrency']), 0.0)
+            conn.execute('INSERT INTO buckets VALUES (?, ?, ?, ?, ?)', (provider, *row))
+        return row
+
+    def try_acquire(self, provider: str, config: Dict[str, float]) -> Tuple[Optional[str], float]:
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            tokens, updated, limit, _ = self._bucket(conn, provider, config, now)
+            conn.execute('DELETE FROM leases WHERE provider = ? AND expires <= ?', (provider, now))
+            inflight = conn.execute('SELECT COUNT(*) FROM leases WHERE provider = ?', (provider,)).fetchone()[0]
+            tokens = refill(tokens, updated, config, now)
+
+            lease_id, wait = None, POLL_INTERVAL
+            if inflight < int(limit):
+                if tokens >= 1:
+                    tokens -= 1
+                    lease_id, wait = uuid.uuid4().hex, 0.0
+                    conn.execute('INSERT INTO leases VALUES (?, ?, ?)', (lease_id, provider, now + LEASE_SECONDS))
+                else:
+                    wait = (1 - tokens) / config['rate']
+            conn.execute('UPDATE buckets SET tokens = ?, updated = ? WHERE provider = ?', (tokens, now, provider))
+            conn.execute('COMMIT')
+            return lease_id, wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release(self, lease_id: str, provider: str, config: Dict[str, float], outcome: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            _, _, limit, last_decrease = self._bucket(conn, provider, config, now)
+            limit, last_decrease = next_limit(limit, outcome, config, last_decrease, now)
+            conn.execute('DELETE FROM leases WHERE id = ?', (lease_id,))
+            conn.execute('UPDATE buckets SET concurrency_limit = ?, last_decrease = ? WHERE provider = ?',
+                         (limit, last_decrease, provider))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def snapshot(self, provider: str) -> Dict[str, float]:
+        conn = self._connect()
+        row = conn.execute('SELECT tokens, concurrency_limit FROM buckets WHERE provider = ?',
+                           (provider,)).fetchone()
+        if row is None:
+            return {}
+        inflight = conn.execute('SELECT COUNT(*) FROM leases WHERE provider = ? AND expires > ?',
+                                (provider, time.time())).fetchone()[0]
+        return {'limit': row[1], 'inflight': inflight, 'tokens': row[0]}
+
+
+class FirestoreBackend(RateLimitBackend):
+    """Backend shared across hosts through a Firestore document per provider.
+
+    Each acquire and release is a transaction, which adds a Firestore round
+    trip per call, and every caller contends on the one document, so this is
+    only for callers that must share a budget across instances. An acquire
+    that fails writes nothing, and waiting callers poll with backoff rather
+    than every POLL_INTERVAL.
+    """
+
+    def __init__(self, db=None, collection: str = 'ratelimits'):
+        if db is None:
+            from firebase_admin import firestore
+            db = firestore.client()
+        self.db = db
+        self.collection = collection
+
+    def _ref(self, provider: str):
+        return self.db.collection(self.collection).document(provider)
+
+    def _state(self, snapshot, config: Dict[str, float], now: float) -> Dict[str, Any]:
+        state = snapshot.to_dict() if snapshot.exists else None
+        if state is None:
+            state = {
+                'tokens': config['burst'],
+                'updated': now,
+                'limit': float(config['initial_concurrency']),
+                'last_decrease': 0.0,
+                'leases': {},
+            }
+        state['leases'] = {lease: expiry for lease, expiry in state.get('leases', {}).items() if expiry > now}
+        return state
+
+    def try_acquire(self, provider: str, config: Dict[str, float]) -> Tuple[Optional[str], float]:
+        from google.cloud import firestore as gcf
+
+        @gcf.transactional
+        def acquire(transaction):
+            now = time.time()
+            ref = self._ref(provider)
+            state = self._state(ref.get(transaction=transaction), config, now)
+            tokens = refill(state['tokens'], state['updated'], config, now)
+            if len(state['leases']) >= int(state['limit']):
+                return None, POLL_INTERVAL
+            if tokens < 1:
+                return None, (1 - tokens) / config['rate']
+            # Only a successful acquire writes; refills are worked out from 'updated'
+            lease_id = uuid.uuid4().hex
+            state['leases'][lease_id] = now + LEASE_SECONDS
+            state['tokens'], state['updated'] = tokens - 1, now
+            transaction.set(ref, state)
+            return lease_id, 0.0
+
+        return acquire(self.db.transaction())
+
+    def release(self, lease_id: str, provider: str, config: Dict[str, float], outcome: str):
+        from google.cloud import firestore as gcf
+
+        @gcf.transactional
+        def release(transaction):
+            now = time.time()
+            ref = self._ref(provider)
+            state = self._state(ref.get(transaction=transaction), config, now)
+            state['leases'].pop(lease_id, None)
+            state['limit'], state['last_decrease'] = next_limit(
+                state['limit'], outcome, config, state['last_decrease'], now)
+            transaction.set(ref, state)
+
+        release(self.db.transaction())
+
+    def snapshot(self, provider: str) -> Dict[str, float]:
+        snapshot = self._ref(provider).get()
+        if not snapshot.exists:
+            return {}
+        state = self._state(snapshot, PROVIDER_LIMITS.get(provider, {}), time.time())
+        return {'limit': state['limit'], 'inflight': len(state['leases']), 'tokens': state['tokens']}
+
+    def poll_delay(self, polls: int) -> float:
+        return max(POLL_INTERVAL, min(REMOTE_POLL_CAP, backoff_delay(polls)))
+
+
+BACKENDS: Dict[str, Callable[[], RateLimitBackend]] = {
+    'memory': MemoryBackend,
+    'sqlite': SQLiteBackend,
+    'firestore': FirestoreBackend,
+}
+
+
+def status_of(error: Exception) -> Optional[int]:
+    """Best-effort HTTP status of a provider error"""
+    for attr in ('status_code', 'status', 'http_status', 'http_error_status'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(error, 'response', None)
+    for attr in ('status_code', 'status'):
+        status = getattr(response, attr, None)
+        if isinstance(status, int):
+            return status
+    match = STATUS_IN_MESSAGE.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return status_of(error) in RETRYABLE_STATUSES
+
+
+def backoff_delay(attempt: int, error: Optional[Exception] = None) -> float:
+    """Full-jitter exponential backoff, honouring Retry-After when present"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(BACKOFF_CAP, float(retry_after)) + random.uniform(0, BACKOFF_BASE)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class Governor:
+    """Outbound-call governor for one provider.
+
+    Every call takes a token from the provider's bucket and a slot under its
+    adaptive concurrency limit, is timed, and is retried with jittered
+    backoff on throttling and transient errors. 429s and calls slower than
+    the latency target halve the limit; successes grow it again.
+    """
+
+    def __init__(self, provider: str, backend: RateLimitBackend, config: Optional[Dict[str, float]] = None):
+        self.provider = provider
+        self.backend = backend
+        self.config = config or PROVIDER_LIMITS[provider]
+
+    def _outcome(self, elapsed: float, error: Optional[Exception]) -> str:
+        if error is not None:
+            return 'throttled' if status_of(error) == 429 else 'error'
+        return 'slow' if elapsed > self.config['latency_target'] else 'ok'
+
+    def acquire(self) -> str:
+        polls = 0
+        while True:
+            hooks.check_deadline(self.provider)
+            lease_id, wait = self.backend.try_acquire(self.provider, self.config)
+            if lease_id is not None:
+                return lease_id
+            time.sleep(max(wait, self.backend.poll_delay(polls)))
+            polls += 1
+
+    async def acquire_async(self) -> str:
+        polls = 0
+        while True:
+            lease_id, wait = self.backend.try_acquire(self.provider, self.config)
+            if lease_id is not None:
+                return lease_id
+            await asyncio.sleep(max(wait, self.backend.poll_delay(polls)))
+            polls += 1
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn under the governor, retrying retryable failures while the
+        request's deadline leaves time for it"""
+        for attempt in range(MAX_ATTEMPTS):
+            lease_id = self.acquire()
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.backend.release(lease_id, self.provider, self.config,
+                                     self._outcome(time.monotonic() - started, e))
+                delay = backoff_delay(attempt, e)
+                left = hooks.remaining()
+                # No retry that could not finish before the request's deadline
+                if attempt == MAX_ATTEMPTS - 1 or not is_retryable(e) or (left is not None and delay >= left):
+                    raise
+                print(f"{self.provider} call failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.backend.release(lease_id, self.provider, self.config,
+                                 self._outcome(time.monotonic() - started, None))
+            return result
+
+    async def acall(self, fn: Callable, *args, **kwargs) -> Any:
+        """Await fn(*args, **kwargs) under the governor, retrying retryable failures"""
+        for attempt in range(MAX_ATTEMPTS):
+            lease_id = await self.acquire_async()
+            started = time.monotonic()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                self.backend.release(lease_id, self.provider, self.config,
+                                     self._outcome(time.monotonic() - started, e))
+                if attempt == MAX_ATTEMPTS - 1 or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt, e)
+                print(f"{self.provider} call failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            self.backend.release(lease_id, self.provider, self.config,
+                                 self._outcome(time.monotonic() - started, None))
+            return result
+
+
+_backend: Optional[RateLimitBackend] = None
+_governors: Dict[str, Governor] = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(provider: str) -> Governor:
+    """Return the governor for a provider, backed by GOVERNOR_BACKEND"""
+    global _backend
+    if provider not in _governors:
+        with _governors_lock:
+            if _backend is None:
+                if GOVERNOR_BACKEND not in BACKENDS:
+                    raise ValueError(f"Unknown governor backend: {GOVERNOR_BACKEND}")
+                _backend = BACKENDS[GOVERNOR_BACKEND]()
+            if provider not in _governors:
+                _governors[provider] = Governor(provider, _backend)
+    return _governors[provider]
+
+
+def use_backend(backend: RateLimitBackend):
+    """Back every governor of this process with backend from now on"""
+    global _backend
+    with _governors_lock:
+        _backend = backend
+        _governors.clear()
@@ -0,0 +1,65 @@
+"""Instrumentation points of the shared modules.
+
+Every hook does nothing by default, which is how the storage trigger runs
+them. The API replaces them with its metrics, tracing and request
+deadlines through install() when the app package is imported. Hooks are
+looked up when they are called, so installing them after a shared module
+was imported still takes effect.
+"""
+import functools
+from contextlib import nullcontext
+from typing import Optional
+
+
+def stage(name: str):
+    """Time a block of work as a named stage"""
+    return nullcontext()
+
+
+def span(name: str, **args):
+    """Trace a block of work as a span of the current request"""
+    return nullcontext()
+
+
+def count(metric: str, amount: float = 1, **labels):
+    """Add to the counter registered under the metric's name"""
+
+
+def call_timeout(default: float) -> float:
+    """Timeout for one provider call: default, or less if the request's deadline is closer"""
+    return default
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the request's deadline, or None without one"""
+    return None
+
+
+def check_deadline(stage: str):
+    """Raise if the request's deadline has passed"""
+
+
+def record_transcription(provider: str, duration: float):
+    """Count audio seconds and cost of a transcription"""
+
+
+HOOKS = ('stage', 'span', 'count', 'call_timeout', 'remaining', 'check_deadline', 'record_transcription')
+
+
+def install(**hooks):
+    """Replace hooks by name"""
+    for name, hook in hooks.items():
+        if name not in HOOKS:
+            raise ValueError(f"Unknown hook: {name}")
+        globals()[name] = hook
+
+
+def timed(name: str):
+    """Decorator form of stage()"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,194 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Any, Iterator, List, Optional
+
+import numpy as np
+
+from .transcription_backends import Transcript, deepgram_transcript
+
+# Layout, little-endian, every section 8-byte aligned:
+#   header      MAGIC, version u16, reserved u16, sentences u32, paragraphs u32,
+#               text bytes u64, duration f64
+#   starts      f32[sentences]
+#   ends        f32[sentences]
+#   offsets     u32[sentences + 1]  byte offsets of each sentence in the text
+#   paragraphs  u32[paragraphs + 1] index of each paragraph's first sentence
+#   text        UTF-8 sentence texts, back to back
+MAGIC = b'TTRX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQd')
+SUFFIX = '.ttrx'
+
+ARCHIVE_PREFIX = 'transcripts/'
+CONTENT_TYPE = 'application/octet-stream'
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class TranscriptArchive:
+    """A transcript as columnar sentence arrays over one buffer.
+
+    Opening an archive only maps the file and slices views out of it, so a
+    multi-hour transcript loads in microseconds and sentences are decoded
+    from the text blob only when asked for.
+    """
+
+    def __init__(self, buffer, duration: float, starts: np.ndarray, ends: np.ndarray,
+                 offsets: np.ndarray, paragraph_index: np.ndarray, text: memoryview):
+        self._buffer = buffer
+        self.duration = duration
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.paragraph_index = paragraph_index
+        self._text = text
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def from_buffer(cls, buffer) -> 'TranscriptArchive':
+        view = memoryview(buffer)
+        magic, version, _, sentences, paragraphs, text_bytes, duration = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a transcript archive")
+        if version != VERSION:
+            raise ValueError(f"Unsupported transcript archive version {version}")
+
+        position = _aligned(HEADER.size)
+
+        def take(dtype, count):
+            nonlocal position
+            array = np.frombuffer(view, dtype=dtype, count=count, offset=position)
+            position = _aligned(position + array.nbytes)
+            return array
+
+        starts = take('<f4', sentences)
+        ends = take('<f4', sentences)
+        offsets = take('<u4', sentences + 1)
+        paragraph_index = take('<u4', paragraphs + 1)
+        text = view[position:position + text_bytes]
+        return cls(buffer, duration, starts, ends, offsets, paragraph_index, text)
+
+    @classmethod
+    def open(cls, path: str) -> 'TranscriptArchive':
+        """Memory-map an archive file"""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(mapped)
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs: List[List[Dict[str, Any]]], duration: float = 0.0) -> 'TranscriptArchive':
+        """Build an archive from lists of {'text', 'start', 'end'} sentences per paragraph"""
+        texts = [sentence.get('text', '').encode('utf-8') for para in paragraphs for sentence in para]
+        count = len(texts)
+        offsets = np.zeros(count + 1, dtype='<u4')
+        np.cumsum([len(text) for text in texts], out=offsets[1:])
+        paragraph_index = np.zeros(len(paragraphs) + 1, dtype='<u4')
+        np.cumsum([len(para) for para in paragraphs], out=paragraph_index[1:])
+        sentences = [sentence for para in paragraphs for sentence in para]
+        starts = np.array([sentence.get('start', 0) for sentence in sentences], dtype='<f4')
+        ends = np.array([sentence.get('end', 0) for sentence in sentences], dtype='<f4')
+        if not duration and count:
+            duration = float(ends.max())
+
+        buffer = bytearray(HEADER.pack(MAGIC, VERSION, 0, count, len(paragraphs), int(offsets[-1]), duration))
+        for array in (starts, ends, offsets, paragraph_index):
+            buffer.extend(bytes(_aligned(len(buffer)) - len(buffer)))
+            buffer.extend(array.tobytes())
+        buffer.extend(bytes(_aligned(len(buffer)) - len(buffer)))
+        for text in texts:
+            buffer.extend(text)
+        return cls.from_buffer(bytes(buffer))
+
+    @classmethod
+    def from_transcript(cls, transcript: Transcript) -> 'TranscriptArchive':
+        return cls.from_paragraphs(transcript.paragraphs, transcript.duration)
+
+    @classmethod
+    def from_deepgram(cls, alternative: Dict[str, Any], duration: float = 0.0) -> 'TranscriptArchive':
+        """Build an archive from the first alternative of a Deepgram response"""
+        return cls.from_transcript(deepgram_transcript(alternative, duration))
+
+    def __reduce__(self):
+        # Pickled as its bytes, e.g. when the live host returns one to a worker
+        return TranscriptArchive.from_buffer, (self.to_bytes(),)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._buffer)
+
+    def write(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        partial = f"{path}.{threading.get_ident()}.partial"
+        with open(partial, 'wb') as f:
+            f.write(self._buffer)
+        os.replace(partial, path)
+
+    def text(self, i: int) -> str:
+        return bytes(self._text[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def sentence(self, i: int) -> Dict[str, Any]:
+        return {'text': self.text(i), 'start': float(self.starts[i]), 'end': float(self.ends[i])}
+
+    def sentences(self, start: int = 0, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        end = len(self) if end is None else end
+        if end <= start:
+            return []
+        starts = self.starts[start:end].tolist()
+        ends = self.ends[start:end].tolist()
+        offsets = self.offsets[start:end + 1].tolist()
+        base = offsets[0]
+        text = bytes(self._text[base:offsets[-1]])
+        return [
+            {'text': text[offsets[i] - base:offsets[i + 1] - base].decode('utf-8'), 'start': starts[i], 'end': ends[i]}
+            for i in range(end - start)
+        ]
+
+    def paragraphs(self) -> Iterator[List[Dict[str, Any]]]:
+        for p in range(len(self.paragraph_index) - 1):
+            yield self.sentences(int(self.paragraph_index[p]), int(self.paragraph_index[p + 1]))
+
+    def between(self, start: float, end: float) -> List[Dict[str, Any]]:
+        """Sentences that start inside [start, end)"""
+        first = int(np.searchsorted(self.starts, start, side='left'))
+        last = int(np.searchsorted(self.starts, end, side='left'))
+        return self.sentences(first, last)
+
+    def clip(self, start: float, end: float) -> 'TranscriptArchive':
+        """The sentences spoken between start and end as a new archive, with
+        times counted from start, e.g. for a trimmed copy of the video"""
+        first = int(np.searchsorted(self.ends, start, side='right'))
+        last = int(np.searchsorted(self.starts, end, side='left'))
+        paragraphs = []
+        for p in range(len(self.paragraph_index) - 1):
+            lo, hi = max(first, int(self.paragraph_index[p])), min(last, int(self.paragraph_index[p + 1]))
+            if lo < hi:
+                paragraphs.append([
+                    {'text': sentence['text'],
+                     'start': max(0.0, sentence['start'] - start),
+                     'end': min(end, sentence['end']) - start}
+                    for sentence in self.sentences(lo, hi)
+                ])
+        return TranscriptArchive.from_paragraphs(paragraphs, max(0.0, end - start))
+
+    @property
+    def transcript(self) -> str:
+        return ' '.join(sentence['text'] for sentence in self.sentences())
+
+
+def archive_path(video_path: str) -> str:
+    """Storage path of a video's transcript: the video's path under transcripts/"""
+    return ARCHIVE_PREFIX + video_path.split('/', 1)[-1] + SUFFIX
+
+
+def upload_transcript(bucket, video_path: str, generation: str, archive: TranscriptArchive):
+    """Store an archive next to the video, tagged with the generation it transcribes"""
+    blob = bucket.blob(archive_path(video_path))
+    blob.metadata = {'videoGeneration': generation}
+    blob.upload_from_string(archive.to_bytes(), content_type=CONTENT_TYPE)
@@ -0,0 +1,263 @@
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Any, Iterator, List, Optional
+
+from . import hooks
+from .governor import get_governor, status_of
+
+TRANSCRIPTION_BACKEND = os.environ.get('TRANSCRIPTION_BACKEND', 'deepgram')
+# faster-whisper model: tiny.en / base.en / small.en trade accuracy for speed
+WHISPER_MODEL = os.environ.get('WHISPER_MODEL', 'base.en')
+WHISPER_WORKERS = int(os.environ.get('WHISPER_WORKERS', '2'))
+DEEPGRAM_TIMEOUT = 300.0
+
+# A pause this long between words starts a new paragraph
+PARAGRAPH_GAP = 1.5
+SENTENCE_END = re.compile(r'[.?!]["\')\]]*$')
+
+
+@dataclass
+class Transcript:
+    """A transcript as paragraphs of {'text', 'start', 'end'} sentences,
+    the same whichever backend produced it"""
+    paragraphs: List[List[Dict[str, Any]]]
+    duration: float = 0.0
+    backend: str = ''
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+    def sentences(self) -> List[Dict[str, Any]]:
+        return [sentence for para in self.paragraphs for sentence in para]
+
+    @property
+    def text(self) -> str:
+        return ' '.join(sentence['text'] for sentence in self.sentences())
+
+
+class SentenceAccumulator:
+    """Builds paragraphs of timed sentences from timed words or segments.
+
+    For engines that return words or segments rather than paragraphs:
+    sentences end at terminal punctuation or the end of an utterance, and a
+    long pause between words starts a new paragraph.
+    """
+
+    def __init__(self, paragraph_gap: float = PARAGRAPH_GAP):
+        self.paragraph_gap = paragraph_gap
+        self.paragraphs: List[List[Dict[str, Any]]] = [[]]
+        self.duration = 0.0
+        self._words: List[Dict[str, Any]] = []
+        self._last_end: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _end_sentence(self):
+        if self._words:
+            self.paragraphs[-1].append({
+                'text': ' '.join(word.get('punctuated_word') or word.get('word', '') for word in self._words),
+                'start': float(self._words[0].get('start', 0)),
+                'end': float(self._words[-1].get('end', 0)),
+            })
+            self._words = []
+
+    def add(self, words: List[Dict[str, Any]], utterance_end: bool = False):
+        with self._lock:
+            for word in words:
+                start = float(word.get('start', 0))
+                if self._last_end is not None and start - self._last_end > self.paragraph_gap:
+                    self._end_sentence()
+                    if self.paragraphs[-1]:
+                        self.paragraphs.append([])
+                self._words.append(word)
+                if SENTENCE_END.search(word.get('punctuated_word') or ''):
+                    self._end_sentence()
+                self._last_end = float(word.get('end', start))
+                self.duration = max(self.duration, self._last_end)
+            if utterance_end:
+                self._end_sentence()
+
+    def sentence_count(self) -> int:
+        with self._lock:
+            return sum(len(para) for para in self.paragraphs)
+
+    def transcript(self, backend: str, duration: float = 0.0) -> Transcript:
+        with self._lock:
+            self._end_sentence()
+            return Transcript([list(para) for para in self.paragraphs if para],
+                              max(duration, self.duration), backend)
+
+
+def deepgram_transcript(alternative: Dict[str, Any], duration: float = 0.0,
+                        backend: str = 'deepgram') -> Transcript:
+    """Normalize the first alternative of a Deepgram prerecorded response"""
+    paragraphs = [
+        [
+            {'text': sentence.get('text', ''), 'start': sentence.get('start', 0), 'end': sentence.get('end', 0)}
+            for sentence in para.get('sentences', [])
+        ]
+        for para in (alternative.get('paragraphs') or {}).get('paragraphs', [])
+    ]
+    paragraphs = [para for para in paragraphs if para]
+    if not paragraphs and alternative.get('transcript'):
+        # No paragraph breakdown; keep the text as one sentence
+        paragraphs = [[{'text': alternative['transcript'], 'start': 0.0, 'end': duration}]]
+    if not duration and paragraphs:
+        duration = float(max(sentence['end'] for para in paragraphs for sentence in para))
+    return Transcript(paragraphs, duration, backend)
+
+
+def is_url(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+
+@contextmanager
+def local_copy(source: str) -> Iterator[str]:
+    """A local path for a source, downloading it to a temporary file if it is a URL"""
+    if not is_url(source):
+        yield source
+        return
+    handle, path = tempfile.mkstemp(prefix='tiptok-media-')
+    try:
+        with os.fdopen(handle, 'wb') as f, urllib.request.urlopen(source) as response:
+            shutil.copyfileobj(response, f)
+        yield path
+    finally:
+        os.remove(path)
+
+
+class TranscriptionBackend:
+    """Speech to text for stored media"""
+    name = 'base'
+    # Sources transcribed at once by transcribe_batch
+    batch_workers = 4
+
+    def transcribe(self, source: str) -> Optional[Transcript]:
+        """Transcribe a media URL or local file; None if it has no speech"""
+        raise NotImplementedError
+
+    def _transcribe_or_none(self, source: str) -> Optional[Transcript]:
+        try:
+            return self.transcribe(source)
+        except Exception as e:
+            print(f"Error transcribing {source[:100]} with {self.name}: {str(e)}")
+            return None
+
+    def transcribe_batch(self, sources: List[str]) -> List[Optional[Transcript]]:
+        """Transcribe several sources, in order; a source that fails gets None"""
+        with ThreadPoolExecutor(max_workers=max(1, min(self.batch_workers, len(sources)))) as executor:
+            return list(executor.map(self._transcribe_or_none, sources))
+
+
+class DeepgramBackend(TranscriptionBackend):
+    """Deepgram's prerecorded API, fetching URLs itself and uploading local files"""
+    name = 'deepgram'
+    batch_workers = 8
+    OPTIONS = {
+        'punctuate': True,
+        'paragraphs': True,
+        'utterances': True,
+        'tier': 'enhanced',
+    }
+
+    def __init__(self, options: Optional[Dict[str, Any]] = None):
+        from deepgram import Deepgram
+        api_key = os.getenv('DEEPGRAM_API_KEY')
+        # DEEPGRAM_API_URL points the client elsewhere, e.g. at a local fake
+        api_url = os.getenv('DEEPGRAM_API_URL')
+        self.client = Deepgram({'api_key': api_key, 'api_url': api_url} if api_url else api_key)
+        self.options = {**self.OPTIONS, **(options or {})}
+
+    def _request(self, source: str) -> Optional[Dict[str, Any]]:
+        timeout = hooks.call_timeout(DEEPGRAM_TIMEOUT)
+        if is_url(source):
+            return self.client.transcription.sync_prerecorded({'url': source}, self.options, timeout=timeout)
+        mimetype = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+        with open(source, 'rb') as f:
+            return self.client.transcription.sync_prerecorded({'buffer': f, 'mimetype': mimetype}, self.options,
+                                                              timeout=timeout)
+
+    @hooks.timed('transcribe_with_deepgram')
+    def transcribe(self, source: str) -> Optional[Transcript]:
+        try:
+            response = get_governor('deepgram').call(self._request, source)
+        except Exception as e:
+            # Deepgram answers 400 for media it cannot read or that has no audio
+            if status_of(e) == 400:
+                print(f"Deepgram could not transcribe {source[:100]}: {str(e)}")
+                return None
+            raise
+        if not response:
+            return None
+        duration = response.get('metadata', {}).get('duration', 0)
+        hooks.record_transcription(self.name, duration)
+        try:
+            alternative = response['results']['channels'][0]['alternatives'][0]
+        except (KeyError, IndexError, TypeError):
+            return None
+        with hooks.span('parse_deepgram'):
+            transcript = deepgram_transcript(alternative, duration, self.name)
+        transcript.metadata = response.get('metadata', {})
+        return transcript if transcript.paragraphs else None
+
+
+class WhisperBackend(TranscriptionBackend):
+    """faster-whisper on the local CPU, with no network or API key.
+
+    The model is loaded once and shared by `workers` transcriptions running
+    side by side, each on its share of the cores, so a batch of files pays
+    for a single model load.
+    """
+    name = 'whisper'
+
+    def __init__(self, model_name: str = WHISPER_MODEL, workers: int = WHISPER_WORKERS):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError("The whisper backend needs faster-whisper: pip install -r requirements-whisper.txt") from e
+        self.model_name = model_name
+        self.batch_workers = max(1, workers)
+        self.model = WhisperModel(model_name, device='cpu', compute_type='int8',
+                                  cpu_threads=max(1, (os.cpu_count() or 1) // self.batch_workers),
+                                  num_workers=self.batch_workers)
+
+    @hooks.timed('transcribe_with_whisper')
+    def transcribe(self, source: str) -> Optional[Transcript]:
+        accumulator = SentenceAccumulator()
+        with local_copy(source) as path:
+            segments, info = self.model.transcribe(path, vad_filter=True)
+            # Segments are decoded lazily, as they are iterated
+            for segment in segments:
+                hooks.check_deadline('whisper')
+                accumulator.add([{'punctuated_word': segment.text.strip(), 'start': segment.start, 'end': segment.end}])
+        hooks.record_transcription(self.name, info.duration)
+        transcript = accumulator.transcript(self.name, info.duration)
+        transcript.metadata = {'model': self.model_name, 'language': info.language, 'duration': info.duration}
+        return transcript if transcript.paragraphs else None
+
+
+TRANSCRIPTION_BACKENDS = {
+    DeepgramBackend.name: DeepgramBackend,
+    WhisperBackend.name: WhisperBackend,
+}
+
+_backends: Dict[str, TranscriptionBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_transcription_backend(name: str = TRANSCRIPTION_BACKEND) -> TranscriptionBackend:
+    """Return the process-wide instance of a transcription backend, so local
+    models are loaded once"""
+    if name not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Unknown transcription backend: {name}")
+    if name not in _backends:
+        with _backends_lock:
+            if name not in _backends:
+                _backends[name] = TRANSCRIPTION_BACKENDS[name]()
+    return _backends[name]
+
@@ -0,0 +1,142 @@
+import io
+import os
+import re
+from typing import Dict, Any, Iterable, Iterator, List, Optional, TextIO, Tuple
+from urllib.parse import quote
+
+from . import hooks
+
+TRACK_PREFIX = 'tracks/'
+CHAPTER_TRACK = 'chapters.vtt'
+CAPTION_TRACK = 'captions.vtt'
+CONTENT_TYPE = 'text/vtt; charset=utf-8'
+# Tracks are rewritten when a video's chapters are regenerated
+CACHE_CONTROL = 'public, max-age=300'
+DOWNLOAD_URL = 'https://firebasestorage.googleapis.com/v0/b/{bucket}/o/{name}?alt=media'
+
+# Captions are split to fit two lines of a phone-width player
+CAPTION_LINE_CHARS = 42
+CAPTION_MAX_CHARS = 2 * CAPTION_LINE_CHARS
+CAPTION_MAX_SECONDS = 7.0
+CHAPTER_TITLE_CHARS = 80
+
+_UNSAFE = re.compile(r'[&<>\r\n]|-->')
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': ' ', '\n': ' ', '-->': '--&gt;'}
+
+Cue = Tuple[float, float, str]
+
+
+def write_timestamp(out: TextIO, seconds: float):
+    millis = int(round(max(seconds, 0.0) * 1000))
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    out.write(f"{hours:02d}:{minutes:02d}:{millis // 1000:02d}.{millis % 1000:03d}")
+
+
+def write_text(out: TextIO, text: str):
+    """Cue text with the characters WebVTT reserves escaped, on one line"""
+    last = 0
+    for match in _UNSAFE.finditer(text):
+        out.write(text[last:match.start()])
+        out.write(_ESCAPES[match.group()])
+        last = match.end()
+    out.write(text[last:])
+
+
+def write_track(out: TextIO, cues: Iterable[Cue], prefix: str = ''):
+    """Write a WebVTT file cue by cue. Cues are numbered prefix1, prefix2, ..."""
+    out.write('WEBVTT\n')
+    for i, (start, end, text) in enumerate(cues, 1):
+        out.write('\n')
+        if prefix:
+            out.write(f"{prefix}{i}\n")
+        write_timestamp(out, start)
+        out.write(' --> ')
+        write_timestamp(out, end)
+        out.write('\n')
+        write_text(out, text)
+        out.write('\n')
+
+
+def _shorten(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(' ', 0, limit)
+    return text[:cut if cut > 0 else limit].rstrip(' ,;:') + '...'
+
+
+def chapter_cues(chapters: List[Dict[str, Any]]) -> Iterator[Cue]:
+    """One cue per chapter, titled with the start of its summary"""
+    for i, chapter in enumerate(chapters, 1):
+        summary = (chapter.get('summary') or '').strip()
+        title = _shorten(summary.split('. ', 1)[0], CHAPTER_TITLE_CHARS) if summary else f"Chapter {i}"
+        yield float(chapter['start']), float(chapter['end']), title
+
+
+def caption_cues(sentences: Iterable[Dict[str, Any]]) -> Iterator[Cue]:
+    """Sentences as captions. A sentence too long to read in one cue is
+    split between words, with its time shared out by length."""
+    for sentence in sentences:
+        text = sentence['text'].strip()
+        start, end = float(sentence['start']), float(sentence['end'])
+        if not text or end <= start:
+            continue
+        parts = max(1, -(-len(text) // CAPTION_MAX_CHARS), int((end - start) // CAPTION_MAX_SECONDS) + 1)
+        if parts == 1:
+            yield start, end, text
+            continue
+        per_second = (end - start) / len(text)
+        target = len(text) / parts
+        first = 0
+        while first < len(text):
+            last = len(text) if len(text) - first <= target * 1.2 else text.rfind(' ', first, int(first + target) + 1)
+            if last <= first:
+                last = text.find(' ', int(first + target))
+                last = len(text) if last < 0 else last
+            yield start + first * per_second, start + last * per_second, text[first:last].strip()
+            first = last + 1
+
+
+def track_prefix(video_path: str) -> str:
+    """Storage prefix of a video's tracks: its path under tracks/, without the extension"""
+    return TRACK_PREFIX + os.path.splitext(video_path.split('/', 1)[-1])[0] + '/'
+
+
+def download_url(bucket_name: str, name: str) -> str:
+    return DOWNLOAD_URL.format(bucket=bucket_name, name=quote(name, safe=''))
+
+
+def render_track(cues: Iterable[Cue], prefix: str = '') -> io.BytesIO:
+    """A WebVTT file in memory, ready to upload"""
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding='utf-8', newline='\n', write_through=True)
+    write_track(text, cues, prefix)
+    text.detach()
+    buffer.seek(0)
+    return buffer
+
+
+def _upload(bucket, name: str, track: io.BytesIO):
+    blob = bucket.blob(name)
+    blob.cache_control = CACHE_CONTROL
+    blob.upload_from_file(track, content_type=CONTENT_TYPE)
+
+
+@hooks.timed('publish_tracks')
+def publish_tracks(bucket, video_path: str, generation: str, chapters: List[Dict[str, Any]],
+                   sentences: Optional[Iterable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Write a video's chapter track, and its caption track when there is a
+    transcript, under tracks/. Returns the fields to record on its video
+    document."""
+    prefix = track_prefix(video_path)
+    record: Dict[str, Any] = {'tracksGeneration': generation}
+    if chapters:
+        _upload(bucket, prefix + CHAPTER_TRACK, render_track(chapter_cues(chapters), prefix='chapter-'))
+        record['chapterTrackPath'] = prefix + CHAPTER_TRACK
+        record['chapterTrackUrl'] = download_url(bucket.name, prefix + CHAPTER_TRACK)
+    if sentences:
+        _upload(bucket, prefix + CAPTION_TRACK, render_track(caption_cues(sentences)))
+        record['captionTrackPath'] = prefix + CAPTION_TRACK
+        record['captionTrackUrl'] = download_url(bucket.name, prefix + CAPTION_TRACK)
+    return record
+
@@ -0,0 +1,227 @@
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+from . import hooks
+from .governor import backoff_delay
+
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH = 500
+FLUSH_INTERVAL = 0.5
+WRITES_METRIC = 'tiptok_firestore_writes_total'
+# Commits a write gets before it is dropped. Rejected writes, such as an
+# update to a missing document, are dropped after the first; Firestore's
+# errors carry their HTTP status as `code`.
+MAX_ATTEMPTS = 3
+REJECTED_STATUSES = {400, 404}
+
+
+def _coalesce(pending: Dict[str, Any], op: str, data: Dict[str, Any], merge: bool):
+    """Merge a later write to a document into the one pending for it"""
+    if op == 'set' and not merge:
+        pending.update(op='set', data=dict(data), merge=False)
+    else:
+        pending['data'].update(data)
+        if op == 'set' and pending['op'] == 'update':
+            # An update followed by a merge is one merge; it
+            # also creates the document, which update would not
+            pending.update(op='set', merge=True)
+
+
+class WriteBehindWriter:
+    """Queues Firestore writes and commits them from a background thread.
+
+    Writes to the same document coalesce while they wait: updates merge
+    into the pending update or set, and a set replaces whatever was
+    pending. The queue is flushed as batched commits once it reaches
+    max_batch documents or its oldest write is flush_interval old, so
+    callers never wait on a commit. close() flushes everything still
+    queued.
+
+    A write whose commit fails is queued again, merged under any newer
+    write to its document, until it has had MAX_ATTEMPTS commits. The next
+    commit waits out the governor's jittered backoff, since the errors
+    worth retrying are mostly contention and quota. Writes that are dropped
+    after that make flush() return False.
+    """
+
+    def __init__(self, db, max_batch: int = MAX_BATCH, flush_interval: float = FLUSH_INTERVAL):
+        self.db = db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        # (collection, document id) -> {'op', 'data', 'merge', 'first', 'seq', 'attempts'},
+        # oldest first; first and seq are the oldest and newest writes merged into it
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._oldest = 0.0
+        self._seq = 0
+        # Every write up to this seq has been committed or dropped
+        self._committed = 0
+        # First seqs of dropped writes not yet reported by flush(), and
+        # the targets of the flushes waiting
+        self._dropped: List[int] = []
+        self._flushing: List[int] = []
+        self._flush_requested = False
+        self._closed = False
+        # No commit starts before this, after a failed one
+        self._retry_at = 0.0
+        self._thread = threading.Thread(target=self._run, name='firestore-write-behind', daemon=True)
+        self._thread.start()
+
+    def _enqueue(self, collection: str, doc_id: str, op: str, data: Dict[str, Any], merge: bool = False):
+        key = (collection, doc_id)
+        # The commit happens on the writer's thread, outside any request trace
+        with hooks.span('firestore_queue', collection=collection, op=op), self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind writer is closed")
+            self._seq += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                self._pending[key] = {'op': op, 'data': dict(data), 'merge': merge, 'first': self._seq,
+                                      'seq': self._seq, 'attempts': 0}
+            else:
+                hooks.count(WRITES_METRIC, outcome='coalesced')
+                _coalesce(pending, op, data, merge)
+                pending['seq'] = self._seq
+            hooks.count(WRITES_METRIC, outcome='queued')
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+    def update(self, collection: str, doc_id: str, fields: Dict[str, Any]):
+        """Queue doc_ref.update(fields)"""
+        self._enqueue(collection, doc_id, 'update', fields)
+
+    def set(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool = False):
+        """Queue doc_ref.set(data, merge=merge)"""
+        self._enqueue(collection, doc_id, 'set', data, merge)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """Commit everything queued so far now rather than at the next threshold
+
+        A dropped write is reported by every flush waiting when it is
+        dropped, or else by the next one.
+
+        Returns:
+            False if wait is set and the writes were not all committed
+            within timeout
+        """
+        with self._cond:
+            target = self._seq
+            self._flush_requested = True
+            self._cond.notify_all()
+            if not wait:
+                return True
+            self._flushing.append(target)
+            try:
+                with hooks.span('firestore_flush_wait'):
+                    done = self._cond.wait_for(lambda: self._committed >= target, timeout)
+                failed = [first for first in self._dropped if first <= target]
+            finally:
+                self._flushing.remove(target)
+            if failed:
+                waiting = max(self._flushing, default=0)
+                self._dropped = [first for first in self._dropped if first > target or first <= waiting]
+            return done and not failed
+
+    def close(self, timeout: Optional[float] = 30.0):
+        """Flush and stop the background thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _take(self) -> List[Tuple[Tuple[str, str], Dict[str, Any]]]:
+        keys = list(self._pending)[:self.max_batch]
+        items = [(key, self._pending.pop(key)) for key in keys]
+        if self._pending:
+            self._oldest = time.monotonic()
+        else:
+            self._flush_requested = False
+        return items
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                while time.monotonic() < self._retry_at:
+                    self._cond.wait(self._retry_at - time.monotonic())
+                deadline = self._oldest + self.flush_interval
+                while (len(self._pending) < self.max_batch and not self._flush_requested
+                       and not self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                items = self._take()
+            failures = self._commit(items)
+            with self._cond:
+                for key, item, error in failures:
+                    item['attempts'] += 1
+                    if item['attempts'] < MAX_ATTEMPTS and getattr(error, 'code', None) not in REJECTED_STATUSES:
+                        hooks.count(WRITES_METRIC, outcome='retried')
+                        self._requeue(key, item)
+                        self._retry_at = max(self._retry_at, time.monotonic() + backoff_delay(item['attempts'], error))
+                    else:
+                        hooks.count(WRITES_METRIC, outcome='failed')
+                        print(f"Dropped write to {key[0]}/{key[1]} after {item['attempts']} attempts: {str(error)}")
+                        self._dropped.append(item['first'])
+                # Writes still queued may be older than the ones just committed
+                oldest = min((item['first'] for item in self._pending.values()), default=self._seq + 1)
+                self._committed = max(self._committed, oldest - 1)
+                self._cond.notify_all()
+
+    def _requeue(self, key: Tuple[str, str], item: Dict[str, Any]):
+        """Queue a failed write again, under any newer write to its document"""
+        newer = self._pending.get(key)
+        if newer is not None:
+            _coalesce(item, newer['op'], newer['data'], newer['merge'])
+            item['seq'] = newer['seq']
+        elif not self._pending:
+            self._oldest = time.monotonic()
+        self._pending[key] = item
+
+    def _write(self, target, key: Tuple[str, str], item: Dict[str, Any]):
+        ref = self.db.collection(key[0]).document(key[1])
+        if item['op'] == 'set':
+            target.set(ref, item['data'], merge=item['merge'])
+        else:
+            target.update(ref, item['data'])
+
+    def _commit(self, items: List[Tuple[Tuple[str, str], Dict[str, Any]]]) -> List[Tuple[Tuple[str, str],
+                                                                                     Dict[str, Any], Exception]]:
+        """Commit a batch of writes, returning the ones that failed with their errors"""
+        try:
+            with hooks.stage('firestore_flush'):
+                batch = self.db.batch()
+                for key, item in items:
+                    self._write(batch, key, item)
+                batch.commit()
+            hooks.count(WRITES_METRIC, len(items), outcome='committed')
+            return []
+        except Exception as e:
+            print(f"Batched Firestore commit of {len(items)} writes failed, retrying one by one: {str(e)}")
+
+        # A batch is all or nothing, so one update to a missing document
+        # would otherwise drop every other write with it
+        failures = []
+        for key, item in items:
+            try:
+                batch = self.db.batch()
+                self._write(batch, key, item)
+                batch.commit()
+                hooks.count(WRITES_METRIC, outcome='committed')
+            except Exception as e:
+                print(f"Error writing {key[0]}/{key[1]}: {str(e)}")
+                failures.append((key, item, e))
+        return failures
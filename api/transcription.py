@@ -1,4 +1,3 @@
-from deepgram import Deepgram
 import os
 from dotenv import load_dotenv
 import asyncio
@@ -10,9 +9,11 @@ from math import ceil
 # Load environment variables
 load_dotenv()
 
-# Get Deepgram API key
+from app.transcription_backends import Transcript, get_transcription_backend, TRANSCRIPTION_BACKEND
+
+# Get Deepgram API key, needed unless another transcription backend is configured
 DEEPGRAM_API_KEY = os.getenv('DEEPGRAM_API_KEY')
-if not DEEPGRAM_API_KEY:
+if TRANSCRIPTION_BACKEND == 'deepgram' and not DEEPGRAM_API_KEY:
     raise ValueError("DEEPGRAM_API_KEY not found in .env file")
 
 @dataclass
@@ -117,46 +118,48 @@ def format_chapters_for_display(chapters: List[Chapter]) -> str:
     
     return "\n".join(output)
 
-async def transcribe_video(url: str) -> Optional[Dict[str, Any]]:
+async def transcribe_video(url: str, backend: str = TRANSCRIPTION_BACKEND) -> Optional[Transcript]:
     """
-    Transcribe video using Deepgram API
+    Transcribe video with a transcription backend
     Args:
-        url: URL of the video to transcribe
+        url: URL or local path of the video to transcribe
+        backend: Name of the transcription backend (default TRANSCRIPTION_BACKEND)
     Returns:
-        Optional[Dict[str, Any]]: Transcription result from Deepgram or None if failed
+        Optional[Transcript]: Normalized transcript or None if failed or no speech
     """
     try:
-        print(f"\nInitializing Deepgram with API key: {DEEPGRAM_API_KEY[:8]}...")
-        dg_client = Deepgram(DEEPGRAM_API_KEY)
-        
-        print(f"Processing URL: {url[:100]}...")
-        source = {'url': url}
-        options = {
-            'punctuate': True,
-            'paragraphs': True,
-            'summarize': True,
-            'detect_topics': True,
-            'tier': 'enhanced'  # Use enhanced model for better accuracy
-        }
-        
-        print("\nSending to Deepgram for transcription...")
-        try:
-            response = await dg_client.transcription.prerecorded(source, options)
-            print("Transcription complete!")
-            return response
-        except Exception as api_error:
-            print(f"Deepgram API error: {str(api_error)}")
-            if hasattr(api_error, 'response'):
-                print(f"Response status: {api_error.response.status}")
-                print(f"Response text: {await api_error.response.text()}")
-            return None
-        
+        print(f"Transcribing {url[:100]}... with {backend}")
+        transcript = await asyncio.to_thread(get_transcription_backend(backend).transcribe, url)
+        print("Transcription complete!")
+        return transcript
     except Exception as e:
-        print(f"Error during transcription setup: {str(e)}")
+        print(f"Error during transcription: {str(e)}")
         print(f"Error type: {type(e).__name__}")
         print(f"Traceback: {traceback.format_exc()}")
         return None
 
+def transcript_data_from(transcript: Transcript) -> Dict[str, Any]:
+    """
+    Shape a normalized transcript like the output of extract_transcript
+    Args:
+        transcript: Transcript from a transcription backend
+    Returns:
+        Dict[str, Any]: Structured transcript data
+    """
+    return {
+        'full_text': transcript.text,
+        'paragraphs': [
+            {
+                'start': para[0]['start'],
+                'end': para[-1]['end'],
+                'text': ' '.join(sent['text'] for sent in para),
+                'sentences': para
+            }
+            for para in transcript.paragraphs
+        ],
+        'metadata': {**transcript.metadata, 'duration': transcript.duration, 'backend': transcript.backend}
+    }
+
 def extract_transcript(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """
     Extract readable transcript information from Deepgram response
@@ -222,7 +225,7 @@ async def process_video_url(url: str, chapter_duration: float = 30.0) -> Optiona
     """
     result = await transcribe_video(url)
     if result:
-        transcript_data = extract_transcript(result)
+        transcript_data = transcript_data_from(result)
         if transcript_data:
             chapters = generate_chapters(transcript_data, chapter_duration)
             transcript_data['chapters'] = [
@@ -1,18 +1,214 @@
 # Initialize Firebase - no need for explicit credentials in Cloud Functions
 from firebase_admin import initialize_app, storage, firestore
-from firebase_functions import storage_fn
+from firebase_functions import storage_fn, options
 from flask import jsonify
 import os
 import json
-from deepgram import Deepgram
-import asyncio
 import pathlib
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List
+from tiptok_core.governor import FirestoreBackend, use_backend
+from tiptok_core.write_behind import WriteBehindWriter
+from tiptok_core.transcription_backends import get_transcription_backend
+from tiptok_core.audio_fingerprint import AUDIO_DEDUP, find_duplicate
+from transcoding import transcode
+from pipeline import Pipeline
+from tiptok_core.webvtt import publish_tracks
+from tiptok_core.transcript_archive import TranscriptArchive, upload_transcript
 
 app = initialize_app()
+# Deepgram calls are governed in Firestore, the only backend that spans
+# instances. An API deployed with GOVERNOR_BACKEND=firestore shares this
+# budget; by default the API governs its calls per host in SQLite.
+use_backend(FirestoreBackend(firestore.client()))
 
-@storage_fn.on_object_finalized(max_instances=1)
+MAX_METADATA_CHAPTERS = 6 * 1024
+PLAYBACK_COLLECTION = 'videoplayback'
+SIGNED_URL_SECONDS = 600  # 10 minutes
+# A signed URL with less than this left is signed again on resume
+SIGNED_URL_MARGIN = 120
+MAX_CHAPTER_SUMMARY = 200
+# Marks chapters summarized here with their paragraph's opening sentence.
+# The API does not serve them as stored results; on first request it
+# summarizes these chapters with a model, from the transcript archived
+# here, and overwrites them.
+SUMMARY_SOURCE = 'trigger'
+# Uploads land in UPLOADS_BUCKET (the default bucket when unset), the only
+# bucket the triggers listen on. Everything derived from them (HLS
+# renditions, tracks, checkpoints) goes to DERIVED_BUCKET, so writing it
+# does not fire the triggers again; unset, e.g. in the emulator, it is the
+# default bucket too.
+UPLOADS_BUCKET = os.environ.get('UPLOADS_BUCKET') or None
+DERIVED_BUCKET = os.environ.get('DERIVED_BUCKET') or None
+
+
+def reused_chapters(db, writer, url: str, video_path: str, generation: str):
+    """Chapters of an earlier upload this one's audio is a copy or trimmed
+    part of, moved onto this upload's timeline, as {'reusedChapters', and
+    the earlier upload's 'summarySource' and 'suggestedTitle'}; None if
+    there is none"""
+    if not AUDIO_DEDUP:
+        return None
+    try:
+        match = find_duplicate(db, writer, url, video_path, generation)
+    except Exception as e:
+        print(f"Error fingerprinting {video_path}: {str(e)}")
+        return None
+    if match is None:
+        return None
+
+    source_id = match.video_path.split('/')[-1].split('.')[0]
+    doc = db.collection('videoprocessing').document(source_id).get()
+    data = (doc.to_dict() or {}) if doc.exists else {}
+    if data.get('status') != 'completed' or str(data.get('generation')) != match.generation:
+        return None
+    start, end = match.offset, match.offset + match.duration
+    chapters = [
+        {**chapter, 'start': max(chapter['start'], start) - start, 'end': min(chapter['end'], end) - start}
+        for chapter in data.get('chapters') or []
+        if chapter['end'] > start and chapter['start'] < end
+    ]
+    if not chapters:
+        return None
+    return {'reusedChapters': chapters,
+            **{key: data[key] for key in ('summarySource', 'suggestedTitle') if data.get(key)}}
+
+def source_url(run: Pipeline) -> str:
+    """The signed URL from the sign stage, or a new one if it has expired
+    since; only the transcription backend and fingerprinting fetch it"""
+    signed = run.output('sign')
+    if signed['expires'] - time.time() > SIGNED_URL_MARGIN:
+        return signed['url']
+    return sign_video(run)['url']
+
+
+def sign_video(run: Pipeline) -> Dict[str, Any]:
+    """Sign a URL the transcription backend can fetch the video from"""
+    blob = run.bucket.blob(run.video_path)
+    blob.reload()
+    print(f"Processing video: {blob.name}")
+    print(f"Content type: {blob.content_type}")
+    url = blob.generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_SECONDS,
+        method="GET"
+    )
+    return {'url': url, 'expires': time.time() + SIGNED_URL_SECONDS}
+
+
+def transcribe_video(run: Pipeline) -> Dict[str, Any]:
+    """The transcript's paragraphs, or the chapters of an earlier upload
+    this one's audio is a copy of, which makes transcribing unnecessary"""
+    url = source_url(run)
+    reused = reused_chapters(run.db, run.writer, url, run.video_path, run.generation)
+    if reused is not None:
+        print(f"Reusing chapters of an earlier upload for {run.video_path}")
+        return reused
+
+    # Transcribe with the configured backend (TRANSCRIPTION_BACKEND, default Deepgram)
+    transcript = get_transcription_backend().transcribe(url)
+    if transcript is None:
+        return {'paragraphs': []}
+    return {
+        'paragraphs': transcript.paragraphs,
+        'duration': transcript.duration,
+        'backend': transcript.backend
+    }
+
+
+def group_chapters(run: Pipeline) -> List[Dict[str, Any]]:
+    """One chapter per transcript paragraph"""
+    transcribed = run.output('transcribe')
+    if 'reusedChapters' in transcribed:
+        return transcribed['reusedChapters']
+    return [{
+        'start': para[0]['start'],
+        'end': para[-1]['end'],
+        'summary': '',
+        'topics': []
+    } for para in transcribed['paragraphs']]
+
+
+def summarize_chapters(run: Pipeline) -> List[Dict[str, Any]]:
+    """Give chapters without a summary the opening sentence of their
+    paragraph, stored as SUMMARY_SOURCE summaries for the API to replace"""
+    chapters = run.output('group')
+    transcribed = run.output('transcribe')
+    if 'reusedChapters' in transcribed:
+        return chapters
+    summarized = []
+    for chapter, para in zip(chapters, transcribed['paragraphs']):
+        summary = chapter['summary'] or para[0]['text'].strip()
+        if len(summary) > MAX_CHAPTER_SUMMARY:
+            summary = summary[:MAX_CHAPTER_SUMMARY].rsplit(' ', 1)[0] + '...'
+        summarized.append({**chapter, 'summary': summary})
+    return summarized
+
+
+def persist_chapters(run: Pipeline) -> None:
+    """Write the chapters to the video's metadata, processing document and
+    WebVTT tracks, and archive the transcript for the API"""
+    chapters = run.output('summarize')
+    blob = run.bucket.blob(run.video_path)
+    transcribed = run.output('transcribe')
+    sentences = [sentence for para in transcribed.get('paragraphs', []) for sentence in para]
+    if sentences:
+        # Archived before the run completes, so the API finds it when it
+        # summarizes these chapters instead of transcribing the video again
+        try:
+            upload_transcript(run.derived_bucket, run.video_path, run.generation,
+                              TranscriptArchive.from_paragraphs(transcribed['paragraphs'],
+                                                                transcribed.get('duration', 0.0)))
+        except Exception as e:
+            print(f"Error archiving transcript of {run.video_path}: {str(e)}")
+    # The app may not have created the video document yet, so the tracks
+    # are also kept on the processing document
+    tracks = publish_tracks(run.derived_bucket, run.video_path, run.generation, chapters, sentences)
+    for doc in run.db.collection('videos').where('storagePath', '==', run.video_path).stream():
+        run.writer.update('videos', doc.id, tracks)
+    
+    # Add chapters as metadata to the original video. Custom metadata is
+    # capped at 8 KiB per object, so long videos keep them in Firestore only.
+    blob.metadata = {'processed_at': datetime.now(timezone.utc).isoformat()}
+    chapters_json = json.dumps(chapters)
+    if len(chapters_json) <= MAX_METADATA_CHAPTERS:
+        blob.metadata['chapters'] = chapters_json
+    
+    if 'reusedChapters' in transcribed:
+        provenance = {key: transcribed[key] for key in ('summarySource', 'suggestedTitle') if key in transcribed}
+    else:
+        provenance = {'summarySource': SUMMARY_SOURCE}
+
+    # Update status to completed, committing it while the metadata patch is in flight
+    run.writer.update('videoprocessing', run.video_id, {
+        **tracks,
+        **provenance,
+        'status': 'completed',
+        'chapters': chapters,
+        'completed_at': firestore.SERVER_TIMESTAMP
+    })
+    run.writer.flush(wait=False)
+    blob.patch()
+
+
+PIPELINE_STAGES = {
+    'sign': sign_video,
+    'transcribe': transcribe_video,
+    'group': group_chapters,
+    'summarize': summarize_chapters,
+    'persist': persist_chapters,
+}
+
+@storage_fn.on_object_finalized(bucket=UPLOADS_BUCKET, max_instances=1, retry=True)
 def generate_chapters(event: storage_fn.CloudEvent) -> None:
-    """Generates chapter markers when a video is uploaded."""
+    """Generates chapter markers when a video is uploaded.
+
+    Each stage of the pipeline is checkpointed in videoprocessing/{id}, so
+    if the function dies partway, the event's next delivery resumes after
+    the last completed stage. A failure is raised again for redelivery
+    until the upload has had MAX_ATTEMPTS.
+    """
     file_path = pathlib.PurePath(event.data.name)
     
     # Check if this is a video in the videos collection
@@ -20,90 +216,84 @@ def generate_chapters(event: storage_fn.CloudEvent) -> None:
         print(f"Ignoring file not in videos directory: {file_path}")
         return
         
+    # Get video ID from path
+    video_id = str(file_path).split('/')[-1].split('.')[0]
+    
+    # Get Firestore client inside the function. Status writes go through
+    # a write-behind writer so they commit while the video is processed.
+    db = firestore.client()
+    writer = WriteBehindWriter(db)
+    run = Pipeline(db, writer, storage.bucket(UPLOADS_BUCKET), 'videoprocessing', video_id,
+                   str(file_path), str(event.data.generation), storage.bucket(DERIVED_BUCKET))
     try:
-        # Get video ID from path
-        video_id = str(file_path).split('/')[-1].split('.')[0]
+        if not run.start():
+            print(f"Already processed: {file_path}")
+            return
+        run.run(PIPELINE_STAGES)
+        print(f"Successfully processed video: {file_path}")
         
-        # Get Firestore client inside the function
-        db = firestore.client()
-        processing_ref = db.collection('videoprocessing').document(video_id)
+    except Exception as e:
+        # Update status to error in Firestore
+        print(f"Error processing video: {str(e)}")
+        print(f"Error type: {type(e).__name__}")
+        if run.fail(e):
+            raise
+    finally:
+        # The instance may be frozen once the function returns
+        writer.close()
         
-        # Update status to processing
-        processing_ref.set({
+
+
+@storage_fn.on_object_finalized(bucket=UPLOADS_BUCKET, max_instances=4, timeout_sec=540, memory=options.MemoryOption.GB_4, cpu=4)
+def transcode_video(event: storage_fn.CloudEvent) -> None:
+    """Encodes an HLS ladder and a faststart MP4 when a video is uploaded.
+
+    Runs alongside generate_chapters. The manifest is recorded on the
+    video's documents so the feed can stream it instead of the upload.
+    """
+    file_path = str(event.data.name)
+    if not file_path.startswith('videos/'):
+        print(f"Ignoring file not in videos directory: {file_path}")
+        return
+
+    video_id = file_path.split('/')[-1].split('.')[0]
+    generation = str(event.data.generation)
+    db = firestore.client()
+    writer = WriteBehindWriter(db)
+    try:
+        writer.set(PLAYBACK_COLLECTION, video_id, {
             'status': 'processing',
-            'path': str(file_path),
+            'path': file_path,
+            'generation': generation,
             'created_at': firestore.SERVER_TIMESTAMP
         })
-        
-        # Initialize Deepgram
-        dg_client = Deepgram(os.getenv('DEEPGRAM_API_KEY'))
-        
-        # Get video from Firebase Storage
-        bucket = storage.bucket()
-        blob = bucket.blob(str(file_path))
-        
-        # Get blob metadata
-        blob.reload()
-        print(f"Processing video: {blob.name}")
-        print(f"Content type: {blob.content_type}")
-        
-        # Generate signed URL for Deepgram
-        url = blob.generate_signed_url(
-            version="v4",
-            expiration=600,  # 10 minutes
-            method="GET"
-        )
-        
-        # Send to Deepgram for transcription
-        async def transcribe():
-            source = {'url': url}
-            options = {
-                'punctuate': True,
-                'paragraphs': True,
-                'summarize': True,
-                'detect_topics': True
-            }
-            return await dg_client.transcription.prerecorded(source, options)
-
-        # Run the transcription
-        transcription = asyncio.run(transcribe())
-        
-        # Extract chapters
-        chapters = []
-        if 'results' in transcription:
-            paragraphs = transcription['results'].get('paragraphs', [])
-            for para in paragraphs:
-                chapters.append({
-                    'start': para['start'],
-                    'end': para['end'],
-                    'summary': para.get('summary', ''),
-                    'topics': para.get('topics', [])
-                })
-        
-        # Add chapters as metadata to the original video
-        blob.metadata = {
-            'chapters': json.dumps(chapters),
-            'processed_at': firestore.SERVER_TIMESTAMP.isoformat()
-        }
-        blob.patch()
-        
-        # Update status to completed
-        processing_ref.update({
+
+        url = storage.bucket(UPLOADS_BUCKET).blob(file_path).generate_signed_url(
+            version="v4", expiration=600, method="GET")
+        playback = transcode(storage.bucket(DERIVED_BUCKET), url, file_path, generation)
+
+        writer.update(PLAYBACK_COLLECTION, video_id, {
+            **playback,
             'status': 'completed',
-            'chapters': chapters,
             'completed_at': firestore.SERVER_TIMESTAMP
         })
-        
-        print(f"Successfully processed video: {blob.name}")
-        
-    except Exception as e:
-        # Update status to error in Firestore
-        if 'processing_ref' in locals():
-            processing_ref.update({
-                'status': 'error',
-                'error': str(e),
-                'error_type': type(e).__name__
+        # The app creates the video document once the upload finishes, which
+        # is long done by the time encoding is
+        for doc in db.collection('videos').where('storagePath', '==', file_path).stream():
+            writer.update('videos', doc.id, {
+                'hlsManifestPath': playback['manifestPath'],
+                'hlsManifestUrl': playback['manifestUrl'],
+                'fallbackPath': playback['fallbackPath'],
+                'fallbackUrl': playback['fallbackUrl'],
+                'playbackGeneration': generation
             })
-        print(f"Error processing video: {str(e)}")
-        print(f"Error type: {type(e).__name__}")
-        
\ No newline at end of file
+        print(f"Transcoded {file_path} into {len(playback['renditions'])} renditions")
+    except Exception as e:
+        writer.update(PLAYBACK_COLLECTION, video_id, {
+            'status': 'error',
+            'error': str(e),
+            'error_type': type(e).__name__
+        })
+        print(f"Error transcoding video: {str(e)}")
+    finally:
+        writer.close()
@@ -0,0 +1,153 @@
+"""Checkpointed stages of the upload pipeline.
+
+The storage trigger runs each upload through a fixed list of stages. A
+stage's output is checkpointed as soon as it finishes, small outputs in
+the video's processing document and large ones in the derived bucket, so when
+the event is delivered again after the function died the run resumes
+after the last completed stage instead of transcribing the video again.
+"""
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, Callable, List
+
+from firebase_admin import firestore
+
+STAGES = ['sign', 'transcribe', 'group', 'summarize', 'persist']
+# Stages whose output is too large for the processing document
+BLOB_STAGES = {'transcribe'}
+CHECKPOINT_PREFIX = 'checkpoints/'
+# Deliveries of a failing upload before it is left in the error state
+MAX_ATTEMPTS = 3
+# Longest wait for a checkpoint to commit
+CHECKPOINT_TIMEOUT = 60.0
+
+
+class Pipeline:
+    """One upload's run through STAGES, checkpointed in {collection}/{video_id}.
+
+    The document records the last completed stage in 'stage', each
+    completed stage's duration and attempt in 'stages', and the outputs
+    kept in Firestore in 'checkpoints'. Checkpoints only count for the
+    generation they were written for; a new upload starts over.
+    """
+
+    def __init__(self, db, writer, bucket, collection: str, video_id: str, video_path: str, generation: str,
+                 derived_bucket=None):
+        self.db = db
+        self.writer = writer
+        self.bucket = bucket
+        # Checkpoints and other outputs go to the derived bucket, so they
+        # do not fire the upload triggers
+        self.derived_bucket = derived_bucket or bucket
+        self.collection = collection
+        self.video_id = video_id
+        self.video_path = video_path
+        self.generation = generation
+        self.attempt = 1
+        self.completed: List[str] = []
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._outputs: Dict[str, Any] = {}
+
+    def checkpoint_path(self, stage: str) -> str:
+        """Storage path of a stage's output: the video's path under checkpoints/"""
+        name = os.path.splitext(self.video_path.split('/', 1)[-1])[0]
+        return f"{CHECKPOINT_PREFIX}{name}.{stage}.json"
+
+    def start(self) -> bool:
+        """Pick up this generation's checkpoints, or start a fresh run.
+        Returns False if this generation was already processed."""
+        doc = self.db.collection(self.collection).document(self.video_id).get()
+        data = (doc.to_dict() or {}) if doc.exists else {}
+        if str(data.get('generation')) == self.generation:
+            if data.get('status') == 'completed':
+                return False
+            stages = data.get('stages') or {}
+            for stage in STAGES:
+                if stage not in stages:
+                    break
+                self.completed.append(stage)
+                self.stages[stage] = stages[stage]
+            self._outputs = {stage: output for stage, output in (data.get('checkpoints') or {}).items()
+                             if stage in self.completed}
+            self.attempt = int(data.get('attempt') or 1) + 1
+
+        if self.completed:
+            print(f"Resuming {self.video_path} after {self.completed[-1]} (attempt {self.attempt})")
+            self.writer.update(self.collection, self.video_id, {
+                'status': 'processing',
+                'attempt': self.attempt,
+                'resumed_from': self.completed[-1],
+                'created_at': firestore.SERVER_TIMESTAMP
+            })
+        else:
+            self.writer.set(self.collection, self.video_id, {
+                'status': 'processing',
+                'path': self.video_path,
+                'generation': self.generation,
+                'attempt': self.attempt,
+                'created_at': firestore.SERVER_TIMESTAMP
+            })
+        return True
+
+    def output(self, stage: str) -> Any:
+        """A completed stage's output, from this run or its checkpoint"""
+        if stage not in self._outputs and stage in BLOB_STAGES and stage in self.completed:
+            blob = self.derived_bucket.get_blob(self.checkpoint_path(stage))
+            if blob is None or (blob.metadata or {}).get('videoGeneration') != self.generation:
+                raise RuntimeError(f"Checkpoint of {stage} for {self.video_path} is missing")
+            self._outputs[stage] = json.loads(blob.download_as_bytes())
+        return self._outputs.get(stage)
+
+    def _checkpoint(self, stage: str, output: Any, seconds: float):
+        self._outputs[stage] = output
+        self.completed.append(stage)
+        self.stages[stage] = {
+            'seconds': round(seconds, 3),
+            'attempt': self.attempt,
+            'completed_at': datetime.now(timezone.utc).isoformat()
+        }
+        if stage in BLOB_STAGES:
+            blob = self.derived_bucket.blob(self.checkpoint_path(stage))
+            blob.metadata = {'videoGeneration': self.generation}
+            blob.upload_from_string(json.dumps(output), content_type='application/json')
+
+        fields: Dict[str, Any] = {'stage': stage, 'stages': self.stages}
+        if stage == STAGES[-1]:
+            # Done; the results live in the document and the video's metadata
+            fields['checkpoints'] = firestore.DELETE_FIELD
+        else:
+            fields['checkpoints'] = {name: value for name, value in self._outputs.items()
+                                     if name not in BLOB_STAGES and name in self.completed}
+        self.writer.update(self.collection, self.video_id, fields)
+        # The next stage only starts once this one is durable
+        if not self.writer.flush(timeout=CHECKPOINT_TIMEOUT):
+            self.completed.remove(stage)
+            raise RuntimeError(f"Checkpoint of {stage} for {self.video_path} was not written")
+
+    def run(self, handlers: Dict[str, Callable[['Pipeline'], Any]]):
+        """Run the stages not yet completed, checkpointing each one"""
+        for stage in STAGES:
+            if stage in self.completed:
+                continue
+            started = time.monotonic()
+            output = handlers[stage](self)
+            self._checkpoint(stage, output, time.monotonic() - started)
+            print(f"{self.video_path}: {stage} took {self.stages[stage]['seconds']:.1f}s")
+
+        for stage in BLOB_STAGES:
+            blob = self.derived_bucket.get_blob(self.checkpoint_path(stage))
+            if blob is not None:
+                blob.delete()
+
+    def fail(self, error: Exception) -> bool:
+        """Record a failed attempt. Returns True if the event should be
+        delivered again to resume the run."""
+        self.writer.update(self.collection, self.video_id, {
+            'status': 'error',
+            'error': str(error),
+            'error_type': type(error).__name__,
+            'failed_stage': next((stage for stage in STAGES if stage not in self.completed), None)
+        })
+        return self.attempt < MAX_ATTEMPTS
@@ -0,0 +1,163 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from firebase_admin import firestore
+
+from pipeline import Pipeline, STAGES, MAX_ATTEMPTS
+
+
+class Store:
+    """Documents of one collection, written straight through by the writer"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda doc_id: SimpleNamespace(get=lambda: self._get(doc_id)))
+
+    def _get(self, doc_id):
+        data = self.docs.get(doc_id)
+        return SimpleNamespace(exists=data is not None, to_dict=lambda: json.loads(json.dumps(data, default=str)))
+
+
+class Writer:
+    def __init__(self, store):
+        self.store = store
+        self.fail_flush = False
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.store.docs[doc_id] = dict(data)
+
+    def update(self, collection, doc_id, fields):
+        doc = self.store.docs[doc_id]
+        for key, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                doc.pop(key, None)
+            else:
+                doc[key] = value
+
+    def flush(self, wait=True, timeout=None):
+        return not self.fail_flush
+
+
+class Bucket:
+    def __init__(self):
+        self.blobs = {}
+
+    def blob(self, name):
+        bucket = self
+
+        class Blob:
+            metadata = None
+
+            def upload_from_string(self, text, content_type):
+                bucket.blobs[name] = (text, self.metadata)
+
+            def download_as_bytes(self):
+                return bucket.blobs[name][0].encode()
+
+            def delete(self):
+                del bucket.blobs[name]
+        return Blob()
+
+    def get_blob(self, name):
+        if name not in self.blobs:
+            return None
+        blob = self.blob(name)
+        blob.metadata = self.blobs[name][1]
+        return blob
+
+
+@pytest.fixture
+def store():
+    return Store()
+
+
+@pytest.fixture
+def bucket():
+    return Bucket()
+
+
+def run(store, bucket, generation='1', derived=None):
+    return Pipeline(store, Writer(store), bucket, 'videoprocessing', 'clip', 'videos/user/clip.mp4', generation,
+                    derived)
+
+
+def handlers(calls, die_at=None):
+    def stage(name, output):
+        def handler(run):
+            calls.append(name)
+            if name == die_at:
+                raise RuntimeError('instance died')
+            if name == 'group':
+                return [{'text': run.output('transcribe')['text']}]
+            return output
+        return handler
+    outputs = {'sign': {'url': 'signed'}, 'transcribe': {'text': 'hello'}, 'summarize': ['s'], 'persist': None}
+    return {name: stage(name, outputs.get(name)) for name in STAGES}
+
+
+def test_a_redelivered_event_resumes_after_the_last_checkpoint(store, bucket):
+    calls = []
+    first = run(store, bucket)
+    assert first.start()
+    with pytest.raises(RuntimeError):
+        first.run(handlers(calls, die_at='summarize'))
+    assert first.fail(RuntimeError('instance died'))
+    assert store.docs['clip']['failed_stage'] == 'summarize'
+
+    calls.clear()
+    second = run(store, bucket)
+    assert second.start()
+    assert second.attempt == 2 and second.completed == ['sign', 'transcribe', 'group']
+    second.run(handlers(calls))
+    assert calls == ['summarize', 'persist']
+    # The transcript came back from its blob checkpoint, which is cleaned up at the end
+    assert second.output('group') == [{'text': 'hello'}]
+    assert 'checkpoints' not in store.docs['clip'] and not bucket.blobs
+
+    store.docs['clip']['status'] = 'completed'
+    assert not run(store, bucket).start()
+
+
+def test_checkpoints_are_kept_out_of_the_uploads_bucket(store, bucket):
+    derived = Bucket()
+    attempt = run(store, bucket, derived=derived)
+    attempt.start()
+    with pytest.raises(RuntimeError):
+        attempt.run(handlers([], die_at='summarize'))
+    assert derived.blobs and not bucket.blobs
+
+
+def test_a_new_upload_starts_over(store, bucket):
+    first = run(store, bucket)
+    first.start()
+    with pytest.raises(RuntimeError):
+        first.run(handlers([], die_at='group'))
+
+    second = run(store, bucket, generation='2')
+    assert second.start()
+    assert second.completed == [] and second.attempt == 1
+    # The old generation's transcript is not picked up
+    second.completed.append('transcribe')
+    with pytest.raises(RuntimeError, match='missing'):
+        second.output('transcribe')
+
+
+def test_a_checkpoint_that_is_not_written_fails_the_stage(store, bucket):
+    calls = []
+    attempt = run(store, bucket)
+    attempt.start()
+    attempt.writer.fail_flush = True
+    with pytest.raises(RuntimeError, match='was not written'):
+        attempt.run(handlers(calls))
+    assert calls == ['sign'] and attempt.completed == []
+
+
+def test_attempts_stop_being_redelivered(store, bucket):
+    store.docs['clip'] = {'generation': '1', 'status': 'error', 'attempt': MAX_ATTEMPTS - 1,
+                          'stages': {'sign': {}}, 'checkpoints': {'sign': {'url': 'signed'}}}
+    last = run(store, bucket)
+    assert last.start() and last.attempt == MAX_ATTEMPTS
+    assert not last.fail(RuntimeError('still failing'))
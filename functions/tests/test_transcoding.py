@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from transcoding import hls_prefix, remove_earlier_generations, absolute_playlist, download_url
+
+
+class Bucket:
+    name = 'tiptok.appspot.com'
+
+    def __init__(self, names):
+        self.names = set(names)
+
+    def list_blobs(self, prefix):
+        return [SimpleNamespace(name=name, delete=lambda name=name: self.names.discard(name))
+                for name in sorted(self.names) if name.startswith(prefix)]
+
+
+def test_each_generation_has_its_own_prefix():
+    assert hls_prefix('videos/u1/v1.mp4') == 'hls/u1/v1/'
+    assert hls_prefix('videos/u1/v1.mp4', '200') == 'hls/u1/v1/200/'
+    assert hls_prefix('videos/u1/v1.mp4', '200') != hls_prefix('videos/u1/v1.mp4', '300')
+
+
+def test_only_earlier_generations_are_removed():
+    bucket = Bucket([
+        'hls/u1/v1/master.m3u8', 'hls/u1/v1/720p/seg_00000.ts',
+        'hls/u1/v1/100/master.m3u8', 'hls/u1/v1/100/720p/seg_00000.ts',
+        'hls/u1/v1/200/master.m3u8', 'hls/u1/v1/200/720p/seg_00000.ts',
+        'hls/u1/v1/300/master.m3u8',
+        'hls/u1/v10/100/master.m3u8',
+    ])
+
+    assert remove_earlier_generations(bucket, 'videos/u1/v1.mp4', '200') == 4
+    assert bucket.names == {'hls/u1/v1/200/master.m3u8', 'hls/u1/v1/200/720p/seg_00000.ts',
+                            'hls/u1/v1/300/master.m3u8', 'hls/u1/v10/100/master.m3u8'}
+
+
+def test_playlist_segments_point_at_the_generation():
+    prefix = hls_prefix('videos/u1/v1.mp4', '200') + '720p/'
+    url_for = lambda name: download_url(Bucket.name, name)
+    playlist = absolute_playlist('#EXTM3U\n#EXTINF:2.0,\nseg_00000.ts\n', prefix, url_for)
+    assert playlist.splitlines()[-1] == url_for('hls/u1/v1/200/720p/seg_00000.ts')
+    assert 'hls%2Fu1%2Fv1%2F200%2F720p%2Fseg_00000.ts' in playlist
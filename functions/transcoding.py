@@ -0,0 +1,314 @@
+"""Adaptive-bitrate HLS renditions and a faststart MP4 for uploaded videos.
+
+Every rendition is encoded by its own ffmpeg process, side by side, with
+keyframes forced at the same timestamps so players can switch renditions
+at any segment boundary. Output goes under hls/{user}/{video}/{generation}/
+in the video's bucket, so a re-upload never overwrites the files of the
+upload before it and every file can be cached as immutable:
+
+    master.m3u8          variant playlist listing the renditions
+    {name}/index.m3u8    media playlist of one rendition
+    {name}/seg_00000.ts  its segments
+    fallback.mp4         faststart MP4 for players without HLS
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from urllib.parse import quote
+
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE', 'ffprobe')
+
+HLS_PREFIX = 'hls/'
+MASTER_PLAYLIST = 'master.m3u8'
+MEDIA_PLAYLIST = 'index.m3u8'
+FALLBACK_NAME = 'fallback.mp4'
+# Short segments let playback start after a small first download
+SEGMENT_SECONDS = 2
+# Players start on the first variant listed, so the one nearest this
+# height goes first and they step up once they have measured bandwidth
+STARTUP_HEIGHT = 480
+FALLBACK_HEIGHT = 720
+ENCODE_TIMEOUT = 480.0
+UPLOAD_WORKERS = 8
+# Main profile, level 4.0 video and AAC-LC audio
+VIDEO_CODEC = 'avc1.4d4028'
+AUDIO_CODEC = 'mp4a.40.2'
+SEGMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PLAYLIST_CACHE_CONTROL = 'public, max-age=60'
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.mp4': 'video/mp4',
+}
+DOWNLOAD_URL = 'https://firebasestorage.googleapis.com/v0/b/{bucket}/o/{name}?alt=media'
+
+
+@dataclass
+class Rendition:
+    name: str
+    # Length of the short side, so portrait phone videos get the same ladder
+    height: int
+    video_kbps: int
+    audio_kbps: int
+
+
+LADDER = [
+    Rendition('1080p', 1080, 5000, 128),
+    Rendition('720p', 720, 2800, 128),
+    Rendition('480p', 480, 1400, 96),
+    Rendition('360p', 360, 700, 64),
+]
+
+
+@dataclass
+class SourceInfo:
+    width: int
+    height: int
+    duration: float
+    has_audio: bool
+
+    @property
+    def short_side(self) -> int:
+        return min(self.width, self.height)
+
+
+def probe(source: str) -> SourceInfo:
+    """Displayed size, duration and audio presence of a media URL or file"""
+    result = subprocess.run([FFPROBE, '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', source],
+                            capture_output=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe could not read {source[:100]}: {result.stderr.decode(errors='replace')[-300:]}")
+    data = json.loads(result.stdout)
+    streams = data.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise ValueError("Upload has no video stream")
+    width, height = int(video['width']), int(video['height'])
+    # Phones record landscape frames with a rotation flag; ffmpeg applies it when encoding
+    rotation = int(float(video.get('tags', {}).get('rotate', 0)))
+    for side_data in video.get('side_data_list', []):
+        rotation = int(float(side_data.get('rotation', rotation)))
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+    return SourceInfo(width, height, float(data.get('format', {}).get('duration') or 0.0),
+                      any(stream.get('codec_type') == 'audio' for stream in streams))
+
+
+def select_ladder(info: SourceInfo) -> List[Rendition]:
+    """The renditions no larger than the source, or one at the source's size
+    if it is smaller than every rung"""
+    ladder = [rendition for rendition in LADDER if rendition.height <= info.short_side]
+    if not ladder:
+        smallest = LADDER[-1]
+        ladder = [Rendition(f'{info.short_side}p', info.short_side - info.short_side % 2,
+                            smallest.video_kbps, smallest.audio_kbps)]
+    return ladder
+
+
+def scaled_size(info: SourceInfo, short_side: int) -> Tuple[int, int]:
+    """Frame size with the short side scaled to short_side, both sides even"""
+    long_side = round(max(info.width, info.height) * short_side / info.short_side / 2) * 2
+    return (long_side, short_side) if info.width >= info.height else (short_side, long_side)
+
+
+def _input_args(source: str) -> List[str]:
+    args = [FFMPEG, '-nostdin', '-v', 'error', '-y']
+    if source.startswith(('http://', 'https://')):
+        args += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+    return args + ['-i', source]
+
+
+def _video_args(size: Tuple[int, int], kbps: int, threads: int) -> List[str]:
+    return [
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f'scale={size[0]}:{size[1]}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-level:v', '4.0', '-pix_fmt', 'yuv420p',
+        '-b:v', f'{kbps}k', '-maxrate', f'{kbps * 11 // 10}k', '-bufsize', f'{kbps * 2}k',
+        '-threads', str(threads),
+    ]
+
+
+def _run(command: List[str]):
+    result = subprocess.run(command, capture_output=True, timeout=ENCODE_TIMEOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace')[-500:]}")
+
+
+def encode_rendition(source: str, info: SourceInfo, rendition: Rendition, directory: str, threads: int):
+    """Encode one rendition as HLS segments and a media playlist in directory"""
+    os.makedirs(directory, exist_ok=True)
+    _run(_input_args(source) + _video_args(scaled_size(info, rendition.height), rendition.video_kbps, threads) + [
+        # Keyframes on the same timestamps in every rendition keep segments aligned
+        '-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_SECONDS})', '-sc_threshold', '0',
+        '-c:a', 'aac', '-b:a', f'{rendition.audio_kbps}k', '-ac', '2', '-ar', '48000',
+        '-f', 'hls', '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+        '-hls_flags', 'independent_segments',
+        '-hls_segment_filename', os.path.join(directory, 'seg_%05d.ts'),
+        os.path.join(directory, MEDIA_PLAYLIST),
+    ])
+
+
+def encode_fallback(source: str, info: SourceInfo, path: str, threads: int):
+    """Encode an MP4 with its index up front, so it plays while downloading"""
+    short_side = min(FALLBACK_HEIGHT, info.short_side - info.short_side % 2)
+    kbps = next((rendition.video_kbps for rendition in LADDER if rendition.height <= short_side), LADDER[-1].video_kbps)
+    _run(_input_args(source) + _video_args(scaled_size(info, short_side), kbps, threads) + [
+        '-c:a', 'aac', '-b:a', '128k', '-ac', '2',
+        '-movflags', '+faststart', path,
+    ])
+
+
+def segment_bandwidth(directory: str) -> Tuple[int, int]:
+    """Peak and average bits per second of a rendition's segments, for the master playlist"""
+    peak = total_bits = 0
+    total_seconds = 0.0
+    duration = None
+    with open(os.path.join(directory, MEDIA_PLAYLIST)) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line and not line.startswith('#') and duration:
+                bits = os.path.getsize(os.path.join(directory, line)) * 8
+                peak = max(peak, int(bits / duration))
+                total_bits += bits
+                total_seconds += duration
+                duration = None
+    return peak, int(total_bits / total_seconds) if total_seconds else 0
+
+
+def master_playlist(variants: List[Dict[str, Any]], has_audio: bool, url_for: Callable[[str], str]) -> str:
+    """Variant playlist for the encoded renditions, the startup one first"""
+    codecs = f'{VIDEO_CODEC},{AUDIO_CODEC}' if has_audio else VIDEO_CODEC
+    startup = min(variants, key=lambda variant: abs(min(variant['width'], variant['height']) - STARTUP_HEIGHT))
+    rest = sorted((variant for variant in variants if variant is not startup), key=lambda variant: -variant['bandwidth'])
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for variant in [startup] + rest:
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={variant["bandwidth"]},'
+                     f'AVERAGE-BANDWIDTH={variant["averageBandwidth"]},'
+                     f'RESOLUTION={variant["width"]}x{variant["height"]},CODECS="{codecs}"')
+        lines.append(url_for(variant['playlist']))
+    return '\n'.join(lines) + '\n'
+
+
+def absolute_playlist(text: str, prefix: str, url_for: Callable[[str], str]) -> str:
+    """Point a media playlist's segment lines at their storage URLs.
+
+    Firebase Storage URLs carry the whole object path in one encoded
+    segment, so relative URIs in a playlist would not resolve.
+    """
+    return re.sub(r'^(?!#)(\S+)$', lambda line: url_for(prefix + line.group(1)), text, flags=re.MULTILINE)
+
+
+def hls_prefix(video_path: str, generation: Optional[str] = None) -> str:
+    """Storage prefix of a video's renditions: its path under hls/, without
+    the extension, and then the generation of the upload they were encoded from"""
+    prefix = HLS_PREFIX + os.path.splitext(video_path.split('/', 1)[-1])[0] + '/'
+    return prefix + f'{generation}/' if generation is not None else prefix
+
+
+def remove_earlier_generations(bucket, video_path: str, generation: str) -> int:
+    """Delete the renditions of uploads older than this generation. Newer
+    ones are kept, in case their encoding finished first. Returns the
+    number of files deleted."""
+    prefix = hls_prefix(video_path)
+    deleted = 0
+    for blob in bucket.list_blobs(prefix=prefix):
+        encoded_from, _, name = blob.name[len(prefix):].partition('/')
+        # Renditions from before they were kept per generation have no generation directory
+        if not name or not encoded_from.isdigit() or int(encoded_from) < int(generation):
+            blob.delete()
+            deleted += 1
+    return deleted
+
+
+def download_url(bucket_name: str, name: str) -> str:
+    return DOWNLOAD_URL.format(bucket=bucket_name, name=quote(name, safe=''))
+
+
+def _upload(bucket, path: str, name: str, data: Optional[str] = None):
+    extension = os.path.splitext(name)[1]
+    blob = bucket.blob(name)
+    blob.cache_control = PLAYLIST_CACHE_CONTROL if extension == '.m3u8' else SEGMENT_CACHE_CONTROL
+    content_type = CONTENT_TYPES.get(extension, 'application/octet-stream')
+    if data is not None:
+        blob.upload_from_string(data, content_type=content_type)
+    else:
+        blob.upload_from_filename(path, content_type=content_type)
+    return name
+
+
+def transcode(bucket, source: str, video_path: str, generation: str) -> Dict[str, Any]:
+    """Encode the HLS ladder and fallback MP4 for a generation of a video and upload them.
+
+    Each rendition is uploaded, and its local files removed, as soon as it
+    finishes, so the working directory never holds the whole ladder.
+    Returns the record to store for the video.
+    """
+    info = probe(source)
+    ladder = select_ladder(info)
+    prefix = hls_prefix(video_path, generation)
+    url_for = lambda name: download_url(bucket.name, name)
+    threads = max(1, (os.cpu_count() or 1) // (len(ladder) + 1))
+    variants = []
+
+    with tempfile.TemporaryDirectory(prefix='tiptok-hls-') as workdir, \
+            ThreadPoolExecutor(max_workers=len(ladder) + 1, thread_name_prefix='encode') as encoders, \
+            ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload') as uploads:
+        jobs = {
+            encoders.submit(encode_rendition, source, info, rendition, os.path.join(workdir, rendition.name),
+                            threads): rendition
+            for rendition in ladder
+        }
+        fallback_path = os.path.join(workdir, FALLBACK_NAME)
+        fallback = encoders.submit(encode_fallback, source, info, fallback_path, threads)
+
+        for job in as_completed(jobs):
+            job.result()
+            rendition = jobs[job]
+            directory = os.path.join(workdir, rendition.name)
+            rendition_prefix = f'{prefix}{rendition.name}/'
+            segments = [name for name in sorted(os.listdir(directory)) if name != MEDIA_PLAYLIST]
+            for future in [uploads.submit(_upload, bucket, os.path.join(directory, name), rendition_prefix + name)
+                           for name in segments]:
+                future.result()
+            peak, average = segment_bandwidth(directory)
+            with open(os.path.join(directory, MEDIA_PLAYLIST)) as f:
+                playlist = absolute_playlist(f.read(), rendition_prefix, url_for)
+            # The playlist goes up last so it never lists a missing segment
+            _upload(bucket, '', rendition_prefix + MEDIA_PLAYLIST, playlist)
+            shutil.rmtree(directory)
+            width, height = scaled_size(info, rendition.height)
+            audio_bits = rendition.audio_kbps * 1000 if info.has_audio else 0
+            variants.append({
+                'name': rendition.name,
+                'width': width,
+                'height': height,
+                'bandwidth': peak or rendition.video_kbps * 1000 + audio_bits,
+                'averageBandwidth': average or rendition.video_kbps * 1000 + audio_bits,
+                'playlist': rendition_prefix + MEDIA_PLAYLIST,
+            })
+
+        fallback.result()
+        _upload(bucket, fallback_path, prefix + FALLBACK_NAME)
+
+    manifest_path = prefix + MASTER_PLAYLIST
+    _upload(bucket, '', manifest_path, master_playlist(variants, info.has_audio, url_for))
+    remove_earlier_generations(bucket, video_path, generation)
+
+    return {
+        'manifestPath': manifest_path,
+        'manifestUrl': url_for(manifest_path),
+        'fallbackPath': prefix + FALLBACK_NAME,
+        'fallbackUrl': url_for(prefix + FALLBACK_NAME),
+        'renditions': [{key: variant[key] for key in ('name', 'width', 'height', 'bandwidth')}
+                       for variant in sorted(variants, key=lambda variant: -variant['bandwidth'])],
+        'duration': info.duration,
+    }
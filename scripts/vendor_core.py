@@ -0,0 +1,22 @@
+"""Copy the shared tiptok_core package into the functions directory.
+
+Run by firebase.json's predeploy step, since the functions directory is
+uploaded on its own and cannot import from api/. Run it by hand before
+starting the emulator or functions/test_local.py.
+"""
+import os
+import shutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, 'api', 'tiptok_core')
+TARGET = os.path.join(ROOT, 'functions', 'tiptok_core')
+
+
+def main():
+    shutil.rmtree(TARGET, ignore_errors=True)
+    shutil.copytree(SOURCE, TARGET, ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+    print(f"Copied {SOURCE} to {TARGET}")
+
+
+if __name__ == '__main__':
+    main()